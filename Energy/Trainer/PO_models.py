@@ -5,14 +5,15 @@ from torch.autograd import Variable
 import torch.nn.functional as F
 import pytorch_lightning as pl
 import numpy as np
+from functools import partial
 
-from Trainer.comb_solver import SolveICON,  MakeLpMat
-from Trainer.utils import regret_aslist, regret_fn, abs_regret_fn, growpool_fn, batch_solve
+from Trainer.comb_solver import SolveICON,  MakeLpMat, make_solver
+from Trainer.utils import regret_aslist, regret_fn, abs_regret_fn, growpool_fn, batch_solve, memo_solver, SolutionPool, AsyncGrowth, SolverPool, SolvePipeline
 
 
 
 class twostage_regression(pl.LightningModule):
-    def __init__(self,param, lr=1e-1, max_epochs=30, seed=0, scheduler=False, relax=False, **kwd):
+    def __init__(self,param, lr=1e-1, max_epochs=30, seed=0, scheduler=False, relax=False, solver_workers=0, memo=False, pipelined=False, **kwd):
         """
         A class to implement two stage mse based model and with test and validation module
         Args:
@@ -21,6 +22,9 @@ class twostage_regression(pl.LightningModule):
             lr: learning rate
             max_epochs: maximum number of epcohs
             seed: seed for reproducibility 
+            solver_workers: if more than 1, the batches are solved by that many worker processes (see SolverPool)
+            memo: if True, calls on bit-identical costs, e.g. SPO and the validation regret on the same predictions, are served from a memo (see memo_solver)
+            pipelined: if True, the regrets of the validation and test batches are solved in the background (see SolvePipeline)
         """
         super().__init__()
         pl.seed_everything(seed)
@@ -29,13 +33,19 @@ class twostage_regression(pl.LightningModule):
         self.lr = lr
         self.max_epochs= max_epochs
         self.scheduler = scheduler
-        self.solver = SolveICON(relax=relax, **param)
-        self.solver.make_model()
+        if solver_workers > 1:
+            self.solver = SolverPool(partial(make_solver, relax=relax, **param), solver_workers)
+        else:
+            self.solver = SolveICON(relax=relax, **param)
+            self.solver.make_model()
+        if memo:
+            self.solver = memo_solver(self.solver)
+        self.pipeline = SolvePipeline() if pipelined else None
 
     def forward(self,x):
         return self.net(x) 
     def training_step(self, batch, batch_idx):
-        x,y,sol = batch
+        x,y,sol,_ = batch
         y_hat =  self(x).squeeze()
         criterion = nn.MSELoss(reduction='mean')
         loss = criterion(y_hat,y)
@@ -48,15 +58,43 @@ class twostage_regression(pl.LightningModule):
         '''
         solver = self.solver
         
-        x,y,sol = batch
+        x,y,sol,_ = batch
         y_hat =  self(x).squeeze()
         regret_tensor = regret_aslist(solver,y_hat,y,sol)
         return regret_tensor
 
+    def regrets(self, stage, y_hat, y, sol):
+        '''
+        The metrics of a batch which need the solver
+        '''
+        return {"{}_regret".format(stage): regret_fn(self.solver, y_hat,y, sol),
+            "{}_abs_regret".format(stage): abs_regret_fn(self.solver, y_hat,y, sol)}
+    def pipelined_step(self, stage, y_hat, y, sol):
+        '''
+        The validation and test steps of the pipelined mode: the regrets are solved in the background
+        and logged at the end of the epoch, so they have no per-step values
+        '''
+        criterion = nn.MSELoss(reduction='mean')
+        mseloss = criterion(y_hat, y)
+        self.pipeline.submit(self.regrets, stage, y_hat.detach(), y, sol, batch_size=len(y))
+        self.log("{}_mse".format(stage), mseloss, prog_bar=True, on_step=stage=="test", on_epoch=True, )
+        return {"{}_mse".format(stage): mseloss}
+    def on_validation_epoch_end(self):
+        if self.pipeline is not None:
+            for k,v in self.pipeline.means(self.pipeline.wait()).items():
+                ### the synchronous steps log these per step too, so their epoch means are named <name>_epoch
+                if k in ("val_abs_regret", "test_regret", "test_abs_regret"):
+                    k = "{}_epoch".format(k)
+                self.log(k, v, prog_bar=True)
+    def on_test_epoch_end(self):
+        self.on_validation_epoch_end()
+
     def validation_step(self, batch, batch_idx):
         criterion = nn.MSELoss(reduction='mean')
-        x,y,sol = batch
+        x,y,sol,_ = batch
         y_hat =  self(x).squeeze()
+        if self.pipeline is not None:
+            return self.pipelined_step("val", y_hat, y, sol)
         val_loss= regret_fn(self.solver, y_hat,y, sol)
         abs_val_loss= abs_regret_fn(self.solver, y_hat,y, sol)
         mseloss = criterion(y_hat, y)
@@ -68,8 +106,10 @@ class twostage_regression(pl.LightningModule):
 
     def test_step(self, batch, batch_idx):
         criterion = nn.MSELoss(reduction='mean')
-        x,y,sol = batch
+        x,y,sol,_ = batch
         y_hat =  self(x).squeeze()
+        if self.pipeline is not None:
+            return self.pipelined_step("test", y_hat, y, sol)
         val_loss= regret_fn(self.solver, y_hat,y, sol)
         abs_val_loss= abs_regret_fn(self.solver, y_hat,y, sol)
         mseloss = criterion(y_hat, y)
@@ -98,10 +138,10 @@ class twostage_regression(pl.LightningModule):
 from Trainer.diff_layer import SPOlayer, DBBlayer
 class SPO(twostage_regression):
     def __init__(self,param, lr=1e-1, max_epochs=30, seed=20, scheduler=False, relax=False, **kwd):
-        super().__init__(param, lr, max_epochs, seed, scheduler, relax)
+        super().__init__(param, lr, max_epochs, seed, scheduler, relax, **kwd)
         self.layer  = SPOlayer(self.solver)
     def training_step(self, batch, batch_idx):
-        x,y,sol = batch
+        x,y,sol,_ = batch
         y_hat =  self(x).squeeze()
         loss = self.layer(y_hat, y, sol)
         self.log("train_loss",loss, prog_bar=True, on_step=True, on_epoch=True, )
@@ -109,10 +149,10 @@ class SPO(twostage_regression):
 
 class DBB(twostage_regression):
     def __init__(self,param,lambda_val=1., lr=1e-1, max_epochs=30, seed=20, scheduler=False, relax=False, **kwd):
-        super().__init__(param, lr, max_epochs, seed, scheduler, relax)
+        super().__init__(param, lr, max_epochs, seed, scheduler, relax, **kwd)
         self.layer  = DBBlayer(self.solver, lambda_val= lambda_val)
     def training_step(self, batch, batch_idx):
-        x,y,sol = batch
+        x,y,sol,_ = batch
         y_hat =  self(x).squeeze()
         sol_hat = self.layer(y_hat, y, sol)
         loss = ((sol_hat - sol)*y).sum(-1).mean() ## to minimze regret
@@ -137,7 +177,7 @@ class IMLE(twostage_regression):
         target_noise_temperature= temperature,nb_samples=nb_samples)
 
     def training_step(self, batch, batch_idx):
-        x,y,sol = batch
+        x,y,sol,_ = batch
         y_hat =  self(x).squeeze()
         sol_hat = self.layer(-y_hat)
         loss = ((sol_hat - sol)*y).sum(-1).mean()
@@ -154,7 +194,7 @@ class FenchelYoung(twostage_regression):
         self.criterion = fy.FenchelYoungLoss( fy_solver, num_samples= num_samples, sigma= sigma, maximize = False,
          batched=True)
     def training_step(self, batch, batch_idx):
-        x,y,sol = batch
+        x,y,sol,_ = batch
         criterion  = self.criterion
         y_hat =  self(x).squeeze()
         loss = criterion(y_hat, sol).mean()
@@ -165,11 +205,11 @@ class FenchelYoung(twostage_regression):
 from intopt.intopt import intopt
 class IntOpt(twostage_regression):
     def __init__(self,param, lr=1e-1, max_epochs=30, seed=20, scheduler=False, relax=False,
-        thr= 1e-8, damping= 1e-5, diffKKT = False, dopresolve = True, **kwd):
-        super().__init__(param, lr, max_epochs, seed, scheduler, relax)
+        thr= 1e-8, damping= 1e-5, diffKKT = False, dopresolve = True, warmstart = False, intopt_cache_dir = None, **kwd):
+        super().__init__(param, lr, max_epochs, seed, scheduler, relax, **kwd)
         self.thr, self.damping, self.diffKKT, self.dopresolve = thr, damping, diffKKT, dopresolve
         A,b,G,h,T = MakeLpMat(**param)
-        self.diff_layer = intopt(A ,b ,G ,h , thr, damping, diffKKT, dopresolve)
+        self.diff_layer = intopt(A ,b ,G ,h , thr, damping, diffKKT, dopresolve, warmstart = warmstart, cache_dir = intopt_cache_dir)
         self.A_trch = A.float()
         self.b_trch = b.float()
         self.G_trch = G.float()
@@ -177,25 +217,33 @@ class IntOpt(twostage_regression):
         self.T_trch = T.float()
 
     def training_step(self, batch, batch_idx):
-        x,y,sol = batch
+        x,y,sol,index = batch
         y_hat =  self(x)
 
         c_hat = torch.matmul(self.T_trch, y_hat).squeeze()
         c_true = torch.matmul(self.T_trch, y.unsqueeze(2)).squeeze()
-        sol_hat = self.diff_layer(c_hat)
+        sol_hat = self.diff_layer(c_hat, index.tolist())
         loss = (sol_hat * c_true).sum()
         self.log("train_loss",loss, prog_bar=True, on_step=True, on_epoch=True, )
         return loss
+    def on_train_epoch_end(self):
+        warmstart = self.diff_layer.warmstart
+        if warmstart is not None:
+            for k,v in warmstart.summary().items():
+                if not np.isnan(v):
+                    self.log("train_{}".format(k), v)
+            warmstart.reset_counts()
 
 import cvxpy as cp
 import cvxpylayers
 from cvxpylayers.torch import CvxpyLayer
+from Trainer.utils import get_cvxpylayer
 class DCOL(twostage_regression):
     '''
     Implementation oF QPTL using cvxpyayers
     '''
     def __init__(self,param, lr=1e-1, max_epochs=30, seed=20, scheduler=False, relax=False, mu=0.1,regularizer='quadratic', **kwd):
-        super().__init__(param, lr, max_epochs, seed, scheduler, relax)
+        super().__init__(param, lr, max_epochs, seed, scheduler, relax, **kwd)
         A,b,G,h,T = MakeLpMat(**param)
         # self.A_trch = A.float()
         # self.b_trch = b.float()
@@ -203,21 +251,23 @@ class DCOL(twostage_regression):
         # self.h_trch = h.float()
         self.T_trch = T.float()
         n = A.shape[1]
-        c = cp.Parameter(n)
-        x = cp.Variable(n)
-        constraints = [x >= 0,A @ x == b,G @ x <= h ]        
-        
-        if regularizer=='quadratic':
-            objective = cp.Minimize(c @ x+ mu*cp.pnorm(x, p=2))  
-        elif regularizer=='entropic':
-            objective = cp.Minimize(c @ x -  mu*cp.sum(cp.entr(x)) )
-        problem = cp.Problem(objective, constraints)
-        self.diff_layer = CvxpyLayer(problem, parameters=[c], variables=[x])
+        def make_problem():
+            c = cp.Parameter(n)
+            x = cp.Variable(n)
+            constraints = [x >= 0,A @ x == b,G @ x <= h ]        
+            
+            if regularizer=='quadratic':
+                objective = cp.Minimize(c @ x+ mu*cp.pnorm(x, p=2))  
+            elif regularizer=='entropic':
+                objective = cp.Minimize(c @ x -  mu*cp.sum(cp.entr(x)) )
+            problem = cp.Problem(objective, constraints)
+            return problem, [c], [x]
+        self.diff_layer = get_cvxpylayer(make_problem, ("energy", A, b, G, h, mu, regularizer))
 
 
 
     def training_step(self, batch, batch_idx):
-        x,y,sol = batch
+        x,y,sol,_ = batch
         y_hat =  self(x)
 
         c_hat = torch.matmul(self.T_trch, y_hat).squeeze()
@@ -232,11 +282,18 @@ class DCOL(twostage_regression):
 from Trainer.CacheLosses import *
 class CachingPO(twostage_regression):
     def __init__(self,loss,param,init_cache, growth =0.1, lr=1e-1,tau=0.,
-        max_epochs=30, seed=20, scheduler=False, relax=False, **kwd):
+        max_epochs=30, seed=20, scheduler=False, relax=False, pool_size=None, eviction="lru",
+        growth_mode="sync", growth_workers=1, max_pending=2, deterministic_growth=False, **kwd):
         '''
         tau: the margin parameter for pairwise ranking / temperatrure for listwise ranking
+        pool_size: maximum number of solutions in the cache, None for no limit
+        eviction: which solution leaves a full cache, "lru" or "violation" (see SolutionPool)
+        growth_mode: "sync", or grow the cache in the background with "thread" or "process" workers (see AsyncGrowth)
+        growth_workers, max_pending, deterministic_growth: the workers, the bound of the batches being solved and
+            whether to merge them in a deterministic order, for the background growth;
+            the worker threads share the solver, so they solve one batch at a time
         '''
-        super().__init__(param, lr, max_epochs, seed, scheduler, relax)
+        super().__init__(param, lr, max_epochs, seed, scheduler, relax, **kwd)
         if loss=="pointwise":
             self.loss_fn = PointwiseLoss()
         elif loss=="pairwise":
@@ -259,39 +316,64 @@ class CachingPO(twostage_regression):
             raise Exception("Invalid Loss Provided")
 
         self.growth = growth
-        cache_np = init_cache.detach().numpy()
-        cache_np = np.unique(cache_np,axis=0)
-        # torch has no unique function, so we have to do this
-        init_cache =  torch.from_numpy(cache_np).float()
-        self.cache = init_cache
+        ### the cache, deduplicated by the pool; self.cache is its torch view
+        self.pool = SolutionPool(init_cache, max_size=pool_size, eviction=eviction, minimize=True)
+        self.cache = self.pool.view()
+        ### the background growth of the pool, None for the synchronous one
+        self.grower = None if growth_mode == "sync" else AsyncGrowth(self.pool, partial(batch_solve, self.solver), growth_mode,
+            growth_workers, max_pending, deterministic_growth)
     
  
     def training_step(self, batch, batch_idx):
-        x,y,sol = batch
+        x,y,sol,_ = batch
         y_hat =  self(x).squeeze()
+        self.pool.touch(y_hat)
+        if self.grower is not None:
+            self.cache = self.grower.merge()
         if (np.random.random(1)[0]< self.growth) or len(self.cache)==0:
-            self.cache = growpool_fn(self.solver, self.cache, y_hat)
+            if self.grower is not None and len(self.cache) > 0:
+                self.grower.submit(y_hat.detach().numpy())
+            else:
+                self.cache = growpool_fn(self.solver, self.pool, y_hat)
 
         loss = self.loss_fn(y_hat,y,sol,self.cache)
         self.log("train_loss",loss, prog_bar=True, on_step=True, on_epoch=True, )
         return loss
 
+    def on_validation_epoch_start(self):
+        ### the validation shares the solver with the growth workers, so they finish first
+        if self.grower is not None:
+            self.cache = self.grower.merge(wait=True)
+
+    def on_test_epoch_start(self):
+        self.on_validation_epoch_start()
+
+    def on_train_end(self):
+        if self.grower is not None:
+            self.grower.close()
+
 class CombinedPO(CachingPO):
     def __init__(self,alpha, loss,param,init_cache, growth =0.1, lr=1e-1,tau=0.,
-        max_epochs=30, seed=20, scheduler=False, relax=False, **kwd):
+        max_epochs=30, seed=20, scheduler=False, relax=False, pool_size=None, eviction="lru", **kwd):
         '''
         tau: the margin parameter for pairwise ranking / temperatrure for listwise ranking
         '''
-        super().__init__(loss,param,init_cache, growth , lr,tau, max_epochs, seed, scheduler, relax)
+        super().__init__(loss,param,init_cache, growth , lr,tau, max_epochs, seed, scheduler, relax, pool_size, eviction, **kwd)
         self.alpha = alpha
         self.save_hyperparameters("lr","growth","tau","alpha")
     
  
     def training_step(self, batch, batch_idx):
-        x,y,sol = batch
+        x,y,sol,_ = batch
         y_hat =  self(x).squeeze()
+        self.pool.touch(y_hat)
+        if self.grower is not None:
+            self.cache = self.grower.merge()
         if (np.random.random(1)[0]< self.growth) or len(self.cache)==0:
-            self.cache = growpool_fn(self.cache, y_hat, self.param)
+            if self.grower is not None and len(self.cache) > 0:
+                self.grower.submit(y_hat.detach().numpy())
+            else:
+                self.cache = growpool_fn(self.solver, self.pool, y_hat)
         criterion = nn.MSELoss(reduction='mean')
         loss = self.alpha* self.loss_fn(y_hat,y,sol,self.cache,tau=self.tau) + (1 - self.alpha)*criterion(y_hat,y)
         self.log("train_loss",loss, prog_bar=True, on_step=True, on_epoch=True, )
@@ -367,3 +367,12 @@ class SolveICON:
         self.model.reset(0)
 
         return solver
+
+
+def make_solver(relax=False, **param):
+    '''
+    SolveICON with its model made, e.g. the factory of the solvers of a Trainer.utils.SolverPool
+    '''
+    solver = SolveICON(relax=relax, **param)
+    solver.make_model()
+    return solver
@@ -22,39 +22,60 @@ class EnergyDatasetWrapper():
         return len(self.y)
     
     def __getitem__(self, idx):
-        return self.X[idx],self.y[idx],self.sol[idx]
+        ### the index of the instance in the dataset keys the state the models keep per instance, e.g. the warm start of IntOpt
+        return self.X[idx],self.y[idx],self.sol[idx], idx
 
 
-class EnergyDataModule(pl.LightningDataModule):
-    def __init__(self,param, standardize=True, batch_size= 16, generator=None,num_workers=4, seed=0, relax=False):
-        super().__init__()
+def load_energy_data(standardize=True):
+    '''
+    Features [n, 48, n_features] and prices [n, 48] of all the instances, the train ones then the test ones
+    '''
+    x_train, y_train, x_test, y_test = get_energy(fname= 'Trainer/prices2013.dat')
+
 
-        x_train, y_train, x_test, y_test = get_energy(fname= 'Trainer/prices2013.dat')
+    x_train = x_train[:,1:]
+    x_test = x_test[:,1:]
+    if standardize:
+        scaler = StandardScaler()
+        x_train = scaler.fit_transform(x_train)
+        x_test = scaler.transform(x_test)
+    x_train = x_train.reshape(-1,48,x_train.shape[1])
+    y_train = y_train.reshape(-1,48)
+    x_test = x_test.reshape(-1,48,x_test.shape[1])
+    y_test = y_test.reshape(-1,48)
+    x = np.concatenate((x_train, x_test), axis=0)
+    y = np.concatenate((y_train,y_test), axis=0)
+    return x, y
 
+def energy_solutions(param, relax=False):
+    '''
+    Schedules of all the instances, in the order of load_energy_data. They do not depend on the seed,
+    so the runs of several seeds can solve them once and pass them to EnergyDataModule.
+    '''
+    x, y = load_energy_data(standardize=False)
+    solver = SolveICON(relax=relax, **param)
+    solver.make_model()
+    return EnergyDatasetWrapper(x, y, solver=solver).sol
 
-        x_train = x_train[:,1:]
-        x_test = x_test[:,1:]
-        if standardize:
-            scaler = StandardScaler()
-            x_train = scaler.fit_transform(x_train)
-            x_test = scaler.transform(x_test)
-        x_train = x_train.reshape(-1,48,x_train.shape[1])
-        y_train = y_train.reshape(-1,48)
-        x_test = x_test.reshape(-1,48,x_test.shape[1])
-        y_test = y_test.reshape(-1,48)
-        x = np.concatenate((x_train, x_test), axis=0)
-        y = np.concatenate((y_train,y_test), axis=0)
-        x,y = sklearn.utils.shuffle(x,y,random_state=seed)
-        x_train, y_train = x[:550], y[:550]
-        x_valid, y_valid = x[550:650], y[550:650]
-        x_test, y_test = x[650:], y[650:]
+class EnergyDataModule(pl.LightningDataModule):
+    def __init__(self,param, standardize=True, batch_size= 16, generator=None,num_workers=4, seed=0, relax=False, solutions=None):
+        '''
+        solutions: schedules of all the instances from energy_solutions, solved here if None
+        '''
+        super().__init__()
 
-        solver = SolveICON(relax=relax, **param)
-        solver.make_model()
+        x, y = load_energy_data(standardize)
+        if solutions is None:
+            solutions = energy_solutions(param, relax)
+        ### the same permutation as the one of x and y alone
+        x,y,solutions = sklearn.utils.shuffle(x,y,solutions,random_state=seed)
+        x_train, y_train, sol_train = x[:550], y[:550], solutions[:550]
+        x_valid, y_valid, sol_valid = x[550:650], y[550:650], solutions[550:650]
+        x_test, y_test, sol_test = x[650:], y[650:], solutions[650:]
 
-        self.train_df = EnergyDatasetWrapper( x_train,y_train,solver=solver)
-        self.valid_df  = EnergyDatasetWrapper( x_valid, y_valid,solver=solver )
-        self.test_df = EnergyDatasetWrapper( x_test, y_test,solver=solver )
+        self.train_df = EnergyDatasetWrapper( x_train,y_train,sol=sol_train)
+        self.valid_df  = EnergyDatasetWrapper( x_valid, y_valid,sol=sol_valid )
+        self.test_df = EnergyDatasetWrapper( x_test, y_test,sol=sol_test )
         self.train_solutions= self.train_df.sol
 
         self.batch_size = batch_size
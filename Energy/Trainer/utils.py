@@ -1,5 +1,12 @@
 import torch
 import numpy as np
+import os, sys
+### the helpers shared by all the problems are in common_utils, at the root of the repository
+_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+if _root not in sys.path:
+    sys.path.append(_root)
+from common_utils import (SolutionPool, AsyncGrowth, SolvePipeline, run_seeds, shared, sweep_callbacks, append_csv,
+    get_cvxpylayer, set_cvxpylayer_cache, SolverPool)
 
 
 
@@ -7,6 +14,9 @@ def batch_solve(solver,y):
     '''
     wrapper around te solver to return solution of a vector of cost coefficients
     '''
+    if hasattr(solver, "batched_solve"):
+        y = y.detach().numpy() if isinstance(y, torch.Tensor) else np.asarray(y)
+        return torch.from_numpy( np.asarray(solver.batched_solve(y)) ).float()
     sol = []
     for i in range(len(y)):
         sol.append( solver.solve(y[i]))
@@ -48,11 +58,24 @@ def abs_regret_fn(solver, y_hat,y_true, sol_true, minimize=True):
 
 def growpool_fn(solver,cache, y_hat):
     '''
-    cache is torch array [currentpoolsize,48]
+    cache is a SolutionPool of solutions [currentpoolsize,48]
     y_hat is  torch array [batch_size,48]
+    returns the grown cache as torch array
     '''
-    sol = batch_solve(solver,y_hat)
-    cache_np = cache.detach().numpy()
-    cache_np = np.unique(np.append(cache_np,sol,axis=0),axis=0)
-    # torch has no unique function, so we have to do this
-    return torch.from_numpy(cache_np).float()
\ No newline at end of file
+    sol = batch_solve(solver,y_hat.detach().numpy())
+    cache.add(sol)
+    return cache.view()
+
+
+########################## Memoized exact solver ##########################
+from common_utils.memo import memo_solver as common_memo_solver
+
+class memo_solver(common_memo_solver):
+    '''
+    common_utils.memo.memo_solver, whose solve takes the time limit of the ICON solvers
+    '''
+    def solve(self, price, timelimit=None):
+        ### with a time limit the solution need not be optimal, so it is not memoized
+        if timelimit:
+            return self.solver.solve(price, timelimit)
+        return super().solve(price)
@@ -16,8 +16,8 @@ from scipy.optimize import OptimizeWarning
 np.set_printoptions(threshold=np.inf)
 from intopt.presolve import presolve
 
-from intopt.util import convert_to_np, standardizeLP
-from intopt.solveLP import solveLP
+from intopt.util import convert_to_np, standardizeLP, get_standardform
+from intopt.solveLP import solveLP, solveLP_batched, sparse_normal_equations, _get_normal_solver, _matvec, _rmatvec, _get_warm_start
 ############################ Code Adapted from https://github.com/scipy/scipy/blob/5dcc0f66fe6af9d954d1a7e3c0f451736fa7500a/scipy/optimize/_linprog_ip.py ####
 
 
@@ -29,7 +29,18 @@ References
        homogeneous algorithm." High performance optimization. Springer US,
        2000. 197-232.
 """
-def intopt_nonbacthed(A_trch =None,b_trch =None,G_trch =None,h_trch =None, thr= 1e-8, damping= 1e-5, diffKKT = False, dopresolve=True):
+def _damped_solve(A, Dinv, damping, r, factor=None):
+    '''
+    Solve (A X^{2} A.T + damping I) t = r, using the Cholesky factor kept from
+    the forward pass if there is one
+    '''
+    if factor is not None:
+        return sp.linalg.cho_solve(factor, r)
+    M = A.dot(Dinv.reshape(-1, 1) * A.T)
+    np.fill_diagonal(M, M.diagonal() + damping)
+    return sp.linalg.solve( M ,r ,assume_a='pos')
+
+def intopt_nonbacthed(A_trch =None,b_trch =None,G_trch =None,h_trch =None, thr= 1e-8, damping= 1e-5, diffKKT = False, dopresolve=True, cache_dir=None, rr_method=None):
     '''
 
     A : 2D tensor, optional
@@ -48,6 +59,11 @@ def intopt_nonbacthed(A_trch =None,b_trch =None,G_trch =None,h_trch =None, thr=
             if True, differentiate the KKT conditions, else the HSD embedding
     dopresolve: boolean
                 if not True no presolving before solving the LP
+    cache_dir: directory, optional
+                if given, the presolved standard form is cached there, see get_standardform
+    rr_method: string, optional
+                the method removing the redundant equality rows, see presolve; "pivot_sparse" gives
+                dense constraints the standard form of the sparse ones
 
     The feasible region is defined by
             G @ x <= h
@@ -59,13 +75,9 @@ def intopt_nonbacthed(A_trch =None,b_trch =None,G_trch =None,h_trch =None, thr=
     
     # if no solution under timelimit or max-iter don't do gradient update
     A,b,G, h = convert_to_np(A_trch, b_trch, G_trch, h_trch)
-    if dopresolve:
-
-        presolver = presolve (G,h, A,b)
-        (G,h, A,b) = presolver.transform ()
-   
-    standardizer = standardizeLP (G,h, A,b)
-    A_,b_ = standardizer.getAb()
+    standardizer, A_,b_ = get_standardform(A,b,G,h, dopresolve, cache_dir, rr_method)
+    if standardizer.sparse:
+        raise Exception("Sparse constraint matrices are only supported by the batched intopt")
     
 
     class WrappedFunc_cls(Function):        
@@ -83,7 +95,12 @@ def intopt_nonbacthed(A_trch =None,b_trch =None,G_trch =None,h_trch =None, thr=
             c_ = standardizer.transformC(c) 
             with warnings.catch_warnings():
                 warnings.simplefilter("ignore")
-                x, y, z, tau, kappa, mu = solveLP(c_ ,A_,b_, thr )
+                if ctx.needs_input_grad[0]:
+                    ### keep the factorization at the final iterate for the backward pass
+                    x, y, z, tau, kappa, mu, factor = solveLP(c_ ,A_,b_, thr, return_factor=True, damping=damping )
+                else:
+                    x, y, z, tau, kappa, mu = solveLP(c_ ,A_,b_, thr )
+                    factor = None
             
             x_solve = torch.from_numpy( standardizer.transformsolution (x/tau)).float()
 
@@ -95,6 +112,7 @@ def intopt_nonbacthed(A_trch =None,b_trch =None,G_trch =None,h_trch =None, thr=
             ctx.z = z
             ctx.tau = tau
             ctx.kappa = kappa
+            ctx.factor = factor
 
 
             end = time.time()
@@ -149,12 +167,11 @@ def intopt_nonbacthed(A_trch =None,b_trch =None,G_trch =None,h_trch =None, thr=
                 mu = (x.dot(z)) / n
                 Dinv = x / z
                 
-                M = A_ .dot(Dinv.reshape(-1, 1) * A_ .T) #### we don't divide by mu because it would cancel out  
-                np.fill_diagonal(M, M.diagonal() + damping)  
+                #### M = A X^{2} A.T + damping I, we don't divide by mu because it would cancel out
 
 
                 r = A_ *Dinv
-                dely = sp.linalg.solve( M ,r ,assume_a='pos')
+                dely = _damped_solve(A_, Dinv, damping, r, ctx.factor)
                 delx = (np.matmul((Dinv.reshape(-1, 1)*A_ .T ), dely ) -  np.diag(Dinv))
                 delx_torch = torch.from_numpy( standardizer.transformsgradient (delx)).float()
             
@@ -172,17 +189,15 @@ def intopt_nonbacthed(A_trch =None,b_trch =None,G_trch =None,h_trch =None, thr=
                 mu = (x.dot(z) + tau*kappa) / (n + 1)
                 Dinv = x / z
                 
-                M = A_.dot(Dinv.reshape(-1, 1) * A_ .T) #### we don't divide by mu because it would cancel out    
-                np.fill_diagonal(M, M.diagonal() + damping) 
+                #### M = A X^{2} A.T + damping I, we don't divide by mu because it would cancel out
                       
-                ##########   Solve :  M t1 = b +  A X^2 c /mu
+                ##########   Solve :  M t1 = b +  A X^2 c /mu and M t2 =   A X^2 tau /mu together
                 r1 =  b_  +  A_ .dot(Dinv*c_ )
-                t1 = sp.linalg.solve( M ,r1 ,assume_a='pos')
+                r2 = tau*A_ *Dinv
+                t = _damped_solve(A_, Dinv, damping, np.column_stack((r1, r2)), ctx.factor)
+                t1, t2 = t[:, 0], t[:, 1:]
                 #### w1  = X^2 (A.T @ t1 - c)\mu 
                 w1  = (A_.T.dot(t1) - c_ )*Dinv
-                ##########   Solve :  M t2 =   A X^2 tau /mu
-                r2 = tau*A_ *Dinv
-                t2 = sp.linalg.solve( M ,r2 ,assume_a='pos')
                 #### w2  = (X^2 @ A.T @ t2 - tau X^2 ) /mu 
                 w2 = (np.matmul((Dinv.reshape(-1, 1)*A_ .T ),t2) - tau* np.diag(Dinv))
                 ###### deltau = x + w2.T @ c - t2 .T @ b / (-c.dot(w1)+ b.dot(t1) + kappa/tau)
@@ -202,21 +217,225 @@ def intopt_nonbacthed(A_trch =None,b_trch =None,G_trch =None,h_trch =None, thr=
     return WrappedFunc_cls.apply
     
 
+class warmstart_store:
+    '''
+    Keeps the last primal-dual iterate (x, y, z, tau, kappa) of every instance,
+    keyed by its dataset index, so that intopt_batched can start the next solve
+    of the same instance, e.g. in the next epoch, from a centred version of it.
+    mu : centring parameter of _get_warm_start; the iterate is centred at max(mu, 10*thr)
+    blend : fraction by which the stored iterate is moved towards the blind start
+    Warm starts pay off for small thr; with a large thr the solver stops early in
+    the interior and the returned point depends on where it started.
+    '''
+    def __init__(self, mu=1e-2, blend=0.1):
+        self.mu, self.blend = mu, blend
+        self.iterates = {}
+        self.reset_counts()
+    def reset_counts(self):
+        self.solves = {"cold": 0, "warm": 0}
+        self.iterations = {"cold": 0, "warm": 0}
+    def get_start(self, index, n_x, m, thr):
+        '''
+        Starting point for the instances index (list of hashable keys) and the
+        boolean mask of those that are warm started
+        '''
+        batch_size = len(index)
+        x, z = np.ones((batch_size, n_x)), np.ones((batch_size, n_x))
+        y = np.zeros((batch_size, m))
+        tau, kappa = np.ones(batch_size), np.ones(batch_size)
+        warm = np.array([i in self.iterates for i in index], dtype=bool)
+        if warm.any():
+            rows = np.flatnonzero(warm)
+            stored = [np.stack([self.iterates[index[i]][k] for i in rows]) for k in range(5)]
+            x[rows], y[rows], z[rows], tau[rows], kappa[rows] = _get_warm_start(*stored,
+                mu = max(self.mu, 10*thr), blend = self.blend)
+        return (x, y, z, tau, kappa), warm
+    def update(self, index, warm, x, y, z, tau, kappa, iterations):
+        for i, key in enumerate(index):
+            self.iterates[key] = (x[i], y[i], z[i], tau[i], kappa[i])
+        self.solves["warm"] += int(warm.sum())
+        self.solves["cold"] += int((~warm).sum())
+        self.iterations["warm"] += int(iterations[warm].sum())
+        self.iterations["cold"] += int(iterations[~warm].sum())
+    def summary(self):
+        '''
+        Mean number of interior point iterations of cold and warm started solves
+        since the last reset_counts and the relative saving of the warm starts
+        '''
+        mean = {k: self.iterations[k]/self.solves[k] if self.solves[k] > 0 else float('nan')
+            for k in ("cold", "warm")}
+        return {"iterations_cold": mean["cold"], "iterations_warm": mean["warm"],
+            "iterations_saving": 1 - mean["warm"]/mean["cold"] if self.solves["cold"] > 0 and self.solves["warm"] > 0 else float('nan')}
+
+
+def intopt_batched(A_trch =None,b_trch =None,G_trch =None,h_trch =None, thr= 1e-8, damping= 1e-5, diffKKT = False, dopresolve=True, warmstart=None, cache_dir=None, rr_method=None):
+    '''
+    Same as intopt_nonbacthed, but the forward pass solves a batch of objective
+    vectors c (batch_size, n_x) together with solveLP_batched and the backward
+    pass differentiates all instances with batched factorizations.
+
+    A, G : 2D tensor or scipy sparse matrix, optional
+        if sparse, presolve, the standard form and both passes stay sparse
+    warmstart: warmstart_store, optional
+                the instances passed with an index are started from their stored iterates
+    The other parameters are the ones of intopt_nonbacthed.
+    '''
+    run_time = 0.
+    
+    A,b,G, h = convert_to_np(A_trch, b_trch, G_trch, h_trch)
+    standardizer, A_,b_ = get_standardform(A,b,G,h, dopresolve, cache_dir, rr_method)
+    b_ = np.asarray(b_, dtype=float)
+    if standardizer.sparse:
+        A_ = sps.csr_matrix(A_, dtype=float)
+        normal_equations = sparse_normal_equations(A_)
+    else:
+        A_ = np.asarray(A_, dtype=float)
+        normal_equations = None
+    
+
+    class WrappedFunc_cls(Function):        
+        @staticmethod
+        def forward(ctx,c_trch, index=None):
+            '''
+            c : 2D array (batch_size, n_x)
+                The coefficients of the linear objectives to be minimized.
+            index : optional list of batch_size hashable keys identifying the instances,
+                used to warm start them
+            '''
+            nonlocal run_time
+            start = time.time()
+            c = c_trch.detach().numpy()
+
+            c_ = standardizer.transformC(c).astype(float)
+            use_warmstart = warmstart is not None and index is not None
+            if use_warmstart:
+                x0, warm = warmstart.get_start(index, A_.shape[1], A_.shape[0], thr)
+            else:
+                x0 = None
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                if ctx.needs_input_grad[0]:
+                    ### keep the factorizations at the final iterates for the backward pass
+                    x, y, z, tau, kappa, mu, iterations, solve = solveLP_batched(c_ ,A_,b_, thr, return_solver=True, damping=damping,
+                        normal_equations=normal_equations, start=x0 )
+                else:
+                    x, y, z, tau, kappa, mu, iterations = solveLP_batched(c_ ,A_,b_, thr, normal_equations=normal_equations, start=x0 )
+                    solve = None
+            if use_warmstart:
+                warmstart.update(index, warm, x, y, z, tau, kappa, iterations)
+            
+            x_solve = torch.from_numpy( standardizer.transformsolution (x/tau[:, None])).float()
+
+            ctx.c = c_
+            ctx.x = x
+            ctx.y = y
+            ctx.z = z
+            ctx.tau = tau
+            ctx.kappa = kappa
+            ctx.solve = solve
+
+            end = time.time()
+            run_time += end -start
+            return x_solve
+
+
+        @staticmethod
+        def backward(ctx,dx):
+            '''
+            Batched version of the backward pass of intopt_nonbacthed.
+            For an incoming gradient d (padded with zeros for the slack variables),
+            the products with the derivative are
+                W1 d = X^{2} (A.T M^{-1} A X^{2} d - d)                 if diffKKT
+            and otherwise, with w2 d = X^{2} (A.T t2d - tau d), t2d = M^{-1} tau A X^{2} d
+                (tau (w2 d + w1 dtau.d) - dtau.(x*d)) / tau^2
+            '''
+            nonlocal run_time
+            start = time.time()
+
+            c_ = ctx.c
+            x = ctx.x
+            z = ctx.z
+            tau = ctx.tau
+            kappa = ctx.kappa
+
+            batch_size, n  = x.shape
+            d = np.zeros((batch_size, n))
+            d[:, :standardizer.n_eq] = dx.detach().numpy()
+
+            #### Tikhonov damped
+            Dinv = x / z
+            solve = ctx.solve
+            if solve is None:
+                solve = _get_normal_solver(A_, Dinv, damping, normal_equations)
+
+            if diffKKT:
+                dely = solve(_matvec(A_, Dinv*d)[:, :, None])[:, :, 0]
+                delx = Dinv*_rmatvec(A_, dely) - Dinv*d
+            
+            else:
+                tau_ = tau[:, None]
+                e = x*d
+                ##########   Solve :  M t1 = b +  A X^2 c, M t2d = tau A X^2 d, M t2e = tau A X^2 e
+                r = np.stack(( b_  +  _matvec(A_, Dinv*c_ ),
+                    tau_*_matvec(A_, Dinv*d), tau_*_matvec(A_, Dinv*e)), axis=2)
+                t = solve(r)
+                t1, t2d, t2e = t[:, :, 0], t[:, :, 1], t[:, :, 2]
+                w1  = (_rmatvec(A_, t1) - c_ )*Dinv
+                w2d = Dinv*_rmatvec(A_, t2d) - tau_*Dinv*d
+                w2e = Dinv*_rmatvec(A_, t2e) - tau_*Dinv*e
+
+                denominator = t1.dot(b_) - (c_*w1).sum(1)  + (kappa/tau)
+                deltau_d = ((x*d).sum(1) + (c_*w2d).sum(1) - t2d.dot(b_))/denominator
+                deltau_e = ((x*e).sum(1) + (c_*w2e).sum(1) - t2e.dot(b_))/denominator
+
+                ### dx(actual) = (tau* dx- x* dtau)/tau^2, as in intopt_nonbacthed
+                delx = (tau_*(w2d + w1*deltau_d[:, None]) - deltau_e[:, None])/(tau_**2)
+
+            end = time.time()
+            run_time += end -start
+            return torch.from_numpy( standardizer.transformsolution (delx)).to(dx.dtype), None
+    return WrappedFunc_cls.apply
+
+
 class intopt(nn.Module):
     '''
         Batched Implementation of the Above Module
-        For now, I am just iterating using a for loop
+        batched: boolean, default True
+                if True, the batch is solved together by intopt_batched, else instance by instance by intopt_nonbacthed
+        warmstart: boolean
+                if True, the final iterates of the instances passed to forward with an index are kept in
+                self.warmstart (a warmstart_store) and start their next solve
+        warmstart_mu, warmstart_blend: the mu and blend of the warmstart_store
+        cache_dir: directory, optional
+                if given, the presolved standard form is cached there; by default nothing is written
+        rr_method: string, optional
+                the method removing the redundant equality rows, see intopt_nonbacthed
     '''
-    def __init__(self,A_trch= None,b_trch= None,G_trch= None,h_trch= None, thr= 1e-8, damping= 1e-5, diffKKT = False, dopresolve = True):
+    def __init__(self,A_trch= None,b_trch= None,G_trch= None,h_trch= None, thr= 1e-8, damping= 1e-5, diffKKT = False, dopresolve = True, batched = True,
+            warmstart = False, warmstart_mu = 1e-2, warmstart_blend = 0.1, cache_dir = None, rr_method = None):
         super().__init__()
         self.A_trch, self.b_trch,  self.G_trch, self.h_trch = A_trch ,b_trch ,G_trch ,h_trch 
         self.thr, self.damping = thr, damping
-        self.net =  intopt_nonbacthed(A_trch ,b_trch ,G_trch ,h_trch , thr, damping, diffKKT, dopresolve )
-    def forward(self, c_trch):
+        self.batched = batched
+        if warmstart and not batched:
+            raise Exception("Warm start is only implemented for the batched intopt")
+        self.warmstart = warmstart_store(warmstart_mu, warmstart_blend) if warmstart else None
+        if batched:
+            self.net =  intopt_batched(A_trch ,b_trch ,G_trch ,h_trch , thr, damping, diffKKT, dopresolve, self.warmstart, cache_dir, rr_method )
+        else:
+            self.net =  intopt_nonbacthed(A_trch ,b_trch ,G_trch ,h_trch , thr, damping, diffKKT, dopresolve, cache_dir, rr_method )
+    def forward(self, c_trch, index=None):
         '''
         In the forward pass take the objective function parameter c
         c : 2D array (batch_size, n_x)
+        index : optional list of hashable keys of the instances, e.g. their indices in the dataset,
+            required for warm starting
         '''
+        if self.batched:
+            if c_trch.dim() == 1:
+                index = None if index is None else [index]
+                return self.net(c_trch.unsqueeze(0), index).to(c_trch.dtype).squeeze(0)
+            return self.net(c_trch, index).to(c_trch.dtype)
         batch_size = len (c_trch)
         sol = torch.zeros_like(c_trch)
         for i in range(batch_size):
@@ -10,7 +10,8 @@ from torch.utils.data import DataLoader
 from pytorch_lightning.callbacks import ModelCheckpoint
 from Trainer.PO_models import *
 from pytorch_lightning import loggers as pl_loggers
-from Trainer.data_utils import EnergyDataModule
+from Trainer.data_utils import EnergyDataModule, energy_solutions
+from Trainer.utils import run_seeds, shared, sweep_callbacks, append_csv, set_cvxpylayer_cache
 from Trainer.comb_solver import data_reading
 from distutils.util import strtobool
 parser = argparse.ArgumentParser()
@@ -40,9 +41,24 @@ parser.add_argument("--regularizer", type=str, help="Types of Regularization", d
 parser.add_argument("--thr", type=float, help="threshold parameter", default= 1e-6)
 parser.add_argument("--damping", type=float, help="damping parameter", default= 1e-8)
 parser.add_argument("--diffKKT",  action='store_true', help="Whether KKT or HSD ",  required=False)
+parser.add_argument("--warmstart",  action='store_true', help="Warm start IntOpt from the iterates of the previous epoch",  required=False)
 
 parser.add_argument("--tau", type=float, help="parameter of rankwise losses", default= 1e-8)
 parser.add_argument("--growth", type=float, help="growth parameter of rankwise losses", default= 1e-8)
+parser.add_argument("--pool_size", type=int, help="maximum number of solutions in the cache of rankwise losses", default= None, required=False)
+parser.add_argument("--eviction", type=str, help="which solution leaves a full cache: lru or violation", default= "lru", required=False)
+parser.add_argument("--growth_mode", type=str, help="grow the cache of rankwise losses in sync, or in the background with thread or process workers", default= "sync", required=False)
+parser.add_argument("--growth_workers", type=int, help="number of background workers growing the cache; the thread workers share the solver and solve one batch at a time", default= 1, required=False)
+parser.add_argument("--max_pending", type=int, help="maximum number of batches being solved in the background", default= 2, required=False)
+parser.add_argument("--memo",  action='store_true', help="Serve the exact solves of bit-identical costs from a memo",  required=False)
+parser.add_argument("--solver_workers", type=int, help="number of worker processes solving the batches, 0 to solve them in this process", default= 0, required=False)
+parser.add_argument("--deterministic_growth",  action='store_true', help="Merge the background solutions in a deterministic order",  required=False)
+parser.add_argument("--pipelined",  action='store_true', help="Solve the validation and test batches in the background, while the network computes the next ones",  required=False)
+parser.add_argument("--seed_workers", type=int, help="number of seeds run at the same time, each in its own process", default= 1, required=False)
+parser.add_argument("--threads_per_worker", type=int, help="number of torch threads of every seed process, 0 for the number of cores over seed_workers", default= 0, required=False)
+parser.add_argument("--output_tag", type=str, help="tag of the checkpoint and log directories, e.g. to run several configurations at the same time", default= "", required=False)
+parser.add_argument("--intopt_cache_dir", type=str, help="directory caching the presolved constraints of IntOpt across runs, none by default", default= None, required=False)
+parser.add_argument("--cvxpylayer_cache_dir", type=str, help="directory caching the compiled cvxpylayers of DCOL across runs, none by default; only trusted runs may write to it", default= None, required=False)
 
 parser.add_argument('--scheduler', dest='scheduler',  type=lambda x: bool(strtobool(x)))
 args = parser.parse_args()
@@ -56,10 +72,20 @@ argument_dict = vars(args)
 get_class = lambda x: globals()[x]
 modelcls = get_class(argument_dict['model'])
 modelname = argument_dict.pop('model')
+### how the seeds are run and where they keep their checkpoints, which are not part of the results
+seed_workers = argument_dict.pop('seed_workers')
+threads_per_worker = argument_dict.pop('threads_per_worker')
+output_tag = argument_dict.pop('output_tag')
+memo = argument_dict.pop('memo')
+intopt_cache_dir = argument_dict.pop('intopt_cache_dir')
+set_cvxpylayer_cache(argument_dict.pop('cvxpylayer_cache_dir'))
 sentinel_ns = Namespace(**{key:sentinel for key in argument_dict})
 parser.parse_args(namespace=sentinel_ns)
 
 explicit = {key:value for key, value in vars(sentinel_ns).items() if value is not sentinel }
+### the cache of the presolved constraints and the memo of the exact solver do not change the results
+argument_dict['intopt_cache_dir'] = intopt_cache_dir
+argument_dict['memo'] = memo
 
 
 torch.use_deterministic_algorithms(True)
@@ -76,8 +102,8 @@ def seed_all(seed):
 ################## Define the outputfile
 outputfile = "Rslt/RuntimeRun.{}{}Energy.csv".format(modelname,args.loss)
 regretfile = "Rslt/RuntimeRun.{}{}EnergyRegret.csv".format( modelname,args.loss )
-ckpt_dir =  "ckpt_dir/{}{}/".format( modelname,args.loss)
-log_dir = "lightning_logs/{}{}/".format(  modelname,args.loss )
+ckpt_dir =  "ckpt_dir/{}{}{}/".format( modelname,args.loss, output_tag)
+log_dir = "lightning_logs/{}{}{}/".format(  modelname,args.loss , output_tag)
 learning_curve_datafile = "LearningCurve/RuntimeRun.{}_".format(modelname)+"_".join( ["{}_{}".format(k,v) for k,v  in explicit.items()] )+".csv"  
 
 
@@ -85,24 +111,29 @@ param = data_reading("SchedulingInstances/load{}/day01.txt".format(load))
 
 shutil.rmtree(log_dir,ignore_errors=True)
 
-for seed in range(10):
+### the schedules do not depend on the seed, so they are solved once and shared by all the seeds
+solutions = shared(("solutions", load), lambda: energy_solutions(param))
+
+def run_seed(seed):
     seed_all(seed)
-    shutil.rmtree(ckpt_dir,ignore_errors=True)
+    ### every seed has its own checkpoints, as the seeds may run at the same time
+    seed_ckpt_dir = ckpt_dir + "seed{}/".format(seed)
+    shutil.rmtree(seed_ckpt_dir,ignore_errors=True)
     checkpoint_callback = ModelCheckpoint(
             #monitor="val_regret",mode="min",
-            dirpath=ckpt_dir, 
+            dirpath=seed_ckpt_dir, 
             filename="model-{epoch:02d}-{val_regret:.8f}",
             )
 
     g = torch.Generator()
     g.manual_seed(seed)    
-    data =  EnergyDataModule(param =  param, batch_size= argument_dict['batch_size'], generator=g, seed= seed)
+    data =  EnergyDataModule(param =  param, batch_size= argument_dict['batch_size'], generator=g, seed= seed, solutions=solutions)
 
     if modelname=="CachingPO":
         cache = torch.from_numpy (data.train_df.sol)
     tb_logger = pl_loggers.TensorBoardLogger(save_dir= log_dir, version=seed)
     trainer = pl.Trainer(max_epochs= argument_dict['max_epochs'], 
-    min_epochs=1,logger=tb_logger, callbacks=[checkpoint_callback])
+    min_epochs=1,logger=tb_logger, callbacks=[checkpoint_callback] + sweep_callbacks())
     if modelname=="CachingPO":
         model =  modelcls(param =  param,  init_cache=cache,seed=seed, **argument_dict)
     else:
@@ -126,21 +157,25 @@ for seed in range(10):
         df[k] = v
     df['seed'] = seed
     df['instance'] = load
-    with open(outputfile, 'a') as f:
-            df.to_csv(f, header=f.tell()==0)
 
 
     regret_list = trainer.predict(model, data.test_dataloader())
     
 
-    df = pd.DataFrame({"regret":regret_list[0].tolist()})
-    df.index.name='instance'
+    regret_df = pd.DataFrame({"regret":regret_list[0].tolist()})
+    regret_df.index.name='instance'
     for k,v in explicit.items():
-        df[k] = v
-    df['seed'] = seed
-    df['instance'] = load    
-    with open(regretfile, 'a') as f:
-        df.to_csv(f, header=f.tell()==0)
+        regret_df[k] = v
+    regret_df['seed'] = seed
+    regret_df['instance'] = load    
+    if memo:
+        print("Exact solver memo after seed {}: {}".format(seed, model.solver.summary()))
+    return [(outputfile, df), (regretfile, regret_df)]
+
+### the results are written here, in the order of the seeds, however many seeds run at the same time
+for seed, results in run_seeds(run_seed, range(10), seed_workers, threads_per_worker):
+    for path, df in results:
+        append_csv(path, df)
 
 
 
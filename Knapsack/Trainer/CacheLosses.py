@@ -2,6 +2,59 @@ import torch
 import numpy as np
 import torch.nn.functional as F
 
+def _objective(y, cache):
+    '''
+    y . s for every cost vector of y [batch_size, *shape] and every solution s of the cache [cache_size, *shape],
+    as [batch_size, cache_size]; the cache may be bit-packed (PackedSolutions)
+    '''
+    if hasattr(cache, "objective"):
+        return cache.objective(y)
+    return y.reshape(len(y), -1) @ cache.reshape(len(cache), -1).T.to(y.dtype)
+
+def _column_sums(cache, square=False, dtype=None):
+    '''
+    Sum of the solutions of the cache, or of their squares, as [*shape] of dtype, the one of the cache if None
+    '''
+    if hasattr(cache, "column_sums"):
+        ### the entries of bit-packed solutions are 0/1, so they are their own squares
+        return cache.column_sums(dtype or torch.float32)
+    if square:
+        ### by blocks of solutions, not to copy the whole cache
+        sums = sum(block.square().sum(dim=0) for block in cache.split(4096))
+    else:
+        sums = cache.sum(dim=0)
+    return sums if dtype is None else sums.to(dtype)
+
+def _ranked_pairs(scores, mode="B"):
+    '''
+    The pairs of solutions of the cache which the pairwise losses compare, for every instance, ranked by
+    scores [batch_size, cache_size], the lower the better. As with np.unique(scores[ii], return_index=True),
+    the solutions of equal scores count once, by the first of them, and the distinct scores are in increasing order.
+    mode "B": the best one against every other one, "W": every one against the worst one,
+        "S": every one against the next one
+    Returns the indices of the better and of the worse solution of the pairs, and the mask of the pairs,
+    all [batch_size, cache_size]
+    '''
+    values, order = torch.sort(scores, dim=1, stable=True)
+    first = torch.ones_like(values, dtype=torch.bool)
+    first[:, 1:] = values[:, 1:] != values[:, :-1]
+    ### the first solution of every distinct score, in increasing order of the scores
+    rank = first.cumsum(dim=1) - 1
+    distinct = torch.zeros_like(order)
+    distinct[torch.nonzero(first, as_tuple=True)[0], rank[first]] = order[first]
+    n_distinct = first.sum(dim=1, keepdim=True)
+    following = torch.cat([distinct[:, 1:], distinct[:, :1]], dim=1)
+    if mode == "B":
+        big, small = distinct[:, :1].expand_as(distinct), following
+    elif mode == "W":
+        big, small = distinct, distinct.gather(1, n_distinct - 1).expand_as(distinct)
+    elif mode == "S":
+        big, small = distinct, following
+    else:
+        raise Exception("Invalid mode {}".format(mode))
+    mask = torch.arange(scores.shape[1], device=scores.device).unsqueeze(0) < n_distinct - 1
+    return big, small, mask
+
 
 
 
@@ -12,15 +65,9 @@ class NCE(torch.nn.Module):
         self.mm  = 1 if minimize else -1
     def forward(self, y_hat,y_true, sol_true,cache):
 
-        loss = 0
         mm = self.mm
-        ## print("shape to be preinted: ")
-        # print(sol_true.shape, cache.shape, y_hat.shape)
-        ### torch.Size([B, 2500]) torch.Size([|S|, 2500]) torch.Size([B, 2500])
-
-        for ii in range(len( y_hat )):
-            loss += ( ( mm* ( sol_true[ii] - cache )*y_hat[ii]  ).sum(dim=(1)) ).mean() 
-        loss /= len(y_hat)
+        ### mean over the cache of (sol_true - s) . y_hat, taken with the mean solution of the cache
+        loss = ( mm* ( sol_true - _column_sums(cache, dtype=y_hat.dtype)/len(cache) )*y_hat  ).sum(dim=(1)).mean()
         return loss
 
 class NCE_c(torch.nn.Module):
@@ -29,11 +76,8 @@ class NCE_c(torch.nn.Module):
         self.mm  = 1 if minimize else -1
     def forward(self, y_hat,y_true, sol_true,cache):
 
-        loss = 0
         mm = self.mm
-        for ii in range(len( y_hat )):
-            loss += ( ( mm* ( sol_true[ii] - cache )* (y_hat[ii] - y_true[ii])  ).sum(dim=(1)) ).mean() 
-        loss /= len(y_hat)
+        loss = ( mm* ( sol_true - _column_sums(cache, dtype=y_hat.dtype)/len(cache) )* (y_hat - y_true)  ).sum(dim=(1)).mean()
         return loss
 
 
@@ -43,12 +87,11 @@ class MAP(torch.nn.Module):
         self.mm  = 1 if minimize else -1
     def forward(self, y_hat,y_true,sol_true,cache):
 
-        loss = 0
         mm = self.mm
-
-        for ii in range(len( y_hat )):
-            loss += (( mm* ( sol_true[ii] - cache )*y_hat[ii]  ).sum(dim=(1)) ).max() 
-        loss /= len(y_hat)
+        ### max over the cache of (sol_true - s) . y_hat, from the objectives of the cache [batch_size, cache_size]
+        ### amax spreads the gradient evenly among the ties, as the max of all the entries of a tensor
+        regret = (sol_true*y_hat).sum(dim=(1)).unsqueeze(1) - _objective(y_hat, cache)
+        loss = ( mm*regret ).amax(dim=1).mean()
         return loss
 
 
@@ -63,12 +106,10 @@ class MAP_c(torch.nn.Module):
         target: true shortest path [batch_size, img,img]
         cache: cache is torch array [cache_size, img,img]
         '''
-        loss = 0
         mm = self.mm
-
-        for ii in range(len( y_hat )):
-            loss += (( mm* ( sol_true[ii] - cache )* (y_hat[ii] - y_true[ii])   ).sum(dim=(1)) ).max() 
-        loss /= len(y_hat)
+        diff = y_hat - y_true
+        regret = (sol_true*diff).sum(dim=(1)).unsqueeze(1) - _objective(diff, cache)
+        loss = ( mm*regret ).amax(dim=1).mean()
         return loss
 
 
@@ -83,13 +124,10 @@ class MAP_c_actual(torch.nn.Module):
         target: true shortest path [batch_size, img,img]
         cache: cache is torch array [cache_size, img,img]
         '''
-        loss = 0
         mm = self.mm
-
-        for ii in range(len( y_hat )):
-
-            loss += (( mm* ( sol_true[ii] - cache )* (y_hat[ii] - y_true[ii])   ).sum(dim=(1)) ).max() 
-        loss /= len(y_hat)
+        diff = y_hat - y_true
+        regret = (sol_true*diff).sum(dim=(1)).unsqueeze(1) - _objective(diff, cache)
+        loss = ( mm*regret ).amax(dim=1).mean()
         return loss
 
 
@@ -104,11 +142,9 @@ class PointwiseLoss(torch.nn.Module):
         target: true shortest path [batch_size, img,img]
         cache: cache is torch array [cache_size, img,img]
         '''
-        loss = 0
-
-        for ii in range(len( y_hat )):
-            loss += ((cache*y_hat[ii])-(cache*y_true[ii])).square().mean() 
-        loss /= len(y_hat)
+        ### mean over the cache and the entries of (s*y_hat - s*y_true)^2 = s^2 (y_hat - y_true)^2
+        diff = (y_hat - y_true).square()
+        loss = ( diff*_column_sums(cache, square=True, dtype=diff.dtype) ).sum(dim=(1)).mean() / (len(cache)*diff[0].numel())
 
         return loss
 class ListwiseLoss(torch.nn.Module):
@@ -118,12 +154,9 @@ class ListwiseLoss(torch.nn.Module):
         self.mm  = 1 if minimize else -1
     def forward(self, y_hat,y_true,sol_true,cache):
 
-        loss = 0
         mm, temperature  = self.mm, self.temperature
-
-        for ii in range(len( y_hat )):
-            loss += - ( F.log_softmax((-mm*y_hat[ii]*cache/temperature).sum(dim=(1)),dim=0) * F.softmax((-mm*y_true[ii]*cache/temperature).sum(dim=(1)),dim=0)).mean()
-        loss /= len(y_hat)
+        ### softmax over the cache of the objectives [batch_size, cache_size]
+        loss = - ( F.log_softmax(-mm*_objective(y_hat, cache)/temperature,dim=1) * F.softmax(-mm*_objective(y_true, cache)/temperature,dim=1)).mean(dim=1).mean()
 
         return loss
 
@@ -141,16 +174,12 @@ class PairwisediffLoss(torch.nn.Module):
         cache: cache is torch array [cache_size, img,img]
         '''
         
-        loss = 0
-        for ii in range(len( y_hat )):
-            _,indices= np.unique((self.mm*y_true[ii]*cache).sum(dim= (1)).detach().numpy(),return_index=True)
-
-            big_ind = [indices[0] for p in range(len(indices)-1)] #good one
-            small_ind = [indices[p+1] for p in range(len(indices)-1)] #bad one
-        
-            
-            loss += ( ( cache[big_ind]*y_hat[ii] -cache[small_ind]*y_hat[ii]).sum(dim=(1)) - ( cache[big_ind]*y_true[ii] -cache[small_ind]*y_true[ii]).sum(dim=(1)) ).square().mean()
-        loss /= len(y_hat)
+        ### the pairs ranked by the true objectives, then the objectives of the solutions of the pairs
+        big, small, mask = _ranked_pairs(self.mm*_objective(y_true, cache).detach())
+        obj_hat, obj_true = _objective(y_hat, cache), _objective(y_true, cache)
+        diff = ( obj_hat.gather(1, big) - obj_hat.gather(1, small) ) - ( obj_true.gather(1, big) - obj_true.gather(1, small) )
+        ### mean over the pairs of every instance; nan as the mean of no pair, if all the solutions are tied
+        loss = ( (diff.square()*mask).sum(dim=1) / mask.sum(dim=1) ).mean()
         return loss
 
 class PairwiseLoss(torch.nn.Module):
@@ -166,14 +195,11 @@ class PairwiseLoss(torch.nn.Module):
         cache: cache is torch array [cache_size, img,img]
         '''
         relu = torch.nn.ReLU()
-        loss = 0
         mm, margin  = self.mm, self.margin
-        for ii in range(len( y_hat )):
-            _,indices= np.unique((self.mm*y_true[ii]*cache).sum(dim= (1)).detach().numpy(),return_index=True)
-
-            big_ind = [indices[0] for p in range(len(indices)-1)] #good one
-            small_ind = [indices[p+1] for p in range(len(indices)-1)] #bad one
-            
-            loss += relu(  margin + mm*( cache[big_ind]*y_hat[ii] -cache[small_ind]*y_hat[ii] ).sum(dim=(1)) ).mean()
-        loss /= len(y_hat)
+        ### the pairs ranked by the true objectives, then the objectives of the solutions of the pairs
+        big, small, mask = _ranked_pairs(mm*_objective(y_true, cache).detach())
+        obj_hat = _objective(y_hat, cache)
+        loss = relu( margin + mm*( obj_hat.gather(1, big) - obj_hat.gather(1, small) ) )
+        ### mean over the pairs of every instance; nan as the mean of no pair, if all the solutions are tied
+        loss = ( (loss*mask).sum(dim=1) / mask.sum(dim=1) ).mean()
         return loss
\ No newline at end of file
@@ -1,5 +1,6 @@
 import pandas as pd
 import numpy as np 
+from functools import partial
 from torch import nn, optim
 from tqdm.auto import tqdm
 import torch 
@@ -7,8 +8,8 @@ from torch.utils.data import DataLoader
 from torch.autograd import Variable
 import torch.nn.functional as F
 import pytorch_lightning as pl
-from Trainer.comb_solver import knapsack_solver, cvx_knapsack_solver,  intopt_knapsack_solver
-from Trainer.utils import batch_solve, regret_fn, abs_regret_fn, regret_list,  growpool_fn
+from Trainer.comb_solver import get_knapsack_solver, cvx_knapsack_solver,  intopt_knapsack_solver
+from Trainer.utils import batch_solve, regret_fn, abs_regret_fn, regret_list,  growpool_fn, SolutionPool, AsyncGrowth, SolvePipeline
 from Trainer.diff_layer import SPOlayer, DBBlayer
 
 from DPO import perturbations
@@ -18,27 +19,55 @@ from imle.target import TargetDistribution
 from imle.noise import SumOfGammaNoiseDistribution
 
 class baseline_mse(pl.LightningModule):
-    def __init__(self,weights,capacity,n_items,lr=1e-1,seed=0,scheduler=False, **kwd):
+    def __init__(self,weights,capacity,n_items,lr=1e-1,seed=0,scheduler=False, solver="dp", solver_workers=0, memo=False, pipelined=False, **kwd):
         super().__init__()
         pl.seed_everything(seed)
         self.model = nn.Linear(8,1)
         self.lr = lr
-        self.solver = knapsack_solver(weights,capacity, n_items)
+        ### with solver_workers > 1, the batches are solved in parallel by a SolverPool, and with memo
+        ### the solves of bit-identical costs are served from a memo_solver
+        self.solver = get_knapsack_solver(solver, weights,capacity, n_items, memo=memo, workers=solver_workers)
         self.scheduler = scheduler
+        ### if pipelined, the regrets of the validation and test batches are solved in the background (see SolvePipeline)
+        self.pipeline = SolvePipeline() if pipelined else None
 
     def forward(self,x):
         return self.model(x) 
     def training_step(self, batch, batch_idx):
-        x,y,sol = batch
+        x,y,sol,_ = batch
         y_hat =  self(x).squeeze()
         criterion = nn.MSELoss(reduction='mean')
         loss = criterion(y_hat,y)
         self.log("train_loss",loss, prog_bar=True, on_step=True, on_epoch=True, )
         return loss
+    def regrets(self, stage, y_hat, y, sol):
+        '''
+        The metrics of a batch which need the solver
+        '''
+        return {"{}_regret".format(stage): regret_fn(self.solver, y_hat,y,sol),
+            "abs_{}_regret".format(stage): abs_regret_fn(self.solver, y_hat,y,sol)}
+    def pipelined_step(self, stage, y_hat, y, sol):
+        '''
+        The validation and test steps of the pipelined mode: the regrets are solved in the background
+        and logged at the end of the epoch
+        '''
+        criterion = nn.MSELoss(reduction='mean')
+        mseloss = criterion(y_hat, y)
+        self.pipeline.submit(self.regrets, stage, y_hat.detach(), y, sol, batch_size=len(y))
+        self.log("{}_mse".format(stage), mseloss, prog_bar=True, on_step=False, on_epoch=True, )
+        return {"{}_mse".format(stage): mseloss}
+    def on_validation_epoch_end(self):
+        if self.pipeline is not None:
+            for k,v in self.pipeline.means(self.pipeline.wait()).items():
+                self.log(k, v, prog_bar=True)
+    def on_test_epoch_end(self):
+        self.on_validation_epoch_end()
     def validation_step(self, batch, batch_idx):
         criterion = nn.MSELoss(reduction='mean')
-        x,y, sol = batch
+        x,y,sol,_ = batch
         y_hat =  self(x).squeeze()
+        if self.pipeline is not None:
+            return self.pipelined_step("val", y_hat, y, sol)
         val_loss= regret_fn(self.solver, y_hat,y,sol)
         abs_val_loss= abs_regret_fn(self.solver, y_hat,y,sol)
         mseloss = criterion(y_hat, y)
@@ -54,14 +83,16 @@ class baseline_mse(pl.LightningModule):
         '''
         solver = self.solver
         
-        x,y,sol = batch
+        x,y,sol,_ = batch
         y_hat =  self(x).squeeze()
         regret_tensor = regret_list(solver,y_hat,y,sol)
         return regret_tensor
     def test_step(self, batch, batch_idx):
         criterion = nn.MSELoss(reduction='mean')
-        x,y, sol = batch
+        x,y,sol,_ = batch
         y_hat =  self(x).squeeze()
+        if self.pipeline is not None:
+            return self.pipelined_step("test", y_hat, y, sol)
         val_loss= regret_fn(self.solver, y_hat,y,sol)
         abs_val_loss= abs_regret_fn(self.solver, y_hat,y,sol)
         mseloss = criterion(y_hat, y)
@@ -90,13 +121,13 @@ class baseline_mse(pl.LightningModule):
 
 
 class SPO(baseline_mse):
-    def __init__(self,weights,capacity,n_items,lr=1e-1,seed=0,scheduler=False, **kwd):
-        super().__init__(weights,capacity,n_items,lr,seed, scheduler)
+    def __init__(self,weights,capacity,n_items,lr=1e-1,seed=0,scheduler=False, solver="dp", **kwd):
+        super().__init__(weights,capacity,n_items,lr,seed, scheduler, solver, **kwd)
         self.layer = SPOlayer(self.solver)
     
 
     def training_step(self, batch, batch_idx):
-        x,y,sol = batch
+        x,y,sol,_ = batch
         
         y_hat =  self(x).squeeze()
         loss =  self.layer(y_hat, y,sol ) 
@@ -104,13 +135,13 @@ class SPO(baseline_mse):
         return loss
 
 class DBB(baseline_mse):
-    def __init__(self,weights,capacity,n_items,lambda_val=1., lr=1e-1,seed=0,scheduler=False, **kwd):
-        super().__init__(weights,capacity,n_items,lr,seed, scheduler)
+    def __init__(self,weights,capacity,n_items,lambda_val=1., lr=1e-1,seed=0,scheduler=False, solver="dp", **kwd):
+        super().__init__(weights,capacity,n_items,lr,seed, scheduler, solver, **kwd)
         self.layer = DBBlayer(self.solver, lambda_val=lambda_val)
     
 
     def training_step(self, batch, batch_idx):
-        x,y,sol = batch
+        x,y,sol,_ = batch
         
         y_hat =  self(x).squeeze()
         sol_hat = self.layer(y_hat, y,sol ) 
@@ -119,23 +150,23 @@ class DBB(baseline_mse):
         return loss
 
 class FenchelYoung(baseline_mse):
-    def __init__(self,weights,capacity,n_items,sigma=0.1,num_samples=10, lr=1e-1,seed=0,scheduler=False, **kwd):
-        super().__init__(weights,capacity,n_items,lr,seed, scheduler)  
+    def __init__(self,weights,capacity,n_items,sigma=0.1,num_samples=10, lr=1e-1,seed=0,scheduler=False, solver="dp", **kwd):
+        super().__init__(weights,capacity,n_items,lr,seed, scheduler, solver, **kwd)
 
         fy_solver =  lambda y_: batch_solve(self.solver,y_) 
         self.criterion = fy.FenchelYoungLoss(fy_solver, num_samples= num_samples, 
         sigma= sigma,maximize = True, batched= True)
     def training_step(self, batch, batch_idx):
         criterion = self.criterion 
-        x,y,sol = batch
+        x,y,sol,_ = batch
         y_hat =  self(x).squeeze()
         loss = criterion(y_hat,sol).mean()
         self.log("train_loss",loss, prog_bar=True, on_step=True, on_epoch=True, )
         return loss
 
 class DPO(baseline_mse):
-    def __init__(self,weights,capacity,n_items,sigma=0.1,num_samples=10, lr=1e-1,seed=0,scheduler=False, **kwd):
-        super().__init__(weights,capacity,n_items,lr,seed, scheduler)  
+    def __init__(self,weights,capacity,n_items,sigma=0.1,num_samples=10, lr=1e-1,seed=0,scheduler=False, solver="dp", **kwd):
+        super().__init__(weights,capacity,n_items,lr,seed, scheduler, solver, **kwd)
 
         fy_solver =  lambda y_: batch_solve(self.solver,y_) 
         self.criterion = fy.FenchelYoungLoss(fy_solver, num_samples= num_samples, 
@@ -147,7 +178,7 @@ class DPO(baseline_mse):
         self.layer = dpo_layer
 
     def training_step(self, batch, batch_idx):
-        x,y,sol = batch
+        x,y,sol,_ = batch
         y_hat =  self(x).squeeze()
         sol_hat = self.layer(y_hat ) 
         loss = ((sol - sol_hat)*y).sum(-1).mean()  ## to minimze regret
@@ -156,8 +187,8 @@ class DPO(baseline_mse):
 
 class IMLE(baseline_mse):
     def __init__(self,weights,capacity,n_items, k=5, nb_iterations=100,nb_samples=1, beta=10.0,
-            temperature=1.0,   lr=1e-1,seed=0,scheduler=False, **kwd):
-        super().__init__(weights,capacity,n_items,lr,seed, scheduler)
+            temperature=1.0,   lr=1e-1,seed=0,scheduler=False, solver="dp", **kwd):
+        super().__init__(weights,capacity,n_items,lr,seed, scheduler, solver, **kwd)
         imle_solver = lambda y_: batch_solve(self.solver,y_)
 
         target_distribution = TargetDistribution(alpha=1.0, beta=beta)
@@ -167,7 +198,7 @@ class IMLE(baseline_mse):
                     input_noise_temperature= temperature, target_noise_temperature= temperature,
                     nb_samples= nb_samples)
     def training_step(self, batch, batch_idx):
-        x,y,sol = batch
+        x,y,sol,_ = batch
         y_hat =  self(x).squeeze()
         sol_hat = self.layer(y_hat ) 
         loss = ((sol - sol_hat)*y).sum(-1).mean()  ## to minimze regret
@@ -177,11 +208,11 @@ class DCOL(baseline_mse):
     '''
     Implementation oF QPTL using cvxpyayers
     '''
-    def __init__(self,weights,capacity,n_items,mu=1.,lr=1e-1,seed=0,scheduler=False, **kwd):
-        super().__init__(weights,capacity,n_items,lr,seed, scheduler)
+    def __init__(self,weights,capacity,n_items,mu=1.,lr=1e-1,seed=0,scheduler=False, solver="dp", **kwd):
+        super().__init__(weights,capacity,n_items,lr,seed, scheduler, solver, **kwd)
         self.comblayer = cvx_knapsack_solver(weights,capacity,n_items,mu=mu)
     def training_step(self, batch, batch_idx):
-        x,y,sol = batch
+        x,y,sol,_ = batch
         y_hat =  self(x).squeeze()
         sol_hat = self.comblayer(y_hat)
         loss = ((sol - sol_hat)*y).sum(-1).mean()
@@ -192,23 +223,39 @@ class DCOL(baseline_mse):
 
 
 class IntOpt(baseline_mse):
-    def __init__(self,weights,capacity,n_items,thr=0.1,damping=1e-3,lr=1e-1,seed=0,scheduler=False, **kwd):
-        super().__init__(weights,capacity,n_items,lr,seed, scheduler)
-        self.comblayer = intopt_knapsack_solver(weights,capacity,n_items, thr= thr,damping= damping)
+    def __init__(self,weights,capacity,n_items,thr=0.1,damping=1e-3,lr=1e-1,seed=0,scheduler=False, solver="dp", warmstart=False, intopt_cache_dir=None, **kwd):
+        super().__init__(weights,capacity,n_items,lr,seed, scheduler, solver, **kwd)
+        self.comblayer = intopt_knapsack_solver(weights,capacity,n_items, thr= thr,damping= damping, warmstart= warmstart, cache_dir= intopt_cache_dir)
     def training_step(self, batch, batch_idx):
-        x,y,sol = batch
+        x,y,sol,index = batch
         y_hat =  self(x).squeeze()
-        sol_hat = self.comblayer(y_hat)
+        sol_hat = self.comblayer(y_hat, index.tolist())
         loss = ((sol - sol_hat)*y).sum(-1).mean()
 
         self.log("train_loss",loss, prog_bar=True, on_step=True, on_epoch=True, )
         return loss  
+    def on_train_epoch_end(self):
+        warmstart = self.comblayer.layer.warmstart
+        if warmstart is not None:
+            for k,v in warmstart.summary().items():
+                if not np.isnan(v):
+                    self.log("train_{}".format(k), v)
+            warmstart.reset_counts()
 
 from Trainer.CacheLosses import *
 class CachingPO(baseline_mse):
-    def __init__(self, weights,capacity,n_items,init_cache,tau=1.,growth=0.1,loss="listwise",lr=1e-1,seed=0,scheduler=False, **kwd):
-        super().__init__(weights,capacity,n_items,lr,seed, scheduler)
+    def __init__(self, weights,capacity,n_items,init_cache,tau=1.,growth=0.1,loss="listwise",lr=1e-1,seed=0,scheduler=False, solver="dp",
+        pool_size=None, eviction="lru", packed=False, growth_mode="sync", growth_workers=1, max_pending=2, deterministic_growth=False,
+        **kwd):
+        super().__init__(weights,capacity,n_items,lr,seed, scheduler, solver, **kwd)
         '''tau: the margin parameter for pairwise ranking / temperatrure for listwise ranking
+        pool_size: maximum number of solutions in the cache, None for no limit
+        eviction: which solution leaves a full cache, "lru" or "violation" (see SolutionPool)
+        packed: store the cache bit-packed (see PackedSolutions)
+        growth_mode: "sync", or grow the cache in the background with "thread" or "process" workers (see AsyncGrowth)
+        growth_workers, max_pending, deterministic_growth: the workers, the bound of the batches being solved and
+            whether to merge them in a deterministic order, for the background growth;
+            the worker threads share the solver, so they solve one batch at a time
         '''
 
 
@@ -234,21 +281,40 @@ class CachingPO(baseline_mse):
             raise Exception("Invalid Loss Provided")
 
         self.growth = growth
-        cache_np = init_cache.detach().numpy()
-        cache_np = np.unique(cache_np,axis=0)
-        # torch has no unique function, so we have to do this
-        init_cache =  torch.from_numpy(cache_np).float()
-        self.cache = init_cache
+        ### the cache, deduplicated by the pool; self.cache is its view
+        self.pool = SolutionPool(init_cache, max_size=pool_size, eviction=eviction, minimize=False, packed=packed)
+        self.cache = self.pool.view()
+        ### the background growth of the pool, None for the synchronous one
+        self.grower = None if growth_mode == "sync" else AsyncGrowth(self.pool, partial(batch_solve, self.solver), growth_mode,
+            growth_workers, max_pending, deterministic_growth)
     
 
     def training_step(self, batch, batch_idx):
-        x,y,sol = batch
+        x,y,sol,_ = batch
         y_hat =  self(x).squeeze()
         
+        self.pool.touch(y_hat)
+        if self.grower is not None:
+            self.cache = self.grower.merge()
         if (np.random.random(1)[0]< self.growth) or len(self.cache)==0:
-            self.cache= growpool_fn(self.solver,self.cache, y_hat)
+            if self.grower is not None and len(self.cache) > 0:
+                self.grower.submit(y_hat)
+            else:
+                self.cache = growpool_fn(self.solver,self.pool, y_hat)
 
         loss = self.loss_fn(y_hat,y,sol,self.cache)
         self.log("train_loss",loss, prog_bar=True, on_step=True, on_epoch=True, )
         return loss 
 
+    def on_validation_epoch_start(self):
+        ### the validation shares the solver with the growth workers, so they finish first
+        if self.grower is not None:
+            self.cache = self.grower.merge(wait=True)
+
+    def on_test_epoch_start(self):
+        self.on_validation_epoch_start()
+
+    def on_train_end(self):
+        if self.grower is not None:
+            self.grower.close()
+
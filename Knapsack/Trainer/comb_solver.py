@@ -5,6 +5,8 @@ import torch.nn as nn
 import cvxpy as cp
 import cvxpylayers
 from cvxpylayers.torch import CvxpyLayer
+from functools import partial
+from Trainer.utils import get_cvxpylayer, memo_solver, SolverPool
 from qpth.qp import QPFunction
 
 
@@ -43,6 +45,70 @@ class knapsack_solver:
         else:
             raise Exception("No soluton found")
 
+class dpknapsack_solver:
+    '''
+    Exact 0/1 knapsack solver by dynamic programming over the integer capacity.
+    A batch of value vectors is solved in one pass: each item updates the
+    [batch, capacity+1] value table with a single array operation and the item
+    sets are recovered by backtracking through the stored take decisions.
+    An item is taken only if it strictly improves the value, so items with
+    non-positive value are never selected.
+    '''
+    def __init__(self, weights,capacity,n_items):
+        weights = np.asarray(weights)
+        if np.any(weights != np.round(weights)) or np.any(weights<0):
+            raise Exception("Dynamic programming solver requires non-negative integer weights")
+        if capacity != int(capacity) or capacity <0:
+            raise Exception("Dynamic programming solver requires a non-negative integer capacity")
+        self.weights=  weights.astype(np.int64)
+        self.capacity = int(capacity)
+        self.n_items = n_items
+    def batched_solve(self,y):
+        '''
+        y is a numpy array [batch_size, n_items]; returns the 0/1 solutions of the same shape
+        '''
+        y = np.asarray(y, dtype=np.float64).reshape(-1, self.n_items)
+        batch_size, capacity = len(y), self.capacity
+        value = np.zeros((batch_size, capacity+1))
+        take = np.zeros((self.n_items, batch_size, capacity+1), dtype=bool)
+        for i in range(self.n_items):
+            w = self.weights[i]
+            if w > capacity:
+                continue
+            candidate = value[:, :capacity+1-w] + y[:, i:i+1]
+            better = candidate > value[:, w:]
+            take[i, :, w:] = better
+            value[:, w:] = np.where(better, candidate, value[:, w:])
+        ### backtrack from the full capacity
+        sol = np.zeros((batch_size, self.n_items))
+        remaining = np.full(batch_size, capacity)
+        rows = np.arange(batch_size)
+        for i in reversed(range(self.n_items)):
+            taken = take[i, rows, remaining]
+            sol[:, i] = taken
+            remaining -= taken*self.weights[i]
+        return sol
+    def solve(self,y):
+        return self.batched_solve(y)[0]
+
+def get_knapsack_solver(solver, weights,capacity,n_items, memo=False, workers=0):
+    '''
+    solver: "dp" for the batched dynamic programming solver, "scip" for the MIP solver
+    memo: if True, calls on bit-identical costs are served from a memo, see Trainer.utils.memo_solver
+    workers: if more than 1, the batches are solved by that many worker processes, see Trainer.utils.SolverPool
+    '''
+    if solver=="dp":
+        exact_solver = dpknapsack_solver(weights,capacity,n_items)
+        if workers > 1:
+            exact_solver = SolverPool(partial(dpknapsack_solver, weights,capacity,n_items), workers, method="batched_solve", batched=True)
+    elif solver=="scip":
+        exact_solver = knapsack_solver(weights,capacity,n_items)
+        if workers > 1:
+            exact_solver = SolverPool(partial(knapsack_solver, weights,capacity,n_items), workers)
+    else:
+        raise Exception("Invalid Solver Provided")
+    return memo_solver(exact_solver) if memo else exact_solver
+
 class cvx_knapsack_solver(nn.Module):
     def __init__(self, weights,capacity,n_items, mu=1.):
         super().__init__()
@@ -51,12 +117,14 @@ class cvx_knapsack_solver(nn.Module):
         self.n_items = n_items  
         A = weights.reshape(1,-1).astype(np.float32)
         b = capacity
-        x = cp.Variable(n_items)
-        c = cp.Parameter(n_items)
-        constraints = [x >= 0,x<=1,A @ x <= b]  
-        objective = cp.Maximize(c @ x - mu*cp.pnorm(x, p=2))  #cp.pnorm(A @ x - b, p=1)
-        problem = cp.Problem(objective, constraints)
-        self.layer = CvxpyLayer(problem, parameters=[c], variables=[x])
+        def make_problem():
+            x = cp.Variable(n_items)
+            c = cp.Parameter(n_items)
+            constraints = [x >= 0,x<=1,A @ x <= b]  
+            objective = cp.Maximize(c @ x - mu*cp.pnorm(x, p=2))  #cp.pnorm(A @ x - b, p=1)
+            problem = cp.Problem(objective, constraints)
+            return problem, [c], [x]
+        self.layer = get_cvxpylayer(make_problem, ("knapsack", A, b, mu))
     def forward(self,costs):
         sol, = self.layer(costs)
 
@@ -66,7 +134,7 @@ class cvx_knapsack_solver(nn.Module):
 
 from intopt.intopt import intopt
 class intopt_knapsack_solver(nn.Module):
-    def __init__(self, weights,capacity,n_items, thr=0.1,damping=1e-3, diffKKT = False, dopresolve = True,):
+    def __init__(self, weights,capacity,n_items, thr=0.1,damping=1e-3, diffKKT = False, dopresolve = True, warmstart = False, cache_dir = None):
         super().__init__()
         self.weights=  weights
         self.capacity = capacity
@@ -83,10 +151,10 @@ class intopt_knapsack_solver(nn.Module):
         self.A, self.b,self.G, self.h =  torch.from_numpy(A), torch.from_numpy(b),  torch.from_numpy(A_ub),  torch.from_numpy(b_ub)
         self.thr =thr
         self.damping = damping
-        self.layer = intopt(self.A, self.b,self.G, self.h, thr, damping, diffKKT, dopresolve)
+        self.layer = intopt(self.A, self.b,self.G, self.h, thr, damping, diffKKT, dopresolve, warmstart = warmstart, cache_dir = cache_dir)
 
-    def forward(self,costs):
-        return self.layer(-costs)
+    def forward(self,costs, index=None):
+        return self.layer(-costs, index)
 
         # sol = [self.layer(-cost) for cost in costs]
 
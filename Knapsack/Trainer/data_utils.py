@@ -5,13 +5,15 @@ import pytorch_lightning as pl
 import torch
 from sklearn.preprocessing import StandardScaler
 import sklearn
-from Trainer.comb_solver import knapsack_solver
+from Trainer.comb_solver import get_knapsack_solver
 
 class Datawrapper():
     def __init__(self, X,y, sol=None,solver=None):
         assert (sol is not None) or (solver is not None)
         self.X = X.astype(np.float32)
         self.y = y.astype(np.float32) 
+        if sol is None and hasattr(solver, "batched_solve"):
+            sol = solver.batched_solve(y).astype(np.float32)
         if sol is None:
             sol = []
             for i in range(len(y)):
@@ -23,40 +25,62 @@ class Datawrapper():
         return len(self.y)
     
     def __getitem__(self, idx):
-        return self.X[idx],self.y[idx], self.sol[idx]
+        ### the index of the instance in the dataset keys the state the models keep per instance, e.g. the warm start of IntOpt
+        return self.X[idx],self.y[idx], self.sol[idx], idx
 
 
+def load_knapsack_data(standardize=True):
+    '''
+    Features [n, 48, n_features] and item values [n, 48] of all the instances, the train ones then the test ones,
+    and the weights of the items
+    '''
+    data = np.load('Trainer/Data.npz')
+    weights = data['weights']
+    weights = np.array(weights)
+    x_train,  x_test, y_train,y_test = data['X_1gtrain'],data['X_1gtest'],data['y_train'],data['y_test']
+    x_train = x_train[:,1:]
+    x_test = x_test[:,1:]
+    if standardize:
+        scaler = StandardScaler()
+        x_train = scaler.fit_transform(x_train)
+        x_test = scaler.transform(x_test)
+    x_train = x_train.reshape(-1,48,x_train.shape[1])
+    y_train = y_train.reshape(-1,48)
+    x_test = x_test.reshape(-1,48,x_test.shape[1])
+    y_test = y_test.reshape(-1,48)
+    x = np.concatenate((x_train, x_test), axis=0)
+    y = np.concatenate((y_train,y_test), axis=0)
+    return x, y, weights
+
+def knapsack_solutions(capacity, solver="dp"):
+    '''
+    Solutions of all the instances, in the order of load_knapsack_data. They do not depend on the seed,
+    so the runs of several seeds can solve them once and pass them to KnapsackDataModule.
+    '''
+    x, y, weights = load_knapsack_data(standardize=False)
+    solver = get_knapsack_solver(solver, weights,capacity= capacity, n_items= len(weights) )
+    return Datawrapper(x, y, solver=solver).sol
+
 class KnapsackDataModule(pl.LightningDataModule):
-    def __init__(self,capacity, standardize=True, batch_size=70, generator=None,num_workers=8, seed=0):
+    def __init__(self,capacity, standardize=True, batch_size=70, generator=None,num_workers=8, seed=0, solver="dp", solutions=None):
+        '''
+        solutions: solutions of all the instances from knapsack_solutions, solved here if None
+        '''
         super().__init__()
 
-        data = np.load('Trainer/Data.npz')
-        weights = data['weights']
-        weights = np.array(weights)
+        x, y, weights = load_knapsack_data(standardize)
         n_items = len(weights)
-        x_train,  x_test, y_train,y_test = data['X_1gtrain'],data['X_1gtest'],data['y_train'],data['y_test']
-        x_train = x_train[:,1:]
-        x_test = x_test[:,1:]
-        if standardize:
-            scaler = StandardScaler()
-            x_train = scaler.fit_transform(x_train)
-            x_test = scaler.transform(x_test)
-        x_train = x_train.reshape(-1,48,x_train.shape[1])
-        y_train = y_train.reshape(-1,48)
-        x_test = x_test.reshape(-1,48,x_test.shape[1])
-        y_test = y_test.reshape(-1,48)
-        x = np.concatenate((x_train, x_test), axis=0)
-        y = np.concatenate((y_train,y_test), axis=0)
-        x,y = sklearn.utils.shuffle(x,y,random_state=seed)
-        x_train, y_train = x[:550], y[:550]
-        x_valid, y_valid = x[550:650], y[550:650]
-        x_test, y_test = x[650:], y[650:]
-
-        solver = knapsack_solver(weights,capacity= capacity, n_items= len(weights) )
+        if solutions is None:
+            solutions = knapsack_solutions(capacity, solver)
+        ### the same permutation as the one of x and y alone
+        x,y,solutions = sklearn.utils.shuffle(x,y,solutions,random_state=seed)
+        x_train, y_train, sol_train = x[:550], y[:550], solutions[:550]
+        x_valid, y_valid, sol_valid = x[550:650], y[550:650], solutions[550:650]
+        x_test, y_test, sol_test = x[650:], y[650:], solutions[650:]
 
-        self.train_df = Datawrapper( x_train,y_train,solver=solver)
-        self.valid_df  = Datawrapper( x_valid, y_valid,solver=solver )
-        self.test_df = Datawrapper( x_test, y_test,solver=solver )
+        self.train_df = Datawrapper( x_train,y_train,sol=sol_train)
+        self.valid_df  = Datawrapper( x_valid, y_valid,sol=sol_valid )
+        self.test_df = Datawrapper( x_test, y_test,sol=sol_test )
         self.train_solutions= self.train_df.sol
 
         self.batch_size = batch_size
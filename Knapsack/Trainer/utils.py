@@ -1,8 +1,18 @@
 import torch
 import numpy as np
+import os, sys
+### the helpers shared by all the problems are in common_utils, at the root of the repository
+_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+if _root not in sys.path:
+    sys.path.append(_root)
+from common_utils import (SolutionPool, PackedSolutions, PackedObjective, popcount, AsyncGrowth, SolvePipeline, run_seeds,
+    shared, sweep_callbacks, append_csv, get_cvxpylayer, set_cvxpylayer_cache, memo_solver,
+    SolverPool)
 
 
 def batch_solve(solver, y):
+    if hasattr(solver, "batched_solve"):
+        return torch.from_numpy(solver.batched_solve(y.detach().numpy())).float()
 
     sol = []
     for i in range(len(y)):
@@ -35,11 +45,10 @@ def abs_regret_fn(solver, y_hat,y_true, sol_true, minimize=False):
 
 def growpool_fn(solver,cache, y_hat):
     '''
-    cache is torch array [currentpoolsize,48]
+    cache is a SolutionPool of solutions [currentpoolsize,48]
     y_hat is  torch array [batch_size,48]
+    returns the view of the grown cache
     '''
     sol = batch_solve(solver,y_hat).detach().numpy()
-    cache_np = cache.detach().numpy()
-    cache_np = np.unique(np.append(cache_np,sol,axis=0),axis=0)
-    # torch has no unique function, so we have to do this
-    return torch.from_numpy(cache_np).float()
\ No newline at end of file
+    cache.add(sol)
+    return cache.view()
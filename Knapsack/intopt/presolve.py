@@ -29,7 +29,8 @@ class presolve:
             looking for a potential speedup (at the expense of reliability).
         rr_method : string
             Method used to identify and remove redundant rows from the
-            equality constraint matrix after presolve.
+            equality constraint matrix after presolve: "svd", "pivot", "id", or "pivot_sparse",
+            which removes the rows a sparse matrix would lose. A sparse matrix always uses "pivot_sparse".
             
         '''
         self.A_ub, self.b_ub, self.A_eq, self.b_eq = A_ub, b_ub, A_eq, b_eq
@@ -123,13 +124,13 @@ class presolve:
         # This is a wild guess for which redundancy removal algorithm will be
         # faster. More testing would be good.
         small_nullspace = 5
-        if rr and A_eq.size > 0:
+        if rr and A_eq.size > 0 and not sps.issparse(A_eq):
             try:  # TODO: use results of first SVD in _remove_redundancy_svd
                 rank = np.linalg.matrix_rank(A_eq)
             # oh well, we'll have to go with _remove_redundancy_pivot_dense
             except Exception:
                 rank = 0
-        if rr and A_eq.size > 0 and rank < A_eq.shape[0]:
+        if rr and A_eq.size > 0 and not sps.issparse(A_eq) and rank < A_eq.shape[0]:
             warn(redundancy_warning)
             dim_row_nullspace = A_eq.shape[0]-rank
             if rr_method is None:
@@ -151,6 +152,12 @@ class presolve:
                 elif rr_method == "id":
                     rr_res = _remove_redundancy_id(A_eq, b_eq, rank)
                     A_eq, b_eq, status, message = rr_res
+                elif rr_method == "pivot_sparse":
+                    ### the rows a sparse A_eq loses, so that the dense and the sparse constraints give the same
+                    ### standard form; which of the dependent rows is removed changes the backward pass of intopt
+                    rr_res = _remove_redundancy_pivot_sparse(sps.csc_matrix(A_eq), b_eq)
+                    A_eq, b_eq, status, message = rr_res
+                    A_eq = A_eq.toarray()
                 else:  # shouldn't get here; option validity checked above
                     pass
             if A_eq.shape[0] < rank:
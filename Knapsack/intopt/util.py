@@ -1,5 +1,6 @@
 import numpy as np
 import scipy.sparse as sps
+import os, sys, hashlib
 from warnings import warn
 # from ._optimize import OptimizeWarning
 # from scipy.optimize._remove_redundancy import (
@@ -7,6 +8,7 @@ from warnings import warn
 #     _remove_redundancy_pivot_dense, _remove_redundancy_id
 #     )
 from collections import namedtuple
+from intopt.presolve import presolve
 
 class standardizeLP:
     def __init__(self,A_ub, b_ub, A_eq, b_eq) -> None:
@@ -186,7 +188,7 @@ class standardizeLP:
             zeros = np.zeros
             eye = np.eye
 
-        return  np.concatenate((c, zeros(m_ub)))
+        return  np.concatenate((c, np.zeros(np.shape(c)[:-1] + (m_ub,))), axis=-1)
 
     def transformsolution(self, x):
         '''
@@ -210,7 +212,7 @@ class standardizeLP:
         #     zeros = np.zeros
         #     eye = np.eye
 
-        return  x[:n_eq]
+        return  x[..., :n_eq]
     def transformsgradient(self, dx):
         '''
         Turn the dx solved found by differentiating the hsd to the derivative of the original problem
@@ -236,29 +238,41 @@ class standardizeLP:
         return  dx[:n_eq, :n_eq]
 
 def convert_to_np(A_trch =None,b_trch =None,G_trch =None,h_trch =None):
+    '''
+    The constraint matrices can be torch tensors or scipy sparse matrices.
+    If either of them is sparse, both are returned as scipy csr matrices,
+    so that presolve, standardizeLP and solveLP work with sparse matrices throughout.
+    '''
 
     #### First a check To Detect an empty torch tensor torch.Tensor() and if it's empty tensor convert to None
-    if A_trch.nelement() == 0:
+    if A_trch is not None and np.prod(A_trch.shape) == 0:
         A_trch = None
-    if G_trch.nelement() == 0:
+    if G_trch is not None and np.prod(G_trch.shape) == 0:
         G_trch = None
+    sparse = sps.issparse(A_trch) or sps.issparse(G_trch)
+
+    def matrix_to_np(M):
+        if sparse:
+            return sps.csr_matrix(M if sps.issparse(M) else M.detach().numpy(), dtype=float)
+        return M.detach().numpy()
+    zeros = (lambda shape: sps.csr_matrix(shape, dtype=float)) if sparse else (lambda shape: np.zeros(shape).astype(float))
 
     if (A_trch is None) and (G_trch is None):
         raise Exception("The problem is (trivially) unbounded "
                     "because there are no non-trivial constraints.")
     elif A_trch is None:
         m_ub, n = G_trch.shape
-        G_np = G_trch.detach().numpy().astype(float)
+        G_np = matrix_to_np(G_trch).astype(float)
         h_np = h_trch.detach().numpy().astype(float)
-        A_np = np.zeros((0, n)).astype(float)
+        A_np = zeros((0, n))
         b_np = np.array([], dtype=float)
         m_eq = 0
         
     elif G_trch is None:
         m_eq, n = A_trch.shape
-        A_np = A_trch.detach().numpy()
+        A_np = matrix_to_np(A_trch)
         b_np = b_trch.detach().numpy()
-        G_np = np.zeros((0, n)).astype(float)
+        G_np = zeros((0, n))
         h_np = np.array([], dtype=float)
         m_ub = 0
     else:
@@ -269,13 +283,104 @@ def convert_to_np(A_trch =None,b_trch =None,G_trch =None,h_trch =None):
                             "with the number of variables in the inequality constraint matrix does not match")
         n = n_ub = n_eq
 
-        G_np = G_trch.detach().numpy().astype(float)
+        G_np = matrix_to_np(G_trch).astype(float)
         h_np = h_trch.detach().numpy().astype(float)
-        A_np = A_trch.detach().numpy()
+        A_np = matrix_to_np(A_trch)
         b_np = b_trch.detach().numpy()
     return (A_np, b_np , G_np, h_np)
 
 
-
-
-
+### attributes of standardizeLP needed by transformC, transformsolution and transformsgradient
+_standardform_metadata = ("m_ub", "n_ub", "m_eq", "n_eq", "sparse")
+
+def _constraints_hash(*arrays, **params):
+    '''
+    Hash of the content of the constraint matrices and vectors (dense or scipy sparse) and the presolve parameters
+    '''
+    h = hashlib.sha1()
+    for M in arrays:
+        if sps.issparse(M):
+            M = sps.csr_matrix(M, dtype=float)
+            M.sum_duplicates()
+            M.sort_indices()
+            parts = (M.data, M.indices, M.indptr)
+        else:
+            M = np.asarray(M, dtype=float)
+            parts = (M,)
+        h.update(repr(("sparse" if sps.issparse(M) else "dense", M.shape)).encode())
+        for part in parts:
+            h.update(np.ascontiguousarray(part).tobytes())
+    h.update(repr(sorted(params.items())).encode())
+    return h.hexdigest()
+
+_code_version = None
+def presolve_code_version():
+    '''
+    Hash of the source of presolve and of this module (standardizeLP), part of the key of the
+    cached standard forms, so that a change of the code computing them invalidates the cache
+    '''
+    global _code_version
+    if _code_version is None:
+        h = hashlib.sha1()
+        for path in (sys.modules[presolve.__module__].__file__, __file__):
+            with open(path, "rb") as f:
+                h.update(f.read())
+        _code_version = h.hexdigest()
+    return _code_version
+
+def get_standardform(A, b, G, h, dopresolve=True, cache_dir=None, rr_method=None):
+    '''
+    Presolve (if dopresolve) the LP with the constraints G @ x <= h, A @ x == b
+    (the output of convert_to_np) and turn it into the standard form with standardizeLP.
+    Returns the standardizeLP, which carries the metadata for transformC, transformsolution
+    and transformsgradient, and the standard form (A_, b_).
+    rr_method is the method removing the redundant equality rows, see presolve.
+    If cache_dir is not None, the result is saved there under a hash of the constraints
+    and of the presolve code, and loaded instead of recomputed when the same constraints
+    are seen again, e.g. in the next seed or hyperparameter run. Writing the cache is
+    best effort: if it fails, a warning is issued and the result is still returned.
+    '''
+    if cache_dir is not None:
+        key = _constraints_hash(A, b, G, h, dopresolve=dopresolve, rr_method=rr_method, code=presolve_code_version())
+        path = os.path.join(cache_dir, "standardform_{}.npz".format(key))
+        if os.path.exists(path):
+            try:
+                with np.load(path, allow_pickle=False) as f:
+                    standardizer = standardizeLP(None, None, None, None)
+                    for k, v in zip(_standardform_metadata, f["metadata"]):
+                        setattr(standardizer, k, int(v))
+                    standardizer.sparse = bool(standardizer.sparse)
+                    if standardizer.sparse:
+                        A_ = sps.csr_matrix((f["A_data"], f["A_indices"], f["A_indptr"]), shape=tuple(f["A_shape"]))
+                    else:
+                        A_ = f["A"]
+                    b_ = f["b"]
+                return standardizer, A_, b_
+            except (OSError, KeyError, ValueError):
+                warn("Could not read the cached standard form {}, recomputing it".format(path))
+
+    if dopresolve:
+        presolver = presolve (G,h, A,b, rr_method=rr_method)
+        (G,h, A,b) = presolver.transform ()
+    standardizer = standardizeLP (G,h, A,b)
+    A_,b_ = standardizer.getAb()
+
+    if cache_dir is not None:
+        if standardizer.sparse:
+            A_csr = sps.csr_matrix(A_, dtype=float)
+            arrays = dict(A_data=A_csr.data, A_indices=A_csr.indices, A_indptr=A_csr.indptr, A_shape=np.array(A_csr.shape))
+        else:
+            arrays = dict(A=np.asarray(A_))
+        ### write to a temporary file first, so that concurrent runs never read a partial file
+        tmp_path = "{}.{}.tmp.npz".format(path[:-4], os.getpid())
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            np.savez(tmp_path, b=np.asarray(b_), metadata=np.array([int(getattr(standardizer, k)) for k in _standardform_metadata]), **arrays)
+            os.replace(tmp_path, path)
+        except OSError:
+            warn("Could not cache the standard form to {}".format(path))
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+    return standardizer, A_, b_
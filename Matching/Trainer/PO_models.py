@@ -1,6 +1,6 @@
 
 from Trainer.NNModels import cora_net, cora_normednet, cora_nosigmoidnet
-from Trainer.utils import regret_fn, regret_list, growpool_fn, abs_regret_fn
+from Trainer.utils import regret_fn, regret_list, growpool_fn, abs_regret_fn, SolutionPool, AsyncGrowth, batch_solve, SolvePipeline
 from Trainer.diff_layer import *
 from DPO import perturbations
 from DPO import fenchel_young as fy
@@ -9,7 +9,8 @@ from imle.target import TargetDistribution
 from imle.noise import SumOfGammaNoiseDistribution
 import pandas as pd
 
-import numpy as np 
+import numpy as np
+from functools import partial 
 from torch import nn, optim
 from tqdm.auto import tqdm
 import torch 
@@ -20,7 +21,7 @@ import pytorch_lightning as pl
 
 
 class baseline_mse(pl.LightningModule):
-    def __init__(self,solver,lr=1e-1,mode='sigmoid',n_layers=2,seed=0,scheduler=False, **kwd):
+    def __init__(self,solver,lr=1e-1,mode='sigmoid',n_layers=2,seed=0,scheduler=False, pipelined=False, **kwd):
         super().__init__()
         pl.seed_everything(seed)
         if mode=='sigmoid':
@@ -35,6 +36,8 @@ class baseline_mse(pl.LightningModule):
         self.lr = lr
         self.solver = solver
         self.scheduler = scheduler
+        ### if pipelined, the regrets of the validation and test batches are solved in the background (see SolvePipeline)
+        self.pipeline = SolvePipeline() if pipelined else None
         self.save_hyperparameters("lr")
 
     def forward(self,x):
@@ -46,12 +49,41 @@ class baseline_mse(pl.LightningModule):
         loss = criterion(y_hat,y)
         self.log("train_loss",loss, prog_bar=True, on_step=True, on_epoch=True, )
         return loss
+    def regrets(self, stage, y_hat, y, sol, m):
+        '''
+        The metrics of a batch which need the solver
+        '''
+        return {"{}_regret".format(stage): regret_fn(self.solver,y_hat,y,sol,m),
+            "{}_abs_regret".format(stage): abs_regret_fn(self.solver,y_hat,y,sol,m)}
+    def pipelined_step(self, stage, y_hat, y, sol, m):
+        '''
+        The validation and test steps of the pipelined mode: the regrets are solved in the background
+        and logged at the end of the epoch
+        '''
+        self.pipeline.submit(self.regrets, stage, y_hat.detach(), y, sol, m, batch_size=len(y))
+        criterion1 = nn.MSELoss(reduction='mean')
+        mseloss = criterion1(y_hat, y)
+        if self.mode!= "sigmoid":
+           y_hat = torch.sigmoid(y_hat)
+        criterion2 = nn.BCELoss(reduction='mean')
+        bceloss = criterion2(y_hat, sol)
+        self.log("{}_mse".format(stage), mseloss, prog_bar=True, on_step=False, on_epoch=True, )
+        self.log("{}_bce".format(stage), bceloss, prog_bar=True, on_step=False, on_epoch=True, )
+        return {"{}_mse".format(stage): mseloss}
+    def on_validation_epoch_end(self):
+        if self.pipeline is not None:
+            for k,v in self.pipeline.means(self.pipeline.wait()).items():
+                self.log(k, v, prog_bar=True)
+    def on_test_epoch_end(self):
+        self.on_validation_epoch_end()
     def validation_step(self, batch, batch_idx):
         solver = self.solver
         
         x,y,sol,m = batch
 
         y_hat =  self(x).squeeze()
+        if self.pipeline is not None:
+            return self.pipelined_step("val", y_hat, y, sol, m)
         val_loss= regret_fn(solver,y_hat,y,sol,m)
         abs_val_loss= abs_regret_fn(solver,y_hat,y,sol,m)
         criterion1 = nn.MSELoss(reduction='mean')
@@ -75,6 +107,8 @@ class baseline_mse(pl.LightningModule):
         
         x,y,sol,m = batch
         y_hat =  self(x).squeeze()
+        if self.pipeline is not None:
+            return self.pipelined_step("test", y_hat, y, sol, m)
         val_loss= regret_fn(solver,y_hat,y,sol,m)
         abs_val_loss= abs_regret_fn(solver,y_hat,y,sol,m)
         criterion1 = nn.MSELoss(reduction='mean')
@@ -127,7 +161,7 @@ class baseline_mse(pl.LightningModule):
 
 class baseline_bce(baseline_mse):
     def __init__(self,solver,lr=1e-1,mode='sigmoid',n_layers=2,seed=0,scheduler=False, **kwd):
-            super().__init__(solver,lr,mode,n_layers,seed, scheduler) 
+            super().__init__(solver,lr,mode,n_layers,seed, scheduler, **kwd) 
     def training_step(self, batch, batch_idx):
         x,y,sol,m = batch
         y_hat =  self(x).squeeze()
@@ -139,7 +173,7 @@ class baseline_bce(baseline_mse):
 
 class SPO(baseline_mse):
     def __init__(self,solver, lr=1e-1,mode='sigmoid',n_layers=2,seed=0,scheduler=False, **kwd):
-        super().__init__(solver,lr,mode,n_layers,seed, scheduler)
+        super().__init__(solver,lr,mode,n_layers,seed, scheduler, **kwd)
         self.layer = SPOlayer(solver)
         # self.automatic_optimization = False
     def training_step(self, batch, batch_idx):
@@ -151,7 +185,7 @@ class SPO(baseline_mse):
 
 class DBB(baseline_mse):
     def __init__(self, solver,lr=1e-1,lambda_val=0.1,mode='sigmoid',n_layers=2, seed=0,scheduler=False, **kwd):
-        super().__init__(solver,lr,mode,n_layers,seed, scheduler)
+        super().__init__(solver,lr,mode,n_layers,seed, scheduler, **kwd)
         self.layer = DBBlayer(solver,lambda_val=lambda_val)
     def training_step(self, batch, batch_idx):
         x,y,sol,m = batch
@@ -166,7 +200,7 @@ class FenchelYoung(baseline_mse):
         lr=1e-1,mode='sigmoid',n_layers=2, seed=0,scheduler=False, **kwd):
         self.sigma = sigma
         self.num_samples = num_samples
-        super().__init__(solver,lr,mode,n_layers,seed, scheduler)
+        super().__init__(solver,lr,mode,n_layers,seed, scheduler, **kwd)
     def training_step(self, batch, batch_idx):
         x,y,sol,m = batch
         y_hat =  self(x).squeeze()
@@ -195,7 +229,7 @@ class DPO(baseline_mse):
         lr=1e-1,mode='sigmoid',n_layers=2, seed=0,scheduler=False, **kwd):
         self.sigma = sigma
         self.num_samples = num_samples
-        super().__init__(solver,lr,mode,n_layers,seed, scheduler)
+        super().__init__(solver,lr,mode,n_layers,seed, scheduler, **kwd)
     def training_step(self, batch, batch_idx):
         x,y,sol,m = batch
         y_hat =  self(x).squeeze()
@@ -222,7 +256,7 @@ class IMLE(baseline_mse):
             temperature=1.0,
             lr=1e-1,mode='sigmoid',n_layers=2, seed=0,scheduler=False, **kwd):
 
-        super().__init__(solver,lr,mode,n_layers,seed, scheduler) 
+        super().__init__(solver,lr,mode,n_layers,seed, scheduler, **kwd) 
 
         self.target_distribution = TargetDistribution(alpha=1.0, beta=beta)
         self.noise_distribution = SumOfGammaNoiseDistribution(k= k, nb_iterations= nb_iterations)
@@ -261,7 +295,7 @@ import cvxpy as cp
 from cvxpylayers.torch import CvxpyLayer
 class DCOL(baseline_mse):
     def __init__(self, solver,lr=1e-1,mu=0.1,mode='sigmoid',n_layers=2, seed=0,scheduler=False, **kwd):
-        super().__init__(solver,lr,mode,n_layers,seed, scheduler)
+        super().__init__(solver,lr,mode,n_layers,seed, scheduler, **kwd)
         self.mu = mu
     def training_step(self, batch, batch_idx):
         mu = self.mu
@@ -285,7 +319,7 @@ from intopt.intopt import intopt_nonbacthed
 class IntOpt(baseline_mse):
     def __init__(self, solver,lr=1e-1,mu=0.1,mode='sigmoid',n_layers=2, seed=0,scheduler=False,
         thr= 1e-8, damping= 1e-5, diffKKT = False, dopresolve = True, **kwd):
-        super().__init__(solver,lr,mode,n_layers,seed, scheduler)
+        super().__init__(solver,lr,mode,n_layers,seed, scheduler, **kwd)
         self.thr, self.damping, self.diffKKT, self.dopresolve = thr, damping, diffKKT, dopresolve
 
     def training_step(self, batch, batch_idx):
@@ -304,10 +338,18 @@ class IntOpt(baseline_mse):
 from Trainer.CacheLosses import *
 class CachingPO(baseline_mse):
     def __init__(self,solver,init_cache,tau=1.,growth=0.1,loss="listwise",
-        lr=1e-1,mode='sigmoid',n_layers=2, seed=0,scheduler=False, **kwd):
+        lr=1e-1,mode='sigmoid',n_layers=2, seed=0,scheduler=False, pool_size=None, eviction="lru", packed=False,
+        growth_mode="sync", growth_workers=1, max_pending=2, deterministic_growth=False, **kwd):
         '''tau: the margin parameter for pairwise ranking / temperatrure for listwise ranking
+        pool_size: maximum number of solutions in the cache, None for no limit
+        eviction: which solution leaves a full cache, "lru" or "violation" (see SolutionPool)
+        packed: store the cache bit-packed (see PackedSolutions)
+        growth_mode: "sync", or grow the cache in the background with "thread" or "process" workers (see AsyncGrowth)
+        growth_workers, max_pending, deterministic_growth: the workers, the bound of the batches being solved and
+            whether to merge them in a deterministic order, for the background growth;
+            the worker threads share the solver, so they solve one batch at a time
         '''
-        super().__init__(solver,lr,mode,n_layers,seed, scheduler) 
+        super().__init__(solver,lr,mode,n_layers,seed, scheduler, **kwd) 
         # self.save_hyperparameters()
         if loss=="pointwise":
             self.loss_fn = PointwiseLoss()
@@ -330,11 +372,12 @@ class CachingPO(baseline_mse):
         else:
             raise Exception("Invalid Loss Provided")
         self.growth = growth
-        cache_np = init_cache.detach().numpy()
-        cache_np = np.unique(cache_np,axis=0)
-        # torch has no unique function, so we have to do this
-        init_cache =  torch.from_numpy(cache_np).float()
-        self.cache = init_cache
+        ### the cache, deduplicated by the pool; self.cache is its view
+        self.pool = SolutionPool(init_cache, max_size=pool_size, eviction=eviction, minimize=False, packed=packed)
+        self.cache = self.pool.view()
+        ### the background growth of the pool, None for the synchronous one
+        self.grower = None if growth_mode == "sync" else AsyncGrowth(self.pool, partial(batch_solve, self.solver), growth_mode,
+            growth_workers, max_pending, deterministic_growth)
 
     
 
@@ -342,10 +385,28 @@ class CachingPO(baseline_mse):
         x,y,sol,m = batch
         y_hat =  self(x).squeeze()
         
+        self.pool.touch(y_hat)
+        if self.grower is not None:
+            self.cache = self.grower.merge()
         if (np.random.random(1)[0]< self.growth) or len(self.cache)==0:
-            self.cache= growpool_fn(self.solver,self.cache, y_hat,m)
+            if self.grower is not None and len(self.cache) > 0:
+                self.grower.submit(y_hat, m)
+            else:
+                self.cache = growpool_fn(self.solver,self.pool, y_hat,m)
 
         loss = self.loss_fn(y_hat,y,sol,self.cache)
         self.log("train_loss",loss, prog_bar=True, on_step=True, on_epoch=True, )
         return loss 
 
+    def on_validation_epoch_start(self):
+        ### the validation shares the solver with the growth workers, so they finish first
+        if self.grower is not None:
+            self.cache = self.grower.merge(wait=True)
+
+    def on_test_epoch_start(self):
+        self.on_validation_epoch_start()
+
+    def on_train_end(self):
+        if self.grower is not None:
+            self.grower.close()
+
@@ -3,6 +3,7 @@ from torch.utils.data import DataLoader
 import numpy as np
 import pytorch_lightning as pl
 import torch 
+from Trainer.utils import SolutionPool
 from torch.utils.data import DataLoader 
 import tqdm
 class CoraDatawrapper():
@@ -29,13 +30,18 @@ class CoraDatawrapper():
 
 
 
-def return_trainlabel(solver,params):
+def return_trainlabel(solver,params, packed=False):
+    '''
+    The distinct solutions of the training instances, bit-packed as PackedSolutions if packed
+    '''
     x, y,m = get_cora()
 
     y_train, y_test = y[:22], y[22:]
     m_train, m_test = m[:22], m[22:]
     y_iter = range(len(y_train))
     sols = np.array([solver.solve(y[i], m[i], **params) for i in y_iter])
+    if packed:
+        return SolutionPool(sols, packed=True).view()
     sols = np.unique(sols,axis=0)  
     return  torch.from_numpy (sols)
 
@@ -1,6 +1,13 @@
 # from Trainer.bipartite import  bmatching_diverse, get_qpt_matrices
 import torch
 import numpy as np
+import os, sys
+### the helpers shared by all the problems are in common_utils, at the root of the repository
+_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+if _root not in sys.path:
+    sys.path.append(_root)
+from common_utils import (SolutionPool, PackedSolutions, PackedObjective, popcount, AsyncGrowth, SolvePipeline, run_seeds,
+    shared, sweep_callbacks, append_csv, memo_solver, SolverPool)
 
 # solver = bmatching_diverse
 # objective_fun=lambda x,v,**params: x @ v
@@ -9,6 +16,8 @@ def batch_solve(solver,y,m,relaxation =False,batched= True):
 
     if batched:
         ### y, m both are of dim (*,2500)
+        if hasattr(solver, "batched_solve"):
+            return torch.from_numpy(np.asarray(solver.batched_solve(y.detach().numpy(), m.numpy(), relaxation=relaxation))).float()
         sol = []
 
         for i in range(len(y)):
@@ -47,11 +56,10 @@ def abs_regret_fn(solver,y_hat,y_true,sol_true,m,minimize=False):
 
 def growpool_fn(solver,cache, y_hat, m):
     '''
-    cache is torch array [currentpoolsize,48]
+    cache is a SolutionPool of solutions [currentpoolsize,48]
     y_hat is  torch array [batch_size,48]
+    returns the view of the grown cache
     '''
     sol = batch_solve(solver,y_hat,m).detach().numpy()
-    cache_np = cache.detach().numpy()
-    cache_np = np.unique(np.append(cache_np,sol,axis=0),axis=0)
-    # torch has no unique function, so we have to do this
-    return torch.from_numpy(cache_np).float()
\ No newline at end of file
+    cache.add(sol)
+    return cache.view()
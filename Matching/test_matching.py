@@ -11,6 +11,8 @@ from Trainer.PO_models import *
 from pytorch_lightning.callbacks import ModelCheckpoint
 from Trainer.data_utils import CoraMatchingDataModule, return_trainlabel
 from Trainer.bipartite import bmatching_diverse
+from Trainer.utils import memo_solver, SolverPool, run_seeds, shared, sweep_callbacks, append_csv
+from functools import partial
 from distutils.util import strtobool
 
 params_dict = { "1":{'p':0.1, 'q':0.1}, "2":{'p':0.25, 'q':0.25},"3":{'p':0.5, 'q':0.5},  }
@@ -47,6 +49,19 @@ parser.add_argument("--diffKKT",  action='store_true', help="Whether KKT or HSD
 
 parser.add_argument("--tau", type=float, help="parameter of rankwise losses", default= 1e-8)
 parser.add_argument("--growth", type=float, help="growth parameter of rankwise losses", default= 1e-8)
+parser.add_argument("--pool_size", type=int, help="maximum number of solutions in the cache of rankwise losses", default= None, required=False)
+parser.add_argument("--eviction", type=str, help="which solution leaves a full cache: lru or violation", default= "lru", required=False)
+parser.add_argument("--packed",  action='store_true', help="Store the cache of rankwise losses bit-packed",  required=False)
+parser.add_argument("--growth_mode", type=str, help="grow the cache of rankwise losses in sync, or in the background with thread or process workers", default= "sync", required=False)
+parser.add_argument("--growth_workers", type=int, help="number of background workers growing the cache; the thread workers share the solver and solve one batch at a time", default= 1, required=False)
+parser.add_argument("--max_pending", type=int, help="maximum number of batches being solved in the background", default= 2, required=False)
+parser.add_argument("--memo",  action='store_true', help="Serve the exact solves of bit-identical costs from a memo",  required=False)
+parser.add_argument("--solver_workers", type=int, help="number of worker processes solving the batches, 0 to solve them in this process", default= 0, required=False)
+parser.add_argument("--deterministic_growth",  action='store_true', help="Merge the background solutions in a deterministic order",  required=False)
+parser.add_argument("--pipelined",  action='store_true', help="Solve the validation and test batches in the background, while the network computes the next ones",  required=False)
+parser.add_argument("--seed_workers", type=int, help="number of seeds run at the same time, each in its own process", default= 1, required=False)
+parser.add_argument("--threads_per_worker", type=int, help="number of torch threads of every seed process, 0 for the number of cores over seed_workers", default= 0, required=False)
+parser.add_argument("--output_tag", type=str, help="tag of the checkpoint and log directories, e.g. to run several configurations at the same time", default= "", required=False)
 
 parser.add_argument('--scheduler', dest='scheduler',  type=lambda x: bool(strtobool(x)))
 args = parser.parse_args()
@@ -63,15 +78,26 @@ argument_dict = vars(args)
 get_class = lambda x: globals()[x]
 modelcls = get_class(argument_dict['model'])
 modelname = argument_dict.pop('model')
+### how the seeds are run and where they keep their checkpoints, which are not part of the results
+seed_workers = argument_dict.pop('seed_workers')
+threads_per_worker = argument_dict.pop('threads_per_worker')
+output_tag = argument_dict.pop('output_tag')
+memo = argument_dict.pop('memo')
 sentinel_ns = Namespace(**{key:sentinel for key in argument_dict})
 parser.parse_args(namespace=sentinel_ns)
 
 explicit = {key:value for key, value in vars(sentinel_ns).items() if value is not sentinel }
 ######## Solver for this instance
 params = params_dict[ argument_dict['instance']]
-solver = bmatching_diverse(**params)
+### with --solver_workers, every worker process solves with its own instance of the solver;
+### the solver, its memo and its workers are reused by the configurations run in the same process
+def make_solver():
+    solver = SolverPool(partial(bmatching_diverse, **params), argument_dict['solver_workers']) if argument_dict['solver_workers'] > 1 else bmatching_diverse(**params)
+    return memo_solver(solver) if memo else solver
+solver = shared(("solver", argument_dict['instance'], argument_dict['solver_workers'], memo), make_solver)
 if modelname=="CachingPO":
-    cache = return_trainlabel( solver,params )
+    cache = shared(("cache", argument_dict['instance'], argument_dict['packed']),
+        lambda: return_trainlabel( solver,params, packed=argument_dict['packed'] ))
 # ###################################### Hyperparams #########################################
 
 
@@ -88,18 +114,24 @@ def seed_all(seed):
 # ################## Define the outputfile
 outputfile = "Rslt/{}matching{}{}.csv".format(modelname, args.loss,  args.instance)
 regretfile = "Rslt/{}matchingRegret{}{}.csv".format(modelname,   args.loss,args.instance)
-ckpt_dir =  "ckpt_dir/{}{}{}/".format(modelname,  args.loss,args.instance)
-log_dir = "lightning_logs/{}{}{}/".format(modelname,  args.loss,args.instance)
+ckpt_dir =  "ckpt_dir/{}{}{}{}/".format(modelname,  args.loss,args.instance, output_tag)
+log_dir = "lightning_logs/{}{}{}{}/".format(modelname,  args.loss,args.instance, output_tag)
 
 learning_curve_datafile = "LearningCurve/{}_".format(modelname)+"_".join( ["{}_{}".format(k,v) for k,v  in explicit.items()] )+".csv"  
 
 shutil.rmtree(log_dir,ignore_errors=True)
 
-for seed in range(10):
-    shutil.rmtree(ckpt_dir,ignore_errors=True)
+### the datasets and their solutions do not depend on the seed, so they are built once and shared by all the seeds
+data =  shared(("data", argument_dict['instance'], argument_dict['batch_size']), lambda: CoraMatchingDataModule(solver,params= params, 
+batch_size= argument_dict['batch_size'], num_workers=4))
+
+def run_seed(seed):
+    ### every seed has its own checkpoints, as the seeds may run at the same time
+    seed_ckpt_dir = ckpt_dir + "seed{}/".format(seed)
+    shutil.rmtree(seed_ckpt_dir,ignore_errors=True)
     checkpoint_callback = ModelCheckpoint(
                     # monitor="val_regret",mode="min",
-                    dirpath=ckpt_dir, 
+                    dirpath=seed_ckpt_dir, 
                     filename="model-{epoch:02d}-{val_regret:.8f}",
                     
                 )
@@ -108,8 +140,8 @@ for seed in range(10):
     g = torch.Generator()
     g.manual_seed(seed)
 
-    data =  CoraMatchingDataModule(solver,params= params, 
-    batch_size= argument_dict['batch_size'], generator=g, num_workers=4)
+    ### only the order of the batches depends on the seed
+    data.generator = g
     tb_logger = pl_loggers.TensorBoardLogger(save_dir= log_dir, version=seed)
     if modelname=="CachingPO":
         model = modelcls(init_cache=cache, solver=solver,seed=seed, **argument_dict)
@@ -117,7 +149,7 @@ for seed in range(10):
         model = modelcls(solver=solver,seed=seed, **argument_dict)
 
     trainer = pl.Trainer(max_epochs=  argument_dict['max_epochs'], min_epochs=3, 
-    logger=tb_logger, callbacks=[checkpoint_callback])
+    logger=tb_logger, callbacks=[checkpoint_callback] + sweep_callbacks())
     trainer.fit(model, datamodule=data)
 
     best_model_path = checkpoint_callback.best_model_path
@@ -132,14 +164,11 @@ for seed in range(10):
     regret_list = trainer.predict(model, data.test_dataloader())
     
 
-    df = pd.DataFrame({"regret":regret_list[0].tolist()})
-    df.index.name='instance'
+    regret_df = pd.DataFrame({"regret":regret_list[0].tolist()})
+    regret_df.index.name='instance'
     for k,v in explicit.items():
-        df[k] = v
-    df['seed']= seed
- 
-    with open(regretfile, 'a') as f:
-        df.to_csv(f, header=f.tell()==0)
+        regret_df[k] = v
+    regret_df['seed']= seed
 
 
     testresult = trainer.test(model, datamodule=data)
@@ -147,9 +176,15 @@ for seed in range(10):
     for k,v in explicit.items():
         df[k] = v
     df['seed']= seed
+    if memo:
+        print("Exact solver memo after seed {}: {}".format(seed, solver.summary()))
+
+    return [(regretfile, regret_df), (outputfile, df)]
 
-    with open(outputfile, 'a') as f:
-            df.to_csv(f, header=f.tell()==0)
+### the results are written here, in the order of the seeds, however many seeds run at the same time
+for seed, results in run_seeds(run_seed, range(10), seed_workers, threads_per_worker):
+    for path, df in results:
+        append_csv(path, df)
 
 
 ###############################  Save  Learning Curve Data ########
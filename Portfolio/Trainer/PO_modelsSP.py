@@ -8,7 +8,7 @@ import pytorch_lightning as pl
 import numpy as np
 
 from Trainer.diff_layer import *
-from Trainer.utils import  regret_fn, regret_list, abs_regret_fn, growcache
+from Trainer.utils import  regret_fn, regret_list, abs_regret_fn, growcache, SolutionPool
 # from Trainer.optimizer_module import spsolver, cvxsolver,  qpsolver, intoptsolver
 from imle.wrapper import imle
 from imle.target import TargetDistribution
@@ -178,7 +178,7 @@ class DBB(baseline):
 from Trainer.CacheLosses import *
 class CachingPO(baseline):
     def __init__(self,loss,init_cache, net,exact_solver,  cov, gamma, growth=0.1,tau=0.,lr=1e-1,
-        l1_weight=1e-5,max_epochs=30, seed=20, scheduler=False, **kwd):
+        l1_weight=1e-5,max_epochs=30, seed=20, scheduler=False, pool_size=None, eviction="lru", **kwd):
         """
         A class to implement loss functions using soluton cache
         Args:
@@ -192,6 +192,8 @@ class CachingPO(baseline):
             l1_weight: the lasso regularization weight
             max_epoch: maximum number of epcohs
             seed: seed for reproducibility 
+            pool_size: maximum number of solutions in the cache, None for no limit
+            eviction: which solution leaves a full cache, "lru" or "violation" (see SolutionPool)
 
         """
         super().__init__(net,exact_solver, cov, gamma, lr, l1_weight,max_epochs, seed, scheduler)
@@ -216,11 +218,9 @@ class CachingPO(baseline):
             self.loss_fn = MAP_c_actual()
         else:
             raise Exception("Invalid Loss Provided")
-        ### The cache
-        init_cache_np = init_cache.detach().numpy()
-        init_cache_np = np.unique(init_cache_np,axis=0)
-        # torch has no unique function, so we have to do this
-        self.cache = torch.from_numpy(init_cache_np).float()
+        ### The cache, deduplicated by the pool; self.cache is its torch view
+        self.pool = SolutionPool(init_cache, max_size=pool_size, eviction=eviction, minimize=False)
+        self.cache = self.pool.view()
         self.growth = growth
         self.tau = tau
         self.save_hyperparameters("lr","growth","tau")
@@ -229,8 +229,9 @@ class CachingPO(baseline):
     def training_step(self, batch, batch_idx):
         x,y, sol = batch
         y_hat =  self(x).squeeze()
+        self.pool.touch(y_hat)
         if (np.random.random(1)[0]<= self.growth) or len(self.cache)==0:
-            self.cache = growcache(self.exact_solver, self.cache, y_hat)
+            self.cache = growcache(self.exact_solver, self.pool, y_hat)
 
   
         loss = self.loss_fn(y_hat,y,sol,self.cache)
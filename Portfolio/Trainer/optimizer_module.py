@@ -50,6 +50,7 @@ class gurobi_portfolio_solver:
 import cvxpy as cp
 import cvxpylayers
 from cvxpylayers.torch import CvxpyLayer
+from Trainer.utils import get_cvxpylayer
 
 ### Build cvxpy model prototype
 class cvxsolver:
@@ -65,10 +66,9 @@ class cvxsolver:
         self.n_stocks =  n_stocks
         self.mu = mu
         self.regularizer = regularizer
-    
-
-
-
+        self.layer = get_cvxpylayer(self.make_proto, ("portfolio", cov, gamma, n_stocks, mu, regularizer))
+    def make_proto(self):
+        cov, gamma, n_stocks = self.cov, self.gamma, self.n_stocks
         x = cp.Variable(n_stocks)
         constraints = [x >= 0, cp.quad_form( x, cov ) <= gamma, cp.sum(x) <= 1]
         ### Original Model invoves inequality, We once tested  with Equality
@@ -81,7 +81,7 @@ class cvxsolver:
         elif self.regularizer=='entropic':
             objective = cp.Minimize(-c @ x -  self.mu*cp.sum(cp.entr(x)) )
         problem = cp.Problem(objective, constraints)
-        self.layer = CvxpyLayer(problem, parameters=[c], variables=[x])
+        return problem, [c], [x]
     def solution(self, y):
               
         sol, = self.layer(y)
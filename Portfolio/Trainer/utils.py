@@ -1,5 +1,12 @@
 import torch 
 import numpy as np
+import os, sys
+### the helpers shared by all the problems are in common_utils, at the root of the repository
+_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+if _root not in sys.path:
+    sys.path.append(_root)
+from common_utils import (SolutionPool, run_seeds, shared, sweep_callbacks, append_csv, get_cvxpylayer,
+    set_cvxpylayer_cache)
 
 def batch_solve(solver, y,relaxation =False):
     sol = []
@@ -30,11 +37,25 @@ def abs_regret_fn(solver, y_hat,y_true, sol_true, minimize = False):
 
 def growcache(solver, cache, y_hat):
     '''
-    cache is torch array [currentpoolsize,48]
+    cache is a SolutionPool of solutions [currentpoolsize,48]
     y_hat is  torch array [batch_size,48]
+    returns the grown cache as torch array
     '''
     sol = batch_solve(solver, y_hat,relaxation =False).detach().numpy()
-    cache_np = cache.detach().numpy()
-    cache_np = np.unique(np.append(cache_np,sol,axis=0),axis=0)
-    # torch has no unique function, so we need to do this
-    return torch.from_numpy(cache_np).float()
\ No newline at end of file
+    cache.add(sol)
+    return cache.view()
+
+
+########################## Memoized exact solver ##########################
+from common_utils.memo import memo_solver as common_memo_solver
+
+class memo_solver(common_memo_solver):
+    '''
+    common_utils.memo.memo_solver with the solution_fromtorch of the portfolio solver
+    '''
+    def solution_fromtorch(self, y_torch):
+        y = y_torch.unsqueeze(0) if y_torch.dim()==1 else y_torch
+        sol = torch.from_numpy(self.batched_solve(y.detach().cpu().numpy())).float()
+        return sol[0] if y_torch.dim()==1 else sol
+
+
@@ -11,6 +11,7 @@ from argparse import Namespace
 from tensorboard.backend.event_processing.event_accumulator import EventAccumulator
 from distutils.util import strtobool
 from Trainer.optimizer_module import gurobi_portfolio_solver
+from Trainer.utils import memo_solver, run_seeds, shared, sweep_callbacks, append_csv, set_cvxpylayer_cache
 
 net_layers = [nn.BatchNorm1d(5),nn.Linear(5,50)]
 batchnorm_net = nn.Sequential(*net_layers)
@@ -63,6 +64,13 @@ parser.add_argument("--diffKKT",  action='store_true', help="Whether KKT or HSD
 
 parser.add_argument("--tau", type=float, help="parameter of rankwise losses", default= 1e-8)
 parser.add_argument("--growth", type=float, help="growth parameter of rankwise losses", default= 1e-8)
+parser.add_argument("--pool_size", type=int, help="maximum number of solutions in the cache of rankwise losses", default= None, required=False)
+parser.add_argument("--eviction", type=str, help="which solution leaves a full cache: lru or violation", default= "lru", required=False)
+parser.add_argument("--memo",  action='store_true', help="Serve the exact solves of bit-identical costs from a memo",  required=False)
+parser.add_argument("--seed_workers", type=int, help="number of seeds run at the same time, each in its own process", default= 1, required=False)
+parser.add_argument("--threads_per_worker", type=int, help="number of torch threads of every seed process, 0 for the number of cores over seed_workers", default= 0, required=False)
+parser.add_argument("--output_tag", type=str, help="tag of the checkpoint and log directories, e.g. to run several configurations at the same time", default= "", required=False)
+parser.add_argument("--cvxpylayer_cache_dir", type=str, help="directory caching the compiled cvxpylayers of DCOL across runs, none by default; only trusted runs may write to it", default= None, required=False)
 
 parser.add_argument('--scheduler', dest='scheduler',  type=lambda x: bool(strtobool(x)))
 args = parser.parse_args()
@@ -81,6 +89,12 @@ network_name = argument_dict.pop('net')
 N = argument_dict.pop('N')
 noise = argument_dict.pop('noise')
 deg = argument_dict.pop('deg')
+### how the seeds are run and where they keep their checkpoints, which are not part of the results
+seed_workers = argument_dict.pop('seed_workers')
+threads_per_worker = argument_dict.pop('threads_per_worker')
+output_tag = argument_dict.pop('output_tag')
+memo = argument_dict.pop('memo')
+set_cvxpylayer_cache(argument_dict.pop('cvxpylayer_cache_dir'))
 
 
 
@@ -101,8 +115,8 @@ def seed_all(seed):
 ################## Define the outputfile
 outputfile = "Rslt/{}{}.csv".format(modelname,args.loss)
 regretfile = "Rslt/{}{}Regret.csv".format(modelname,args.loss)
-ckpt_dir =  "ckpt_dir/{}{}/".format(modelname, args.loss)
-log_dir = "lightning_logs/{}{}/".format(modelname, args.loss)
+ckpt_dir =  "ckpt_dir/{}{}{}/".format(modelname, args.loss, output_tag)
+log_dir = "lightning_logs/{}{}{}/".format(modelname, args.loss, output_tag)
 learning_curve_datafile =    "LearningCurve/{}_".format(modelname)+"_".join( ["{}_{}".format(k,v) for k,v  in explicit.items()] )+".csv" 
 
 
@@ -124,7 +138,11 @@ y_test = Test_dfy.T.values.astype(np.float32)
 data =  np.load('SyntheticPortfolioData/GammaSigma_N_{}_noise_{}_deg_{}.npz'.format(N,noise,deg))
 cov = data['sigma']
 gamma = data['gamma']
-portfolio_solver = gurobi_portfolio_solver(cov= cov, gamma=gamma)
+### the solver, and with --memo its memo, are reused by the configurations run in the same process
+def make_portfolio_solver():
+    solver = gurobi_portfolio_solver(cov= cov, gamma=gamma)
+    return memo_solver(solver) if memo else solver
+portfolio_solver = shared(("portfolio_solver", N, noise, deg, memo), make_portfolio_solver)
 
 
 train_df =  datawrapper( x_train,y_train, solver=portfolio_solver )
@@ -132,7 +150,12 @@ valid_df =  datawrapper( x_valid,y_valid, solver=portfolio_solver)
 test_df =  datawrapper( x_test,y_test, solver=portfolio_solver)
 shutil.rmtree(log_dir,ignore_errors=True)
 
-for seed in range(10):
+### the solutions do not depend on the seed, so they are computed once and shared by all the seeds
+if modelname=="CachingPO":
+    init_cache = batch_solve(portfolio_solver, torch.from_numpy(y_train),relaxation =False)
+sol_test =  batch_solve(portfolio_solver, torch.from_numpy(y_test).float())
+
+def run_seed(seed):
     seed_all(seed)
 
     g = torch.Generator()
@@ -141,18 +164,19 @@ for seed in range(10):
     net = network_dict[network_name]
 
 
-    shutil.rmtree(ckpt_dir,ignore_errors=True)
+    ### every seed has its own checkpoints, as the seeds may run at the same time
+    seed_ckpt_dir = ckpt_dir + "seed{}/".format(seed)
+    shutil.rmtree(seed_ckpt_dir,ignore_errors=True)
     checkpoint_callback = ModelCheckpoint(
         # monitor="val_regret",mode="min",
-        dirpath=ckpt_dir, 
+        dirpath=seed_ckpt_dir, 
         filename="model-{epoch:02d}-{val_loss:.2f}",
     )
     
     
     tb_logger = pl_loggers.TensorBoardLogger(save_dir= log_dir, version=seed)
-    trainer = pl.Trainer(max_epochs= argument_dict['max_epochs'], callbacks=[checkpoint_callback],  min_epochs=5, logger=tb_logger)
+    trainer = pl.Trainer(max_epochs= argument_dict['max_epochs'], callbacks=[checkpoint_callback] + sweep_callbacks(),  min_epochs=5, logger=tb_logger)
     if modelname=="CachingPO":
-        init_cache = batch_solve(portfolio_solver, torch.from_numpy(y_train),relaxation =False)
         model = modelcls(exact_solver = portfolio_solver, cov=cov, gamma=gamma,  net= net,seed=seed, init_cache=init_cache, **argument_dict)
     else:
         model = modelcls(exact_solver = portfolio_solver, cov=cov, gamma=gamma, net= net ,seed=seed, **argument_dict)
@@ -163,23 +187,19 @@ for seed in range(10):
     
     best_model_path = checkpoint_callback.best_model_path
     if modelname=="CachingPO":
-        init_cache = batch_solve(portfolio_solver, torch.from_numpy(y_train),relaxation =False)
         model = modelcls.load_from_checkpoint(best_model_path,  exact_solver = portfolio_solver, cov=cov, gamma=gamma,  seed=seed, net= net, init_cache=init_cache, **argument_dict)
     else:
         model = modelcls.load_from_checkpoint(best_model_path,   exact_solver = portfolio_solver, cov=cov, gamma=gamma,  net= net,seed=seed, **argument_dict)
 
 
     y_pred = model(torch.from_numpy(x_test).float()).squeeze()
-    sol_test =  batch_solve(portfolio_solver, torch.from_numpy(y_test).float())
     regret_list_data = regret_list(portfolio_solver, y_pred, torch.from_numpy(y_test).float(), sol_test)
 
-    df = pd.DataFrame({"regret":regret_list_data})
-    df.index.name='instance'
-    df['seed'] =seed
+    regret_df = pd.DataFrame({"regret":regret_list_data})
+    regret_df.index.name='instance'
+    regret_df['seed'] =seed
     for k,v in explicit.items():
-        df[k] = v
-    with open(regretfile, 'a') as f:
-        df.to_csv(f, header=f.tell()==0)
+        regret_df[k] = v
 
 
     ##### Summary
@@ -189,8 +209,14 @@ for seed in range(10):
     df['seed'] =seed
     for k,v in explicit.items():
         df[k] = v
-    with open(outputfile, 'a') as f:
-        df.to_csv(f, header=f.tell()==0)
+    if memo:
+        print("Exact solver memo after seed {}: {}".format(seed, portfolio_solver.summary()))
+    return [(regretfile, regret_df), (outputfile, df)]
+
+### the results are written here, in the order of the seeds, however many seeds run at the same time
+for seed, results in run_seeds(run_seed, range(10), seed_workers, threads_per_worker):
+    for path, df in results:
+        append_csv(path, df)
 ###############################  Save  Learning Curve Data ########
 import os
 from tensorboard.backend.event_processing.event_accumulator import EventAccumulator
@@ -216,5 +242,4 @@ df = pd.DataFrame({"step": steps,'wall_time':walltimes,  "val_abs_regret": regre
 "val_mse": mses })
 for k,v in explicit.items():
     df[k] = v
-with open( learning_curve_datafile, 'a') as f:
-    df.to_csv(f, header=f.tell()==0)
+append_csv(learning_curve_datafile, df)
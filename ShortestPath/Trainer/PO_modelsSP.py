@@ -6,10 +6,11 @@ import torch.nn.functional as F
 from torch.utils.data import DataLoader
 import pytorch_lightning as pl
 import numpy as np
+from functools import partial
 
 from Trainer.diff_layer import *
-from Trainer.utils import  regret_fn, regret_list, abs_regret_fn, growcache
-from Trainer.optimizer_module import spsolver, cvxsolver,  qpsolver, intoptsolver
+from Trainer.utils import  regret_fn, regret_list, abs_regret_fn, growcache, SolutionPool, PoolArgmin, AsyncGrowth, batch_solve, SolvePipeline
+from Trainer.optimizer_module import spsolver, cvxsolver,  qpsolver, intoptsolver, certified_solver
 from imle.wrapper import imle
 from imle.target import TargetDistribution
 from imle.noise import SumOfGammaNoiseDistribution
@@ -17,7 +18,7 @@ from DPO import perturbations
 from DPO import fenchel_young as fy
 
 class baseline(pl.LightningModule):
-    def __init__(self,net,exact_solver = spsolver, lr=1e-1, l1_weight=1e-5,max_epochs=30, seed=20, scheduler=False, **kwd):
+    def __init__(self,net,exact_solver = spsolver, lr=1e-1, l1_weight=1e-5,max_epochs=30, seed=20, scheduler=False, pipelined=False, **kwd):
         """
         A class to implement two stage mse based model and with test and validation module
         Args:
@@ -27,6 +28,7 @@ class baseline(pl.LightningModule):
             l1_weight: the lasso regularization weight
             max_epoch: maximum number of epcohs
             seed: seed for reproducibility 
+            pipelined: if True, the regrets of the validation and test batches are solved in the background (see SolvePipeline)
         """
         super().__init__()
         pl.seed_everything(seed)
@@ -36,11 +38,12 @@ class baseline(pl.LightningModule):
         self.exact_solver = exact_solver
         self.max_epochs = max_epochs
         self.scheduler = scheduler
+        self.pipeline = SolvePipeline() if pipelined else None
     def forward(self,x):
         return self.net(x) 
     def training_step(self, batch, batch_idx):
         
-        x,y, sol = batch
+        x,y, sol, _ = batch
         
         y_hat =  self(x).squeeze()
         criterion = nn.MSELoss(reduction='mean')
@@ -51,11 +54,31 @@ class baseline(pl.LightningModule):
         self.log("train_l1penalty",l1penalty * self.l1_weight,  on_step=True, on_epoch=True, )
         self.log("train_loss",loss,  on_step=True, on_epoch=True, )
         return training_loss 
+    def regrets(self, stage, y_hat, y, sol):
+        '''
+        The metrics of a batch which need the solver
+        '''
+        return {"{}_regret".format(stage): regret_fn(self.exact_solver, y_hat,y, sol),
+            "{}_abs_regret".format(stage): abs_regret_fn(self.exact_solver, y_hat,y, sol)}
+    def pipelined_step(self, stage, y_hat, y, sol):
+        '''
+        The validation and test steps of the pipelined mode: the regrets are solved in the background
+        and logged at the end of the epoch
+        '''
+        criterion = nn.MSELoss(reduction='mean')
+        mseloss = criterion(y_hat, y)
+        abs_pred = torch.abs( y_hat ).mean()
+        self.pipeline.submit(self.regrets, stage, y_hat.detach(), y, sol, batch_size=len(y))
+        self.log("{}_mse".format(stage), mseloss, prog_bar=True, on_step=False, on_epoch=True, )
+        self.log("val_absolute_value", abs_pred, prog_bar=True, on_step=False, on_epoch=True, )
+        return {"{}_mse".format(stage): mseloss}
     def validation_step(self, batch, batch_idx):
         criterion = nn.MSELoss(reduction='mean')
-        x,y, sol = batch
+        x,y, sol, _ = batch
         
         y_hat =  self(x).squeeze()
+        if self.pipeline is not None:
+            return self.pipelined_step("val", y_hat, y, sol)
         mseloss = criterion(y_hat, y)
         regret_loss =  regret_fn(self.exact_solver, y_hat,y, sol) 
         abs_regret_loss =  abs_regret_fn(self.exact_solver, y_hat,y, sol) 
@@ -71,6 +94,13 @@ class baseline(pl.LightningModule):
 
         return {"val_mse":mseloss, "val_regret":regret_loss}
     def validation_epoch_end(self, outputs):
+        if self.pipeline is not None:
+            ### the regrets of the batches solved in the background
+            results = self.pipeline.wait()
+            for k,v in self.pipeline.means(results).items():
+                self.log(k, v, prog_bar=True)
+            for x, (metrics, _) in zip(outputs, results):
+                x["val_regret"] = metrics["val_regret"]
         avg_regret = torch.stack([x["val_regret"] for x in outputs]).mean()
         avg_mse = torch.stack([x["val_mse"] for x in outputs]).mean()
         
@@ -78,10 +108,16 @@ class baseline(pl.LightningModule):
         self.log("ptl/val_mse", avg_mse)
         # self.log("ptl/val_accuracy", avg_acc)
         
+    def on_test_epoch_end(self):
+        if self.pipeline is not None:
+            for k,v in self.pipeline.means(self.pipeline.wait()).items():
+                self.log(k, v, prog_bar=True)
     def test_step(self, batch, batch_idx):
         criterion = nn.MSELoss(reduction='mean')
-        x,y, sol = batch
+        x,y, sol, _ = batch
         y_hat =  self(x).squeeze()
+        if self.pipeline is not None:
+            return self.pipelined_step("test", y_hat, y, sol)
         mseloss = criterion(y_hat, y)
         regret_loss =  regret_fn(self.exact_solver, y_hat,y, sol) 
         abs_regret_loss =  abs_regret_fn(self.exact_solver, y_hat,y, sol) 
@@ -130,43 +166,55 @@ class baseline(pl.LightningModule):
         return optimizer
 
 class SPO(baseline):
-    def __init__(self,net,exact_solver = spsolver,lr=1e-1, l1_weight=1e-5,max_epochs=30, seed=20, scheduler=False, **kwd):
+    def __init__(self,net,exact_solver = spsolver,lr=1e-1, l1_weight=1e-5,max_epochs=30, seed=20, scheduler=False, certificate=False, **kwd):
         """
         Implementaion of SPO+ loss subclass of twostage model
             loss_fn: loss function 
+            certificate: if True, the solves of the training instances whose last solution is certified optimal are skipped
 
  
         """
-        super().__init__(net,exact_solver, lr, l1_weight,max_epochs, seed, scheduler)
-        self.loss_fn =  SPOlayer(self.exact_solver)
+        super().__init__(net,exact_solver, lr, l1_weight,max_epochs, seed, scheduler, **kwd)
+        self.certified_solver = certified_solver(self.exact_solver) if certificate else None
+        self.loss_fn =  SPOlayer(self.exact_solver if self.certified_solver is None else self.certified_solver)
 
     def training_step(self, batch, batch_idx):
-        x,y, sol = batch
+        x,y, sol, index = batch
         y_hat =  self(x).squeeze()
         loss = 0
         l1penalty = sum([(param.abs()).sum() for param in self.net.parameters()])
         # for ii in range(len(y)):
         #     loss += self.loss_fn(y_hat[ii],y[ii], sol[ii])
-        training_loss = self.loss_fn(y_hat,y, sol)/len(y) + l1penalty * self.l1_weight
+        index = None if self.certified_solver is None else index.tolist()
+        training_loss = self.loss_fn(y_hat,y, sol, index)/len(y) + l1penalty * self.l1_weight
         # training_loss=  loss/len(y)  + l1penalty * self.l1_weight
         self.log("train_totalloss",training_loss, prog_bar=True, on_step=True, on_epoch=True, )
         self.log("train_l1penalty",l1penalty * self.l1_weight,  on_step=True, on_epoch=True, )
         self.log("train_loss",loss/len(y),  on_step=True, on_epoch=True, )
         return training_loss  
+    def on_train_epoch_end(self):
+        if self.certified_solver is not None:
+            for k,v in self.certified_solver.summary().items():
+                if not np.isnan(v):
+                    self.log("train_{}".format(k), v)
+            self.certified_solver.reset_counts()
 
 class DBB(baseline):
     """
     Implemenation of Blackbox differentiation gradient
     """
-    def __init__(self,net,exact_solver = spsolver,lr=1e-1,lambda_val =0.1, l1_weight=1e-5,max_epochs=30, seed=20, scheduler=False, **kwd):
-        super().__init__(net,exact_solver, lr, l1_weight,max_epochs, seed, scheduler)
+    def __init__(self,net,exact_solver = spsolver,lr=1e-1,lambda_val =0.1, l1_weight=1e-5,max_epochs=30, seed=20, scheduler=False, certificate=False, **kwd):
+        super().__init__(net,exact_solver, lr, l1_weight,max_epochs, seed, scheduler, **kwd)
         self.lambda_val = lambda_val
-        self.layer = DBBlayer(self.exact_solver,self.lambda_val)
+        ### if certificate, the solves of the training instances whose last solution is certified optimal are skipped
+        self.certified_solver = certified_solver(self.exact_solver) if certificate else None
+        self.layer = DBBlayer(self.exact_solver if self.certified_solver is None else self.certified_solver,self.lambda_val)
         self.save_hyperparameters("lr","lambda_val")
     def training_step(self, batch, batch_idx):
-        x,y, sol = batch
+        x,y, sol, index = batch
         y_hat =  self(x).squeeze()
-        sol_hat = self.layer(y_hat, y, sol)
+        index = None if self.certified_solver is None else index.tolist()
+        sol_hat = self.layer(y_hat, y, sol, index)
         l1penalty = sum([(param.abs()).sum() for param in self.net.parameters()])
 
         training_loss =  ((sol_hat - sol)*y).sum(-1).mean() + l1penalty * self.l1_weight
@@ -175,10 +223,17 @@ class DBB(baseline):
         self.log("train_l1penalty",l1penalty * self.l1_weight,  on_step=True, on_epoch=True, )
         self.log("train_loss", ((sol_hat - sol)*y).sum(-1).mean(),  on_step=True, on_epoch=True, )
         return training_loss   
+    def on_train_epoch_end(self):
+        if self.certified_solver is not None:
+            for k,v in self.certified_solver.summary().items():
+                if not np.isnan(v):
+                    self.log("train_{}".format(k), v)
+            self.certified_solver.reset_counts()
 from Trainer.CacheLosses import *
 class CachingPO(baseline):
     def __init__(self,loss,init_cache, net,exact_solver = spsolver,growth=0.1,tau=0.,lr=1e-1,
-        l1_weight=1e-5,max_epochs=30, seed=20, scheduler=False, **kwd):
+        l1_weight=1e-5,max_epochs=30, seed=20, scheduler=False, pool_size=None, eviction="lru", packed=False, argmin="exact",
+        growth_mode="sync", growth_workers=1, max_pending=2, deterministic_growth=False, **kwd):
         """
         A class to implement loss functions using soluton cache
         Args:
@@ -192,10 +247,20 @@ class CachingPO(baseline):
             l1_weight: the lasso regularization weight
             max_epoch: maximum number of epcohs
             seed: seed for reproducibility 
+            pool_size: maximum number of solutions in the cache, None for no limit
+            eviction: which solution leaves a full cache, "lru" or "violation" (see SolutionPool)
+            packed: store the cache bit-packed (see PackedSolutions)
+            argmin: backend of the argmin over the cache of the SPO loss, "exact" or "cluster" (see PoolArgmin)
+            growth_mode: "sync", or grow the cache in the background with "thread" or "process" workers (see AsyncGrowth)
+            growth_workers, max_pending, deterministic_growth: the workers, the bound of the batches being solved and
+                whether to merge them in a deterministic order, for the background growth;
+                the worker threads share the solver, so they solve one batch at a time
 
         """
-        super().__init__(net,exact_solver, lr, l1_weight,max_epochs, seed, scheduler)
+        super().__init__(net,exact_solver, lr, l1_weight,max_epochs, seed, scheduler, **kwd)
         # self.save_hyperparameters()
+        ### the argmin over the cache of the SPO loss
+        self.argmin = None
         if loss=="pointwise":
             self.loss_fn = PointwiseLoss()
         elif loss=="pairwise":
@@ -215,26 +280,35 @@ class CachingPO(baseline):
         elif loss== 'MAP_c_actual':
             self.loss_fn = MAP_c_actual()
         elif loss== 'SPO':
-            self.loss_fn = SPOCaching()
+            self.argmin = PoolArgmin(backend=argmin, minimize=True)
+            self.loss_fn = SPOCaching(engine=self.argmin)
         else:
             raise Exception("Invalid Loss Provided")
-        ### The cache
-        init_cache_np = init_cache.detach().numpy()
-        init_cache_np = np.unique(init_cache_np,axis=0)
-        # torch has no unique function, so we have to do this
-        self.cache = torch.from_numpy(init_cache_np).float()
+        ### The cache, deduplicated by the pool; self.cache is its view
+        self.pool = SolutionPool(init_cache, max_size=pool_size, eviction=eviction, minimize=True, packed=packed)
+        self.cache = self.pool.view()
         self.growth = growth
+        ### the background growth of the pool, None for the synchronous one
+        self.grower = None if growth_mode == "sync" else AsyncGrowth(self.pool, partial(batch_solve, self.exact_solver), growth_mode,
+            growth_workers, max_pending, deterministic_growth)
         self.tau = tau
         self.save_hyperparameters("lr","growth","tau")
     
  
     def training_step(self, batch, batch_idx):
-        x,y, sol = batch
+        x,y, sol, _ = batch
         y_hat =  self(x).squeeze()
+        self.pool.touch(y_hat)
+        if self.grower is not None:
+            self.cache = self.grower.merge()
         if (np.random.random(1)[0]<= self.growth) or len(self.cache)==0:
-            self.cache = growcache(self.exact_solver, self.cache, y_hat)
+            if self.grower is not None and len(self.cache) > 0:
+                self.grower.submit(y_hat)
+            else:
+                self.cache = growcache(self.exact_solver, self.pool, y_hat)
+        if self.argmin is not None:
+            self.argmin.update(self.pool)
 
-  
         loss = self.loss_fn(y_hat,y,sol,self.cache)
         l1penalty = sum([(param.abs()).sum() for param in self.net.parameters()])
         training_loss=  loss/len(y)  + l1penalty * self.l1_weight
@@ -243,6 +317,18 @@ class CachingPO(baseline):
         self.log("train_loss",loss/len(y),  on_step=True, on_epoch=True, )
         return training_loss  
 
+    def on_validation_epoch_start(self):
+        ### the validation shares the solver with the growth workers, so they finish first
+        if self.grower is not None:
+            self.cache = self.grower.merge(wait=True)
+
+    def on_test_epoch_start(self):
+        self.on_validation_epoch_start()
+
+    def on_train_end(self):
+        if self.grower is not None:
+            self.grower.close()
+
 
 
 ###################################### This approach use it's own solver #########################################
@@ -255,11 +341,11 @@ class DCOL(baseline):
     Differentiable Convex Optimization Layers
     '''
     def __init__(self,net,exact_solver = spsolver,lr=1e-1, l1_weight=1e-5,max_epochs=30, seed=20,mu=0.1,regularizer='quadratic', scheduler= False,**kwd):
-        super().__init__(net,exact_solver, lr, l1_weight,max_epochs, seed, scheduler)
+        super().__init__(net,exact_solver, lr, l1_weight,max_epochs, seed, scheduler, **kwd)
         self.layer = cvxsolver(mu=mu, regularizer=regularizer)
     def training_step(self, batch, batch_idx):
    
-        x,y, sol = batch
+        x,y, sol, _ = batch
         y_hat =  self(x).squeeze()
         loss = 0
         l1penalty = sum([(param.abs()).sum() for param in self.net.parameters()])
@@ -283,22 +369,42 @@ class QPTL(DCOL):
     Implementation of
     Differentiable Convex Optimization Layers
     '''
-    def __init__(self,net,exact_solver = spsolver,lr=1e-1, l1_weight=1e-5,  max_epochs=30, seed=20,mu=0.1, scheduler=False, **kwd):
+    def __init__(self,net,exact_solver = spsolver,lr=1e-1, l1_weight=1e-5,  max_epochs=30, seed=20,mu=0.1, scheduler=False, intopt_cache_dir=None, **kwd):
         
 
-        super().__init__(net,exact_solver,lr, l1_weight,max_epochs, seed, mu,  scheduler=scheduler)  
-        self.solver = qpsolver( mu=mu)
+        super().__init__(net,exact_solver,lr, l1_weight,max_epochs, seed, mu,  scheduler=scheduler, **kwd)  
+        self.layer = qpsolver( mu=mu, cache_dir=intopt_cache_dir)
     
 class IntOpt(DCOL):
     '''
     Implementation of
     Differentiable Convex Optimization Layers
     '''
-    def __init__(self,net,exact_solver = spsolver,thr=0.1,damping=1e-3,diffKKT = False, lr=1e-1, l1_weight=1e-5,max_epochs=30, seed=20, scheduler=False, **kwd):
+    def __init__(self,net,exact_solver = spsolver,thr=0.1,damping=1e-3,diffKKT = False, lr=1e-1, l1_weight=1e-5,max_epochs=30, seed=20, scheduler=False,
+            warmstart=False, intopt_cache_dir=None, **kwd):
         
 
-        super().__init__(net,exact_solver , lr, l1_weight,max_epochs, seed, scheduler=scheduler)  
-        self.solver  = intoptsolver(thr=thr,damping=damping, diffKKT = diffKKT )
+        super().__init__(net,exact_solver , lr, l1_weight,max_epochs, seed, scheduler=scheduler, **kwd)  
+        self.layer  = intoptsolver(thr=thr,damping=damping, diffKKT = diffKKT, warmstart = warmstart, cache_dir = intopt_cache_dir )
+    def training_step(self, batch, batch_idx):
+        x,y, sol, index = batch
+        y_hat =  self(x).squeeze()
+        l1penalty = sum([(param.abs()).sum() for param in self.net.parameters()])
+
+        sol_hat = self.layer.shortest_pathsolution(y_hat, index.tolist())
+        loss = ((sol_hat - sol)*y).sum(-1).mean()
+        training_loss =  loss + l1penalty * self.l1_weight
+        self.log("train_totalloss",training_loss, prog_bar=True, on_step=True, on_epoch=True, )
+        self.log("train_l1penalty",l1penalty * self.l1_weight,  on_step=True, on_epoch=True, )
+        self.log("train_loss",loss,  on_step=True, on_epoch=True, )
+        return training_loss 
+    def on_train_epoch_end(self):
+        warmstart = self.layer.intoptsolver.warmstart
+        if warmstart is not None:
+            for k,v in warmstart.summary().items():
+                if not np.isnan(v):
+                    self.log("train_{}".format(k), v)
+            warmstart.reset_counts()
 
 
 
@@ -310,7 +416,7 @@ class IntOpt(DCOL):
 class IMLE(baseline):
     def __init__(self,net,solver=spsolver,exact_solver = spsolver,k=5,nb_iterations=100,nb_samples=1, beta=10.,
             temperature=1.0, lr=1e-1,l1_weight=1e-5,max_epochs=30,seed=20 , scheduler=False, **kwd):
-        super().__init__(net,exact_solver , lr, l1_weight, max_epochs, seed, scheduler)
+        super().__init__(net,exact_solver , lr, l1_weight, max_epochs, seed, scheduler, **kwd)
         self.solver = solver
         self.k = k
         self.nb_iterations = nb_iterations
@@ -327,7 +433,7 @@ class IMLE(baseline):
         target_noise_temperature= temperature,nb_samples=self.nb_samples)
         self.save_hyperparameters("lr")
     def training_step(self, batch, batch_idx):
-        x,y, sol = batch
+        x,y, sol, _ = batch
         y_hat =  self(x).squeeze()
         l1penalty = sum([(param.abs()).sum() for param in self.net.parameters()])
         
@@ -343,7 +449,7 @@ class IMLE(baseline):
 
 class DPO(baseline):
     def __init__(self,net,solver=spsolver,exact_solver = spsolver,num_samples=10, sigma=0.1, lr=1e-1,l1_weight=1e-5, max_epochs= 30, seed=20, scheduler=False, **kwd):
-        super().__init__(net,exact_solver , lr, l1_weight, max_epochs, seed, scheduler)
+        super().__init__(net,exact_solver , lr, l1_weight, max_epochs, seed, scheduler, **kwd)
         self.solver = solver
         @perturbations.perturbed(num_samples= num_samples, sigma= sigma, noise='gumbel',batched = True)
         def dpo_layer(y):
@@ -353,7 +459,7 @@ class DPO(baseline):
 
         self.save_hyperparameters("lr")
     def training_step(self, batch, batch_idx):
-        x,y, sol = batch
+        x,y, sol, _ = batch
         y_hat =  self(x).squeeze()
         l1penalty = sum([(param.abs()).sum() for param in self.net.parameters()])
 
@@ -373,14 +479,14 @@ class DPO(baseline):
 
 class FenchelYoung(baseline):
     def __init__(self,net,solver=spsolver,exact_solver = spsolver,num_samples=10, sigma=0.1,lr=1e-1, l1_weight=1e-5, max_epochs=30, seed=20, scheduler=False, **kwd):
-        super().__init__(net,exact_solver , lr, l1_weight, max_epochs, seed, scheduler)
+        super().__init__(net,exact_solver , lr, l1_weight, max_epochs, seed, scheduler, **kwd)
         self.solver = solver
         self.num_samples = num_samples
         self.sigma = sigma
         self.save_hyperparameters("lr")
         self.fy_solver = lambda y_: solver.solution_fromtorch(y_)
     def training_step(self, batch, batch_idx):
-        x,y, sol = batch
+        x,y, sol, _ = batch
         y_hat =  self(x).squeeze()
         loss = 0
         # solver= self.solver
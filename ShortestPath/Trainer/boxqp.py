@@ -0,0 +1,167 @@
+import numpy as np
+import scipy.sparse as sps
+import torch
+from torch import nn
+from torch.autograd import Function
+from intopt.util import get_standardform
+from intopt.solveLP import sparse_normal_equations
+
+
+"""
+Batched QPTL layer for the quadratic programs
+
+    min_x   mu/2 ||x||^2 + c @ x
+    s.t.    A @ x == b
+            lb <= x <= ub
+
+The box bounds are kept as bounds, with their own slacks and multipliers, instead of
+2n dense inequality rows, and Q = mu I is kept as a scalar, so no n x n matrix is formed.
+The forward pass solves all instances of a batch with a primal-dual interior point method
+(Mehrotra predictor-corrector). With H = mu + z_l/(x-lb) + z_u/(ub-x), a diagonal matrix,
+the Newton system reduces to the normal equations
+    A H^{-1} A^T dy = r
+whose sparsity pattern depends only on A: the fill-reducing ordering is computed once for
+the layer, every iteration factorizes the normal matrices of the batch together and
+uses the factorization for both the predictor and the corrector step.
+The backward pass factorizes the normal matrices once more, at the final iterates, as in [1]:
+    dx/dc = - (H^{-1} - H^{-1} A^T (A H^{-1} A^T)^{-1} A H^{-1})
+
+References
+----------
+    [1] Amos, Brandon, and J. Zico Kolter. "OptNet: Differentiable optimization as a layer
+       in neural networks." International Conference on Machine Learning. PMLR, 2017.
+    [2] Nocedal, Jorge, and Stephen J. Wright. "Numerical Optimization", 2nd edition,
+       Springer, 2006, Section 16.6.
+"""
+
+
+def _max_step(v, dv):
+    '''
+    Largest step alpha <= 1 with v + alpha dv >= 0 for every row
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.minimum(1., np.where(dv < 0, v / -dv, np.inf).min(1))
+
+
+class boxqp(nn.Module):
+    '''
+    A, b : constraint matrix (m, n) and vector (m,); torch tensors, numpy arrays or scipy sparse
+    mu : coefficient of the quadratic regularizer, Q = mu I
+    lb, ub : finite scalars or 1D arrays (n,) bounding x
+    tol : tolerance on the relative residuals and the complementarity gap
+    maxiter : maximum number of interior point iterations
+    damping : added to the diagonal of the normal matrices; redundant rows of A are removed
+        beforehand, so that A H^{-1} A^T is nonsingular
+    cache_dir : if given, directory where the presolved A is cached, see intopt.util.get_standardform
+    forward takes c of shape (batch_size, n) or (n,) and returns x of the same shape.
+    '''
+    def __init__(self, A, b, mu, lb=0., ub=1., tol=1e-8, maxiter=100, damping=1e-10, cache_dir=None):
+        super().__init__()
+        A = A.detach().numpy() if isinstance(A, torch.Tensor) else A
+        b = b.detach().numpy() if isinstance(b, torch.Tensor) else np.asarray(b)
+        A, b = sps.csr_matrix(A, dtype=float), b.astype(float)
+        n = A.shape[1]
+        ### remove redundant equality rows, e.g. of incidence matrices; without inequality
+        ### constraints the standard form adds no slack variables
+        _, A, b = get_standardform(A, b, sps.csr_matrix((0, n)), np.zeros(0), True, cache_dir)
+        self.A, self.b = sps.csr_matrix(A, dtype=float), np.asarray(b, dtype=float)
+        self.n, self.mu = n, mu
+        self.lb = np.broadcast_to(np.asarray(lb, dtype=float), (n,))
+        self.ub = np.broadcast_to(np.asarray(ub, dtype=float), (n,))
+        if not (np.all(np.isfinite(self.lb)) and np.all(np.isfinite(self.ub)) and np.all(self.lb < self.ub)):
+            raise Exception("The bounds must be finite with lb < ub")
+        self.tol, self.maxiter, self.damping = tol, maxiter, damping
+        ### ordering of A H^{-1} A^T, which depends only on A
+        self.normal_equations = sparse_normal_equations(self.A)
+        ### number of iterations of every instance in the last solve
+        self.iterations = None
+        self.layer = self.make_layer()
+
+    def _newton(self, solve, Hinv, r_d, r_p, s_l, z_l, s_u, z_u, t_l, t_u):
+        '''
+        Solve the Newton system for the complementarity targets (x-lb) z_l = t_l and (ub-x) z_u = t_u
+        '''
+        A = self.A
+        r = -r_d + (t_l / s_l - z_l) - (t_u / s_u - z_u)
+        rhs = -r_p - (A @ (Hinv * r).T).T
+        dy = solve(rhs[:, :, None])[:, :, 0]
+        dx = Hinv * (r + (A.T @ dy.T).T)
+        dz_l = (t_l - s_l * z_l - z_l * dx) / s_l
+        dz_u = (t_u - s_u * z_u + z_u * dx) / s_u
+        return dx, dy, dz_l, dz_u
+
+    def solve(self, c):
+        '''
+        Solve the QP for every row of c : 2D array (batch_size, n).
+        Returns x and H^{-1} at the final iterates.
+        '''
+        A, b, mu, lb, ub, tol = self.A, self.b, self.mu, self.lb, self.ub, self.tol
+        batch_size, n = c.shape
+        x = np.broadcast_to((lb + ub) / 2, (batch_size, n)).copy()
+        y = np.zeros((batch_size, A.shape[0]))
+        scale = max(1., np.abs(c).max())
+        z_l, z_u = np.full((batch_size, n), scale), np.full((batch_size, n), scale)
+        iterations = np.zeros(batch_size, dtype=int)
+        c_norm = 1 + np.abs(c).max(1)
+        b_norm = 1 + np.abs(b).max(initial=0.)
+
+        for k in range(self.maxiter + 1):
+            s_l, s_u = x - lb, ub - x
+            r_d = mu * x + c - (A.T @ y.T).T - z_l + z_u
+            r_p = (A @ x.T).T - b
+            gap = ((s_l * z_l).sum(1) + (s_u * z_u).sum(1)) / (2 * n)
+            Hinv = 1. / (mu + z_l / s_l + z_u / s_u)
+            active = (np.abs(r_p).max(1) > tol * b_norm) | (np.abs(r_d).max(1) > tol * c_norm) | (gap > tol)
+            if not active.any() or k == self.maxiter:
+                break
+            idx = np.flatnonzero(active)
+            iterations[idx] += 1
+            x_, y_, z_l_, z_u_, s_l_, s_u_ = x[idx], y[idx], z_l[idx], z_u[idx], s_l[idx], s_u[idx]
+            r_d_, r_p_, gap_, Hinv_ = r_d[idx], r_p[idx], gap[idx], Hinv[idx]
+
+            ### one factorization for the predictor and the corrector step
+            solve = self.normal_equations.factorize(Hinv_, self.damping)
+            zeros = np.zeros_like(x_)
+            dx, dy, dz_l, dz_u = self._newton(solve, Hinv_, r_d_, r_p_, s_l_, z_l_, s_u_, z_u_, zeros, zeros)
+            alpha = np.minimum.reduce([_max_step(s_l_, dx), _max_step(s_u_, -dx), _max_step(z_l_, dz_l), _max_step(z_u_, dz_u)])[:, None]
+            gap_aff = (((s_l_ + alpha * dx) * (z_l_ + alpha * dz_l)).sum(1) +
+                ((s_u_ - alpha * dx) * (z_u_ + alpha * dz_u)).sum(1)) / (2 * n)
+            sigma = ((gap_aff / gap_) ** 3)[:, None]
+            t_l = sigma * gap_[:, None] - dx * dz_l
+            t_u = sigma * gap_[:, None] + dx * dz_u
+            dx, dy, dz_l, dz_u = self._newton(solve, Hinv_, r_d_, r_p_, s_l_, z_l_, s_u_, z_u_, t_l, t_u)
+            alpha = 0.99 * np.minimum.reduce([_max_step(s_l_, dx), _max_step(s_u_, -dx), _max_step(z_l_, dz_l), _max_step(z_u_, dz_u)])[:, None]
+
+            x[idx], y[idx] = x_ + alpha * dx, y_ + alpha * dy
+            z_l[idx], z_u[idx] = z_l_ + alpha * dz_l, z_u_ + alpha * dz_u
+
+        self.iterations = iterations
+        return x, Hinv
+
+    def make_layer(self):
+        qp = self
+        class WrappedFunc_cls(Function):
+            @staticmethod
+            def forward(ctx, c_trch):
+                c = c_trch.detach().numpy().astype(float)
+                x, Hinv = qp.solve(c)
+                ctx.Hinv = Hinv
+                return torch.from_numpy(x).to(c_trch.dtype)
+
+            @staticmethod
+            def backward(ctx, dx):
+                '''
+                dc = - (H^{-1} dx - H^{-1} A^T (A H^{-1} A^T)^{-1} A H^{-1} dx)
+                '''
+                A, Hinv = qp.A, ctx.Hinv
+                g = Hinv * dx.detach().numpy().astype(float)
+                solve = qp.normal_equations.factorize(Hinv, qp.damping)
+                t = solve((A @ g.T).T[:, :, None])[:, :, 0]
+                dc = -(g - Hinv * (A.T @ t.T).T)
+                return torch.from_numpy(dc).to(dx.dtype)
+        return WrappedFunc_cls.apply
+
+    def forward(self, c):
+        if c.dim() == 1:
+            return self.layer(c.unsqueeze(0)).squeeze(0)
+        return self.layer(c)
@@ -9,17 +9,15 @@ class datawrapper():
         self.x = x
         self.y = y
         if sol is None:
-            sol = []
-            for i in range(len(y)):
-                sol.append(   solver.shortest_pathsolution(y[i])   )            
-            sol = np.array(sol).astype(np.float32)
+            sol = solver.solution_fromtorch(torch.from_numpy(y)).numpy().astype(np.float32)
         self.sol = sol
 
     def __len__(self):
         return len(self.y)
     
     def __getitem__(self, index):
-        return self.x[index], self.y[index],self.sol[index]
+        ### the index of the instance in the dataset keys the state the models keep per instance, e.g. the warm start of IntOpt
+        return self.x[index], self.y[index],self.sol[index], index
 
 
 ###################################### Dataloader #########################################
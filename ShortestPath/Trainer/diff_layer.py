@@ -11,10 +11,11 @@ def SPOlayer(solver,minimize = True):
     mm = 1 if minimize else -1
     class SPOlayer_cls(torch.autograd.Function):
         @staticmethod
-        def forward(ctx, y_hat,y_true,sol_true ):
-            sol_hat = batch_solve(solver, y_hat)
+        def forward(ctx, y_hat,y_true,sol_true, index=None):
+            sol_hat = batch_solve(solver, y_hat, index=index)
 
             ctx.save_for_backward(y_hat,y_true,sol_true)
+            ctx.index = index
 
             return ( mm*(sol_hat -sol_true)*y_true).sum()
 
@@ -22,8 +23,9 @@ def SPOlayer(solver,minimize = True):
         def backward(ctx, grad_output):
             y_hat,y_true,sol_true = ctx.saved_tensors
             y_spo = 2*y_hat - y_true
-            sol_spo = batch_solve(solver,y_spo) 
-            return (sol_true - sol_spo)*mm, None, None
+            index = None if ctx.index is None else [(key, "spo") for key in ctx.index]
+            sol_spo = batch_solve(solver,y_spo, index=index) 
+            return (sol_true - sol_spo)*mm, None, None, None
     return SPOlayer_cls.apply
 
 
@@ -31,10 +33,11 @@ def DBBlayer(solver,lambda_val=1., minimize = True):
     mm = 1 if minimize else -1
     class DBBlayer_cls(torch.autograd.Function):
         @staticmethod
-        def forward(ctx, y_hat,y_true,sol_true ):
-            sol_hat =  batch_solve(solver, y_hat) 
+        def forward(ctx, y_hat,y_true,sol_true, index=None):
+            sol_hat =  batch_solve(solver, y_hat, index=index) 
 
             ctx.save_for_backward(y_hat,y_true,sol_true, sol_hat)
+            ctx.index = index
 
             return sol_hat
 
@@ -45,7 +48,8 @@ def DBBlayer(solver,lambda_val=1., minimize = True):
             """
             y_hat,y_true,sol_true, sol_hat= ctx.saved_tensors
             y_perturbed = y_hat + mm* lambda_val* grad_output
-            sol_perturbed =  batch_solve(solver, y_perturbed) 
+            index = None if ctx.index is None else [(key, "perturbed") for key in ctx.index]
+            sol_perturbed =  batch_solve(solver, y_perturbed, index=index) 
             
-            return -mm*(sol_hat - sol_perturbed)/lambda_val, None, None
+            return -mm*(sol_hat - sol_perturbed)/lambda_val, None, None, None
     return DBBlayer_cls.apply
\ No newline at end of file
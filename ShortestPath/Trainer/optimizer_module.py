@@ -3,7 +3,6 @@ import numpy as np
 import torch 
 from torch import nn, optim
 import torch.nn.functional as F
-from qpth.qp import QPFunction
 ###################################### Graph Structure ###################################################
 V = range(25)
 E = []
@@ -19,53 +18,58 @@ G.add_nodes_from(V)
 G.add_edges_from(E)
 ##################################   Ortools Shortest path Solver #########################################
 from ortools.linear_solver import pywraplp
+def normalize_objective(y):
+    '''
+    GLOP returns ABNORMAL (status 4) when the cost coefficients are below its tolerances.
+    Scaling the objective by a positive constant does not change the optimal solution,
+    so the vector is scaled by a power of two (which is exact) to bring its maximum absolute value in [0.5,1)
+    '''
+    y = np.array(y, dtype=np.float64)
+    max_abs = np.abs(y).max()
+    if max_abs==0 or not np.isfinite(max_abs):
+        return y
+    _, exponent = np.frexp(max_abs)
+    return np.ldexp(y, -exponent)
+
 class shortestpath_solver:
     def __init__(self,G= G):
         self.G = G
-    
-    def shortest_pathsolution(self, y):
-        '''
-        y: the vector of  edge weight
-        '''
-        A = nx.incidence_matrix(G,oriented=True).todense()
-        b =  np.zeros(len(A))
-        b[0] = -1
-        b[-1] =1
+        ### The constraint matrix does not change between calls
+        self.A = nx.incidence_matrix(G,oriented=True).toarray()
+        self.b =  np.zeros(len(self.A))
+        self.b[0] = -1
+        self.b[-1] =1
+        ### Number of times the rescale-and-retry loop for the ABNORMAL status is used
+        self.abnormal_count = 0
 
+    def build_model(self):
+        A, b = self.A, self.b
         solver = pywraplp.Solver.CreateSolver('GLOP')
-
-        x = {}
-        
         x = [solver.NumVar(0.0, 1, str(jj)) for jj  in range(A.shape[1])]
-        
-        constraints = []
         for ii in range(len(A)):
-            constraints.append(solver.Constraint(b[ii], b[ii]))
-            for jj in range(A.shape[1]):
-                constraints[ii].SetCoefficient(x[jj], A[ii,jj])
-        
-        
-        
+            constraint = solver.Constraint(b[ii], b[ii])
+            for jj in np.flatnonzero(A[ii]):
+                constraint.SetCoefficient(x[jj], A[ii,jj])
         objective = solver.Objective()
-        for jj in range(A.shape[1]):
-            objective.SetCoefficient(x[jj], float(y[jj]))
         objective.SetMinimization()
+        return solver, x, objective
+
+    def solve_model(self, solver, x, objective, y):
+        y_prime = normalize_objective(y)
+        for jj in range(len(x)):
+            objective.SetCoefficient(x[jj], float(y_prime[jj]))
         status = solver.Solve()
-        # print(status)
-        sol = np.zeros(A.shape[1])
         ##############   Ortools LP solver has an error called Abnormal (status code=4)
-        ############## I Don't know why it happens. But I observe multiplying the coefficients by 100 normally solves the problem
-        ############## and Return  the right solution. So, I do the following
-
+        ############## It should not happen after normalizing the objective; if it still does, we multiply
+        ############## the coefficients by 100 until it is solved, as before.
         if status==4:
-            y_prime =   np.copy( y )
+            self.abnormal_count += 1
             while(status==4):
                 y_prime *=1e2
-                objective = solver.Objective()
-                for jj in range(A.shape[1]):
+                for jj in range(len(x)):
                     objective.SetCoefficient(x[jj], float(y_prime[jj]))
-                objective.SetMinimization()
                 status = solver.Solve()
+        sol = np.zeros(len(x))
         if status ==  pywraplp.Solver.OPTIMAL:
             for i, v in enumerate(x):
                 sol[i] = v.solution_value()
@@ -76,6 +80,14 @@ class shortestpath_solver:
                 print( v.solution_value())
             raise Exception("Optimal Solution not found")
         return sol
+
+    def shortest_pathsolution(self, y):
+        '''
+        y: the vector of  edge weight
+        '''
+        solver, x, objective = self.build_model()
+        return self.solve_model(solver, x, objective, y)
+
     def solution_fromtorch(self,y_torch):
         if y_torch.dim()==1:
             return torch.from_numpy(self.shortest_pathsolution( y_torch.detach().numpy())).float()
@@ -84,6 +96,26 @@ class shortestpath_solver:
             for ii in range(len(y_torch)):
                 solutions.append(torch.from_numpy(self.shortest_pathsolution( y_torch[ii].detach().numpy())).float())
             return torch.stack(solutions)
+
+class persistent_shortestpath_solver(shortestpath_solver):
+    def __init__(self,G= G):
+        '''
+        The LP is built once; each call only rewrites the objective coefficients and re-solves.
+        GLOP keeps its basis between solves, so each solve is warm started from the previous optimal basis.
+        As a consequence, when there are more than one shortest path, the returned path depends on the previous solves,
+        so it is not the oracle of the ties of dagshortestpath_solver, which builds a fresh model for every tie.
+        It is the exact solver of the graphs which are not acyclic, where the LP is the only option.
+        '''
+        super().__init__(G)
+        self.solver, self.x, self.objective = self.build_model()
+        self.num_solves = 0
+
+    def shortest_pathsolution(self, y):
+        '''
+        y: the vector of  edge weight
+        '''
+        self.num_solves += 1
+        return self.solve_model(self.solver, self.x, self.objective, y)
 ###################################### Gurobi Shortest path Solver #########################################
 # import gurobipy as gp
 # class gurobi_shortestpath_solver:
@@ -170,14 +202,213 @@ class shortestpath_solver:
 #             return torch.stack(solutions) , nonunique_cnt      
         
 
-        
-spsolver =  shortestpath_solver()
+
+##################################   Batched DAG Shortest path Solver #########################################
+class dagshortestpath_solver:
+    def __init__(self,G= G, lp_solver=None, tie_tol=1e-9):
+        '''
+        Exact shortest path solver for a directed acyclic graph.
+        The whole batch of edge weights is solved in one dynamic-programming pass over the reverse topological order.
+        G: the graph, the first node is the source and the last node is the sink (as in the LP formulation)
+        lp_solver: if not None, instances which have more than one shortest path are solved by this solver,
+                    so that the returned solution is the same as the one returned by the LP
+        tie_tol: two path lengths within this tolerance are considered equal
+        '''
+        if not nx.is_directed_acyclic_graph(G):
+            raise Exception("Dynamic programming solver requires an acyclic graph")
+        self.G = G
+        self.lp_solver = lp_solver
+        self.tie_tol = tie_tol
+        node_index = {v:ii for ii,v in enumerate(G.nodes())}
+        ### the edge order is the column order of nx.incidence_matrix
+        edges = list(G.edges())
+        self.num_nodes, self.num_edges = G.number_of_nodes(), G.number_of_edges()
+        self.source, self.sink = 0, self.num_nodes -1
+        self.head = torch.tensor([node_index[v] for (u,v) in edges], dtype=torch.long)
+        self.tail = torch.tensor([node_index[u] for (u,v) in edges], dtype=torch.long)
+        out_edges = [[] for _ in range(self.num_nodes)]
+        for jj, (u,v) in enumerate(edges):
+            out_edges[node_index[u]].append(jj)
+        ### nodes in reverse topological order alongwith their outgoing edges (in increasing edge index)
+        self.order = [(node_index[u], torch.tensor(out_edges[node_index[u]], dtype=torch.long))
+            for u in reversed(list(nx.topological_sort(G))) if len(out_edges[node_index[u]])>0]
+
+    def batched_solution(self, y, return_choice=False):
+        '''
+        y: torch tensor of edge weights [batch_size, num_edges]
+        Returns the path indicators [batch_size, num_edges] (float64)
+        and a boolean tensor [batch_size] which is True if the instance has more than one shortest path
+        If return_choice, also returns the shortest path tree [batch_size, num_nodes]: the outgoing edge
+        of every node on its shortest path to the sink (0 for the sink)
+        '''
+        y = y.detach().double()
+        batch_size = len(y)
+        cost_to_go = torch.full((batch_size, self.num_nodes), float('inf'), dtype=torch.float64, device= y.device)
+        cost_to_go[:, self.sink] = 0.
+        ### number of shortest paths from each node to the sink, to detect ties
+        num_optimal = torch.zeros((batch_size, self.num_nodes), dtype=torch.float64, device= y.device)
+        num_optimal[:, self.sink] = 1.
+        choice = torch.zeros((batch_size, self.num_nodes), dtype=torch.long, device= y.device)
+        head = self.head.to(y.device)
+        for u, out in self.order:
+            out = out.to(y.device)
+            candidates = y[:, out] + cost_to_go[:, head[out]]
+            ### min returns the first minimal index, i.e. the lowest edge index,
+            ### which is the LP solution when all the weights are equal
+            val, ind = torch.min(candidates, 1)
+            cost_to_go[:, u] = val
+            choice[:, u] = out[ind]
+            is_tied = (candidates <= val.unsqueeze(1) + self.tie_tol) & torch.isfinite(candidates)
+            num_optimal[:, u] = (is_tied * num_optimal[:, head[out]]).sum(1)
+        if not torch.isfinite(cost_to_go[:, self.source]).all():
+            raise Exception("Optimal Solution not found")
+
+        sol = torch.zeros_like(y)
+        rows = torch.arange(batch_size, device= y.device)
+        node = torch.full((batch_size,), self.source, dtype=torch.long, device= y.device)
+        for _ in range(self.num_nodes -1):
+            active = node != self.sink
+            if not active.any():
+                break
+            edge = choice[rows, node]
+            sol[rows[active], edge[active]] = 1.
+            node = torch.where(active, head[edge], node)
+        if return_choice:
+            return sol, num_optimal[:, self.source] > 1, choice
+        return sol, num_optimal[:, self.source] > 1
+
+    def shortest_pathsolution(self, y):
+        '''
+        y: the vector of  edge weight
+        '''
+        return self.solution_fromtorch(torch.from_numpy(np.asarray(y))).double().numpy()
+
+    def solution_fromtorch(self,y_torch):
+        y = y_torch.unsqueeze(0) if y_torch.dim()==1 else y_torch
+        sol, has_tie = self.batched_solution(y)
+        if self.lp_solver is not None and has_tie.any():
+            for ii in torch.nonzero(has_tie).flatten().tolist():
+                sol[ii] = torch.from_numpy(self.lp_solver.shortest_pathsolution( y[ii].detach().cpu().numpy()))
+        sol = sol.float()
+        return sol[0] if y_torch.dim()==1 else sol
+
+### The GLOP solver is kept as a reference oracle
+glopsolver = shortestpath_solver()
+### the exact solver; the test_sp.py --memo flag wraps it in a Trainer.utils.memo_solver
+spsolver =  dagshortestpath_solver(lp_solver= glopsolver)
+
+def make_spsolver(solver="dag"):
+    '''
+    A new exact solver, e.g. the factory of the solvers of a Trainer.utils.SolverPool
+    solver: "dag" for the solver of spsolver, with its own GLOP oracle of the ties,
+            "glop" for a persistent_shortestpath_solver, the LP of the graphs which are not acyclic
+    '''
+    if solver == "dag":
+        return dagshortestpath_solver(lp_solver= shortestpath_solver())
+    if solver == "glop":
+        return persistent_shortestpath_solver()
+    raise Exception("Invalid solver {}".format(solver))
+
+##################################   Certified Shortest path Solver #########################################
+class certified_solver:
+    def __init__(self, solver=spsolver, tie_tol=1e-9):
+        '''
+        Solver mode for the training instances, which skips the solve of an instance whose last solution is
+        still optimal under the new edge weights.
+        The shortest path tree of the last solve of every instance is kept, keyed by its dataset index.
+        Under new weights y, its node potentials pi (the length of the tree path from every node to the sink)
+        and the reduced costs y_e + pi[head_e] - pi[tail_e] are computed in O(nnz). If no reduced cost is
+        negative, pi is dual feasible, so the stored path is optimal; if moreover every edge leaving the path
+        has a reduced cost larger than tie_tol, the solver finds no tie and returns the stored path.
+        Otherwise, and for the instances without a certificate, the instance is solved and its certificate replaced.
+        solver: dagshortestpath_solver, or a memo_solver around it
+        tie_tol: the tolerance of the ties of the solver
+        '''
+        self.solver = solver
+        self.tie_tol = tie_tol
+        ### the trees and the paths are stored in rows of preallocated tensors, slots maps an index to its row
+        self.slots = {}
+        self.choice = torch.zeros((0, solver.num_nodes), dtype=torch.long)
+        self.paths = torch.zeros((0, solver.num_edges))
+        self.valid = torch.zeros(0, dtype=torch.bool)
+        ### number of pointer jumping steps to sum the weights along the longest tree path
+        self.num_jumps = max(1, int(np.ceil(np.log2(solver.num_nodes))))
+        self.reset_counts()
+    def reset_counts(self):
+        self.solves = {"skipped": 0, "solved": 0}
+    def summary(self):
+        '''
+        Fraction of the solves skipped since the last reset_counts
+        '''
+        total = self.solves["skipped"] + self.solves["solved"]
+        return {"solves_skipped": self.solves["skipped"]/total if total > 0 else float('nan')}
+
+    def _slot(self, key):
+        if key not in self.slots:
+            if len(self.slots) == len(self.valid):
+                capacity = max(64, 2*len(self.valid))
+                grow = lambda t: torch.cat([t, torch.zeros((capacity - len(t),) + t.shape[1:], dtype=t.dtype)])
+                self.choice, self.paths, self.valid = grow(self.choice), grow(self.paths), grow(self.valid)
+            self.slots[key] = len(self.slots)
+        return self.slots[key]
+
+    def _certified(self, y, slots):
+        '''
+        Boolean tensor, True for the rows of y whose stored path is optimal for y
+        '''
+        solver = self.solver
+        choice = self.choice[slots]
+        rows = torch.arange(len(slots)).unsqueeze(1)
+        ### potentials by pointer jumping along the trees: pi[u] = y[choice[u]] + pi[head[choice[u]]], pi[sink] = 0
+        pi = y.gather(1, choice)
+        pi[:, solver.sink] = 0.
+        succ = solver.head[choice]
+        succ[:, solver.sink] = solver.sink
+        for _ in range(self.num_jumps):
+            pi = pi + pi[rows, succ]
+            succ = succ[rows, succ]
+        on_tree = torch.zeros_like(y, dtype=torch.bool)
+        on_tree[rows, choice[:, :solver.sink]] = True
+        reduced = y + pi[:, solver.head] - pi[:, solver.tail]
+        ### the edges which leave a node of the stored path by another edge than the path
+        on_path = self.paths[slots].bool()
+        path_nodes = torch.zeros_like(pi, dtype=torch.bool)
+        path_nodes[rows, torch.where(on_path, solver.tail, solver.sink)] = True
+        leaving = path_nodes[:, solver.tail] & ~on_path
+        return self.valid[slots] & (on_tree | (reduced >= 0)).all(1) & (~leaving | (reduced > self.tie_tol)).all(1)
+
+    def solution_fromtorch(self, y_torch, index=None):
+        '''
+        index: list of the dataset indices of the rows of y_torch; without it every row is solved
+        '''
+        if index is None:
+            return self.solver.solution_fromtorch(y_torch)
+        y_in = y_torch.unsqueeze(0) if y_torch.dim()==1 else y_torch
+        y = y_in.detach().double()
+        slots = torch.tensor([self._slot(key) for key in index], dtype=torch.long)
+        certified = self._certified(y, slots)
+        sol = self.paths[slots]
+        unsolved = torch.nonzero(~certified).flatten()
+        if len(unsolved) > 0:
+            sol_, has_tie, choice = self.solver.batched_solution(y[unsolved], return_choice=True)
+            sol_ = sol_.float()
+            if has_tie.any():
+                ### the LP solver decides between the shortest paths, so the tree does not certify its solution
+                sol_[has_tie] = self.solver.solution_fromtorch(y_in[unsolved[has_tie]])
+            self.choice[slots[unsolved]] = choice
+            self.paths[slots[unsolved]] = sol_
+            self.valid[slots[unsolved]] = ~has_tie
+            sol[unsolved] = sol_
+        self.solves["skipped"] += int(certified.sum())
+        self.solves["solved"] += len(unsolved)
+        return sol[0] if y_torch.dim()==1 else sol
 
 import cvxpy as cp
 import cvxpylayers
 from cvxpylayers.torch import CvxpyLayer
+from Trainer.utils import get_cvxpylayer
 # from intopt.intopt_model import IPOfunc
-from qpth.qp import QPFunction
+from Trainer.boxqp import boxqp
 # from qpthlocal.qp import QPFunction
 # from qpthlocal.qp import QPSolvers
 # from qpthlocal.qp import make_gurobi_model
@@ -187,18 +418,22 @@ class cvxsolver:
     def __init__(self,G=G, mu=1e-6,regularizer='quadratic'):
         '''
         regularizer: form of regularizer- either quadratic or entropic
+        The CvxpyLayer is compiled at the first call and shared by all cvxsolver with the same (G, mu, regularizer)
         '''
         self.G = G
         self.mu = mu
         self.regularizer = regularizer
-    def make_proto(self):
-        #### Maybe we can model a better LP formulation
-        G = self.G
-        num_nodes, num_edges = G.number_of_nodes(),  G.number_of_edges()
         A = torch.from_numpy((nx.incidence_matrix(G,oriented=True).todense())).float()  
         b =  torch.zeros(len(A))
         b[0] = -1
         b[-1] = 1       
+        self.A, self.b = A, b
+        self.layer = None
+    def make_proto(self):
+        #### Maybe we can model a better LP formulation
+        G = self.G
+        num_nodes, num_edges = G.number_of_nodes(),  G.number_of_edges()
+        A, b = self.A, self.b
 
         # A = cp.Parameter((num_nodes, num_edges))
         # b = cp.Parameter(num_nodes)
@@ -210,14 +445,10 @@ class cvxsolver:
         elif self.regularizer=='entropic':
             objective = cp.Minimize(c @ x -  self.mu*cp.sum(cp.entr(x)) )
         problem = cp.Problem(objective, constraints)
-        self.layer = CvxpyLayer(problem, parameters=[c], variables=[x])
+        return problem, [c], [x]
     def shortest_pathsolution(self, y):
-        self.make_proto()
-        # G = self.G
-        # A = torch.from_numpy((nx.incidence_matrix(G,oriented=True).todense())).float()  
-        # b =  torch.zeros(len(A))
-        # b[0] = -1
-        # b[-1] = 1        
+        if self.layer is None:
+            self.layer = get_cvxpylayer(self.make_proto, ("shortestpath", self.A, self.b, self.mu, self.regularizer))
         sol, = self.layer(y)
         return sol
     # def solution_fromtorch(self,y_torch):
@@ -227,7 +458,7 @@ class cvxsolver:
 
 from intopt.intopt import intopt
 class intoptsolver:
-    def __init__(self,G=G,thr=1e-8,damping=1e-8, diffKKT = False):
+    def __init__(self,G=G,thr=1e-8,damping=1e-8, diffKKT = False, warmstart = False, cache_dir = None):
         self.G = G
         self.thr =thr
         self.damping = damping
@@ -236,46 +467,30 @@ class intoptsolver:
         b =  torch.zeros(len(A))
         b[0] = -1
         b[-1] = 1      
-        self.intoptsolver = intopt( A, b, None, None, thr= thr, damping=damping, dopresolve=True, diffKKT = diffKKT)
-    def shortest_pathsolution(self, y):
-        self.intoptsolver (y)
-
-        sol = self.intoptsolver (y)
+        self.intoptsolver = intopt( A, b, None, None, thr= thr, damping=damping, dopresolve=True, diffKKT = diffKKT, warmstart = warmstart, cache_dir = cache_dir)
+    def shortest_pathsolution(self, y, index=None):
+        sol = self.intoptsolver (y, index)
         return sol
 
 
 
 class qpsolver:
-    def __init__(self,G=G,mu=1e-6):
+    def __init__(self,G=G,mu=1e-6, cache_dir=None):
+        '''
+        QPTL with the batched boxqp engine, the bounds 0 <= x <= 1 are kept as bounds
+        cache_dir: if given, the presolved incidence matrix is cached there
+        '''
         self.G = G
-        A = nx.incidence_matrix(G,oriented=True).todense().astype(np.float32)
-        b =  np.zeros(len(A)).astype(np.float32)
+        A = nx.incidence_matrix(G,oriented=True).astype(np.float32)
+        b =  np.zeros(A.shape[0]).astype(np.float32)
         b[0] = -1
         b[-1] = 1
         self.mu = mu
-        G_lb = -1*np.eye(A.shape[1])
-        h_lb = np.zeros(A.shape[1])
-        G_ub = np.eye(A.shape[1])
-        h_ub = np.ones(A.shape[1])
-        G_ineq = np.concatenate((G_lb, G_ub)).astype(np.float32)
-        h_ineq = np.concatenate((h_lb, h_ub)).astype(np.float32)
-        Q =  mu*torch.eye(A.shape[1]).float()
-
-        # G_ineq = G_lb
-        # h_ineq = h_lb
-
-
-        # self.model_params_quad = make_gurobi_model(G_ineq,h_ineq,
-        #     A, b, np.zeros((A.shape[1],A.shape[1]))  ) #mu*np.eye(A.shape[1])
-        # self.solver = QPFunction(verbose=False, solver=QPSolvers.GUROBI,
-        #                 model_params=self.model_params_quad)
-
-        self.A, self.b,self.G, self.h, self.Q =  torch.from_numpy(A), torch.from_numpy(b),  torch.from_numpy(G_ineq),  torch.from_numpy(h_ineq ),  Q
-        self.layer = QPFunction()        
+        self.A, self.b = A, torch.from_numpy(b)
+        self.layer = boxqp(A, self.b, mu, lb=0., ub=1., cache_dir=cache_dir)
 
     def shortest_pathsolution(self, y):
-        A,b,G,h,  Q = self.A, self.b,self.G, self.h, self.Q
-        sol = self.layer(Q,y,G,h,A,b)
+        sol = self.layer(y)
         return sol
 
 
@@ -5,12 +5,20 @@ import torch.nn.functional as F
 from torch.utils.data import DataLoader
 import pytorch_lightning as pl
 import numpy as np
+import os, sys
+### the helpers shared by all the problems are in common_utils, at the root of the repository
+_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+if _root not in sys.path:
+    sys.path.append(_root)
+from common_utils import (SolutionPool, PackedSolutions, PackedObjective, popcount, AsyncGrowth, SolvePipeline, run_seeds,
+    shared, sweep_callbacks, append_csv, get_cvxpylayer, set_cvxpylayer_cache)
 
-def batch_solve(solver, y,relaxation =False):
-    sol = []
-    for i in range(len(y)):
-        sol.append(   solver.solution_fromtorch(y[i]).reshape(1,-1)   )
-    return torch.cat(sol,0).float()
+def batch_solve(solver, y,relaxation =False, index=None):
+    ### solution_fromtorch accepts the whole batch, so a batched solver can solve it in one pass
+    if index is not None:
+        ### dataset indices of the rows, for the solvers which keep per-instance state (certified_solver)
+        return solver.solution_fromtorch(y, index).reshape(len(y),-1).float()
+    return solver.solution_fromtorch(y).reshape(len(y),-1).float()
 
 
 def regret_list(solver, y_hat,y_true, sol_true, minimize= True):  
@@ -34,21 +42,213 @@ def abs_regret_fn(solver, y_hat,y_true, sol_true, minimize= True):
 
 def growcache(solver, cache, y_hat):
     '''
-    cache is torch array [currentpoolsize,48]
+    cache is a SolutionPool of solutions [currentpoolsize,48]
     y_hat is  torch array [batch_size,48]
+    returns the view of the grown cache
     '''
     sol = batch_solve(solver, y_hat,relaxation =False).detach().numpy()
-    cache_np = cache.detach().numpy()
-    cache_np = np.unique(np.append(cache_np,sol,axis=0),axis=0)
-    # torch has no unique function, so we need to do this
-    return torch.from_numpy(cache_np).float()
+    cache.add(sol)
+    return cache.view()
 
 
-def cachingsolver(cache, y_hat, minimize= True):
-    mm = 1 if minimize else -1  
-    solutions = []
-    for ii in range(len(y_hat)):
-        val,ind  = torch.min(((cache)*y_hat[ii]*mm).sum(dim=1),0)
-        solutions.append(cache[ind])
+def cachingsolver(cache, y_hat, minimize= True, engine=None):
+    '''
+    The solution of the cache (torch tensor or PackedSolutions) of best objective for every cost vector of y_hat.
+    engine: a PoolArgmin already updated with the cache; by default the cache is scanned
+    '''
+    if engine is None:
+        engine = PoolArgmin(minimize=minimize)
+        engine.update(cache)
+    ind = engine.argmin(y_hat)
+    if isinstance(cache, PackedSolutions):
+        return cache.unpack(ind.numpy())
+    return cache[ind].float()
+
+
+########################## Memoized exact solver ##########################
+from common_utils.memo import memo_solver as common_memo_solver
+
+class memo_solver(common_memo_solver):
+    '''
+    common_utils.memo.memo_solver with the methods of the shortest path solvers
+    '''
+    def solution_fromtorch(self, y_torch):
+        y = y_torch.unsqueeze(0) if y_torch.dim()==1 else y_torch
+        sol = self.memoize("solution_fromtorch", lambda y_: self.solver.solution_fromtorch(torch.from_numpy(y_)).numpy(),
+            y.detach().cpu().numpy(), batched=True)
+        sol = torch.from_numpy(np.stack(sol))
+        return sol[0] if y_torch.dim()==1 else sol
+
+    def shortest_pathsolution(self, y):
+        return self.memoize("shortest_pathsolution", self.solver.shortest_pathsolution, np.asarray(y)[None])[0]
+
+
+########################## Argmin over the pool ##########################
+class PoolArgmin:
+    '''
+    Argmin of the objective y . solution over a pool of solutions which grows by appending rows,
+    for a batch of cost vectors y; the engine of cachingsolver.
+    backend :
+        "exact" : scan the pool block_size solutions at a time with a matmul
+        "cluster" : group the solutions by k-means and keep, for every cluster, the box [lo, hi] containing its solutions;
+            y . lo+ + y . hi- is then a lower bound of the objective of the solutions of the cluster, and the clusters
+            whose bound is above the best objective found so far are not scanned. It pays off when the solutions form
+            tight clusters; pools smaller than min_size, and batches for which more than scan_fraction of the pool
+            cannot be pruned, are scanned as by "exact".
+    Both backends return the argmin of the objectives computed in float64, the first one in case of ties,
+    i.e. the same solutions as a brute-force scan.
+    minimize : whether the argmin is the solution of minimum (True) or maximum objective
+    n_clusters : number of clusters of the "cluster" backend, sqrt(pool size) by default
+    '''
+    def __init__(self, backend="exact", minimize=True, block_size=4096, n_clusters=None, min_size=4096,
+        scan_fraction=0.5, seed=0):
+        if backend not in ("exact", "cluster"):
+            raise Exception("Invalid argmin backend {}".format(backend))
+        self.backend = backend
+        self.mm = 1 if minimize else -1
+        self.block_size, self.n_clusters, self.min_size = block_size, n_clusters, min_size
+        self.scan_fraction = scan_fraction
+        self.rng = np.random.RandomState(seed)
+        self.solutions, self.size, self.evictions = None, 0, 0
+        ### the clusters: centroids [C, D], box of every cluster [C, D], the rows of every cluster
+        ### and the pool size when the centroids were fitted
+        self.centroids, self.members, self.fitted_size = None, None, 0
+
+    def _block(self, start, stop):
+        if isinstance(self.solutions, PackedSolutions):
+            return self.solutions.unpack(slice(start, stop)).reshape(-1, self.solutions.dim)
+        block = self.solutions[start:stop]
+        return block.reshape(len(block), -1).float()
+
+    def _rows(self, index):
+        if isinstance(self.solutions, PackedSolutions):
+            return self.solutions.unpack(index).reshape(len(index), -1)
+        return self.solutions[torch.as_tensor(index)].reshape(len(index), -1).float()
+
+    def update(self, solutions):
+        '''
+        Index the rows of solutions [n, *shape] (a torch tensor, a PackedSolutions or a SolutionPool) appended
+        since the last update. The rows indexed before must be unchanged, which is checked on the evictions
+        of a SolutionPool; otherwise, or if the pool shrank, all the rows are indexed again.
+        '''
+        evictions = getattr(solutions, "evictions", 0)
+        rows = solutions.view() if isinstance(solutions, SolutionPool) else solutions
+        start = self.size if (evictions == self.evictions and len(rows) >= self.size) else 0
+        self.solutions, self.size, self.evictions = rows, len(rows), evictions
+        if self.backend != "cluster" or self.size < self.min_size:
+            self.centroids = None
+            return
+        if self.centroids is None or self.size > 2*self.fitted_size:
+            self._fit()
+        elif start < self.size:
+            self._assign(start)
+
+    def _fit(self, iterations=5):
+        '''
+        k-means of a sample of the solutions, then the assignment of all of them
+        '''
+        n_clusters = self.n_clusters or int(np.sqrt(self.size))
+        sample = self.rng.choice(self.size, min(self.size, 64*n_clusters), replace=False)
+        x = self._rows(np.sort(sample))
+        centroids = x[self.rng.choice(len(x), n_clusters, replace=False)]
+        for _ in range(iterations):
+            labels = (centroids.square().sum(1) - 2 * x @ centroids.T).argmin(1)
+            counts = torch.bincount(labels, minlength=n_clusters).unsqueeze(1)
+            sums = torch.zeros_like(centroids).index_add_(0, labels, x)
+            ### an empty cluster keeps its centroid
+            centroids = torch.where(counts > 0, sums / counts.clamp(min=1), centroids)
+        self.centroids, self.fitted_size = centroids, self.size
+        self._assign(0)
+
+    def _assign(self, start):
+        '''
+        Assign the rows from start on to their nearest centroid, and widen the boxes of their clusters
+        '''
+        n_clusters, dim = self.centroids.shape
+        if start == 0:
+            self.lo = torch.full((n_clusters, dim), np.inf, dtype=torch.float64)
+            self.hi = torch.full((n_clusters, dim), -np.inf, dtype=torch.float64)
+            self.members = [np.zeros(0, dtype=np.int64) for _ in range(n_clusters)]
+        norms = self.centroids.square().sum(1)
+        for first in range(start, self.size, self.block_size):
+            block = self._block(first, min(first + self.block_size, self.size))
+            labels = (norms - 2 * block @ self.centroids.T).argmin(1)
+            block = block.double()
+            for c in labels.unique().tolist():
+                rows = torch.nonzero(labels == c).squeeze(1)
+                self.lo[c] = torch.minimum(self.lo[c], block[rows].amin(0))
+                self.hi[c] = torch.maximum(self.hi[c], block[rows].amax(0))
+                self.members[c] = np.concatenate([self.members[c], first + rows.numpy()])
+
+    def argmin(self, y):
+        '''
+        Row of the argmin of every cost vector y [batch_size, *shape], as int64 torch tensor [batch_size]
+        '''
+        if self.size == 0:
+            raise Exception("The pool is empty")
+        y = self.mm * y.detach().reshape(len(y), -1).double()
+        if self.centroids is None:
+            return self._scan(y)
+        return self._search(y)
+
+    def _scan(self, y):
+        best = torch.full((len(y),), np.inf, dtype=torch.float64)
+        index = torch.zeros(len(y), dtype=torch.int64)
+        for start in range(0, self.size, self.block_size):
+            val, ind = (y @ self._block(start, min(start + self.block_size, self.size)).double().T).min(1)
+            ### strictly better only, so that the first of tied solutions wins
+            better = val < best
+            best[better], index[better] = val[better], ind[better] + start
+        return index
+
+    def _search(self, y):
+        bound = y.clamp(min=0) @ self.lo.T + y.clamp(max=0) @ self.hi.T
+        ### slack for the rounding errors of the bounds and of the objectives
+        bound -= 1e-9 * (y.abs() @ torch.maximum(self.lo.abs(), self.hi.abs()).T) + 1e-12
+        empty = torch.tensor([len(m) == 0 for m in self.members])
+        bound[:, empty] = np.inf
+        best = torch.full((len(y),), np.inf, dtype=torch.float64)
+        index = torch.zeros(len(y), dtype=torch.int64)
+        ### first the cluster of lowest bound of every cost vector
+        top = bound.argmin(1)
+        for c in top.unique().tolist():
+            self._scan_cluster(y, c, torch.nonzero(top == c).squeeze(1), best, index)
+        ### then the clusters whose bound is below the best objective, unless they are most of the pool
+        bound[torch.arange(len(y)), top] = np.inf
+        needed = (bound <= best.unsqueeze(1)).any(0)
+        if sum(len(self.members[c]) for c in torch.nonzero(needed).squeeze(1).tolist()) > self.scan_fraction * self.size:
+            return self._scan(y)
+        for c in torch.nonzero(needed).squeeze(1)[bound[:, needed].min(0).values.argsort()].tolist():
+            active = torch.nonzero(bound[:, c] <= best).squeeze(1)
+            if len(active) > 0:
+                self._scan_cluster(y, c, active, best, index)
+        return index
+
+    def _scan_cluster(self, y, c, active, best, index):
+        '''
+        Update best and index, in place, with the solutions of the cluster c for the cost vectors active
+        '''
+        members = self.members[c]
+        val, ind = (y[active] @ self._rows(members).double().T).min(1)
+        ind = torch.from_numpy(members)[ind]
+        better = (val < best[active]) | ((val == best[active]) & (ind < index[active]))
+        best[active[better]], index[active[better]] = val[better], ind[better]
+
+
+########################## Solver pool ##########################
+from common_utils.solver_pool import SolverPool as common_SolverPool
+
+class SolverPool(common_SolverPool):
+    '''
+    common_utils.solver_pool.SolverPool of the shortest path solvers, e.g. SolverPool(make_spsolver)
+    '''
+    def __init__(self, factory, workers=None, method="shortest_pathsolution", batched=False, chunk_size=None):
+        super().__init__(factory, workers, method, batched, chunk_size)
+
+    def solution_fromtorch(self, y_torch):
+        y = y_torch.unsqueeze(0) if y_torch.dim()==1 else y_torch
+        sol = torch.from_numpy(self.map(y.detach().cpu().numpy())).float()
+        return sol[0] if y_torch.dim()==1 else sol
 
-    return torch.stack(solutions).float()
\ No newline at end of file
+    def shortest_pathsolution(self, y):
+        return self.solve(y)
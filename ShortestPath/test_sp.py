@@ -5,6 +5,9 @@ from pytorch_lightning.callbacks import ModelCheckpoint
 import random
 from pytorch_lightning import loggers as pl_loggers
 from Trainer.data_utils import datawrapper, ShortestPathDataModule
+from Trainer.utils import memo_solver, SolverPool, run_seeds, shared, sweep_callbacks, append_csv, set_cvxpylayer_cache
+from Trainer.optimizer_module import make_spsolver
+from functools import partial
 torch.use_deterministic_algorithms(True)
 import argparse
 from argparse import Namespace
@@ -64,9 +67,28 @@ parser.add_argument("--regularizer", type=str, help="Types of Regularization", d
 parser.add_argument("--thr", type=float, help="threshold parameter", default= 1e-6)
 parser.add_argument("--damping", type=float, help="damping parameter", default= 1e-8)
 parser.add_argument("--diffKKT",  action='store_true', help="Whether KKT or HSD ",  required=False)
+parser.add_argument("--warmstart",  action='store_true', help="Warm start IntOpt from the iterates of the previous epoch",  required=False)
+parser.add_argument("--certificate",  action='store_true', help="Skip the solves of SPO and DBB whose last solution is certified optimal",  required=False)
 
 parser.add_argument("--tau", type=float, help="parameter of rankwise losses", default= 1e-8)
 parser.add_argument("--growth", type=float, help="growth parameter of rankwise losses", default= 1e-8)
+parser.add_argument("--pool_size", type=int, help="maximum number of solutions in the cache of rankwise losses", default= None, required=False)
+parser.add_argument("--eviction", type=str, help="which solution leaves a full cache: lru or violation", default= "lru", required=False)
+parser.add_argument("--packed",  action='store_true', help="Store the cache of rankwise losses bit-packed",  required=False)
+parser.add_argument("--argmin", type=str, help="argmin over the cache of the SPO loss: exact or cluster", default= "exact", required=False)
+parser.add_argument("--growth_mode", type=str, help="grow the cache of rankwise losses in sync, or in the background with thread or process workers", default= "sync", required=False)
+parser.add_argument("--growth_workers", type=int, help="number of background workers growing the cache; the thread workers share the solver and solve one batch at a time", default= 1, required=False)
+parser.add_argument("--max_pending", type=int, help="maximum number of batches being solved in the background", default= 2, required=False)
+parser.add_argument("--solver", type=str, help="exact solver: dag, the batched solver of the acyclic graph, or glop, one LP warm started from its last basis, for the graphs which are not acyclic", default= "dag", required=False)
+parser.add_argument("--memo",  action='store_true', help="Serve the exact solves of bit-identical costs from a memo",  required=False)
+parser.add_argument("--solver_workers", type=int, help="number of worker processes solving the batches, 0 to solve them in this process", default= 0, required=False)
+parser.add_argument("--deterministic_growth",  action='store_true', help="Merge the background solutions in a deterministic order",  required=False)
+parser.add_argument("--pipelined",  action='store_true', help="Solve the validation and test batches in the background, while the network computes the next ones",  required=False)
+parser.add_argument("--seed_workers", type=int, help="number of seeds run at the same time, each in its own process", default= 1, required=False)
+parser.add_argument("--threads_per_worker", type=int, help="number of torch threads of every seed process, 0 for the number of cores over seed_workers", default= 0, required=False)
+parser.add_argument("--output_tag", type=str, help="tag of the checkpoint and log directories, e.g. to run several configurations at the same time", default= "", required=False)
+parser.add_argument("--intopt_cache_dir", type=str, help="directory caching the presolved constraints of IntOpt and QPTL across runs, none by default", default= None, required=False)
+parser.add_argument("--cvxpylayer_cache_dir", type=str, help="directory caching the compiled cvxpylayers of DCOL across runs, none by default; only trusted runs may write to it", default= None, required=False)
 
 parser.add_argument('--scheduler', dest='scheduler',  type=lambda x: bool(strtobool(x)))
 args = parser.parse_args()
@@ -85,12 +107,39 @@ network_name = argument_dict.pop('net')
 N = argument_dict.pop('N')
 noise = argument_dict.pop('noise')
 deg = argument_dict.pop('deg')
+### how the seeds are run and where they keep their checkpoints, which are not part of the results
+seed_workers = argument_dict.pop('seed_workers')
+threads_per_worker = argument_dict.pop('threads_per_worker')
+output_tag = argument_dict.pop('output_tag')
+memo = argument_dict.pop('memo')
+intopt_cache_dir = argument_dict.pop('intopt_cache_dir')
+set_cvxpylayer_cache(argument_dict.pop('cvxpylayer_cache_dir'))
 
 
 
 sentinel_ns = Namespace(**{key:sentinel for key in argument_dict})
 parser.parse_args(namespace=sentinel_ns)
 explicit = {key:value for key, value in vars(sentinel_ns).items() if value is not sentinel }
+### the exact solver breaks the ties between shortest paths, so it is part of the results, but it is not a model argument
+solver_name = argument_dict.pop('solver')
+if solver_name not in ("dag", "glop"):
+    raise Exception("Invalid solver {}".format(solver_name))
+if solver_name == "glop" and argument_dict['certificate']:
+    raise Exception("The certificates require the dag solver")
+### the cache of the presolved constraints does not change the results
+argument_dict['intopt_cache_dir'] = intopt_cache_dir
+### with --solver_workers, the exact solver runs in worker processes, each with its own solver, and with --memo
+### the solves of bit-identical costs, e.g. SPO and the validation regret on the same predictions, are served
+### from a memo; neither changes the solutions
+def make_exact_solver():
+    if argument_dict['solver_workers'] > 1:
+        solver = SolverPool(partial(make_spsolver, solver_name), argument_dict['solver_workers'])
+    else:
+        solver = spsolver if solver_name == "dag" else make_spsolver(solver_name)
+    return memo_solver(solver) if memo else solver
+exact_solver = shared(("exact_solver", solver_name, argument_dict['solver_workers'], memo), make_exact_solver)
+if exact_solver is not spsolver:
+    argument_dict['exact_solver'] = exact_solver
 
 torch.use_deterministic_algorithms(True)
 def seed_all(seed):
@@ -105,8 +154,8 @@ def seed_all(seed):
 ################## Define the outputfile
 outputfile = "Rslt/{}{}.csv".format(modelname,args.loss)
 regretfile = "Rslt/{}{}Regret.csv".format(modelname,args.loss)
-ckpt_dir =  "ckpt_dir/{}{}/".format(modelname, args.loss)
-log_dir = "lightning_logs/{}{}/".format(modelname, args.loss)
+ckpt_dir =  "ckpt_dir/{}{}{}/".format(modelname, args.loss, output_tag)
+log_dir = "lightning_logs/{}{}{}/".format(modelname, args.loss, output_tag)
 learning_curve_datafile =    "LearningCurve/{}_".format(modelname)+"_".join( ["{}_{}".format(k,v) for k,v  in explicit.items()] )+".csv" 
 
 
@@ -126,12 +175,17 @@ Test_dfy= pd.read_csv("SyntheticData/Testdatay_N_{}_noise_{}_deg_{}.csv".format(
 x_test =  Test_dfx.T.values.astype(np.float32)
 y_test = Test_dfy.T.values.astype(np.float32)
 
-train_df =  datawrapper( x_train,y_train)
-valid_df =  datawrapper( x_valid,y_valid)
-test_df =  datawrapper( x_test,y_test)
+train_df =  datawrapper( x_train,y_train, solver=exact_solver)
+valid_df =  datawrapper( x_valid,y_valid, solver=exact_solver)
+test_df =  datawrapper( x_test,y_test, solver=exact_solver)
 shutil.rmtree(log_dir,ignore_errors=True)
 
-for seed in range(10):
+### the solutions do not depend on the seed, so they are computed once and shared by all the seeds
+if modelname=="CachingPO":
+    init_cache = batch_solve(exact_solver, torch.from_numpy(y_train),relaxation =False)
+sol_test =  batch_solve(exact_solver, torch.from_numpy(y_test).float())
+
+def run_seed(seed):
     seed_all(seed)
 
     g = torch.Generator()
@@ -140,18 +194,19 @@ for seed in range(10):
     net = network_dict[network_name]
 
 
-    shutil.rmtree(ckpt_dir,ignore_errors=True)
+    ### every seed has its own checkpoints, as the seeds may run at the same time
+    seed_ckpt_dir = ckpt_dir + "seed{}/".format(seed)
+    shutil.rmtree(seed_ckpt_dir,ignore_errors=True)
     checkpoint_callback = ModelCheckpoint(
         # monitor="val_regret",mode="min",
-        dirpath=ckpt_dir, 
+        dirpath=seed_ckpt_dir, 
         filename="model-{epoch:02d}-{val_loss:.2f}",
     )
     
     
     tb_logger = pl_loggers.TensorBoardLogger(save_dir= log_dir, version=seed)
-    trainer = pl.Trainer(max_epochs= argument_dict['max_epochs'],callbacks=[checkpoint_callback],  min_epochs=5, logger=tb_logger)
+    trainer = pl.Trainer(max_epochs= argument_dict['max_epochs'],callbacks=[checkpoint_callback] + sweep_callbacks(),  min_epochs=5, logger=tb_logger)
     if modelname=="CachingPO":
-        init_cache = batch_solve(spsolver, torch.from_numpy(y_train),relaxation =False)
         model = modelcls(net= net,seed=seed, init_cache=init_cache, **argument_dict)
     else:
         model = modelcls(net= net ,seed=seed, **argument_dict)
@@ -162,23 +217,19 @@ for seed in range(10):
     
     best_model_path = checkpoint_callback.best_model_path
     if modelname=="CachingPO":
-        init_cache = batch_solve(spsolver, torch.from_numpy(y_train),relaxation =False)
         model = modelcls.load_from_checkpoint(best_model_path,seed=seed, net= net, init_cache=init_cache, **argument_dict)
     else:
         model = modelcls.load_from_checkpoint(best_model_path,net= net,seed=seed, **argument_dict)
 
 
     y_pred = model(torch.from_numpy(x_test).float()).squeeze()
-    sol_test =  batch_solve(spsolver, torch.from_numpy(y_test).float())
-    regret_list_data = regret_list(spsolver, y_pred, torch.from_numpy(y_test).float(), sol_test)
+    regret_list_data = regret_list(exact_solver, y_pred, torch.from_numpy(y_test).float(), sol_test)
 
-    df = pd.DataFrame({"regret":regret_list_data})
-    df.index.name='instance'
-    df['seed'] =seed
+    regret_df = pd.DataFrame({"regret":regret_list_data})
+    regret_df.index.name='instance'
+    regret_df['seed'] =seed
     for k,v in explicit.items():
-        df[k] = v
-    with open(regretfile, 'a') as f:
-        df.to_csv(f, header=f.tell()==0)
+        regret_df[k] = v
 
 
     ##### Summary
@@ -188,8 +239,14 @@ for seed in range(10):
     df['seed'] =seed
     for k,v in explicit.items():
         df[k] = v
-    with open(outputfile, 'a') as f:
-        df.to_csv(f, header=f.tell()==0)
+    if memo:
+        print("Exact solver memo after seed {}: {}".format(seed, exact_solver.summary()))
+    return [(regretfile, regret_df), (outputfile, df)]
+
+### the results are written here, in the order of the seeds, however many seeds run at the same time
+for seed, results in run_seeds(run_seed, range(10), seed_workers, threads_per_worker):
+    for path, df in results:
+        append_csv(path, df)
 ###############################  Save  Learning Curve Data ########
 import os
 from tensorboard.backend.event_processing.event_accumulator import EventAccumulator
@@ -215,5 +272,4 @@ df = pd.DataFrame({"step": steps,'wall_time':walltimes,  "val_regret": regrets,
 "val_mse": mses })
 for k,v in explicit.items():
     df[k] = v
-with open( learning_curve_datafile, 'a') as f:
-    df.to_csv(f, header=f.tell()==0)
+append_csv(learning_curve_datafile, df)
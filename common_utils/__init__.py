@@ -0,0 +1,11 @@
+'''
+Helpers shared by the problems of the benchmark. The Trainer/utils.py of every problem imports them from here,
+so that the scripts and the models keep importing them from Trainer.utils.
+'''
+from common_utils.solution_pool import SolutionPool, PackedSolutions, PackedObjective, popcount
+from common_utils.growth import AsyncGrowth
+from common_utils.pipeline import SolvePipeline
+from common_utils.runs import run_seeds, shared, sweep_callbacks, append_csv
+from common_utils.compiled_layers import get_cvxpylayer, set_cvxpylayer_cache
+from common_utils.memo import memo_solver
+from common_utils.solver_pool import SolverPool
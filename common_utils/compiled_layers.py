@@ -0,0 +1,93 @@
+'''
+CvxpyLayers compiled once per process, and optionally pickled for the later runs
+'''
+import os, hashlib, pickle, warnings
+import numpy as np
+import scipy.sparse as sps
+import torch
+
+
+### CvxpyLayers compiled in this process, keyed by the content hash of their inputs
+_cvxpylayers = {}
+### directory of set_cvxpylayer_cache
+_cache = {"dir": None}
+
+def _content_hash(*items):
+    '''
+    Hash of nested tuples/lists of numpy arrays, torch tensors, scipy sparse matrices and scalars/strings
+    '''
+    h = hashlib.sha1()
+    def update(item):
+        if isinstance(item, (tuple, list)):
+            h.update(b"(")
+            for it in item:
+                update(it)
+            h.update(b")")
+        elif sps.issparse(item):
+            M = sps.csr_matrix(item)
+            M.sum_duplicates()
+            M.sort_indices()
+            h.update(repr(("sparse", M.shape, M.dtype.str)).encode())
+            for part in (M.data, M.indices, M.indptr):
+                h.update(np.ascontiguousarray(part).tobytes())
+        elif isinstance(item, (np.ndarray, torch.Tensor)):
+            M = item.detach().cpu().numpy() if isinstance(item, torch.Tensor) else item
+            h.update(repr(("array", M.shape, M.dtype.str)).encode())
+            h.update(np.ascontiguousarray(M).tobytes())
+        else:
+            h.update(repr(item).encode())
+    update(items)
+    return h.hexdigest()
+
+def set_cvxpylayer_cache(cache_dir=None):
+    '''
+    Directory where get_cvxpylayer pickles the compiled layers and reads them back in later runs,
+    e.g. from the --cvxpylayer_cache_dir argument of the scripts; None (the default) keeps them in memory only.
+    Reading a pickle may run arbitrary code, so it must be a directory which only trusted runs write to.
+    '''
+    _cache["dir"] = cache_dir
+
+def get_cvxpylayer(make_problem, key, cache_dir=None):
+    '''
+    Return the CvxpyLayer of the problem built by make_problem, compiled once per key.
+    make_problem: function returning (problem, parameters, variables) of the CvxpyLayer
+    key: tuple of everything the problem depends on, e.g. (name, A, b, mu, regularizer);
+        numpy arrays, torch tensors and scipy sparse matrices are hashed by content
+    The compiled layer is kept for the lifetime of the process, so that all the seeds of a run share it.
+    If cache_dir, or else the directory of set_cvxpylayer_cache, is not None, the layer is also pickled there,
+    so that later runs skip the DPP canonicalization; only the file named after the hash of key is read back.
+    '''
+    import cvxpy as cp
+    import cvxpylayers
+    from cvxpylayers.torch import CvxpyLayer
+    key_hash = _content_hash(key, cp.__version__, cvxpylayers.__version__)
+    if key_hash in _cvxpylayers:
+        return _cvxpylayers[key_hash]
+
+    cache_dir = cache_dir if cache_dir is not None else _cache["dir"]
+    path = None if cache_dir is None else os.path.join(cache_dir, "cvxpylayer_{}.pkl".format(key_hash))
+    if path is not None and os.path.exists(path):
+        try:
+            with open(path, "rb") as f:
+                layer = pickle.load(f)
+            if not isinstance(layer, CvxpyLayer):
+                raise Exception("{} is not a CvxpyLayer".format(path))
+            _cvxpylayers[key_hash] = layer
+            return layer
+        except Exception:
+            warnings.warn("Could not read the cached cvxpylayer {}, compiling it again".format(path))
+
+    problem, parameters, variables = make_problem()
+    layer = CvxpyLayer(problem, parameters=parameters, variables=variables)
+    _cvxpylayers[key_hash] = layer
+    if path is not None:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            ### write to a temporary file first, so that concurrent runs never read a partial file
+            tmp_path = "{}.{}.tmp".format(path, os.getpid())
+            with open(tmp_path, "wb") as f:
+                pickle.dump(layer, f)
+            os.replace(tmp_path, path)
+        except Exception:
+            warnings.warn("Could not pickle the cvxpylayer to {}".format(path))
+    return layer
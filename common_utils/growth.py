@@ -0,0 +1,110 @@
+'''
+Growth of a SolutionPool by background workers
+'''
+import time, threading
+from functools import partial
+import numpy as np
+import torch
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+
+### the solve function of the worker processes, sent once when they start
+_worker_solve = None
+
+def _init_worker(solve, factory=None):
+    global _worker_solve
+    _worker_solve = solve if factory is None else factory()
+
+def _run_worker(*args):
+    return _worker_solve(*args)
+
+def _locked(lock, solve, *args):
+    with lock:
+        return solve(*args)
+
+class AsyncGrowth:
+    '''
+    Grows a SolutionPool in the background. submit() hands the detached predicted costs of a batch to a pool
+    of workers, which solve them, and merge(), at the next step, adds the solutions found since to the pool.
+    pool : the SolutionPool to grow
+    solve : function of the arguments given to submit, which returns the solutions [batch_size, *shape];
+        it must be picklable for processes
+    mode : "thread", when the solver releases the GIL, or "process"
+    workers : number of worker threads or processes. The solvers of Gurobi and OR-tools hold their model and
+        are not thread safe, so the worker threads which share solve call it one at a time
+    factory : if not None, every worker thread or process builds its own solve once with factory(), and the
+        worker threads then solve at the same time; solve may be None
+    max_pending : bound of the batches being solved; submit waits for the oldest one while there are as many
+    deterministic : merge waits for all the batches submitted before and adds them in the order they were
+        submitted, so that the pool does not depend on the timing of the workers; otherwise merge only adds
+        the batches already solved
+    '''
+    def __init__(self, pool, solve, mode="thread", workers=1, max_pending=2, deterministic=False, factory=None):
+        if mode not in ("thread", "process"):
+            raise Exception("Invalid growth mode {}".format(mode))
+        if max_pending < 1:
+            raise Exception("max_pending must be at least 1")
+        self.pool = pool
+        self.max_pending, self.deterministic = max_pending, deterministic
+        if solve is None and factory is None:
+            raise Exception("AsyncGrowth needs solve or factory")
+        self.factory = factory
+        if mode == "thread":
+            self.executor = ThreadPoolExecutor(max_workers=workers)
+            if factory is not None:
+                self._local = threading.local()
+                self.solve = self._thread_solve
+            elif workers > 1:
+                self.solve = partial(_locked, threading.Lock(), solve)
+            else:
+                self.solve = solve
+        else:
+            self.solve = _run_worker
+            self.executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(solve, factory))
+        self.pending = []
+        ### number of batches submitted and merged, and the seconds spent waiting for the workers
+        self.submitted, self.merged, self.waited = 0, 0, 0.
+
+    def _thread_solve(self, *args):
+        ### the solve of the worker thread, built by its first call
+        if not hasattr(self._local, "solve"):
+            self._local.solve = self.factory()
+        return self._local.solve(*args)
+
+    def submit(self, *args):
+        '''
+        Solve args in the background; the torch tensors and numpy arrays are copied first
+        '''
+        args = [a.detach().cpu().clone() if isinstance(a, torch.Tensor) else np.copy(a) if isinstance(a, np.ndarray) else a
+            for a in args]
+        while len(self.pending) >= self.max_pending:
+            self._merge(self.pending.pop(0))
+        self.pending.append(self.executor.submit(self.solve, *args))
+        self.submitted += 1
+
+    def _merge(self, future):
+        start = time.time()
+        solutions = future.result()
+        self.waited += time.time() - start
+        self.pool.add(solutions)
+        self.merged += 1
+
+    def merge(self, wait=False):
+        '''
+        Add the solutions of the batches solved so far to the pool, or of all the pending ones if wait
+        or deterministic; returns the view of the pool
+        '''
+        if wait or self.deterministic:
+            while self.pending:
+                self._merge(self.pending.pop(0))
+        else:
+            status = [(f, f.done()) for f in self.pending]
+            self.pending = [f for f, done in status if not done]
+            for future, done in status:
+                if done:
+                    self._merge(future)
+        return self.pool.view()
+
+    def close(self):
+        self.merge(wait=True)
+        self.executor.shutdown()
@@ -0,0 +1,134 @@
+'''
+Memo of the solutions of an exact solver, shared by the memo_solver of every problem
+'''
+import os, hashlib, threading, warnings
+from collections import OrderedDict
+import numpy as np
+
+
+class memo_solver:
+    '''
+    Memoizing wrapper around an exact solver. Solutions are keyed on the bytes of the cost vector and of the
+    side inputs, so only bit-identical calls are shared, and kept in a bounded LRU.
+    solver : the wrapped solver; the attributes which are not memoized are forwarded to it
+    maxsize : maximum number of solutions kept in memory
+    max_bytes : cap on the memory taken by the solutions kept in memory and their keys
+    spill_dir : if not None, the solutions evicted from memory are written to this directory
+        and read back on a later call, instead of being solved again
+    The memo is locked, so that the growth threads of AsyncGrowth and the training step may call it at the
+    same time; the solver itself is called outside of the lock, with the rows missing from the memo.
+    The Trainer/utils.py of every problem subclasses it with the methods of its solvers; solve and
+    batched_solve take the cost vectors with one row of every side input per row, and keyword arguments.
+    '''
+    def __init__(self, solver, maxsize=100000, max_bytes=2**28, spill_dir=None):
+        self.solver = solver
+        self.maxsize, self.max_bytes, self.spill_dir = maxsize, max_bytes, spill_dir
+        self.memo = OrderedDict()
+        self.nbytes = 0
+        self.hits, self.misses, self.spill_hits = 0, 0, 0
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        ### only called for the attributes not found on the wrapper
+        if name in ("solver", "lock"):
+            raise AttributeError(name)
+        return getattr(self.solver, name)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def _keys(self, name, y, side):
+        prefix = repr((name, y.dtype.str, y.shape[1:], [(s.dtype.str, s.shape[1:]) for s in side])).encode()
+        rows = [np.ascontiguousarray(y)] + [np.ascontiguousarray(s) for s in side]
+        return [b"".join([prefix] + [x[i].tobytes() for x in rows]) for i in range(len(y))]
+
+    def _spill_path(self, key):
+        return os.path.join(self.spill_dir, "{}.npy".format(hashlib.sha1(key).hexdigest()))
+
+    def _lookup(self, key):
+        if key in self.memo:
+            self.memo.move_to_end(key)
+            return self.memo[key]
+        if self.spill_dir is not None and os.path.exists(self._spill_path(key)):
+            try:
+                sol = np.load(self._spill_path(key))
+            except Exception:
+                return None
+            self.spill_hits += 1
+            self._store(key, sol)
+            return sol
+        return None
+
+    def _store(self, key, sol):
+        if key in self.memo:
+            ### solved by another thread in the meantime
+            return
+        self.memo[key] = sol
+        self.nbytes += sol.nbytes + len(key)
+        while len(self.memo) > self.maxsize or (self.nbytes > self.max_bytes and len(self.memo) > 1):
+            old_key, old_sol = self.memo.popitem(last=False)
+            self.nbytes -= old_sol.nbytes + len(old_key)
+            if self.spill_dir is not None and not os.path.exists(self._spill_path(old_key)):
+                try:
+                    os.makedirs(self.spill_dir, exist_ok=True)
+                    tmp_path = "{}.{}.tmp.npy".format(self._spill_path(old_key)[:-4], os.getpid())
+                    np.save(tmp_path, old_sol)
+                    os.replace(tmp_path, self._spill_path(old_key))
+                except Exception:
+                    warnings.warn("Could not spill a solution to {}".format(self.spill_dir))
+
+    def memoize(self, name, fn, y, side=(), batched=False):
+        '''
+        Solutions of every row of y : 2D numpy array, as a list of numpy arrays.
+        side : tuple of arrays with one row of side inputs per row of y
+        fn : solves a 2D array of the missing rows if batched, else a single row, called with the side inputs
+        '''
+        keys = self._keys(name, y, side)
+        with self.lock:
+            sols = [self._lookup(key) for key in keys]
+            ### rows missing from the memo, grouped by key so that repeated rows of a call are solved once
+            missing = OrderedDict()
+            for i, (key, sol) in enumerate(zip(keys, sols)):
+                if sol is None:
+                    missing.setdefault(key, []).append(i)
+            first = [rows[0] for rows in missing.values()]
+            self.hits += len(keys) - len(first)
+            self.misses += len(first)
+        if len(first) > 0:
+            if batched:
+                solved = fn(y[first], *[s[first] for s in side])
+            else:
+                solved = [fn(y[i], *[s[i] for s in side]) for i in first]
+            solved = [np.array(sol) for sol in solved]
+            with self.lock:
+                for (key, rows), sol in zip(missing.items(), solved):
+                    self._store(key, sol)
+                    for i in rows:
+                        sols[i] = sol
+        ### copies, so that callers may modify the returned solutions
+        return [sol.copy() for sol in sols]
+
+    def summary(self):
+        with self.lock:
+            calls = self.hits + self.misses
+            return {"memo_hits": self.hits, "memo_misses": self.misses, "memo_spill_hits": self.spill_hits,
+                "memo_hit_rate": self.hits / calls if calls > 0 else 0., "memo_size": len(self.memo), "memo_bytes": self.nbytes}
+
+    def solve(self, y, *side, **kwargs):
+        ### the keyword arguments are part of the key, the side inputs are part of the key of every row
+        return self.memoize("solve{}".format(sorted(kwargs.items())), lambda *rows: self.solver.solve(*rows, **kwargs),
+            np.asarray(y)[None], tuple(np.asarray(s)[None] for s in side))[0]
+
+    def batched_solve(self, y, *side, **kwargs):
+        if hasattr(self.solver, "batched_solve"):
+            fn, batched = (lambda *rows: self.solver.batched_solve(*rows, **kwargs)), True
+        else:
+            fn, batched = (lambda *rows: self.solver.solve(*rows, **kwargs)), False
+        return np.stack(self.memoize("solve{}".format(sorted(kwargs.items())), fn,
+            np.asarray(y), tuple(np.asarray(s) for s in side), batched=batched))
@@ -0,0 +1,42 @@
+'''
+Solves of the validation and test batches overlapped with the forward passes of the network
+'''
+import torch
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SolvePipeline:
+    '''
+    Solves the validation and test batches in a background thread, so that the solver works on batch k
+    while the network computes the forward pass of batch k+1. The batches are solved one at a time and
+    in order, so the solver is never called concurrently.
+    submit(fn, *args, batch_size) : fn(*args) returns a dict of the metrics of the batch
+    wait() : the metrics and sizes of the batches submitted since the last wait, in order
+    means(results) : the means of the metrics weighted by the batch sizes, as self.log(on_epoch=True) reduces them
+    '''
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = []
+
+    def submit(self, fn, *args, batch_size=1):
+        self.pending.append((self.executor.submit(fn, *args), batch_size))
+
+    def wait(self):
+        pending, self.pending = self.pending, []
+        return [(future.result(), batch_size) for future, batch_size in pending]
+
+    @staticmethod
+    def means(results):
+        ### accumulated in the default dtype and in order, as lightning does
+        means = {}
+        for key in (results[0][0] if results else {}):
+            total, cumulated_batch_size = torch.tensor(0.), torch.tensor(0.)
+            for metrics, batch_size in results:
+                total = total + torch.as_tensor(metrics[key], dtype=total.dtype).mean() * batch_size
+                cumulated_batch_size = cumulated_batch_size + batch_size
+            means[key] = total / cumulated_batch_size
+        return means
+
+    def close(self):
+        self.pending = []
+        self.executor.shutdown()
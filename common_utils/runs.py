@@ -0,0 +1,131 @@
+'''
+Runs of the seeds and of the configurations of a script: seed processes, objects kept between runs and result files
+'''
+import os
+import traceback
+import multiprocessing as mp
+from multiprocessing.connection import wait
+import torch
+
+
+def _seed_worker(run, seed, threads, conn):
+    if threads is not None:
+        torch.set_num_threads(threads)
+    try:
+        conn.send((None, run(seed)))
+    except Exception:
+        conn.send((traceback.format_exc(), None))
+    conn.close()
+
+def run_seeds(run, seeds, workers=1, threads=None):
+    '''
+    Yields (seed, run(seed)) for every seed, in the order of seeds.
+    With workers > 1, every seed is run by a process forked from this one, at most workers at a time,
+    so the seeds share the datasets and the solutions computed before the call instead of building them again,
+    and every seed starts from the same state. The results of run must be picklable.
+    threads : number of torch threads of every seed process, the number of cores over workers by default
+    Without fork, the seeds are run one after the other in this process.
+    '''
+    seeds = list(seeds)
+    if workers <= 1 or "fork" not in mp.get_all_start_methods():
+        for seed in seeds:
+            yield seed, run(seed)
+        return
+    ctx = mp.get_context("fork")
+    threads = threads or max(1, os.cpu_count() // workers)
+    pending, running, results = list(seeds), {}, {}
+
+    def start():
+        while pending and len(running) < workers:
+            conn, child_conn = ctx.Pipe(duplex=False)
+            process = ctx.Process(target=_seed_worker, args=(run, pending[0], threads, child_conn))
+            process.start()
+            child_conn.close()
+            running[conn] = (pending.pop(0), process)
+
+    try:
+        start()
+        for seed in seeds:
+            while seed not in results:
+                for conn in wait(list(running)):
+                    done, process = running.pop(conn)
+                    try:
+                        error, result = conn.recv()
+                    except EOFError:
+                        error, result = "The process exited with code {}".format(process.exitcode), None
+                    conn.close(), process.join()
+                    if error is not None:
+                        raise Exception("Seed {} failed:\n{}".format(done, error))
+                    results[done] = result
+                    ### the next seed starts as soon as one is done, whether or not it is the next to be yielded
+                    start()
+            yield seed, results.pop(seed)
+    finally:
+        ### the seeds still running when a seed fails or the caller stops
+        for conn, (_, process) in running.items():
+            process.terminate(), process.join()
+            conn.close()
+
+
+try:
+    import fcntl
+except ImportError:
+    ### no file locks on Windows
+    fcntl = None
+
+### kept between the runs of the scripts in this process, by the workers of sweep.py which run many configurations
+_shared = {}
+_sweep_callbacks = []
+### the rows append_csv was given since stage_csv, None when they are written at once
+_staged = {"rows": None}
+
+def shared(key, build):
+    '''
+    The object build() returned the first time shared was called with key in this process, e.g. the data
+    and the solvers of a script, which the workers of sweep.py then reuse between configurations.
+    key: hashable, with everything the object depends on
+    '''
+    if key not in _shared:
+        _shared[key] = build()
+    return _shared[key]
+
+def sweep_callbacks():
+    '''
+    Callbacks which sweep.py adds to the trainers of the scripts it runs, none otherwise
+    '''
+    return [make() for make in _sweep_callbacks]
+
+def append_csv(path, df, **kwargs):
+    '''
+    Appends df to the csv file path, with the header if the file is empty. The file is locked while it is
+    written, so that the runs which share it, e.g. the workers of sweep.py, never interleave their rows.
+    After stage_csv, the rows are kept until write_staged_csv instead.
+    '''
+    if _staged["rows"] is not None:
+        _staged["rows"].append((os.path.abspath(path), df, kwargs))
+        return
+    with open(path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        ### another run may have written to the file since it was opened
+        f.seek(0, os.SEEK_END)
+        df.to_csv(f, header=f.tell()==0, **kwargs)
+
+def stage_csv():
+    '''
+    Keep the rows given to append_csv from now on until write_staged_csv, e.g. in the workers of sweep.py,
+    so that the runs which are stopped or fail, or do not finish before the sweep crashes, write none
+    '''
+    _staged["rows"] = []
+
+def write_staged_csv(write=True):
+    '''
+    Appends the rows kept since stage_csv to their files if write, else drops them, and writes the next rows
+    at once again; returns the number of frames written
+    '''
+    rows, _staged["rows"] = _staged["rows"] or [], None
+    if not write:
+        return 0
+    for path, df, kwargs in rows:
+        append_csv(path, df, **kwargs)
+    return len(rows)
@@ -0,0 +1,275 @@
+'''
+Pools of the distinct solutions of the caching losses, stored as float32 or bit-packed
+'''
+import numpy as np
+import torch
+from torch.autograd import Function
+
+
+class SolutionPool:
+    '''
+    Pool of the distinct solutions used by the caching losses.
+    Membership is tested on a hash set of the solutions (bit-packed when they are binary),
+    new solutions are appended to a preallocated buffer, whose capacity doubles when it is full,
+    and view() returns the pool as a torch tensor sharing the memory of that buffer.
+    solutions : initial solutions, numpy array or torch tensor [n, *shape]; duplicates are dropped
+    max_size : maximum number of solutions in the pool, None for no limit
+    eviction : which solution makes room for a new one once the pool has max_size solutions
+        "lru" : the one which was last the argmin of the predicted costs the longest time ago
+        "violation" : the least violated one, i.e. the one whose objective under the predicted costs
+            was the furthest from the one of the argmin of the pool
+    minimize : whether the argmin is the solution of minimum (True) or maximum objective
+    packed : whether to store the solutions bit-packed, they must then be 0/1 and view() returns
+        a PackedSolutions
+    '''
+    def __init__(self, solutions, max_size=None, eviction="lru", minimize=True, capacity=1024, packed=False):
+        if eviction not in ("lru", "violation"):
+            raise Exception("Invalid eviction policy {}".format(eviction))
+        if max_size is not None and max_size < 1:
+            raise Exception("max_size must be at least 1")
+        if not isinstance(solutions, PackedSolutions):
+            solutions = self._asarray(solutions)
+        self.shape = tuple(solutions.shape[1:]) if not isinstance(solutions, PackedSolutions) else solutions.shape
+        self.dim = int(np.prod(self.shape))
+        self.packed = packed
+        self.max_size, self.eviction = max_size, eviction
+        self.mm = 1 if minimize else -1
+        ### key of a solution -> its row in the buffer, and the key of every row
+        self.index, self.keys = {}, []
+        self.size, self.clock, self.evictions = 0, 0, 0
+        capacity = max(capacity, len(solutions), 1)
+        if max_size is not None:
+            capacity = min(capacity, max_size)
+        self.buffer = self._empty(capacity)
+        ### for the eviction policies: when each solution was last the argmin, and its last gap to the argmin
+        self.last_used = np.zeros(capacity, dtype=np.int64)
+        self.gap = np.zeros(capacity)
+        self.add(solutions)
+
+    @staticmethod
+    def _asarray(x):
+        x = x.detach().cpu().numpy() if isinstance(x, torch.Tensor) else np.asarray(x)
+        ### + 0. turns -0. into 0., so that both have the same key
+        return x.astype(np.float32) + np.float32(0.)
+
+    def _keys(self, solutions):
+        flat = solutions.reshape(len(solutions), -1)
+        binary = ((flat == 0) | (flat == 1)).all(1)
+        packed = np.packbits(flat > 0.5, axis=1)
+        return [b"b" + packed[i].tobytes() if binary[i] else b"f" + flat[i].tobytes() for i in range(len(flat))]
+
+    def _empty(self, capacity):
+        if self.packed:
+            return np.empty((capacity, (self.dim + 7) // 8), dtype=np.uint8)
+        return np.empty((capacity,) + self.shape, dtype=np.float32)
+
+    def _rows(self, solutions):
+        '''
+        The rows of the buffer and the keys of solutions
+        '''
+        if isinstance(solutions, PackedSolutions):
+            keys = [b"b" + row.tobytes() for row in solutions.bits]
+            return (solutions.bits if self.packed else solutions.unpack().numpy()), keys
+        solutions = self._asarray(solutions).reshape((-1,) + self.shape)
+        keys = self._keys(solutions)
+        if not self.packed:
+            return solutions, keys
+        if not all(key.startswith(b"b") for key in keys):
+            raise Exception("Only 0/1 solutions can be packed")
+        return np.packbits(solutions.reshape(len(solutions), -1) > 0.5, axis=1), keys
+
+    def _reserve(self, capacity):
+        if self.max_size is not None:
+            capacity = min(capacity, self.max_size)
+        buffer = self._empty(capacity)
+        buffer[:self.size] = self.buffer[:self.size]
+        last_used, gap = np.zeros(capacity, dtype=np.int64), np.zeros(capacity)
+        last_used[:self.size], gap[:self.size] = self.last_used[:self.size], self.gap[:self.size]
+        self.buffer, self.last_used, self.gap = buffer, last_used, gap
+
+    def _evict(self):
+        if self.eviction == "lru":
+            victim = int(np.argmin(self.last_used[:self.size]))
+        else:
+            victim = int(np.argmax(self.gap[:self.size]))
+        ### the last row takes the place of the evicted one
+        last = self.size - 1
+        del self.index[self.keys[victim]]
+        if victim != last:
+            self.buffer[victim] = self.buffer[last]
+            self.last_used[victim], self.gap[victim] = self.last_used[last], self.gap[last]
+            self.keys[victim] = self.keys[last]
+            self.index[self.keys[victim]] = victim
+        self.keys.pop()
+        self.size -= 1
+        self.evictions += 1
+
+    def add(self, solutions):
+        '''
+        Add the solutions [n, *shape] which are not in the pool yet; returns the number of solutions added.
+        The solutions come from the solver, so they are the argmin of their cost vectors.
+        '''
+        rows, keys = self._rows(solutions)
+        added = 0
+        for row, key in zip(rows, keys):
+            if key in self.index:
+                i = self.index[key]
+                self.last_used[i], self.gap[i] = self.clock, 0.
+                continue
+            if self.max_size is not None and self.size >= self.max_size:
+                self._evict()
+            if self.size == len(self.buffer):
+                self._reserve(2 * len(self.buffer))
+            self.buffer[self.size] = row
+            self.last_used[self.size], self.gap[self.size] = self.clock, 0.
+            self.index[key] = self.size
+            self.keys.append(key)
+            self.size += 1
+            added += 1
+        return added
+
+    def touch(self, y_hat):
+        '''
+        Record which solutions are the argmin of the predicted costs y_hat [batch_size, *shape].
+        Only the eviction policies use it, so it does nothing if the pool has no maximum size.
+        '''
+        if self.max_size is None or self.size == 0:
+            return
+        self.clock += 1
+        y = self._asarray(y_hat).reshape(-1, self.dim)
+        if self.packed:
+            with torch.no_grad():
+                obj = self.mm * self.view().objective(torch.from_numpy(y)).numpy()
+        else:
+            obj = self.mm * (y @ self.buffer[:self.size].reshape(self.size, -1).T)
+        self.last_used[:self.size][obj.argmin(1)] = self.clock
+        self.gap[:self.size] = (obj - obj.min(1, keepdims=True)).min(0)
+
+    def view(self):
+        '''
+        The solutions in the pool as a torch tensor [size, *shape], or a PackedSolutions if the pool
+        is packed, without copy. It is valid until the next call to add, which may move or overwrite the rows.
+        '''
+        if self.packed:
+            return PackedSolutions(self.buffer[:self.size], self.shape)
+        return torch.from_numpy(self.buffer[:self.size])
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, solution):
+        return self._keys(self._asarray(solution).reshape((1,) + self.shape))[0] in self.index
+
+
+### number of ones of every byte, for the numpy versions without np.bitwise_count
+_popcount_table = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+def popcount(bits):
+    '''
+    Number of ones of every row of bits : uint8 array [..., nbytes]
+    '''
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(bits).sum(-1, dtype=np.int64)
+    return _popcount_table[bits].sum(-1, dtype=np.int64)
+
+class PackedSolutions:
+    '''
+    0/1 solutions [n, *shape] stored 8 per byte by np.packbits, 32 times smaller than as float32.
+    bits : uint8 array [n, ceil(D/8)], D the number of entries of a solution
+    shape : shape of one solution
+    block_size : number of solutions unpacked at a time by objective, column_sums and blocks
+    The objective of real costs is computed block by block, so that it takes O(block_size D) memory
+    on top of the [batch_size, n] result; the overlap of 0/1 vectors is counted with popcount on the bits.
+    '''
+    def __init__(self, bits, shape, block_size=4096):
+        self.bits = bits
+        self.shape = tuple(shape)
+        self.dim = int(np.prod(self.shape))
+        self.block_size = block_size
+
+    @classmethod
+    def pack(cls, solutions, block_size=4096):
+        '''
+        Pack solutions : numpy array or torch tensor [n, *shape] of 0/1 entries
+        '''
+        if isinstance(solutions, cls):
+            return solutions
+        x = solutions.detach().cpu().numpy() if isinstance(solutions, torch.Tensor) else np.asarray(solutions)
+        flat = x.reshape(len(x), -1)
+        if not ((flat == 0) | (flat == 1)).all():
+            raise Exception("Only 0/1 solutions can be packed")
+        return cls(np.packbits(flat.astype(bool), axis=1), x.shape[1:], block_size)
+
+    def __len__(self):
+        return len(self.bits)
+
+    def unpack(self, index=slice(None)):
+        '''
+        The solutions of the rows index of bits, as float torch tensor [k, *shape]
+        '''
+        bits = self.bits[index]
+        if bits.ndim == 1:
+            return self.unpack([index])[0]
+        x = np.unpackbits(bits, axis=1, count=self.dim).astype(np.float32)
+        return torch.from_numpy(x.reshape((len(x),) + self.shape))
+
+    def blocks(self):
+        '''
+        The solutions, block_size at a time, as (index of the first one, float torch tensor [k, *shape])
+        '''
+        for start in range(0, len(self), self.block_size):
+            yield start, self.unpack(slice(start, start + self.block_size))
+
+    def objective(self, y):
+        '''
+        y . solution of every cost vector y : torch tensor [batch_size, *shape] and every solution,
+        as torch tensor [batch_size, n], differentiable with respect to y
+        '''
+        return PackedObjective.apply(y.reshape(len(y), self.dim), self)
+
+    def column_sums(self, dtype=torch.float32):
+        '''
+        Sum of the solutions, i.e. the number of solutions with a one at every entry, as torch tensor [*shape] of dtype
+        '''
+        counts = np.zeros(self.dim, dtype=np.int64)
+        for start in range(0, len(self), self.block_size):
+            counts += np.unpackbits(self.bits[start:start + self.block_size], axis=1, count=self.dim).sum(0, dtype=np.int64)
+        return torch.from_numpy(counts.reshape(self.shape)).to(dtype)
+
+    def overlap(self, solutions):
+        '''
+        Number of common ones of every 0/1 vector of solutions [batch_size, *shape] and every solution,
+        i.e. their objective when the costs are 0/1, as int64 numpy array [batch_size, n]
+        '''
+        other = PackedSolutions.pack(solutions).bits
+        return np.stack([popcount(self.bits & row) for row in other])
+
+    def hamming(self, solutions):
+        '''
+        Hamming distance between every 0/1 vector of solutions [batch_size, *shape] and every solution,
+        as int64 numpy array [batch_size, n]
+        '''
+        other = PackedSolutions.pack(solutions).bits
+        return np.stack([popcount(self.bits ^ row) for row in other])
+
+class PackedObjective(Function):
+    '''
+    y @ solutions.T, unpacking block_size solutions at a time in the forward and the backward pass
+    '''
+    @staticmethod
+    def forward(ctx, y, packed):
+        ctx.packed = packed
+        out = y.new_empty((len(y), len(packed)))
+        for start in range(0, len(packed), packed.block_size):
+            block = packed.unpack(slice(start, start + packed.block_size)).reshape(-1, packed.dim).to(y)
+            out[:, start:start + len(block)] = y @ block.T
+        return out
+
+    @staticmethod
+    def backward(ctx, grad):
+        packed = ctx.packed
+        dy = grad.new_zeros((len(grad), packed.dim))
+        for start in range(0, len(packed), packed.block_size):
+            block = packed.unpack(slice(start, start + packed.block_size)).reshape(-1, packed.dim).to(grad)
+            dy += grad[:, start:start + len(block)] @ block
+        return dy, None
@@ -0,0 +1,220 @@
+'''
+Persistent worker processes, each with its own solver, solving the rows of a batch through shared memory
+'''
+import os, threading, time, traceback
+import multiprocessing as mp
+from multiprocessing import shared_memory, resource_tracker
+from multiprocessing.util import Finalize
+from multiprocessing.connection import wait
+import numpy as np
+
+
+def _constant(value):
+    ### the factory of the pools whose workers all apply the same function, e.g. LocalPool of warcraft
+    return value
+
+def _solver_worker(factory, conn):
+    '''
+    Loop of a worker process: builds its solver once, then solves the rows start:stop of the arrays
+    in shared memory it is sent, and replies the error if any and the time it took, until it is sent None
+    '''
+    solver = factory()
+    blocks = {}
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+        method, batched, specs, start, stop, kwargs = task
+        tic = time.perf_counter()
+        try:
+            ### the blocks of the previous calls which were replaced by larger ones
+            for name in [name for name in blocks if name not in [spec[0] for spec in specs]]:
+                blocks.pop(name).close()
+            for name, _, _ in specs:
+                if name not in blocks:
+                    blocks[name] = shared_memory.SharedMemory(name=name)
+            *inputs, out = [np.ndarray(shape, dtype=dtype, buffer=blocks[name].buf) for name, shape, dtype in specs]
+            fn = solver if method is None else getattr(solver, method)
+            if batched:
+                out[start:stop] = np.asarray(fn(*[x[start:stop] for x in inputs], **kwargs)).reshape(out[start:stop].shape)
+            else:
+                for i in range(start, stop):
+                    out[i] = np.asarray(fn(*[x[i] for x in inputs], **kwargs)).reshape(out[i].shape)
+            ### the views must be released before the blocks can be closed
+            del inputs, out
+            conn.send((None, time.perf_counter() - tic))
+        except Exception:
+            conn.send((traceback.format_exc(), time.perf_counter() - tic))
+    for block in blocks.values():
+        block.close()
+
+def _stop_worker(conn, process):
+    try:
+        conn.send(None)
+    except Exception:
+        pass
+    process.join(timeout=5)
+    if process.is_alive():
+        process.terminate()
+        process.join()
+    conn.close()
+
+def _close_pool(conns, processes, blocks):
+    for conn, process in zip(conns, processes):
+        _stop_worker(conn, process)
+    for block in blocks:
+        block.close()
+        block.unlink()
+    conns.clear(), processes.clear(), blocks.clear()
+
+class SolverPool:
+    '''
+    Persistent worker processes, each with its own solver, to solve a batch of cost vectors in parallel.
+    It is a drop-in for the solver in batch_solve (and so in the diff layers), and can be wrapped in memo_solver.
+    The solvers hold per-process state and are not picklable, so every worker builds its own once with factory.
+    The batches and the solutions go through shared memory, chunk_size rows per task, and the solutions
+    are written back in the order of the rows.
+    factory : picklable callable returning a solver, e.g. partial(knapsack_solver, weights, capacity, n_items)
+    workers : number of worker processes, the number of cores by default
+    method : the method of the solver which solves a row (or a block of rows if batched), None for the solver itself
+    chunk_size : rows sent to a worker at a time, by default a quarter of the rows per worker
+    The solutions must have the shape of the cost vectors.
+    A worker which dies, e.g. killed by the out of memory killer, is replaced by a new one and its rows are sent
+    to it once more; if they kill it again, the call fails, and the pool stays usable.
+    The calls are serialized by a lock, so that threads, e.g. the ones of AsyncGrowth, may share the pool.
+    efficiency : the parallel efficiency of every call, the time the workers were busy over the wall time
+        of all the workers
+    '''
+    def __init__(self, factory, workers=None, method="solve", batched=False, chunk_size=None):
+        self.factory, self.workers = factory, workers or os.cpu_count()
+        self.method, self.batched, self.chunk_size = method, batched, chunk_size
+        self.conns, self.processes, self.blocks = [], [], []
+        self.lock = threading.Lock()
+        self.efficiency = []
+        self.restarts = 0
+        self._finalizer = None
+        self._pid = None
+
+    def _spawn(self):
+        conn, child_conn = self._ctx.Pipe()
+        process = self._ctx.Process(target=_solver_worker, args=(self.factory, child_conn), daemon=True)
+        process.start()
+        child_conn.close()
+        return conn, process
+
+    def _start(self):
+        ### a forked process, e.g. a seed of run_seeds, starts its own workers and leaves the ones of its parent alone
+        if self._finalizer is not None:
+            self._finalizer.cancel()
+            self.conns, self.processes, self.blocks = [], [], []
+        self._pid = os.getpid()
+        ### the workers are stopped and the blocks freed on close, or when the pool is garbage collected or at exit;
+        ### unlike weakref.finalize, the finalizers of multiprocessing also run at the exit of a forked process
+        self._finalizer = Finalize(self, _close_pool, args=(self.conns, self.processes, self.blocks), exitpriority=0)
+        ### fork, where available, so that the scripts which build the pool are not run again by the workers
+        self._ctx = mp.get_context("fork" if "fork" in mp.get_all_start_methods() else "spawn")
+        ### the workers share the resource tracker of this process, which unlinks the blocks only if this process dies
+        resource_tracker.ensure_running()
+        for _ in range(self.workers):
+            conn, process = self._spawn()
+            self.conns.append(conn), self.processes.append(process)
+
+    def _restart(self, i):
+        '''
+        Replace the worker i, which died; the lists are changed in place, as the finalizer holds them
+        '''
+        _stop_worker(self.conns[i], self.processes[i])
+        self.conns[i], self.processes[i] = self._spawn()
+        self.restarts += 1
+
+    def _block(self, slot, nbytes):
+        '''
+        Shared memory block of at least nbytes for the array slot, reused between calls
+        '''
+        if slot < len(self.blocks) and self.blocks[slot].size >= nbytes:
+            return self.blocks[slot]
+        block = shared_memory.SharedMemory(create=True, size=max(2 * nbytes, 1))
+        if slot < len(self.blocks):
+            self.blocks[slot].close(), self.blocks[slot].unlink()
+            self.blocks[slot] = block
+        else:
+            self.blocks.append(block)
+        return block
+
+    def map(self, y, *side, **kwargs):
+        '''
+        Solutions of every row of y : numpy array [batch_size, ...] with the side inputs of every row,
+        as float64 numpy array of the shape of y
+        '''
+        if self._pid is not None and self._pid != os.getpid():
+            ### in a forked process, the lock may have been held by another thread of the parent
+            self.lock = threading.Lock()
+        with self.lock:
+            if not self.processes or self._pid != os.getpid():
+                self._start()
+            arrays = [np.ascontiguousarray(y)] + [np.ascontiguousarray(s) for s in side]
+            n = len(arrays[0])
+            out = np.zeros(arrays[0].shape, dtype=np.float64)
+            specs, views = [], []
+            for slot, x in enumerate(arrays + [out]):
+                block = self._block(slot, x.nbytes)
+                view = np.ndarray(x.shape, dtype=x.dtype, buffer=block.buf)
+                view[...] = x
+                specs.append((block.name, x.shape, x.dtype.str))
+                views.append(view)
+            chunk_size = self.chunk_size or max(1, -(-n // (4 * self.workers)))
+            ### every chunk with the number of times it was sent to a worker which died
+            chunks = [(start, min(start + chunk_size, n), 0) for start in range(0, n, chunk_size)]
+            idle, busy, errors, busy_time = list(range(self.workers)), {}, [], 0.
+            tic = time.perf_counter()
+            while chunks or busy:
+                while chunks and idle:
+                    i = idle.pop()
+                    start, stop, deaths = chunk = chunks.pop(0)
+                    task = (self.method, self.batched, specs, start, stop, kwargs)
+                    try:
+                        self.conns[i].send(task)
+                    except OSError:
+                        ### the worker died since its last task
+                        self._restart(i)
+                        self.conns[i].send(task)
+                    busy[self.conns[i]] = (i, chunk)
+                for conn in wait(list(busy)):
+                    i, (start, stop, deaths) = busy.pop(conn)
+                    try:
+                        error, seconds = conn.recv()
+                    except (EOFError, OSError):
+                        ### the pipe is closed before the process is reaped
+                        self.processes[i].join(timeout=5)
+                        exitcode = self.processes[i].exitcode
+                        self._restart(i)
+                        idle.append(i)
+                        if deaths == 0:
+                            chunks.insert(0, (start, stop, 1))
+                        else:
+                            errors.append("The worker solving the rows {}:{} exited with code {}, twice".format(start, stop, exitcode))
+                            chunks = []
+                        continue
+                    busy_time += seconds
+                    if error is not None:
+                        ### the other chunks are not sent, but the ones being solved are waited for
+                        errors.append(error)
+                        chunks = []
+                    idle.append(i)
+            wall_time = time.perf_counter() - tic
+            out = views[-1].copy()
+            del views
+            if errors:
+                raise Exception("A solver worker failed:\n{}".format(errors[0]))
+            self.efficiency.append(busy_time / (wall_time * self.workers) if wall_time > 0 else 1.)
+            return out
+
+    def solve(self, y, *side, **kwargs):
+        return self.map(np.asarray(y)[None], *[np.asarray(s)[None] for s in side], **kwargs)[0]
+
+    def batched_solve(self, y, *side, **kwargs):
+        return self.map(y, *side, **kwargs)
+
+    def close(self):
+        if self._finalizer is not None:
+            self._finalizer()
@@ -0,0 +1,320 @@
+'''
+Hyperparameter sweeps over the script of a problem, e.g. Knapsack/testknapsack.py, run by long-lived worker processes.
+
+    python sweep.py sweep.json --workers 4
+
+sweep.json gives the script, its fixed arguments and the ones to search, e.g.
+    {"script": "Knapsack/testknapsack.py",
+     "args": {"capacity": 120, "max_epochs": 20},
+     "grid": {"model": ["SPO", "DCOL"], "lr": [0.1, 0.5]},
+     "random": {"mu": {"loguniform": [0.01, 10]}, "tau": {"uniform": [0, 1]}, "loss": {"choice": ["listwise", "pairwise"]}},
+     "samples": 10}
+Every point of the grid is run with samples draws of the random arguments (once if there are none). The arguments
+are passed as --name value, and as --name alone if the value is true, for the flags of the scripts.
+The other entries of the spec, all optional:
+    seed: seed of the random draws, so that a resumed sweep draws the same configurations (0)
+    metric, mode: the metric the scripts log every epoch, and whether it is minimized ("val_regret", "min")
+    grace_epochs: epochs every run trains before it may be stopped (3)
+    min_peers: other runs the median is taken over before a run may be stopped (3)
+    cost_key: the arguments the cost of a run depends on (["model"])
+
+Every worker runs the configurations in its own process, in the directory of the script, so the packages
+(cvxpy, gurobipy, ortools, ...) are imported once, and the data, the solutions and the solver pools the scripts
+keep with shared (common_utils/runs.py), as well as the compiled cvxpylayers, are reused between configurations.
+Every configuration has its own checkpoint and log directories (--output_tag) and all of them append their
+results to the same files, as the scripts run one by one would. A run writes its results only once it is done,
+so the runs which are stopped or fail leave none in these files.
+
+The configurations are packed on the workers longest first, by the mean time the runs of the same method
+(cost_key) took; the methods which have not been measured yet are run first, one at a time.
+A run is stopped (median stopping rule) when, after grace_epochs, the best metric of one of its trainers so far
+is worse than the median of the best ones of the other runs at the same epoch of the same trainer (seed).
+
+The finished runs are recorded in a json lines file (sweep.state.jsonl by default), so that a sweep which crashed
+is resumed by running it again: the finished runs are skipped, and their costs and metrics are reused. The runs
+which had not finished start again; they had written no results, as a run writes them just before it is recorded.
+'''
+import argparse
+import hashlib
+import itertools
+import json
+import math
+import os
+import random
+import runpy
+import statistics
+import sys
+import time
+import traceback
+import multiprocessing as mp
+from collections import defaultdict
+from multiprocessing.connection import wait
+
+DEFAULTS = {"args": {}, "grid": {}, "random": {}, "samples": 1, "seed": 0, "metric": "val_regret", "mode": "min",
+    "grace_epochs": 3, "min_peers": 3, "cost_key": ["model"]}
+
+class Pruned(Exception):
+    '''
+    Raised in the trainer of a run which the sweep stops
+    '''
+
+def _sample(rng, distribution):
+    (kind, values), = distribution.items()
+    if kind == "choice":
+        return rng.choice(values)
+    if kind == "uniform":
+        return rng.uniform(*values)
+    if kind == "loguniform":
+        return math.exp(rng.uniform(math.log(values[0]), math.log(values[1])))
+    if kind == "randint":
+        return rng.randint(*values)
+    raise Exception("Invalid distribution {}".format(kind))
+
+def make_configs(spec):
+    '''
+    The arguments of the script of every configuration of spec, always in the same order
+    '''
+    rng = random.Random(spec["seed"])
+    names = sorted(spec["grid"])
+    configs = []
+    for values in itertools.product(*[spec["grid"][name] for name in names]):
+        for _ in range(spec["samples"] if spec["random"] else 1):
+            config = {**spec["args"], **dict(zip(names, values))}
+            config.update({name: _sample(rng, spec["random"][name]) for name in sorted(spec["random"])})
+            configs.append(config)
+    return configs
+
+def run_id(script, config):
+    return hashlib.sha1(json.dumps([script, config], sort_keys=True).encode()).hexdigest()[:12]
+
+def command_line(config):
+    argv = []
+    for name, value in config.items():
+        if value is True:
+            argv.append("--" + name)
+        elif value is not False and value is not None:
+            argv += ["--" + name, str(value)]
+    return argv
+
+########################## Workers ##########################
+def _worker(script, metric, threads, conn):
+    '''
+    Loop of a worker process: runs the script with the configurations it is sent, and replies how each run ended
+    and the time it took, until it is sent None. While a run trains, it reports the metric of every epoch
+    and is told whether to stop. The rows the run appends to the result files are kept until it is done,
+    and dropped if it is stopped or fails.
+    '''
+    ### imported next to this file, before the worker moves to the directory of the script
+    import common_utils.runs as runs
+    directory, name = os.path.split(os.path.abspath(script))
+    os.chdir(directory)
+    sys.path.insert(0, directory)
+    import torch
+    import pytorch_lightning as pl
+    torch.set_num_threads(threads)
+
+    class Reporter(pl.Callback):
+        def __init__(self, key, fit):
+            self.key, self.fit = key, fit
+
+        def on_train_epoch_end(self, trainer, pl_module):
+            ### the validation of the epoch is over by now
+            value = trainer.callback_metrics.get(metric)
+            if value is None:
+                return
+            conn.send(("report", self.key, self.fit, trainer.current_epoch, float(value)))
+            if conn.recv():
+                raise Pruned("Run {} stopped at epoch {} of trainer {}".format(self.key, trainer.current_epoch, self.fit))
+
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+        key, config = task
+        ### the scripts build a trainer for every seed, one after the other
+        fits = itertools.count()
+        runs._sweep_callbacks[:] = [lambda: Reporter(key, next(fits))]
+        sys.argv = [name] + command_line(config) + ["--output_tag", key]
+        tic = time.perf_counter()
+        runs.stage_csv()
+        try:
+            runpy.run_path(name, run_name="__main__")
+            status, error = "done", None
+        except Pruned:
+            status, error = "pruned", None
+        except (Exception, SystemExit):
+            ### SystemExit if argparse rejects the arguments
+            status, error = "failed", traceback.format_exc()
+        finally:
+            runs._sweep_callbacks[:] = []
+        try:
+            runs.write_staged_csv(write=status == "done")
+        except Exception:
+            status, error = "failed", traceback.format_exc()
+        conn.send(("finished", key, status, time.perf_counter() - tic, error))
+
+########################## Scheduler ##########################
+class Sweep:
+    '''
+    The configurations of spec, run by workers worker processes with threads torch threads each.
+    state: json lines file of the finished runs, read to resume the sweep
+    '''
+    def __init__(self, spec, workers=1, threads=None, state="sweep.state.jsonl"):
+        unknown = set(spec) - set(DEFAULTS) - {"script"}
+        if unknown:
+            raise Exception("Invalid entries of the sweep {}".format(sorted(unknown)))
+        self.spec = {**DEFAULTS, **spec}
+        if self.spec["mode"] not in ("min", "max"):
+            raise Exception("Invalid mode {}".format(self.spec["mode"]))
+        self.script = self.spec["script"]
+        self.configs = {run_id(self.script, config): config for config in make_configs(self.spec)}
+        if any(config.get("seed_workers", 1) > 1 for config in self.configs.values()):
+            ### the seed processes would report to the sweep at the same time
+            raise Exception("The runs of a sweep must run their seeds one after the other")
+        self.workers = workers
+        self.threads = threads or max(1, os.cpu_count() // workers)
+        self.state = state
+        ### the runs which finished, the seconds the runs of every method took and the metric of every epoch
+        ### of every trainer of every run
+        self.finished, self.seconds = {}, defaultdict(list)
+        self.curves = defaultdict(lambda: defaultdict(list))
+        self.started = defaultdict(int)
+        if state is not None and os.path.exists(state):
+            with open(state) as f:
+                for line in f:
+                    self._restore(json.loads(line))
+
+    def _restore(self, record):
+        key = record["run"]
+        self.curves[key] = defaultdict(list, {int(fit): curve for fit, curve in record["curves"].items()})
+        if record["status"] == "done":
+            self.seconds[self.cost_key(record["config"])].append(record["seconds"])
+        if record["status"] in ("done", "pruned"):
+            self.finished[key] = record
+
+    def cost_key(self, config):
+        return json.dumps([config.get(name) for name in self.spec["cost_key"]])
+
+    def cost(self, key):
+        '''
+        The mean time of the runs of the method of the run key which are done, None if there are none
+        '''
+        seconds = self.seconds.get(self.cost_key(self.configs[key]))
+        return sum(seconds) / len(seconds) if seconds else None
+
+    def next_run(self, pending):
+        def priority(key):
+            cost = self.cost(key)
+            ### the methods not measured yet first, one run of each at a time, then the longest runs first
+            if cost is None:
+                return (1, -self.started[self.cost_key(self.configs[key])], 0.)
+            return (0, 0, cost)
+        return max(pending, key=priority)
+
+    def should_stop(self, key, fit, epoch, value):
+        '''
+        Records the metric of the epoch of the trainer fit of the run key, and whether to stop the run
+        '''
+        curve = self.curves[key][fit]
+        curve.append(value if self.spec["mode"] == "min" else -value)
+        if epoch + 1 < self.spec["grace_epochs"]:
+            return False
+        peers = [min(curves[fit][:len(curve)]) for other, curves in self.curves.items()
+            if other != key and len(curves.get(fit, [])) >= len(curve)]
+        if len(peers) < self.spec["min_peers"]:
+            return False
+        return min(curve) > statistics.median(peers)
+
+    def _record(self, key, status, seconds, error):
+        record = {"run": key, "config": self.configs[key], "status": status, "seconds": seconds,
+            "curves": self.curves.get(key, {}), "error": error}
+        if self.state is not None:
+            with open(self.state, "a") as f:
+                f.write(json.dumps(record) + "\n")
+        self._restore(record)
+        print("[{}/{}] {} {} in {:.1f}s: {}".format(len(self.finished), len(self.configs), status, key, seconds,
+            " ".join(command_line(self.configs[key]))))
+        if error is not None:
+            print(error)
+
+    def _start_worker(self, ctx):
+        conn, child_conn = ctx.Pipe()
+        process = ctx.Process(target=_worker, args=(self.script, self.spec["metric"], self.threads, child_conn))
+        process.start()
+        child_conn.close()
+        return conn, process
+
+    def run(self):
+        pending = [key for key in self.configs if key not in self.finished]
+        print("{} runs, {} finished already".format(len(self.configs), len(self.configs) - len(pending)))
+        ctx = mp.get_context()
+        workers = dict(self._start_worker(ctx) for _ in range(min(self.workers, len(pending))))
+        idle, running = list(workers), {}
+        try:
+            while pending or running:
+                while pending and idle:
+                    key = self.next_run(pending)
+                    pending.remove(key)
+                    conn = idle.pop()
+                    conn.send((key, self.configs[key]))
+                    ### a run which failed before starts its curves again
+                    self.curves[key] = defaultdict(list)
+                    running[conn] = (key, time.perf_counter())
+                    self.started[self.cost_key(self.configs[key])] += 1
+                for conn in wait(list(running)):
+                    try:
+                        message = conn.recv()
+                    except EOFError:
+                        ### the worker died, e.g. out of memory; the run fails and a new worker takes its place
+                        key, tic = running.pop(conn)
+                        workers.pop(conn).join()
+                        self._record(key, "failed", time.perf_counter() - tic, "The worker exited")
+                        conn, process = self._start_worker(ctx)
+                        workers[conn] = process
+                        idle.append(conn)
+                        continue
+                    if message[0] == "report":
+                        conn.send(self.should_stop(*message[1:]))
+                        continue
+                    _, key, status, seconds, error = message
+                    running.pop(conn)
+                    self._record(key, status, seconds, error)
+                    idle.append(conn)
+        finally:
+            for conn, process in workers.items():
+                try:
+                    conn.send(None)
+                except Exception:
+                    pass
+            for process in workers.values():
+                process.join(timeout=5)
+                if process.is_alive():
+                    process.terminate()
+        return self.summary()
+
+    def summary(self):
+        '''
+        The runs which are done, best first by the mean over their trainers of the best metric
+        '''
+        sign = 1 if self.spec["mode"] == "min" else -1
+        rows = []
+        for key, record in self.finished.items():
+            if record["status"] == "done" and record["curves"]:
+                best = [min(curve) for curve in self.curves[key].values() if curve]
+                rows.append((sign * sum(best) / len(best), key, record["config"]))
+        return sorted(rows, key=lambda row: sign * row[0])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("spec", type=str, help="json file of the sweep")
+    parser.add_argument("--workers", type=int, help="number of worker processes running configurations", default= 1, required=False)
+    parser.add_argument("--threads_per_worker", type=int, help="number of torch threads of every worker, 0 for the number of cores over workers", default= 0, required=False)
+    parser.add_argument("--state", type=str, help="json lines file of the finished runs, by default the spec with .state.jsonl", default= None, required=False)
+    args = parser.parse_args()
+
+    with open(args.spec) as f:
+        spec = json.load(f)
+    state = args.state or os.path.splitext(args.spec)[0] + ".state.jsonl"
+    sweep = Sweep(spec, args.workers, args.threads_per_worker, os.path.abspath(state))
+    for value, key, config in sweep.run()[:10]:
+        print("{:.6f} {} {}".format(value, key, " ".join(command_line(config))))
@@ -0,0 +1,11 @@
+import os
+import sys
+
+### the tests import common_utils from the root of the repository, wherever pytest is run from
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+### the scripts import ortools before cvxpy, whose HiGHS library may clash with the one ortools is linked with
+try:
+    from ortools.linear_solver import pywraplp  # noqa: F401
+except ImportError:
+    pass
@@ -0,0 +1,55 @@
+import importlib.util
+import os
+
+import numpy as np
+import pytest
+import torch
+
+from common_utils import PackedSolutions
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="module")
+def losses():
+    spec = importlib.util.spec_from_file_location("warcraft_losses", os.path.join(ROOT, "warcraft", "comb_modules", "losses.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def grids(seed=0, batch_size=3, cache_size=10, size=5):
+    rng = np.random.default_rng(seed)
+    ### few distinct costs, so that there are ties
+    pred = torch.tensor(rng.integers(0, 3, size=(batch_size, size, size)), dtype=torch.float64)
+    true = torch.tensor(rng.random((batch_size, size, size)))
+    target = torch.tensor(rng.integers(0, 2, size=(batch_size, size, size)), dtype=torch.float64)
+    ### float64, so that the sums of the dense cache are those of the cost dtype
+    cache = torch.tensor(rng.integers(0, 2, size=(cache_size, size, size)), dtype=torch.float64)
+    return pred, true, target, cache
+
+
+@pytest.mark.parametrize("name", ["MAP", "MAP_c", "MAP_c_actual", "NCE", "NCE_c", "PointwiseLoss"])
+def test_packed_cache_gives_the_loss_and_gradient_of_the_dense_one(losses, name):
+    pred, true, target, cache = grids()
+    results = []
+    for c in (cache, PackedSolutions.pack(cache, block_size=3)):
+        p = pred.clone().requires_grad_()
+        loss = getattr(losses, name)()(p, true, target, c)
+        loss.backward()
+        results.append((loss.detach(), p.grad))
+    assert results[0][0].dtype == torch.float64 and results[1][0].dtype == torch.float64
+    assert torch.allclose(results[0][0], results[1][0], rtol=1e-12, atol=1e-12)
+    assert torch.allclose(results[0][1], results[1][1], rtol=1e-12, atol=1e-12)
+
+
+def test_columnwise_max_spreads_the_gradient_among_the_ties(losses):
+    pred, _, target, cache = grids(seed=1)
+    ### the same solution twice ties with itself
+    cache = torch.cat([cache, cache[:1]])
+    p = pred.clone().requires_grad_()
+    loss = losses._columnwise_max(p, target, PackedSolutions.pack(cache, block_size=4), 1)
+    values = ((target.unsqueeze(1) - cache.double().unsqueeze(0))*pred.unsqueeze(1)).sum(dim=2)
+    assert torch.allclose(loss, values.reshape(len(pred), -1).max(dim=1)[0].mean())
+    loss.backward()
+    assert torch.isfinite(p.grad).all()
@@ -0,0 +1,93 @@
+import os
+import pickle
+
+import numpy as np
+import pytest
+import torch
+
+cp = pytest.importorskip("cvxpy")
+pytest.importorskip("cvxpylayers")
+from cvxpylayers.torch import CvxpyLayer
+
+from common_utils import compiled_layers
+from common_utils import get_cvxpylayer, set_cvxpylayer_cache
+
+A = np.array([[1., 1., 1., 1.]])
+
+
+def make_problem(calls):
+    def make():
+        calls.append(1)
+        c, x = cp.Parameter(A.shape[1]), cp.Variable(A.shape[1])
+        problem = cp.Problem(cp.Minimize(c @ x + 0.5 * cp.sum_squares(x)), [A @ x == 1, x >= 0])
+        return problem, [c], [x]
+    return make
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    compiled_layers._cvxpylayers.clear()
+    yield
+    compiled_layers._cvxpylayers.clear()
+    set_cvxpylayer_cache(None)
+
+
+def solve(layer, y):
+    y = y.clone().requires_grad_()
+    sol, = layer(y)
+    (sol * torch.arange(sol.shape[1])).sum().backward()
+    return sol.detach(), y.grad
+
+
+def test_compiled_once_per_key_and_nothing_written_by_default(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    calls = []
+    first = get_cvxpylayer(make_problem(calls), ("test", A, 1.))
+    assert get_cvxpylayer(make_problem(calls), ("test", A.copy(), 1.)) is first
+    assert get_cvxpylayer(make_problem(calls), ("test", A, 2.)) is not first
+    assert len(calls) == 2
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.parametrize("through_setter", [False, True])
+def test_pickled_layer_round_trip(tmp_path, through_setter):
+    cache_dir = str(tmp_path / "layers")
+    kwargs = {} if through_setter else {"cache_dir": cache_dir}
+    if through_setter:
+        set_cvxpylayer_cache(cache_dir)
+    calls = []
+    y = torch.tensor([[0.3, -0.2, 0.1, 0.5], [1., 0., -1., 0.]], dtype=torch.float64)
+    compiled = get_cvxpylayer(make_problem(calls), ("test", A), **kwargs)
+    files = os.listdir(cache_dir)
+    assert len(files) == 1 and files[0].endswith(".pkl")
+
+    ### a later run reads the layer back instead of compiling it
+    compiled_layers._cvxpylayers.clear()
+    loaded = get_cvxpylayer(make_problem(calls), ("test", A), **kwargs)
+    assert len(calls) == 1
+    assert isinstance(loaded, CvxpyLayer) and loaded is not compiled
+    for a, b in zip(solve(compiled, y), solve(loaded, y)):
+        assert torch.allclose(a, b, atol=1e-6)
+
+
+def test_unreadable_or_foreign_files_are_compiled_again(tmp_path):
+    cache_dir = str(tmp_path)
+    calls = []
+    get_cvxpylayer(make_problem(calls), ("test", A), cache_dir=cache_dir)
+    path, = [os.path.join(cache_dir, f) for f in os.listdir(cache_dir)]
+    for content in [b"not a pickle", pickle.dumps({"not": "a layer"})]:
+        with open(path, "wb") as f:
+            f.write(content)
+        compiled_layers._cvxpylayers.clear()
+        with pytest.warns(UserWarning, match="Could not read"):
+            layer = get_cvxpylayer(make_problem(calls), ("test", A), cache_dir=cache_dir)
+        assert isinstance(layer, CvxpyLayer)
+    assert len(calls) == 3
+
+
+def test_unwritable_cache_dir_warns(tmp_path):
+    blocker = tmp_path / "file"
+    blocker.write_text("")
+    with pytest.warns(UserWarning, match="Could not pickle"):
+        layer = get_cvxpylayer(make_problem([]), ("test", A), cache_dir=str(blocker / "layers"))
+    assert isinstance(layer, CvxpyLayer)
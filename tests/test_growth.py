@@ -0,0 +1,119 @@
+import threading
+import time
+from functools import partial
+
+import numpy as np
+import pytest
+import torch
+
+from common_utils import SolutionPool, AsyncGrowth
+
+
+def solve(y):
+    ### the argmin over the vertices of the unit cube
+    return (y.numpy() < 0).astype(np.float32)
+
+
+def costs(n=12, seed=0):
+    rng = np.random.default_rng(seed)
+    return [torch.from_numpy(rng.normal(size=(4, 6)).astype(np.float32)) for _ in range(n)]
+
+
+@pytest.mark.parametrize("mode", ["thread", "process"])
+def test_deterministic_growth_matches_sync(mode):
+    sync = SolutionPool(np.zeros((1, 6)))
+    for y in costs():
+        sync.add(solve(y))
+    pool = SolutionPool(np.zeros((1, 6)))
+    growth = AsyncGrowth(pool, solve, mode=mode, workers=2, max_pending=3, deterministic=True)
+    for y in costs():
+        growth.submit(y)
+        growth.merge()
+    growth.close()
+    assert torch.equal(pool.view(), sync.view())
+    assert growth.submitted == growth.merged == 12
+
+
+def test_merge_adds_the_solved_batches():
+    pool = SolutionPool(np.zeros((1, 6)))
+    growth = AsyncGrowth(pool, solve, workers=1, max_pending=2)
+    for y in costs(5):
+        growth.submit(y)
+        ### at most max_pending batches are being solved
+        assert len(growth.pending) <= 2
+    growth.merge(wait=True)
+    assert growth.merged == 5 and not growth.pending
+    growth.close()
+
+
+def test_submit_copies_the_costs():
+    pool = SolutionPool(np.zeros((1, 6)))
+    growth = AsyncGrowth(pool, solve, max_pending=1, deterministic=True)
+    y = -torch.ones(1, 6)
+    growth.submit(y)
+    y.fill_(1.)
+    growth.close()
+    assert np.ones(6, dtype=np.float32) in pool
+
+
+def test_invalid_mode():
+    with pytest.raises(Exception):
+        AsyncGrowth(SolutionPool(np.zeros((1, 6))), solve, mode="fiber")
+
+
+class exclusive_solver:
+    '''
+    Solver which, like the models of Gurobi, must not be called by two threads at once
+    '''
+    lock = threading.Lock()
+    instances = 0
+
+    def __init__(self):
+        self.busy = False
+        with exclusive_solver.lock:
+            exclusive_solver.instances += 1
+
+    def __call__(self, y):
+        if self.busy:
+            raise Exception("solver called by two threads at once")
+        self.busy = True
+        time.sleep(0.01)
+        self.busy = False
+        return solve(y)
+
+
+def test_threads_sharing_a_solver_call_it_one_at_a_time():
+    pool = SolutionPool(np.zeros((1, 6)))
+    growth = AsyncGrowth(pool, exclusive_solver(), workers=4, max_pending=4, deterministic=True)
+    for y in costs():
+        growth.submit(y)
+    growth.close()
+    assert growth.merged == 12
+
+
+def test_factory_builds_one_solver_per_thread():
+    exclusive_solver.instances = 0
+    pool = SolutionPool(np.zeros((1, 6)))
+    growth = AsyncGrowth(pool, None, workers=3, max_pending=6, deterministic=True, factory=exclusive_solver)
+    for y in costs():
+        growth.submit(y)
+    growth.close()
+    assert growth.merged == 12
+    assert 1 <= exclusive_solver.instances <= 3
+
+
+def test_factory_of_the_worker_processes():
+    sync = SolutionPool(np.zeros((1, 6)))
+    for y in costs(4):
+        sync.add(solve(y))
+    pool = SolutionPool(np.zeros((1, 6)))
+    growth = AsyncGrowth(pool, None, mode="process", workers=2, deterministic=True, factory=partial(partial, solve))
+    for y in costs(4):
+        growth.submit(y)
+    growth.close()
+    assert torch.equal(pool.view(), sync.view())
+
+
+def test_solve_or_factory_is_needed():
+    with pytest.raises(Exception):
+        AsyncGrowth(SolutionPool(np.zeros((1, 6))), None)
@@ -0,0 +1,184 @@
+import os
+import sys
+import warnings
+
+import networkx as nx
+import numpy as np
+import pytest
+import scipy.sparse as sps
+import torch
+
+### the intopt of every problem is the same, the one of the shortest path is tested
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "ShortestPath"))
+from intopt.intopt import intopt, intopt_batched, get_standardform, convert_to_np
+from intopt.util import _constraints_hash
+
+
+def grid_lp(k, sparse):
+    '''
+    Shortest path over a k x k grid where every cell is connected to its 8 neighbours; the flow conservation
+    rows of the incidence matrix sum to zero, so one of them is redundant
+    '''
+    G = nx.DiGraph()
+    for i in range(k):
+        for j in range(k):
+            G.add_edges_from(((i, j), (i + p, j + q)) for p in (-1, 0, 1) for q in (-1, 0, 1)
+                if (p != 0 or q != 0) and 0 <= i + p < k and 0 <= j + q < k)
+    A = nx.incidence_matrix(G, oriented=True)
+    b = torch.zeros(A.shape[0], dtype=torch.float64)
+    b[0], b[-1] = -1, 1
+    if not sparse:
+        A = torch.from_numpy(A.toarray())
+    return A, b
+
+
+@pytest.fixture(autouse=True)
+def quiet():
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        yield
+
+
+def test_dense_and_sparse_presolve_give_the_same_standard_form_with_pivot_sparse():
+    forms = []
+    for sparse in (False, True):
+        standardizer, A_, b_ = get_standardform(*convert_to_np(*grid_lp(4, sparse), None, None), True, None, "pivot_sparse")
+        forms.append((A_.toarray() if sps.issparse(A_) else np.asarray(A_), np.asarray(b_)))
+    assert forms[0][0].shape[0] == 16 - 1
+    assert np.array_equal(forms[0][0], forms[1][0]) and np.array_equal(forms[0][1], forms[1][1])
+    ### by default, the dense constraints lose a redundant row too, but not necessarily the same one
+    standardizer, A_, b_ = get_standardform(*convert_to_np(*grid_lp(4, False), None, None), True, None)
+    assert A_.shape == forms[0][0].shape
+
+
+def test_dense_and_sparse_solutions_and_gradients():
+    '''
+    Presolve removes the same redundant rows from dense and sparse constraints, so the forward iterates agree
+    to about 1e-14. The gradients agree only as far as the damped backward system is conditioned: about 5e-4
+    relative with damping=1e-3 on a 6x6 grid, while with damping=1e-8 a relative change of 1e-12 in c already
+    changes the gradient of either path by more than its size.
+    '''
+    c = torch.rand(3, grid_lp(4, True)[0].shape[1], dtype=torch.float64, generator=torch.Generator().manual_seed(0))
+    weights = torch.arange(c.shape[1], dtype=torch.float64)
+    results = []
+    for sparse in (False, True):
+        layer = intopt_batched(*grid_lp(4, sparse), None, None, thr=1e-6, damping=1e-3, rr_method="pivot_sparse")
+        c_ = c.clone().requires_grad_()
+        x = layer(c_)
+        (x.double() * weights).sum().backward()
+        results.append((x.detach(), c_.grad))
+    assert torch.allclose(results[0][0], results[1][0], atol=1e-6)
+    ### the backward systems are well enough conditioned with damping=1e-3
+    assert (results[0][1] - results[1][1]).abs().max() <= 1e-2 * results[0][1].abs().max()
+
+
+def shortest_path_lp():
+    '''
+    The 5 x 5 grid shortest path of ShortestPath, as its IntOpt model builds it
+    '''
+    G = nx.DiGraph()
+    G.add_nodes_from(range(25))
+    G.add_edges_from([(i, i + 1) for i in range(25) if (i + 1) % 5 != 0] + [(i, i + 5) for i in range(20)])
+    A = torch.from_numpy(nx.incidence_matrix(G, oriented=True).todense()).float()
+    b = torch.zeros(len(A))
+    b[0], b[-1] = -1, 1
+    return A, b
+
+
+def batched_and_per_instance(thr, damping, c, weights, rr_method=None):
+    results = []
+    for batched in (True, False):
+        layer = intopt(*shortest_path_lp(), None, None, thr=thr, damping=damping, batched=batched, rr_method=rr_method)
+        c_ = c.clone().requires_grad_()
+        x = layer(c_)
+        (x * weights).sum().backward()
+        results.append((x.detach(), c_.grad))
+    return results
+
+
+@pytest.fixture
+def costs():
+    generator = torch.Generator().manual_seed(0)
+    return torch.rand(8, 40, generator=generator), torch.randn(8, 40, generator=generator)
+
+
+def test_batched_backward_matches_per_instance_on_well_conditioned_iterates(costs):
+    '''
+    The solutions agree to about 1e-12, and the gradients to about 1e-7 relative to their largest entry
+    when the final iterates are well inside the feasible region
+    '''
+    (x, grad), (x_ref, grad_ref) = batched_and_per_instance(0.1, 1e-3, *costs)
+    assert torch.allclose(x, x_ref, atol=1e-6)
+    assert (grad - grad_ref).abs().max() <= 1e-5 * grad_ref.abs().max()
+
+
+def test_batched_intopt_at_the_thresholds_of_the_scripts(costs):
+    '''
+    With thr=1e-6 and damping=1e-8, the final iterates are close to a vertex and the damped backward system
+    is ill-conditioned: changing c by a float32 rounding changes the per-instance gradient by more than its
+    largest entry, and the batched gradient differs from it by about as much.
+    With the rows the default dense presolve removes, the damped system of the per-instance backward is not
+    even numerically positive definite for these costs, so the rows of the sparse presolve are removed.
+    '''
+    c, weights = costs
+    (x, grad), (x_ref, grad_ref) = batched_and_per_instance(1e-6, 1e-8, c, weights, "pivot_sparse")
+    assert torch.allclose(x, x_ref, atol=1e-6)
+    layer = intopt(*shortest_path_lp(), None, None, thr=1e-6, damping=1e-8, batched=False, rr_method="pivot_sparse")
+    c_ = (c * (1 + 1e-7 * torch.randn(c.shape, generator=torch.Generator().manual_seed(1)))).requires_grad_()
+    (layer(c_) * weights).sum().backward()
+    assert (grad - grad_ref).abs().max() <= 10 * (c_.grad - grad_ref).abs().max()
+    assert torch.isfinite(grad).all()
+
+
+def bounded_grid_lp(sparse):
+    '''
+    grid_lp with the upper bounds x <= 1, so that the standard form has slacks
+    '''
+    A, b = grid_lp(3, sparse)
+    G = sps.identity(A.shape[1], format="csr") if sparse else torch.eye(A.shape[1], dtype=torch.float64)
+    return A, b, G, torch.ones(A.shape[1], dtype=torch.float64)
+
+
+@pytest.fixture
+def no_presolve(monkeypatch):
+    '''
+    Fails the presolves, so that a standard form can only come from the cache
+    '''
+    def fail(*args, **kwargs):
+        raise Exception("presolve was run")
+    monkeypatch.setattr(sys.modules["intopt.util"], "presolve", fail)
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+def test_cached_standard_form_is_the_computed_one(sparse, tmp_path, request):
+    constraints = convert_to_np(*bounded_grid_lp(sparse))
+    standardizer, A_, b_ = get_standardform(*constraints, True, None)
+    get_standardform(*constraints, True, str(tmp_path))
+    assert len(list(tmp_path.iterdir())) == 1
+    c = torch.rand(4, constraints[0].shape[1], dtype=torch.float64, generator=torch.Generator().manual_seed(0))
+    x = intopt_batched(*bounded_grid_lp(sparse), thr=1e-6, damping=1e-3)(c)
+
+    request.getfixturevalue("no_presolve")
+    loaded, A_loaded, b_loaded = get_standardform(*constraints, True, str(tmp_path))
+    assert sps.issparse(A_loaded) == sps.issparse(A_)
+    dense = lambda M: M.toarray() if sps.issparse(M) else np.asarray(M)
+    assert np.array_equal(dense(A_loaded), dense(A_)) and np.array_equal(b_loaded, b_)
+    assert np.array_equal(loaded.transformC(c.numpy()), standardizer.transformC(c.numpy()))
+    assert torch.equal(intopt_batched(*bounded_grid_lp(sparse), thr=1e-6, damping=1e-3, cache_dir=str(tmp_path))(c), x)
+
+
+@pytest.mark.parametrize("changed", range(4))
+def test_changed_constraints_miss_the_cache(changed, tmp_path, request):
+    constraints = list(convert_to_np(*bounded_grid_lp(False)))
+    get_standardform(*constraints, True, str(tmp_path))
+    request.getfixturevalue("no_presolve")
+    get_standardform(*constraints, True, str(tmp_path))
+    ### one entry of A, b, G or h
+    changed_constraints = list(constraints)
+    changed_constraints[changed] = constraints[changed].copy()
+    changed_constraints[changed].flat[0] += 1
+    assert _constraints_hash(*changed_constraints) != _constraints_hash(*constraints)
+    with pytest.raises(Exception, match="presolve was run"):
+        get_standardform(*changed_constraints, True, str(tmp_path))
+    with pytest.raises(Exception, match="presolve was run"):
+        get_standardform(*constraints, True, str(tmp_path), "pivot_sparse")
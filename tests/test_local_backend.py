@@ -0,0 +1,54 @@
+import importlib.util
+import os
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="module")
+def utils():
+    ### every problem has its own Trainer package, so the one of warcraft is loaded from its path
+    spec = importlib.util.spec_from_file_location("warcraft_trainer_utils", os.path.join(ROOT, "warcraft", "Trainer", "utils.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    yield module
+    module.close_local_pools()
+
+
+def negate(x):
+    return -x
+
+
+def test_local_backend_matches_serial(utils):
+    grids = list(np.random.default_rng(0).random((9, 4, 4)))
+    local = utils.maybe_parallelize(negate, grids, backend="local")
+    assert np.array_equal(np.stack(local), np.stack(utils.maybe_parallelize(negate, grids, backend="serial")))
+    assert utils.parallel_summary()["parallel_batches"] == 1
+    assert utils.parallel_summary()["parallel_batches"] == 0
+
+
+def test_local_worker_dying_mid_batch_is_replaced(utils, tmp_path):
+    marker = str(tmp_path / "died")
+    def die_once(x):
+        if x[0, 0] == 42. and not os.path.exists(marker):
+            open(marker, "w").close()
+            os._exit(2)
+        return 2 * x
+    grids = np.random.default_rng(1).random((10, 4, 4))
+    grids[6, 0, 0] = 42.
+    out = utils.maybe_parallelize(die_once, list(grids), backend="local")
+    assert np.array_equal(np.stack(out), 2 * grids)
+    assert utils._local_pool(die_once).restarts == 1
+
+
+def test_local_pool_is_reused_and_stopped_with_the_backend(utils):
+    grids = list(np.random.default_rng(2).random((6, 4, 4)))
+    utils.maybe_parallelize(negate, grids, backend="local")
+    pool = utils._local_pool(negate)
+    utils.maybe_parallelize(negate, grids, backend="local")
+    assert utils._local_pool(negate) is pool and len(pool.processes) == pool.workers
+    utils.set_parallel_backend("serial")
+    assert (negate, False) not in utils._local_pools and not pool.processes
+    utils.set_parallel_backend()
@@ -0,0 +1,112 @@
+import os
+import pickle
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from common_utils import memo_solver
+
+### the calls of the test solvers are counted under this lock, which stays out of their pickles
+count_lock = threading.Lock()
+
+
+class counting_solver:
+    '''
+    argmin of y over the vertices of the unit cube, counting its calls
+    '''
+    def __init__(self):
+        self.rows = 0
+
+    def solve(self, y, scale=1.):
+        with count_lock:
+            self.rows += 1
+        return (np.asarray(y) * scale < 0).astype(np.float64)
+
+
+class batched_counting_solver(counting_solver):
+    def batched_solve(self, y):
+        with count_lock:
+            self.rows += len(y)
+        return (np.asarray(y) < 0).astype(np.float64)
+
+
+def test_repeated_rows_are_solved_once():
+    solver = counting_solver()
+    memo = memo_solver(solver)
+    y = np.random.default_rng(0).normal(size=(5, 6))
+    sols = memo.batched_solve(np.concatenate([y, y[:2]]))
+    assert solver.rows == 5 and np.array_equal(sols, np.concatenate([y, y[:2]]) < 0)
+    assert np.array_equal(memo.solve(y[3]), y[3] < 0)
+    assert solver.rows == 5
+    summary = memo.summary()
+    assert (summary["memo_hits"], summary["memo_misses"], summary["memo_size"]) == (3, 5, 5)
+    ### the callers get copies
+    sols[0][:] = 7
+    assert np.array_equal(memo.solve(y[0]), y[0] < 0)
+
+
+def test_batched_solver_is_called_with_the_missing_rows():
+    solver = batched_counting_solver()
+    memo = memo_solver(solver)
+    y = np.random.default_rng(1).normal(size=(4, 3))
+    memo.batched_solve(y[:2])
+    memo.batched_solve(y)
+    assert solver.rows == 4
+
+
+def test_keyword_and_side_inputs_are_part_of_the_key():
+    solver = counting_solver()
+    memo = memo_solver(solver)
+    y = np.array([1., -1.])
+    assert np.array_equal(memo.solve(y, scale=-1.), [1., 0.])
+    assert np.array_equal(memo.solve(y), [0., 1.])
+    assert solver.rows == 2
+    keys = memo._keys("solve", y[None], (np.array([[0.]]),)), memo._keys("solve", y[None], (np.array([[1.]]),))
+    assert keys[0] != keys[1]
+
+
+def test_lru_and_spill(tmp_path):
+    solver = counting_solver()
+    memo = memo_solver(solver, maxsize=2, spill_dir=str(tmp_path))
+    y = np.random.default_rng(2).normal(size=(3, 4))
+    memo.batched_solve(y)
+    assert len(memo.memo) == 2 and len(os.listdir(tmp_path)) == 1
+    ### the first row was evicted to disk, and is read back instead of solved
+    assert np.array_equal(memo.solve(y[0]), y[0] < 0)
+    assert solver.rows == 3 and memo.spill_hits == 1
+
+
+def test_max_bytes_counts_the_keys():
+    memo = memo_solver(counting_solver(), max_bytes=1000)
+    memo.batched_solve(np.random.default_rng(3).normal(size=(50, 8)))
+    assert memo.nbytes <= 1000 and 0 < len(memo.memo) < 50
+    assert memo.nbytes == sum(sol.nbytes + len(key) for key, sol in memo.memo.items())
+
+
+def test_concurrent_threads():
+    solver = counting_solver()
+    memo = memo_solver(solver, maxsize=64)
+    ys = np.random.default_rng(4).normal(size=(100, 5))
+
+    def work(seed):
+        rng = np.random.default_rng(seed)
+        for _ in range(50):
+            y = ys[rng.integers(0, len(ys), size=8)]
+            assert np.array_equal(memo.batched_solve(y), y < 0)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(work, range(16)))
+    summary = memo.summary()
+    assert summary["memo_hits"] + summary["memo_misses"] == 16 * 50 * 8
+    assert len(memo.memo) <= 64
+    assert memo.nbytes == sum(sol.nbytes + len(key) for key, sol in memo.memo.items())
+
+
+def test_pickle_round_trip():
+    memo = memo_solver(counting_solver())
+    y = np.array([[1., -2.]])
+    memo.batched_solve(y)
+    other = pickle.loads(pickle.dumps(memo))
+    assert np.array_equal(other.batched_solve(y), y < 0)
+    assert other.solver.rows == 1 and other.lock is not memo.lock
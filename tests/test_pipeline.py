@@ -0,0 +1,23 @@
+import time
+
+import torch
+
+from common_utils import SolvePipeline
+
+
+def test_results_in_order_and_weighted_means():
+    pipeline = SolvePipeline()
+    for i, batch_size in enumerate([4, 4, 2]):
+        ### the first batches take longer, the results still come in the order of submission
+        pipeline.submit(lambda i: (time.sleep(0.01 * (3 - i)), {"loss": torch.tensor(float(i))})[1], i, batch_size=batch_size)
+    results = pipeline.wait()
+    assert [r["loss"].item() for r, _ in results] == [0., 1., 2.]
+    assert [b for _, b in results] == [4, 4, 2]
+    means = SolvePipeline.means(results)
+    assert torch.isclose(means["loss"], torch.tensor((0. * 4 + 1. * 4 + 2. * 2) / 10))
+    assert pipeline.wait() == []
+    pipeline.close()
+
+
+def test_means_of_no_batches():
+    assert SolvePipeline.means([]) == {}
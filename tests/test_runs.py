@@ -0,0 +1,93 @@
+import multiprocessing as mp
+import os
+import time
+
+import pandas as pd
+import pytest
+
+from common_utils import run_seeds, shared, append_csv
+from common_utils import runs
+
+fork = pytest.mark.skipif("fork" not in mp.get_all_start_methods(), reason="the seed processes are forked")
+
+
+def slow_square(seed):
+    ### the first seeds finish last
+    time.sleep(0.05 * (3 - seed))
+    return seed * seed, os.getpid()
+
+
+@fork
+def test_run_seeds_in_processes_yields_in_order():
+    results = list(run_seeds(slow_square, range(4), workers=2))
+    assert [seed for seed, _ in results] == [0, 1, 2, 3]
+    assert [r[0] for _, r in results] == [0, 1, 4, 9]
+    assert os.getpid() not in [r[1] for _, r in results]
+
+
+def test_run_seeds_serial():
+    assert [r[0] for _, r in run_seeds(slow_square, [2, 1])] == [4, 1]
+
+
+def fail_on_two(seed):
+    if seed == 2:
+        raise ValueError("bad seed")
+    return seed
+
+
+@fork
+def test_run_seeds_reports_the_failed_seed():
+    with pytest.raises(Exception, match="Seed 2 failed"):
+        list(run_seeds(fail_on_two, range(4), workers=2))
+
+
+def test_shared_builds_once():
+    calls = []
+    build = lambda: calls.append(1) or object()
+    first = shared(("test_shared_builds_once", 1), build)
+    assert shared(("test_shared_builds_once", 1), build) is first
+    assert shared(("test_shared_builds_once", 2), build) is not first
+    assert len(calls) == 2
+    for key in [("test_shared_builds_once", 1), ("test_shared_builds_once", 2)]:
+        del runs._shared[key]
+
+
+def append_rows(path, worker):
+    for i in range(20):
+        append_csv(path, pd.DataFrame({"worker": [worker] * 50, "row": range(50)}), index=False)
+
+
+@fork
+def test_append_csv_writes_one_header_and_whole_frames(tmp_path):
+    path = str(tmp_path / "results.csv")
+    ctx = mp.get_context("fork")
+    processes = [ctx.Process(target=append_rows, args=(path, w)) for w in range(3)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+    df = pd.read_csv(path)
+    assert list(df.columns) == ["worker", "row"] and len(df) == 3 * 20 * 50
+    ### the frames of the workers are never interleaved
+    for start in range(0, len(df), 50):
+        block = df.iloc[start:start + 50]
+        assert block["worker"].nunique() == 1 and list(block["row"]) == list(range(50))
+
+
+def test_staged_rows_are_written_only_when_asked(tmp_path):
+    path = str(tmp_path / "results.csv")
+    runs.stage_csv()
+    try:
+        append_csv(path, pd.DataFrame({"seed": [0]}), index=False)
+        append_csv(path, pd.DataFrame({"seed": [1]}), index=False)
+        assert not os.path.exists(path)
+    finally:
+        assert runs.write_staged_csv() == 2
+    assert list(pd.read_csv(path)["seed"]) == [0, 1]
+    ### dropped, e.g. the rows of a run the sweep stopped
+    runs.stage_csv()
+    append_csv(path, pd.DataFrame({"seed": [2]}), index=False)
+    assert runs.write_staged_csv(write=False) == 0
+    ### and written at once again
+    append_csv(path, pd.DataFrame({"seed": [3]}), index=False)
+    assert list(pd.read_csv(path)["seed"]) == [0, 1, 3]
@@ -0,0 +1,38 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+import torch
+
+### the solvers of the shortest path problem
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "ShortestPath"))
+from Trainer.optimizer_module import shortestpath_solver, persistent_shortestpath_solver, make_spsolver
+
+
+def costs(seed):
+    '''
+    Edge weights of the 5x5 grid: continuous ones, and integer ones which have several shortest paths
+    '''
+    rng = np.random.default_rng(seed)
+    return np.concatenate([rng.uniform(0, 1, size=(20, 40)), rng.integers(1, 3, size=(20, 40)).astype(np.float64)])
+
+
+def test_persistent_solver_matches_fresh_model():
+    fresh, persistent = shortestpath_solver(), persistent_shortestpath_solver()
+    for y in costs(0):
+        sol = persistent.shortest_pathsolution(y)
+        ### the warm started solve may return another path among the tied ones, but one as short
+        assert np.isclose(sol @ y, fresh.shortest_pathsolution(y) @ y, rtol=0, atol=1e-9)
+        assert np.all((sol == 0) | (sol == 1))
+    assert persistent.num_solves == 40
+
+
+def test_make_spsolver():
+    y = costs(1)
+    dag, glop = make_spsolver("dag"), make_spsolver("glop")
+    assert isinstance(glop, persistent_shortestpath_solver)
+    objective = lambda solver: (solver.solution_fromtorch(torch.from_numpy(y)).double().numpy() * y).sum(1)
+    assert np.allclose(objective(dag), objective(glop), rtol=0, atol=1e-9)
+    with pytest.raises(Exception, match="Invalid solver"):
+        make_spsolver("bellman-ford")
@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+import torch
+
+from common_utils import SolutionPool, PackedSolutions, popcount
+
+
+def random_solutions(n, shape=(3, 4), seed=0):
+    rng = np.random.default_rng(seed)
+    return (rng.random((n,) + shape) > 0.5).astype(np.float32)
+
+
+@pytest.mark.parametrize("packed", [False, True])
+def test_add_drops_duplicates_and_grows(packed):
+    sols = random_solutions(50)
+    pool = SolutionPool(sols[:10], capacity=4, packed=packed)
+    assert len(pool) == len(np.unique(sols[:10].reshape(10, -1), axis=0))
+    added = pool.add(np.concatenate([sols, sols]))
+    expected = np.unique(sols.reshape(50, -1), axis=0)
+    assert len(pool) == len(expected)
+    assert added == len(expected) - len(np.unique(sols[:10].reshape(10, -1), axis=0))
+    view = pool.view()
+    rows = (view.unpack() if packed else view).numpy().reshape(len(pool), -1)
+    assert sorted(map(tuple, rows)) == sorted(map(tuple, expected))
+    for sol in sols:
+        assert sol in pool
+
+
+def test_negative_zero_is_zero():
+    pool = SolutionPool(np.array([[0., 1.5]]))
+    assert pool.add(np.array([[-0., 1.5]])) == 0
+
+
+def test_view_shares_the_buffer():
+    pool = SolutionPool(random_solutions(5), capacity=8)
+    view = pool.view()
+    pool.buffer[0] = 7.
+    assert (view[0] == 7.).all()
+
+
+def test_lru_eviction():
+    sols = np.eye(4, dtype=np.float32)
+    pool = SolutionPool(sols[:3], max_size=3, eviction="lru")
+    ### the argmin of these costs is the first solution, the others were last used longer ago
+    pool.touch(torch.tensor([[-1., 0., 0., 0.]]))
+    pool.touch(torch.tensor([[0., -1., 0., 0.]]))
+    pool.add(sols[3:])
+    assert len(pool) == 3 and pool.evictions == 1
+    assert sols[2] not in pool and sols[0] in pool and sols[1] in pool and sols[3] in pool
+
+
+def test_violation_eviction():
+    sols = np.eye(3, dtype=np.float32)
+    pool = SolutionPool(sols[:2], max_size=2, eviction="violation")
+    ### the objective of the second solution is the furthest from the argmin
+    pool.touch(torch.tensor([[-1., 5., 0.]]))
+    pool.add(sols[2:])
+    assert sols[1] not in pool and sols[0] in pool and sols[2] in pool
+
+
+@pytest.mark.parametrize("eviction", ["lru", "violation"])
+def test_packed_pool_matches_float_pool(eviction):
+    sols = random_solutions(40, seed=1)
+    costs = torch.from_numpy(np.random.default_rng(2).normal(size=(8, 3, 4)).astype(np.float32))
+    pools = [SolutionPool(sols[:5], max_size=12, eviction=eviction, packed=packed) for packed in (False, True)]
+    for start in range(5, 40, 5):
+        for pool in pools:
+            pool.touch(costs)
+            pool.add(sols[start:start + 5])
+    dense, packed = pools
+    assert isinstance(packed.view(), PackedSolutions)
+    assert torch.equal(dense.view(), packed.view().unpack())
+
+
+def test_packed_pool_rejects_real_solutions():
+    with pytest.raises(Exception):
+        SolutionPool(np.array([[0.5, 1.]]), packed=True)
+
+
+def test_packed_solutions():
+    sols = random_solutions(30, shape=(11,), seed=3)
+    packed = PackedSolutions.pack(sols, block_size=7)
+    dense = torch.from_numpy(sols)
+    assert torch.equal(packed.unpack(), dense)
+    assert torch.equal(packed.unpack(4), dense[4])
+
+    y = torch.randn(5, 11, dtype=torch.float64, requires_grad=True)
+    obj = packed.objective(y)
+    assert torch.allclose(obj, y @ dense.double().T)
+    grad = torch.randn(5, 30, dtype=torch.float64)
+    obj.backward(grad)
+    assert torch.allclose(y.grad, grad @ dense.double())
+
+    other = random_solutions(4, shape=(11,), seed=4)
+    assert np.array_equal(packed.overlap(other), other @ sols.T)
+    assert np.array_equal(packed.hamming(other), np.abs(other[:, None] - sols[None]).sum(-1))
+    assert torch.equal(packed.column_sums(), dense.sum(0))
+    assert packed.column_sums(torch.float64).dtype == torch.float64
+    assert torch.equal(torch.cat([block for _, block in packed.blocks()]), dense)
+    assert [start for start, _ in packed.blocks()] == list(range(0, 30, packed.block_size))
+    assert np.array_equal(popcount(packed.bits), sols.sum(1))
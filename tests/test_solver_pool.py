@@ -0,0 +1,128 @@
+import os
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import numpy as np
+import pytest
+
+from common_utils import SolverPool
+
+
+class sign_solver:
+    '''
+    argmin of y over the vertices of the unit cube; the rows whose first entry is die_on make the worker exit,
+    only the first time if marker is the path of a file which is created then
+    '''
+    def __init__(self, die_on=None, marker=None):
+        self.die_on, self.marker = die_on, marker
+
+    def solve(self, y, shift=0., scale=1.):
+        if self.die_on is not None and y[0] == self.die_on:
+            if self.marker is None or not os.path.exists(self.marker):
+                if self.marker is not None:
+                    open(self.marker, "w").close()
+                os._exit(3)
+        if y[0] == -999.:
+            raise ValueError("bad row")
+        return (np.asarray(y) * scale + shift < 0).astype(np.float64)
+
+    def batched_solve(self, y, shift=0., scale=1.):
+        return np.stack([self.solve(row, shift, scale) for row in y])
+
+
+@pytest.fixture
+def costs():
+    return np.random.default_rng(0).normal(size=(23, 5))
+
+
+@pytest.mark.parametrize("batched", [False, True])
+def test_solutions_in_the_order_of_the_rows(costs, batched):
+    pool = SolverPool(sign_solver, workers=3, method="batched_solve" if batched else "solve", batched=batched, chunk_size=2)
+    try:
+        assert np.array_equal(pool.map(costs), costs < 0)
+        assert np.array_equal(pool.map(costs, scale=-1.), costs > 0)
+        assert np.array_equal(pool.solve(costs[0]), costs[0] < 0)
+        assert len(pool.efficiency) == 3
+    finally:
+        pool.close()
+
+
+def test_side_inputs(costs):
+    pool = SolverPool(sign_solver, workers=2)
+    try:
+        shift = np.full_like(costs, 0.5)
+        assert np.array_equal(pool.map(costs, shift), costs + 0.5 < 0)
+    finally:
+        pool.close()
+
+
+def test_solver_error_is_raised_and_the_pool_stays_usable(costs):
+    pool = SolverPool(sign_solver, workers=2)
+    try:
+        bad = costs.copy()
+        bad[5, 0] = -999.
+        with pytest.raises(Exception, match="bad row"):
+            pool.map(bad)
+        assert np.array_equal(pool.map(costs), costs < 0)
+    finally:
+        pool.close()
+
+
+def test_worker_killed_between_calls_is_replaced(costs):
+    pool = SolverPool(sign_solver, workers=2)
+    try:
+        pool.map(costs)
+        os.kill(pool.processes[0].pid, signal.SIGKILL)
+        pool.processes[0].join()
+        assert np.array_equal(pool.map(costs), costs < 0)
+        assert pool.restarts == 1 and all(p.is_alive() for p in pool.processes)
+    finally:
+        pool.close()
+
+
+def test_worker_dying_mid_task_is_replaced_and_its_rows_solved_again(costs, tmp_path):
+    costs[7, 0] = 42.
+    pool = SolverPool(partial(sign_solver, die_on=42., marker=str(tmp_path / "died")), workers=2, chunk_size=3)
+    try:
+        assert np.array_equal(pool.map(costs), costs < 0)
+        assert pool.restarts == 1
+    finally:
+        pool.close()
+
+
+def test_rows_which_kill_the_worker_twice_fail_the_call(costs):
+    costs[7, 0] = 42.
+    pool = SolverPool(partial(sign_solver, die_on=42.), workers=2, chunk_size=3)
+    try:
+        with pytest.raises(Exception, match="exited with code 3, twice"):
+            pool.map(costs)
+        assert pool.restarts == 2
+        assert np.array_equal(pool.map(costs[8:]), costs[8:] < 0)
+    finally:
+        pool.close()
+
+
+def test_threads_share_the_pool(costs):
+    pool = SolverPool(sign_solver, workers=2)
+    try:
+        def work(seed):
+            y = np.random.default_rng(seed).normal(size=(11, 5))
+            return np.array_equal(pool.map(y), y < 0)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            assert all(executor.map(work, range(12)))
+    finally:
+        pool.close()
+
+
+def test_close_stops_the_workers_and_frees_the_blocks(costs):
+    pool = SolverPool(sign_solver, workers=2)
+    pool.map(costs)
+    processes, names = list(pool.processes), [block.name for block in pool.blocks]
+    pool.close()
+    assert not any(p.is_alive() for p in processes)
+    for name in names:
+        with pytest.raises(FileNotFoundError):
+            from multiprocessing import shared_memory
+            shared_memory.SharedMemory(name=name)
@@ -0,0 +1,35 @@
+import os
+
+import pandas as pd
+
+from sweep import Sweep
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCRIPT = '''
+import argparse, sys
+sys.path.insert(0, {root!r})
+import pandas as pd
+from common_utils import append_csv
+parser = argparse.ArgumentParser()
+parser.add_argument("--x", type=int)
+parser.add_argument("--output_tag", type=str, default="")
+args = parser.parse_args()
+append_csv("results.csv", pd.DataFrame({{"x": [args.x]}}), index=False)
+if args.x == 2:
+    raise Exception("the run fails after writing its results")
+'''
+
+
+def test_only_the_runs_which_are_done_write_their_results(tmp_path):
+    script = tmp_path / "script.py"
+    script.write_text(SCRIPT.format(root=ROOT))
+    spec = {"script": str(script), "grid": {"x": [1, 2, 3]}}
+    state = str(tmp_path / "sweep.state.jsonl")
+    Sweep(spec, workers=2, threads=1, state=state).run()
+    assert sorted(pd.read_csv(tmp_path / "results.csv")["x"]) == [1, 3]
+    ### resumed, the failed run is run again and the others are not
+    resumed = Sweep(spec, workers=1, threads=1, state=state)
+    assert len(resumed.finished) == 2
+    resumed.run()
+    assert sorted(pd.read_csv(tmp_path / "results.csv")["x"]) == [1, 3]
@@ -2,6 +2,8 @@ import argparse
 from argparse import Namespace
 from Trainer.data_utils import WarcraftDataModule, return_trainlabel
 from Trainer.Trainer import *
+from Trainer.utils import shared, sweep_callbacks, append_csv, set_cvxpylayer_cache, memo_solver
+from comb_modules.dijkstra import get_solver
 import pytorch_lightning as pl
 import pandas as pd
 import numpy as np
@@ -40,10 +42,24 @@ parser.add_argument("--thr", type=float, help="threshold parameter", default= 1e
 parser.add_argument("--damping", type=float, help="damping parameter", default= 1e-8)
 parser.add_argument("--tau", type=float, help="parameter of rankwise losses", default= 1e-8)
 parser.add_argument("--growth", type=float, help="growth parameter of rankwise losses", default= 1e-8)
-
-
-
-parser.add_argument("--output_tag", type=str, help="tag", default= 50, required=False)
+parser.add_argument("--pool_size", type=int, help="maximum number of solutions in the cache of rankwise losses", default= None, required=False)
+parser.add_argument("--eviction", type=str, help="which solution leaves a full cache: lru or violation", default= "lru", required=False)
+parser.add_argument("--packed",  action='store_true', help="Store the cache of rankwise losses bit-packed",  required=False)
+parser.add_argument("--growth_mode", type=str, help="grow the cache of rankwise losses in sync, or in the background with thread or process workers", default= "sync", required=False)
+parser.add_argument("--growth_workers", type=int, help="number of background workers growing the cache; the thread workers share the solver and solve one batch at a time", default= 1, required=False)
+parser.add_argument("--max_pending", type=int, help="maximum number of batches being solved in the background", default= 2, required=False)
+parser.add_argument("--deterministic_growth",  action='store_true', help="Merge the background solutions in a deterministic order",  required=False)
+parser.add_argument("--pipelined",  action='store_true', help="Solve the validation and test batches in the background, while the network computes the next ones",  required=False)
+parser.add_argument("--certificate",  action='store_true', help="Skip the solves of SPO and DBB whose last shortest path is certified optimal",  required=False)
+parser.add_argument("--parallel_backend", type=str, help="backend of the batched solves: auto (ray if initialized), ray, local or serial; the WARCRAFT_PARALLEL variable by default", default= None, required=False)
+parser.add_argument("--parallel_workers", type=int, help="number of worker processes of the local backend", default= None, required=False)
+
+
+
+parser.add_argument("--output_tag", type=str, help="tag of the checkpoint and log directories, e.g. to run several configurations at the same time", default= "", required=False)
+parser.add_argument("--intopt_cache_dir", type=str, help="directory caching the presolved constraints of IntOpt and QPTL across runs, none by default", default= None, required=False)
+parser.add_argument("--cvxpylayer_cache_dir", type=str, help="directory caching the compiled cvxpylayers of DCOL across runs, none by default; only trusted runs may write to it", default= None, required=False)
+parser.add_argument("--memo",  action='store_true', help="Serve the exact solves of bit-identical weights from a memo",  required=False)
 parser.add_argument("--index", type=int, help="index", default= 1, required=False)
 
 args = parser.parse_args()
@@ -59,15 +75,23 @@ modelname = argument_dict.pop('model')
 img_size = argument_dict.pop('img_size')
 img_size = "{}x{}".format(img_size, img_size)
 seed = argument_dict['seed']
-argument_dict.pop('output_tag')
+output_tag = argument_dict.pop('output_tag')
+intopt_cache_dir = argument_dict.pop('intopt_cache_dir')
+set_cvxpylayer_cache(argument_dict.pop('cvxpylayer_cache_dir'))
 index = argument_dict.pop('index')
+memo = argument_dict.pop('memo')
 
 
 sentinel_ns = Namespace(**{key:sentinel for key in argument_dict})
 parser.parse_args(namespace=sentinel_ns)
 
 explicit = {key:value for key, value in vars(sentinel_ns).items() if value is not sentinel }
+### the cache of the presolved constraints does not change the results
+argument_dict['intopt_cache_dir'] = intopt_cache_dir
+
 
+if argument_dict['parallel_backend'] is not None:
+    set_parallel_backend(argument_dict['parallel_backend'], argument_dict['parallel_workers'])
 
 torch.use_deterministic_algorithms(True)
 def seed_all(seed):
@@ -84,8 +108,8 @@ def seed_all(seed):
 ################## Define the outputfile
 outputfile = "Rslt/{}{}{}seed{}_index{}.csv".format(modelname,args.loss, img_size,seed, index)
 regretfile = "Rslt/{}{}{}Regretseed{}_index{}.csv".format(modelname,args.loss, img_size,seed, index)
-ckpt_dir =  "ckpt_dir/{}{}{}seed{}_index{}/".format(modelname, args.loss, img_size,seed, index)
-log_dir = "lightning_logs/{}{}{}seed{}_index{}/".format(modelname, args.loss, img_size,seed, index)
+ckpt_dir =  "ckpt_dir/{}{}{}seed{}_index{}{}/".format(modelname, args.loss, img_size,seed, index, output_tag)
+log_dir = "lightning_logs/{}{}{}seed{}_index{}{}/".format(modelname, args.loss, img_size,seed, index, output_tag)
 learning_curve_datafile = "LearningCurve/{}{}{}seed{}_".format(modelname, args.loss, img_size,seed)+"_".join( ["{}_{}".format(k,v) for k,v  in explicit.items() ]  )+".csv"
 shutil.rmtree(log_dir,ignore_errors=True)
 
@@ -97,8 +121,10 @@ seed_all(seed)
 g = torch.Generator()
 g.manual_seed(seed)
 
-data = WarcraftDataModule(data_dir="data/warcraft_shortest_path/{}".format(img_size), 
-batch_size= argument_dict['batch_size'], generator=g)
+### the images are loaded once by the configurations run in the same process, only the order of the batches depends on the seed
+data = shared(("data", img_size, argument_dict['batch_size']), lambda: WarcraftDataModule(data_dir="data/warcraft_shortest_path/{}".format(img_size), 
+batch_size= argument_dict['batch_size']))
+data.generator = g
 metadata = data.metadata
 
 shutil.rmtree(ckpt_dir,ignore_errors=True)
@@ -110,20 +136,27 @@ checkpoint_callback = ModelCheckpoint(
 
 tb_logger = pl_loggers.TensorBoardLogger(save_dir= log_dir, version=seed)
 trainer = pl.Trainer(max_epochs= argument_dict['max_epochs'],
-  min_epochs=1,logger=tb_logger, callbacks=[checkpoint_callback])
+  min_epochs=1,logger=tb_logger, callbacks=[checkpoint_callback] + sweep_callbacks())
+### one exact solver for the model and its layers; with --memo, the shortest paths of bit-identical weights
+### are served from its memo, which is reused by the configurations run in the same process
+def make_exact_solver():
+    solver = get_solver("8-grid")
+    return memo_solver(solver) if memo else solver
+exact_solver = shared(("exact_solver", memo), make_exact_solver)
 if modelname=="CachingPO":
-    cache = return_trainlabel(data_dir="data/warcraft_shortest_path/{}".format(img_size))
-    model = modelcls(metadata=metadata,init_cache=cache, **argument_dict)
+    cache = shared(("cache", img_size, argument_dict['packed']),
+        lambda: return_trainlabel(data_dir="data/warcraft_shortest_path/{}".format(img_size), packed=argument_dict['packed']))
+    model = modelcls(metadata=metadata,init_cache=cache, exact_solver=exact_solver, **argument_dict)
 else:
-    model = modelcls(metadata=metadata,**argument_dict)
+    model = modelcls(metadata=metadata, exact_solver=exact_solver, **argument_dict)
 
 trainer.fit(model, datamodule=data)
 
 best_model_path = checkpoint_callback.best_model_path
 if modelname=="CachingPO":
-    model = modelcls.load_from_checkpoint(best_model_path,metadata=metadata,init_cache=cache, **argument_dict)
+    model = modelcls.load_from_checkpoint(best_model_path,metadata=metadata,init_cache=cache, exact_solver=exact_solver, **argument_dict)
 else:
-    model = modelcls.load_from_checkpoint(best_model_path,metadata=metadata, **argument_dict)
+    model = modelcls.load_from_checkpoint(best_model_path,metadata=metadata, exact_solver=exact_solver, **argument_dict)
 
 
 regret_list = trainer.predict(model, data.test_dataloader())
@@ -132,8 +165,7 @@ df = pd.DataFrame({"regret":regret_list[0].tolist()})
 df.index.name='instance'
 for k,v in explicit.items():
     df[k] = v
-with open(regretfile, 'a') as f:
-    df.to_csv(f, header=f.tell()==0)
+append_csv(regretfile, df)
 
 ##### SummaryWrite ######################
 validresult = trainer.validate(model,datamodule=data)
@@ -141,8 +173,9 @@ testresult = trainer.test(model, datamodule=data)
 df = pd.DataFrame({**testresult[0], **validresult[0]},index=[0])
 for k,v in explicit.items():
     df[k] = v
-with open(outputfile, 'a') as f:
-    df.to_csv(f, header=f.tell()==0)
+append_csv(outputfile, df)
+if memo:
+    print("Exact solver memo: {}".format(exact_solver.summary()))
 
 ##### Save Learning Curve Data ######################
 parent_dir=   log_dir+"lightning_logs/"
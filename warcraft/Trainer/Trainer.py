@@ -2,14 +2,16 @@ import imp
 import pytorch_lightning as pl
 import torch 
 import numpy as np
+from functools import partial
 from torch import nn, optim
 from torch.autograd import Variable
 import torch.nn.functional as F
 from Trainer.computervisionmodels import get_model
 from comb_modules.losses import *
 from Trainer.diff_layer import BlackboxDifflayer,SPOlayer, CvxDifflayer, IntoptDifflayer, QptDifflayer    
-from comb_modules.dijkstra import get_solver
-from Trainer.utils import shortest_pathsolution, growcache, maybe_parallelize
+from comb_modules.dijkstra import get_solver, certified_solver
+from Trainer.utils import shortest_pathsolution, growcache, maybe_parallelize, SolutionPool, AsyncGrowth
+from Trainer.utils import set_parallel_backend, parallel_summary, SolvePipeline
 
 from Trainer.metric import normalized_regret, regret_list, normalized_hamming
 from DPO import perturbations
@@ -23,7 +25,7 @@ from imle.noise import SumOfGammaNoiseDistribution
 
 class SPO(pl.LightningModule):
     def __init__(self, metadata, model_name= "CombResnet18", arch_params={}, neighbourhood_fn =  "8-grid",
-        lr=1e-1,validation_metric ='regret', seed=20,**kwd):
+        lr=1e-1,validation_metric ='regret', seed=20, certificate=False, pipelined=False, exact_solver=None, **kwd):
         super().__init__()
         pl.seed_everything(seed)
         self.metadata = metadata
@@ -33,10 +35,15 @@ class SPO(pl.LightningModule):
         )
         self.lr = lr
         self.validation_metric = validation_metric
-        self.comb_layer =  SPOlayer( neighbourhood_fn= neighbourhood_fn)
-
-        self.solver =   get_solver(neighbourhood_fn)
+        ### if certificate, the solves of the training instances whose last shortest path is certified optimal are skipped
+        self.certified_solver = certified_solver(neighbourhood_fn) if certificate else None
+        ### the exact solver is shared by the model and its layers, e.g. one memo_solver built by the script;
+        ### the dijkstra solver of neighbourhood_fn if None
+        self.solver = get_solver(neighbourhood_fn) if exact_solver is None else exact_solver
+        self.comb_layer =  SPOlayer( neighbourhood_fn= neighbourhood_fn, solver= self.certified_solver or self.solver)
         self.loss_fn = RegretLoss()
+        ### if pipelined, the shortest paths of the validation and test batches are solved in the background (see SolvePipeline)
+        self.pipeline = SolvePipeline() if pipelined else None
 
     def forward(self,x):
         output = self.model(x)
@@ -47,22 +54,64 @@ class SPO(pl.LightningModule):
         return relu_op(output)
 
     def training_step(self, batch, batch_idx):
-        input, label, true_weights = batch
+        input, label, true_weights, index = batch
         output = self(input)
         weights = output.reshape(-1, output.shape[-1], output.shape[-1])
         ### For SPO, we need the true weights as we have to compute 2*\hat{c} - c
-        shortest_path = self.comb_layer(weights, label, true_weights)
+        index = None if self.certified_solver is None else index.tolist()
+        shortest_path = self.comb_layer(weights, label, true_weights, index)
         training_loss = self.loss_fn(shortest_path, label,  true_weights)
         self.log("train_loss",training_loss,  on_step=True, on_epoch=True, )
         return training_loss 
+    def on_train_epoch_end(self):
+        if self.certified_solver is not None:
+            for k,v in self.certified_solver.summary().items():
+                if not np.isnan(v):
+                    self.log("train_{}".format(k), v)
+            self.certified_solver.reset_counts()
+        ### mean parallel efficiency of the batches solved by the local backend of maybe_parallelize
+        summary = parallel_summary()
+        if summary["parallel_batches"] > 0:
+            self.log("train_parallel_efficiency", summary["parallel_efficiency"])
+
+    def regrets(self, stage, weights, label, true_weights):
+        '''
+        The metrics of a batch which need the solver
+        '''
+        shortest_path =  shortest_pathsolution(self.solver, weights)
+        return {"{}_regret".format(stage): normalized_regret(true_weights, label, shortest_path ),
+            "{}_hammingloss".format(stage): normalized_hamming(true_weights, label, shortest_path )}
+    def pipelined_step(self, stage, output, label, true_weights):
+        '''
+        The validation and test steps of the pipelined mode: the shortest paths are solved in the background
+        and their metrics logged at the end of the epoch
+        '''
+        weights = output.reshape(-1, output.shape[-1], output.shape[-1])
+        self.pipeline.submit(self.regrets, stage, weights.detach(), label, true_weights, batch_size=len(label))
+        criterion1 = nn.MSELoss(reduction='mean')
+        mse =  criterion1(output, true_weights).mean()
+        output = torch.sigmoid(output)
+        criterion2 = nn.BCELoss()
+        bceloss = criterion2(output, label.to(torch.float32)).mean()
+        self.log("{}_bce".format(stage), bceloss, prog_bar=True, on_step=False, on_epoch=True,sync_dist=True )
+        self.log("{}_mse".format(stage), mse, prog_bar=True, on_step=False, on_epoch=True, sync_dist=True )
+        return {"{}_mse".format(stage):mse, "{}_bce".format(stage):bceloss}
+    def on_validation_epoch_end(self):
+        if self.pipeline is not None:
+            for k,v in self.pipeline.means(self.pipeline.wait()).items():
+                self.log(k, v, prog_bar=True, sync_dist=True)
+    def on_test_epoch_end(self):
+        self.on_validation_epoch_end()
 
     def validation_step(self, batch, batch_idx):
-        input, label, true_weights = batch
+        input, label, true_weights, _ = batch
         output = self(input)
         # output = torch.sigmoid(output)
 
         if not len(output.shape) == 3:
             output = output.view(label.shape)
+        if self.pipeline is not None:
+            return self.pipelined_step("val", output, label, true_weights)
 
         weights = output.reshape(-1, output.shape[-1], output.shape[-1])
         shortest_path =  shortest_pathsolution(self.solver, weights)
@@ -91,12 +140,14 @@ class SPO(pl.LightningModule):
 
         
     def test_step(self, batch, batch_idx):
-        input, label, true_weights = batch
+        input, label, true_weights, _ = batch
         output = self(input)
         # output = torch.sigmoid(output)
 
         if not len(output.shape) == 3:
             output = output.view(label.shape)
+        if self.pipeline is not None:
+            return self.pipelined_step("test", output, label, true_weights)
  
         weights = output.reshape(-1, output.shape[-1], output.shape[-1])
         shortest_path =  shortest_pathsolution(self.solver, weights)
@@ -128,7 +179,7 @@ class SPO(pl.LightningModule):
         '''
         I am using the the predict module to compute regret !
         '''
-        input, label, true_weights = batch
+        input, label, true_weights, _ = batch
         output = self(input)
         # output = torch.sigmoid(output)
 
@@ -182,7 +233,7 @@ class baseline(SPO):
             loss: could be bce or mse
             validation: which quantity to be monitored for validation, either regret or hamming
         """
-        super().__init__( metadata, model_name,arch_params, neighbourhood_fn, lr, validation_metric,seed  )
+        super().__init__( metadata, model_name,arch_params, neighbourhood_fn, lr, validation_metric,seed, **kwd)
         
         self.loss = loss
         
@@ -197,7 +248,7 @@ class baseline(SPO):
 
 
     def training_step(self, batch, batch_idx):
-        input, label, true_weights = batch
+        input, label, true_weights, _ = batch
         # print("input shape",input.shape,"label shape",label.shape)
         output = self(input)
         # print("Output shape", output.shape)
@@ -219,11 +270,11 @@ class baseline(SPO):
 
 class DBB(SPO):
     def __init__(self, metadata, model_name= "CombResnet18", arch_params={},lambda_val=20., neighbourhood_fn =  "8-grid",
-        lr=1e-1, loss="regret",seed=20,**kwd):
+        lr=1e-1, loss="regret",seed=20, certificate=False, **kwd):
 
         validation_metric = loss
-        super().__init__(metadata, model_name,arch_params, neighbourhood_fn, lr, validation_metric,seed)
-        self.comb_layer =  BlackboxDifflayer(lambda_val=lambda_val, neighbourhood_fn= neighbourhood_fn)
+        super().__init__(metadata, model_name,arch_params, neighbourhood_fn, lr, validation_metric,seed, certificate, **kwd)
+        self.comb_layer =  BlackboxDifflayer(lambda_val=lambda_val, neighbourhood_fn= neighbourhood_fn, solver= self.certified_solver or self.solver)
 
         if loss=="hamming":
             self.loss_fn = HammingLoss()
@@ -232,11 +283,12 @@ class DBB(SPO):
 
 
     def training_step(self, batch, batch_idx):
-        input, label, true_weights = batch
+        input, label, true_weights, index = batch
         # print("input shape",input.shape,"label shape",label.shape)
         output = self(input)
         weights = output.reshape(-1, output.shape[-1], output.shape[-1])
-        shortest_path = self.comb_layer(weights)
+        index = None if self.certified_solver is None else index.tolist()
+        shortest_path = self.comb_layer(weights, index)
         training_loss = self.loss_fn(shortest_path, label, true_weights)
         self.log("train_loss",training_loss ,  on_step=True, on_epoch=True, )
         return training_loss 
@@ -247,7 +299,7 @@ class DBB(SPO):
 class FenchelYoung(SPO):
     def __init__(self, metadata, model_name= "CombResnet18", arch_params={}, neighbourhood_fn =  "8-grid",
         lr=1e-1, sigma=0.1,num_samples=10, validation_metric ='regret', seed=20,**kwd ):
-        super().__init__(metadata, model_name,arch_params, neighbourhood_fn, lr, validation_metric,seed)
+        super().__init__(metadata, model_name,arch_params, neighbourhood_fn, lr, validation_metric,seed, **kwd)
         self.sigma = sigma
         self.num_samples = num_samples
         solver =   get_solver(neighbourhood_fn)
@@ -259,7 +311,7 @@ class FenchelYoung(SPO):
     def training_step(self, batch, batch_idx):
         criterion = fy.FenchelYoungLoss(self.fy_solver, num_samples= self.num_samples, sigma= self.sigma,maximize = False, batched= True)
 
-        input, label, true_weights = batch
+        input, label, true_weights, _ = batch
         output = self(input)
         
         weights = output.reshape(-1, output.shape[-1], output.shape[-1])
@@ -275,7 +327,7 @@ class IMLE(SPO):
         temperature=1.0, seed=20,**kwd):
         
         validation_metric = loss
-        super().__init__(metadata, model_name,arch_params, neighbourhood_fn, lr, validation_metric,seed)
+        super().__init__(metadata, model_name,arch_params, neighbourhood_fn, lr, validation_metric,seed, **kwd)
         solver =   get_solver(neighbourhood_fn)
 
         target_distribution = TargetDistribution(alpha=1.0, beta=beta)
@@ -293,7 +345,7 @@ class IMLE(SPO):
 
 
     def training_step(self, batch, batch_idx):
-        input, label, true_weights = batch
+        input, label, true_weights, _ = batch
         output = self(input)
         
         weights = output.reshape(-1, output.shape[-1], output.shape[-1])
@@ -311,7 +363,7 @@ class DPO(SPO):
     def __init__(self, metadata, model_name= "CombResnet18", arch_params={}, neighbourhood_fn =  "8-grid",
         lr=1e-1, loss="regret",sigma=0.1,num_samples=10 ,seed=20,**kwd):
         validation_metric = loss
-        super().__init__(metadata, model_name,arch_params, neighbourhood_fn, lr, validation_metric,seed)
+        super().__init__(metadata, model_name,arch_params, neighbourhood_fn, lr, validation_metric,seed, **kwd)
         self.sigma = sigma
         self.num_samples = num_samples
         solver =   get_solver(neighbourhood_fn)
@@ -327,7 +379,7 @@ class DPO(SPO):
 
 
     def training_step(self, batch, batch_idx):
-        input, label, true_weights = batch
+        input, label, true_weights, _ = batch
         output = self(input)
         
         weights = output.reshape(-1, output.shape[-1], output.shape[-1])
@@ -343,7 +395,7 @@ class DCOL(SPO):
     def __init__(self, metadata, model_name= "CombResnet18", arch_params={}, neighbourhood_fn =  "8-grid",
         lr=1e-3, loss="regret",mu=1e-3,seed=20,**kwd):
         validation_metric = loss
-        super().__init__(metadata, model_name,arch_params, neighbourhood_fn, lr, validation_metric,seed)
+        super().__init__(metadata, model_name,arch_params, neighbourhood_fn, lr, validation_metric,seed, **kwd)
 
         if loss=="hamming":
             self.loss_fn = HammingLoss()
@@ -355,7 +407,7 @@ class DCOL(SPO):
 
 
     def training_step(self, batch, batch_idx):
-        input, label, true_weights = batch
+        input, label, true_weights, _ = batch
         output = self(input)
         
         weights = output.reshape(-1, output.shape[-1], output.shape[-1])
@@ -372,25 +424,24 @@ class DCOL(SPO):
 
 class IntOpt(SPO):
     def __init__(self, metadata, model_name= "CombResnet18", arch_params={}, neighbourhood_fn =  "8-grid",
-        lr=1e-3, loss="regret",thr=0.1,damping=1e-3 ,seed=20,**kwd):
+        lr=1e-3, loss="regret",thr=0.1,damping=1e-3 ,seed=20, intopt_cache_dir=None,**kwd):
         validation_metric = loss
         if loss=="hamming":
             
             self.loss_fn = HammingLoss()
         if loss=="regret":
             self.loss_fn = RegretLoss()
-        super().__init__(metadata, model_name,arch_params, neighbourhood_fn, lr, validation_metric,seed)
-        self.comb_layer = IntoptDifflayer(metadata["output_shape"],thr, damping) 
+        super().__init__(metadata, model_name,arch_params, neighbourhood_fn, lr, validation_metric,seed, **kwd)
+        self.comb_layer = IntoptDifflayer(metadata["output_shape"],thr, damping, cache_dir=intopt_cache_dir) 
 
 
 
     def training_step(self, batch, batch_idx):
-        input, label, true_weights = batch
+        input, label, true_weights, _ = batch
         output = self(input)
         
         weights = output.reshape(-1, output.shape[-1], output.shape[-1])
-        shortest_path = (maybe_parallelize(self.comb_layer, arg_list=list(weights)))
-        shortest_path = torch.stack(shortest_path)
+        shortest_path = self.comb_layer(weights)
 
         training_loss = self.loss_fn(shortest_path, label, true_weights)
 
@@ -401,24 +452,23 @@ class IntOpt(SPO):
 
 class QPTL(SPO):
     def __init__(self, metadata, model_name= "CombResnet18", arch_params={}, neighbourhood_fn =  "8-grid",
-        lr=1e-3, loss="regret",mu=1e-3 ,seed=20,**kwd):
+        lr=1e-3, loss="regret",mu=1e-3 ,seed=20, intopt_cache_dir=None,**kwd):
         validation_metric = loss
-        super().__init__(metadata, model_name,arch_params, neighbourhood_fn, lr, validation_metric,seed)
+        super().__init__(metadata, model_name,arch_params, neighbourhood_fn, lr, validation_metric,seed, **kwd)
 
         if loss=="hamming":
             self.loss_fn = HammingLoss()
         if loss=="regret":
             self.loss_fn = RegretLoss()
-        self.comb_layer =  QptDifflayer(metadata["output_shape"], mu) 
+        self.comb_layer =  QptDifflayer(metadata["output_shape"], mu, cache_dir=intopt_cache_dir) 
 
 
     def training_step(self, batch, batch_idx):
-        input, label, true_weights = batch
+        input, label, true_weights, _ = batch
         output = self(input)
         
         weights = output.reshape(-1, output.shape[-1], output.shape[-1])
-        shortest_path = (maybe_parallelize(self.comb_layer, arg_list=list(weights)))
-        shortest_path = torch.stack(shortest_path)
+        shortest_path = self.comb_layer(weights)
         training_loss = self.loss_fn(shortest_path, label, true_weights)
 
 
@@ -429,7 +479,8 @@ class QPTL(SPO):
 
 class CachingPO(SPO):
     def __init__(self, metadata,init_cache,tau=0.,growth=0.1, model_name= "CombResnet18", arch_params={}, neighbourhood_fn =  "8-grid",
-        lr=1e-1, loss="pointwise",validation_metric = 'regret',seed=20,**kwd):
+        lr=1e-1, loss="pointwise",validation_metric = 'regret',seed=20, pool_size=None, eviction="lru", packed=False,
+        growth_mode="sync", growth_workers=1, max_pending=2, deterministic_growth=False, **kwd):
         """
         A class to implement loss functions using soluton cache
         Args:
@@ -437,9 +488,16 @@ class CachingPO(SPO):
             init_cache: initial solution cache
             growth: p_solve
             tau: the margin parameter for pairwise ranking / temperatrure for listwise ranking
+            pool_size: maximum number of solutions in the cache, None for no limit
+            eviction: which solution leaves a full cache, "lru" or "violation" (see SolutionPool)
+            packed: store the cache bit-packed (see PackedSolutions)
+            growth_mode: "sync", or grow the cache in the background with "thread" or "process" workers (see AsyncGrowth)
+            growth_workers, max_pending, deterministic_growth: the workers, the bound of the batches being solved and
+                whether to merge them in a deterministic order, for the background growth;
+                the worker threads share the solver, so they solve one batch at a time
         """
         
-        super().__init__(metadata, model_name,arch_params, neighbourhood_fn, lr, validation_metric,seed)
+        super().__init__(metadata, model_name,arch_params, neighbourhood_fn, lr, validation_metric,seed, **kwd)
         if loss=="pointwise":
             self.loss_fn = PointwiseLoss()
         elif loss=="pairwise":
@@ -460,12 +518,13 @@ class CachingPO(SPO):
             self.loss_fn = MAP_c_actual()
         else:
             raise Exception("Invalid Loss Provided")
-        ### The cache
-        init_cache_np = init_cache.detach().numpy()
-        init_cache_np = np.unique(init_cache_np,axis=0)
-        # torch has no unique function, so we have to do this
-        self.cache = torch.from_numpy(init_cache_np).float()
+        ### The cache, deduplicated by the pool; self.cache is its view
+        self.pool = SolutionPool(init_cache, max_size=pool_size, eviction=eviction, minimize=True, packed=packed)
+        self.cache = self.pool.view()
         self.growth = growth
+        ### the background growth of the pool, None for the synchronous one
+        self.grower = None if growth_mode == "sync" else AsyncGrowth(self.pool, partial(shortest_pathsolution, self.solver), growth_mode,
+            growth_workers, max_pending, deterministic_growth)
         self.tau = tau
         self.save_hyperparameters("lr","growth","tau")
 
@@ -475,13 +534,30 @@ class CachingPO(SPO):
         return relu_op(output)
 
     def training_step(self, batch, batch_idx):
-        input, label, true_weights = batch
+        input, label, true_weights, _ = batch
         output = self(input)
+        self.pool.touch(output)
+        if self.grower is not None:
+            self.cache = self.grower.merge()
         if (np.random.random(1)[0]<= self.growth) or len(self.cache)==0:
-            self.cache = growcache(self.solver, self.cache, output)
-            
+            if self.grower is not None and len(self.cache) > 0:
+                self.grower.submit(output.reshape(-1, output.shape[-1], output.shape[-1]))
+            else:
+                self.cache = growcache(self.solver, self.pool, output)
 
         training_loss = self.loss_fn(output, true_weights, label ,self.cache)
 
         self.log("train_loss",training_loss,  on_step=True, on_epoch=True, )
         return training_loss    
+
+    def on_validation_epoch_start(self):
+        ### the validation shares the solver with the growth workers, so they finish first
+        if self.grower is not None:
+            self.cache = self.grower.merge(wait=True)
+
+    def on_test_epoch_start(self):
+        self.on_validation_epoch_start()
+
+    def on_train_end(self):
+        if self.grower is not None:
+            self.grower.close()
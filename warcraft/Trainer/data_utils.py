@@ -3,6 +3,7 @@ import os
 from torch.utils.data import Dataset, DataLoader
 import pytorch_lightning as pl
 import torch
+from Trainer.utils import SolutionPool, PackedSolutions
 
 class WarcraftImageDataset(Dataset):
     def __init__(self, inputs, labels, true_weights):
@@ -14,13 +15,18 @@ class WarcraftImageDataset(Dataset):
         return len(self.labels)
 
     def __getitem__(self, idx):
+        ### the index of the instance in the dataset keys the state the models keep per instance, e.g. the certificates
+        return self.inputs[idx], self.labels[idx], self.true_weights[idx], idx
 
-        return self.inputs[idx], self.labels[idx], self.true_weights[idx]
-
-def return_trainlabel(data_dir):
+def return_trainlabel(data_dir, packed=False):
+    '''
+    The distinct shortest paths of the training set, bit-packed as PackedSolutions if packed
+    '''
     train_prefix = "train"
 
     train_labels = np.load(os.path.join(data_dir, train_prefix + "_shortest_paths.npy")) 
+    if packed:
+        return SolutionPool(PackedSolutions.pack(train_labels), packed=True).view()
     train_labels = np.unique(train_labels,axis=0)   
     return torch.from_numpy(train_labels)
 
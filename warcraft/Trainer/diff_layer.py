@@ -3,50 +3,62 @@ import numpy as np
 import torch
 import torch.nn as nn
 from comb_modules.dijkstra import get_solver
-from Trainer.utils import maybe_parallelize, shortest_pathsolution
+from Trainer.utils import maybe_parallelize, shortest_pathsolution, solve_batch
 
-def BlackboxDifflayer( lambda_val, neighbourhood_fn="8-grid"):
-    solver = get_solver(neighbourhood_fn)
+def BlackboxDifflayer( lambda_val, neighbourhood_fn="8-grid", solver=None):
+    '''
+    solver: if None, the dijkstra solver of neighbourhood_fn
+    '''
+    if solver is None:
+        solver = get_solver(neighbourhood_fn)
     class BlackboxDifflayer_cls(torch.autograd.Function):
         # def __init__(ctx, lambda_val, neighbourhood_fn="8-grid"):
         #     ctx.lambda_val = lambda_val
         #     ctx.neighbourhood_fn = neighbourhood_fn
         
         @staticmethod
-        def forward(ctx, weights):
+        def forward(ctx, weights, index=None):
             ctx.weights = weights.detach().cpu().numpy()
+            ctx.index = index
             # ctx.suggested_tours = np.asarray (maybe_parallelize(solver, arg_list=list(ctx.weights)))
             # return torch.from_numpy(ctx.suggested_tours).float().to(weights.device)
-            ctx.suggested_tours = shortest_pathsolution(solver, weights)
+            ctx.suggested_tours = shortest_pathsolution(solver, weights, index)
             return ctx.suggested_tours
         @staticmethod
         def backward(ctx, grad_output):
             assert grad_output.shape == ctx.suggested_tours.shape
             grad_output_numpy = grad_output.detach().cpu().numpy()
             weights_prime = np.maximum(ctx.weights + lambda_val * grad_output_numpy, 0.0)
-            better_paths = np.asarray(maybe_parallelize( solver, arg_list=list(weights_prime)))
+            index = None if ctx.index is None else [(key, "perturbed") for key in ctx.index]
+            better_paths = solve_batch(solver, weights_prime, index)
             better_paths = torch.from_numpy(better_paths).float().to(grad_output.device)
             gradient = -(ctx.suggested_tours - better_paths) / lambda_val
-            return   gradient #torch.from_numpy(gradient).to(grad_output.device)
+            return   gradient, None #torch.from_numpy(gradient).to(grad_output.device)
     return BlackboxDifflayer_cls.apply
 
 
-def  SPOlayer(  neighbourhood_fn="8-grid"):
-    solver = get_solver(neighbourhood_fn)
+def  SPOlayer(  neighbourhood_fn="8-grid", solver=None):
+    '''
+    solver: if None, the dijkstra solver of neighbourhood_fn
+    '''
+    if solver is None:
+        solver = get_solver(neighbourhood_fn)
     class SPOlayer_cls(torch.autograd.Function):
         # def __init__(ctx, lambda_val, neighbourhood_fn="8-grid"):
         #     ctx.lambda_val = lambda_val
         #     ctx.neighbourhood_fn = neighbourhood_fn
         
         @staticmethod
-        def forward(ctx, weights, label, true_weights):
+        def forward(ctx, weights, label, true_weights, index=None):
             ctx.save_for_backward(weights, label, true_weights)
-            ctx.suggested_tours = shortest_pathsolution(solver, weights)
+            ctx.index = index
+            ctx.suggested_tours = shortest_pathsolution(solver, weights, index)
             return ctx.suggested_tours
         @staticmethod
         def backward(ctx, grad_output):
             weights, label, true_weights = ctx.saved_tensors
-            spo_tour = shortest_pathsolution(solver, 2*weights - true_weights)
+            index = None if ctx.index is None else [(key, "spo") for key in ctx.index]
+            spo_tour = shortest_pathsolution(solver, 2*weights - true_weights, index)
             
             gradient = (label - spo_tour)
             # assert grad_output.shape == ctx.suggested_tours.shape
@@ -55,13 +67,15 @@ def  SPOlayer(  neighbourhood_fn="8-grid"):
             # better_paths = np.asarray(maybe_parallelize( solver, arg_list=list(weights_prime)))
             # better_paths = torch.from_numpy(better_paths).float().to(grad_output.device)
             # gradient = -(ctx.suggested_tours - better_paths) / lambda_val
-            return   gradient, None, None #torch.from_numpy(gradient).to(grad_output.device)
+            return   gradient, None, None, None #torch.from_numpy(gradient).to(grad_output.device)
     return SPOlayer_cls.apply
 
 import cvxpy as cp
 import cvxpylayers
 from cvxpylayers.torch import CvxpyLayer
+from Trainer.utils import get_cvxpylayer
 import networkx as nx
+import scipy.sparse as sps
 
 # def build_graph(x_max, y_max):
 #     '''
@@ -406,21 +420,24 @@ class CvxDifflayer(nn.Module):
 
         self.N, self.V = Incidence_mat.shape
         N, V = self.N, self.V
-        x = cp.Variable(V)
-        # z = cp.Variable(N)
-        # A = cp.Parameter((N,V))
-        # A_pos = cp.Parameter((N,V))
-        # b = cp.Parameter(N)
-        c = cp.Parameter(V)
-
-        # constraints = [x >= 0, x<=1,z>=0, z<=1,z[-1]==1, A @ x == b, A_pos@x =z]
-        constraints = [x >= 0, x<=1, Incidence_mat @ x == b_vector ]
-
-        objective = cp.Minimize(c @ x + mu*cp.pnorm(x, p=2))
-
-        problem = cp.Problem(objective, constraints)
-        # self.layer = CvxpyLayer(problem, parameters=[A,A_pos, b,c], variables=[z,x])
-        self.layer = CvxpyLayer(problem, parameters=[c], variables=[x])
+        def make_problem():
+            x = cp.Variable(V)
+            # z = cp.Variable(N)
+            # A = cp.Parameter((N,V))
+            # A_pos = cp.Parameter((N,V))
+            # b = cp.Parameter(N)
+            c = cp.Parameter(V)
+
+            # constraints = [x >= 0, x<=1,z>=0, z<=1,z[-1]==1, A @ x == b, A_pos@x =z]
+            constraints = [x >= 0, x<=1, Incidence_mat @ x == b_vector ]
+
+            objective = cp.Minimize(c @ x + mu*cp.pnorm(x, p=2))
+
+            problem = cp.Problem(objective, constraints)
+            # self.layer = CvxpyLayer(problem, parameters=[A,A_pos, b,c], variables=[z,x])
+            return problem, [c], [x]
+        ### compiled once per grid size and mu and shared across seeds and runs
+        self.layer = get_cvxpylayer(make_problem, ("warcraft", Incidence_mat, b_vector, mu))
         self.Incidence_mat = Incidence_mat
         self.b = b_vector 
         self.mu = mu
@@ -448,78 +465,53 @@ class CvxDifflayer(nn.Module):
         sol = sol[self.non_zero_edge_idx]
         return sol.view(weights.shape[-1],weights.shape[-1])
 
-from qpth.qp import QPFunction
+from Trainer.boxqp import boxqp
 class QptDifflayer(nn.Module):
-    def __init__(self, shape, mu=1e-8 ) -> None:
+    def __init__(self, shape, mu=1e-8, cache_dir=None ) -> None:
+        '''
+        QPTL with the batched boxqp engine: the bounds 0 <= x <= 1 are kept as bounds and
+        the incidence matrix stays sparse, so no V x V matrix is formed
+        cache_dir: if given, the presolved incidence matrix is cached there
+        '''
         super().__init__()
         x_max, y_max = shape
         G = build_graph(x_max, y_max)
         self.non_zero_edge_idx = [ i for i,k in enumerate( list(G.edges) ) if "_".join(k[0].split("_", 2)[:2]) == "_".join(k[1].split("_", 2)[:2])]
         self.mu  = mu
 
-        Incidence_mat = -nx.incidence_matrix(G, oriented=True).todense().astype(np.float32)
+        Incidence_mat = -nx.incidence_matrix(G, oriented=True).astype(np.float32)
         
-        b_vector  = np.zeros(len(Incidence_mat)).astype(np.float32)
+        b_vector  = np.zeros(Incidence_mat.shape[0]).astype(np.float32)
         b_vector[0] = 1
         b_vector[-1] = -1
 
         N,V = Incidence_mat.shape # N is the number of nodes, V is the bumbe rof edges
 
-        A_lb  = -np.eye(V).astype(np.float32)
-        b_lb = np.zeros(V).astype(np.float32)
-        A_ub  = np.eye(V).astype(np.float32)
-        b_ub = np.ones(V).astype(np.float32)
-
-        # A = np.concatenate((A,A_lb, A_ub   ), axis=0).astype(np.float32)
-        # b = np.concatenate(( b, b_lb, b_ub )).astype(np.float32)
-        C = np.concatenate((A_lb, A_ub   ), axis=0).astype(np.float32)
-        d = np.concatenate(( b_lb, b_ub )).astype(np.float32)
-
-        
-        self.A, self.b = torch.from_numpy(Incidence_mat),  torch.from_numpy(b_vector)
-        self.C,self.d = torch.from_numpy(C),  torch.from_numpy(d)
-
-
-        
+        self.A, self.b = Incidence_mat.tocsr(),  torch.from_numpy(b_vector)
         self.N, self.V =N,V
-        self.solver = QPFunction()
+        self.solver = boxqp(self.A, self.b, mu, lb=0., ub=1., cache_dir=cache_dir)
                 
     def forward(self,weights):
-        A_trch, b_trch = self.A, self.b 
-        C_trch, d_trch =  self.C, self.d
-        
-
         N, V = self.N, self.V 
-        weights_flatten = weights.view(weights.shape[-1]*weights.shape[-1])
-        expanded_c = torch.zeros(V)
-        expanded_c[self.non_zero_edge_idx ] = weights_flatten
-        # print(expanded_c[0:10])
-
-        # print(expanded_c[10:20])
-
-        # print(expanded_c[100:120])
+        ### weights is either a single [x_max, y_max] map or a batch of them, the batch is solved together
+        weights_flatten = weights.reshape(-1, weights.shape[-1]*weights.shape[-1])
+        expanded_c = torch.zeros(len(weights_flatten), V)
+        expanded_c[:, self.non_zero_edge_idx ] = weights_flatten
 
-        # print(expanded_c[450:480])  
-        Q =   self.mu*torch.eye(A_trch.shape[1]).float()
-
-        sol = self.solver(Q,
-                            expanded_c ,
-                            C_trch,d_trch, 
-                            A_trch, b_trch, 
-                            )
-        # sol = self.solver(Q,
-        #                     weights_concat , 
-        #                     A_trch, b_trch, 
-        #                     torch.tensor(), torch.tensor()
-        #                     )
-        sol = sol[0][self.non_zero_edge_idx ]
-
-        return sol.view(weights.shape[-1],weights.shape[-1])
+        sol = self.solver(expanded_c)
+        return sol[:, self.non_zero_edge_idx ].view(weights.shape)
 
 
 from intopt.intopt import intopt
 class IntoptDifflayer(nn.Module):
-    def __init__(self, shape,thr=1e-8,damping=1e-8, diffKKT = False ) -> None:
+    def __init__(self, shape,thr=1e-8,damping=1e-8, diffKKT = False, sparse = True, cache_dir = None, rr_method = None ) -> None:
+        '''
+        sparse: if True the constraint matrices are kept as scipy sparse matrices and
+        intopt solves the LP in sparse mode; the incidence matrix is more than 99% zeros.
+        cache_dir: if given, the presolved standard form is cached there
+        rr_method: the method removing the redundant rows of the dense constraints, see intopt;
+            with "pivot_sparse" the dense mode solves the standard form of the sparse mode
+        '''
         super().__init__()
         self.thr, self.damping  = thr, damping
         x_max, y_max = shape
@@ -527,29 +519,32 @@ class IntoptDifflayer(nn.Module):
         self.non_zero_edge_idx = [ i for i,k in enumerate( list(G.edges) ) if "_".join(k[0].split("_", 2)[:2]) == "_".join(k[1].split("_", 2)[:2])]
         
 
-        Incidence_mat = -nx.incidence_matrix(G, oriented=True).todense().astype(np.float32)
+        Incidence_mat = -nx.incidence_matrix(G, oriented=True).astype(np.float32)
         
-        b_vector  = np.zeros(len(Incidence_mat)).astype(np.float32)
+        b_vector  = np.zeros(Incidence_mat.shape[0]).astype(np.float32)
         b_vector[0] = 1
         b_vector[-1] = -1
 
         N,V = Incidence_mat.shape # N is the number of nodes, V is the bumbe rof edges
 
-        A_lb  = -np.eye(V).astype(np.float32)
+        eye = sps.identity if sparse else np.eye
+        A_lb  = -eye(V, dtype=np.float32)
         b_lb = np.zeros(V).astype(np.float32)
-        A_ub  = np.eye(V).astype(np.float32)
+        A_ub  = eye(V, dtype=np.float32)
         b_ub = np.ones(V).astype(np.float32)
 
         # A = np.concatenate((A,A_lb, A_ub   ), axis=0).astype(np.float32)
         # b = np.concatenate(( b, b_lb, b_ub )).astype(np.float32)
-        C = np.concatenate((A_lb, A_ub   ), axis=0).astype(np.float32)
         d = np.concatenate(( b_lb, b_ub )).astype(np.float32)
 
-        
-        self.A, self.b = torch.from_numpy(Incidence_mat),  torch.from_numpy(b_vector)
-        self.C,self.d = torch.from_numpy(C),  torch.from_numpy(d)        
+        if sparse:
+            self.A, self.C = Incidence_mat.tocsr(), sps.vstack((A_lb, A_ub), format="csr")
+        else:
+            self.A = torch.from_numpy(Incidence_mat.toarray())
+            self.C = torch.from_numpy(np.concatenate((A_lb, A_ub   ), axis=0))
+        self.b, self.d = torch.from_numpy(b_vector), torch.from_numpy(d)        
         self.N, self.V =N,V
-        self.intoptsolver = intopt( self.A, self.b, None, None, thr= thr, damping=damping, dopresolve=True, diffKKT = diffKKT)
+        self.intoptsolver = intopt( self.A, self.b, None, None, thr= thr, damping=damping, dopresolve=True, diffKKT = diffKKT, cache_dir = cache_dir, rr_method = rr_method)
 
     def forward(self,weights):
 
@@ -558,16 +553,10 @@ class IntoptDifflayer(nn.Module):
         
 
         N, V = self.N, self.V 
-        weights_flatten = weights.view(weights.shape[-1]*weights.shape[-1])
-        expanded_c = torch.zeros(V)
-        expanded_c[self.non_zero_edge_idx ] = weights_flatten
-        print(expanded_c[0:10])
-
-        print(expanded_c[10:20])
-
-        print(expanded_c[100:120])
-
-        print(expanded_c[450:480])
+        ### weights is either a single [x_max, y_max] map or a batch of them, the batch is solved together
+        weights_flatten = weights.reshape(-1, weights.shape[-1]*weights.shape[-1])
+        expanded_c = torch.zeros(len(weights_flatten), V)
+        expanded_c[:, self.non_zero_edge_idx ] = weights_flatten
 
 
         # A_trch, b_trch = self.A, self.b 
@@ -583,4 +572,4 @@ class IntoptDifflayer(nn.Module):
 
         sol = self.intoptsolver (expanded_c)
 
-        return sol[self.non_zero_edge_idx ].view(weights.shape[-1],weights.shape[-1])
+        return sol[:, self.non_zero_edge_idx ].view(weights.shape)
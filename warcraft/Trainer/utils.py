@@ -1,43 +1,156 @@
+import os
 import sys
+import multiprocessing as mp
+from functools import partial
 import torch
 import numpy as np
+### the helpers shared by all the problems are in common_utils, at the root of the repository
+_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+if _root not in sys.path:
+    sys.path.append(_root)
+from common_utils import (SolutionPool, PackedSolutions, PackedObjective, popcount, AsyncGrowth, SolvePipeline, shared,
+    sweep_callbacks, append_csv, get_cvxpylayer, set_cvxpylayer_cache)
+from common_utils.solver_pool import SolverPool, _constant
 try:
     import ray
 except ImportError as e:
     print(e)
 
-def maybe_parallelize(function, arg_list):
+### backend of maybe_parallelize when none is given, set from the environment or with set_parallel_backend
+_parallel = {"backend": os.environ.get("WARCRAFT_PARALLEL", "auto"),
+    "workers": int(os.environ.get("WARCRAFT_PARALLEL_WORKERS", 0)) or None}
+
+def set_parallel_backend(backend="auto", workers=None):
+    """
+    :param backend: "auto" (ray if it is initialized, else serial), "ray", "local" or "serial"
+    :param workers: number of worker processes of the local backend, the number of cores if None
+    """
+    if backend not in ("auto", "ray", "local", "serial"):
+        raise Exception("Invalid parallel backend {}".format(backend))
+    ### the workers of the previous backend are stopped
+    close_local_pools()
+    _parallel["backend"], _parallel["workers"] = backend, workers
+
+def maybe_parallelize(function, arg_list, backend=None, batched=False):
     """
-    Parallelizes execution is ray is enabled
+    Parallelizes execution is ray is enabled, or with the persistent worker processes of the local backend
     :param function: callable
     :param arg_list: list of function arguments (one for each execution)
+    :param backend: "auto", "ray", "local" or "serial", the one of set_parallel_backend if None
+    :param batched: function also takes the stacked arguments at once, which the local and serial backends use
     :return:
     """
+    backend = backend or _parallel["backend"]
+    if backend not in ("auto", "ray", "local", "serial"):
+        raise Exception("Invalid parallel backend {}".format(backend))
     # Passive ray module check
-    if 'ray' in sys.modules and ray.is_initialized():
+    if backend in ("auto", "ray") and 'ray' in sys.modules and ray.is_initialized():
         ray_fn = ray.remote(function)
         return ray.get([ray_fn.remote(arg) for arg in arg_list])
-    else:
-        return [function(arg) for arg in arg_list]
-def shortest_pathsolution(solver, weights):
+    if backend == "ray":
+        raise Exception("The ray backend requires ray to be initialized")
+    ### the local workers return no gradients, and only the main process starts them
+    if (backend == "local" and len(arg_list) > 1 and mp.parent_process() is None
+            and not any(isinstance(arg, torch.Tensor) for arg in arg_list)):
+        return list(_local_pool(function, batched).map(np.stack(arg_list)))
+    if batched and len(arg_list) > 0:
+        return list(function(np.stack(arg_list)))
+    return [function(arg) for arg in arg_list]
+
+def solve_batch(solver, matrices, index=None):
+    '''
+    Shortest paths of a batch of grids [B, H, W] : numpy array, solved with maybe_parallelize.
+    A memo_solver looks up the grids in this process and only the others are dispatched; the certified
+    solver keeps its certificates in this process, so with an index it is not dispatched.
+    '''
+    if index is not None:
+        return np.asarray(solver(matrices, index))
+    if isinstance(solver, memo_solver):
+        return np.stack(solver.memoize("shortest_path", lambda y: solve_batch(solver.solver, y), matrices, batched=True))
+    return np.stack(maybe_parallelize(solver, list(matrices), batched=True))
+
+def shortest_pathsolution(solver, weights, index=None):
     '''
     solver: dijkstra solver
     weights: torch tensor matrix
+    index: dataset indices of the grids, for the solvers which keep per-instance state (certified_solver)
     '''
     np_weights = weights.detach().cpu().numpy()
-    suggested_tours = np.asarray (maybe_parallelize(solver, arg_list=list(np_weights)))
+    ### the solver takes the whole batch [B, H, W] at once
+    suggested_tours = solve_batch(solver, np_weights, index)
     return torch.from_numpy(suggested_tours).float().to(weights.device)
 
 
 
 def growcache(solver, cache, output):
     '''
-    cache is torch array [currentpoolsize,48]
-    y_hat is  torch array [batch_size,48]
+    cache is a SolutionPool of shortest paths [currentpoolsize,H,W]
+    output is  torch array [batch_size,H*W]
+    returns the view of the grown cache
     '''
     weights = output.reshape(-1, output.shape[-1], output.shape[-1])
     shortest_path =  shortest_pathsolution(solver, weights).numpy() 
-    cache_np = cache.detach().numpy()
-    cache_np = np.unique(np.append(cache_np,shortest_path,axis=0),axis=0)
-    # torch has no unique function, so we need to do this
-    return torch.from_numpy(cache_np).float()
\ No newline at end of file
+    cache.add(shortest_path)
+    return cache.view()
+
+
+########################## Memoized exact solver ##########################
+from common_utils.memo import memo_solver as common_memo_solver
+
+class memo_solver(common_memo_solver):
+    '''
+    common_utils.memo.memo_solver around the shortest path solvers of the grids, which are called on the grids
+    '''
+    def __call__(self, matrix):
+        """
+        matrix: a single grid [x_max, y_max] or a batch of grids [B, x_max, y_max]
+        """
+        matrix = np.asarray(matrix)
+        if matrix.ndim == 3:
+            return np.stack(self.memoize("shortest_path", self.solver, matrix, batched=True))
+        return self.memoize("shortest_path", self.solver, matrix[None])[0]
+
+
+########################## Local parallel backend ##########################
+class LocalPool(SolverPool):
+    '''
+    Persistent worker processes of the local backend of maybe_parallelize, which apply function to the rows
+    of a batch: a common_utils.solver_pool.SolverPool whose workers all call function, started once and kept
+    for the whole run.
+    function : applied to every row, or to a block of rows if batched; the results must have the shape of
+        the rows. Without fork (spawn), it must be picklable.
+    workers : number of worker processes, the number of cores by default
+    chunk_size : rows sent to a worker at a time, by default a quarter of the rows per worker
+    '''
+    def __init__(self, function, workers=None, batched=False, chunk_size=None):
+        super().__init__(partial(_constant, function), workers, method=None, batched=batched, chunk_size=chunk_size)
+        self.function = function
+
+### persistent pools of the local backend, keyed by the function they apply; get_solver returns the same
+### function for the same neighbourhood_fn, so the models and layers of a run share one pool per neighbourhood
+_local_pools = {}
+
+def _local_pool(function, batched=False):
+    key = (function, batched)
+    if key not in _local_pools:
+        _local_pools[key] = LocalPool(function, _parallel["workers"], batched)
+    return _local_pools[key]
+
+def close_local_pools():
+    '''
+    Stop the workers of the local backend; the next parallel batch starts them again
+    '''
+    for pool in _local_pools.values():
+        pool.close()
+    _local_pools.clear()
+
+def parallel_summary(reset=True):
+    '''
+    Mean parallel efficiency of the batches run by the local backend since the last reset, and their number
+    '''
+    efficiency = [e for pool in _local_pools.values() for e in pool.efficiency]
+    if reset:
+        for pool in _local_pools.values():
+            pool.efficiency = []
+    return {"parallel_efficiency": float(np.mean(efficiency)) if efficiency else float("nan"),
+        "parallel_batches": len(efficiency)}
@@ -1,15 +1,19 @@
+import functools
 import numpy as np
 import heapq
 import torch
 from functools import partial
-from comb_modules.utils import get_neighbourhood_func
+from comb_modules.utils import get_neighbourhood_func, cached_neighbour_index, cached_neighbour_lists
 from collections import namedtuple
 # from utils import maybe_parallelize
 
 DijkstraOutput = namedtuple("DijkstraOutput", ["shortest_path", "is_unique", "transitions"])
 
 
-def dijkstra(matrix, neighbourhood_fn="8-grid", request_transitions=False):
+def reference_dijkstra(matrix, neighbourhood_fn="8-grid", request_transitions=False):
+    """
+    The original heapq implementation, kept to check and benchmark dijkstra against.
+    """
 
     x_max, y_max = matrix.shape
     neighbors_func = partial(get_neighbourhood_func(neighbourhood_fn), x_max=x_max, y_max=y_max)
@@ -54,11 +58,337 @@ def dijkstra(matrix, neighbourhood_fn="8-grid", request_transitions=False):
         return DijkstraOutput(shortest_path=on_path, is_unique=is_unique, transitions=None)
 
 
+def dijkstra(matrix, neighbourhood_fn="8-grid", request_transitions=False):
+    """
+    Vertex weighted shortest path from the top left to the bottom right corner of the grid.
+    The result is identical to reference_dijkstra, with flat arrays and precomputed neighbour lists.
+    Stale heap entries are not expanded again (they can not improve any cost, so only the ties they
+    add to num_path are counted), and the search stops once the sink is popped.
+    """
+    x_max, y_max = matrix.shape
+    neighbours = cached_neighbour_lists(x_max, y_max, neighbourhood_fn)
+    num_vertices = x_max * y_max
+    sink = num_vertices - 1
+    weights = matrix.reshape(num_vertices)
+
+    costs = np.full_like(weights, 1.0e10)
+    costs[0] = weights[0]
+    num_path = [0] * num_vertices
+    num_path[0] = 1
+    certain = [False] * num_vertices
+    transitions = [-1] * num_vertices
+    # the flat index has the same order as the (x, y) coordinates
+    priority_queue = [(weights[0], 0)]
+
+    while priority_queue:
+        _, cur = heapq.heappop(priority_queue)
+        cur_cost = costs[cur]
+        if certain[cur]:
+            for v in neighbours[cur]:
+                if not certain[v] and weights[v] + cur_cost == costs[v]:
+                    num_path[v] += 1
+            continue
+        if cur == sink and not request_transitions:
+            break
+
+        for v in neighbours[cur]:
+            if not certain[v]:
+                new_cost = weights[v] + cur_cost
+                if new_cost < costs[v]:
+                    costs[v] = new_cost
+                    heapq.heappush(priority_queue, (costs[v], v))
+                    transitions[v] = cur
+                    num_path[v] = num_path[cur]
+                elif new_cost == costs[v]:
+                    num_path[v] += 1
+
+        certain[cur] = True
+    # retrieve the path
+    on_path = np.zeros_like(weights)
+    on_path[sink] = 1
+    cur = sink
+    while cur != 0:
+        cur = transitions[cur]
+        on_path[cur] = 1.0
+
+    is_unique = np.bool_(num_path[sink] == 1)
+
+    if request_transitions:
+        transitions = {divmod(v, y_max): divmod(u, y_max) for v, u in enumerate(transitions) if u >= 0}
+        return DijkstraOutput(shortest_path=on_path.reshape(x_max, y_max), is_unique=is_unique, transitions=transitions)
+    else:
+        return DijkstraOutput(shortest_path=on_path.reshape(x_max, y_max), is_unique=is_unique, transitions=None)
+
+
+def batched_dijkstra(matrices, neighbourhood_fn="8-grid", request_transitions=False):
+    """
+    Solves a batch of vertex weighted grids [B, x_max, y_max] at once with array operations.
+    The result is identical to calling dijkstra on every matrix, including the is_unique flag.
+    If request_transitions, transitions [B, x_max * y_max] is the flat index of the predecessor of every
+    vertex in its shortest path tree (x_max * y_max for the source).
+
+    The costs are found by iterated min-plus relaxation over the neighbours until convergence.
+    When the weights are non-negative and every vertex attains its cost through a neighbour which
+    comes before it in (cost, vertex) order, dijkstra pops the heap entries in that order. The
+    transitions and the num_path counter of dijkstra can then be recovered from the final costs.
+    An instance which does not satisfy this (e.g. zero weights entered from a later vertex) is solved by dijkstra.
+    """
+    batch_size, x_max, y_max = matrices.shape
+    num_vertices = x_max * y_max
+    source, sink = 0, num_vertices - 1
+    neighbours = cached_neighbour_index(x_max, y_max, neighbourhood_fn)
+    is_neighbour = neighbours < num_vertices
+    offsets = [(x - 1, y - 1) for x, y in get_neighbourhood_func(neighbourhood_fn)(1, 1, x_max=3, y_max=3)]
+    unreached = np.full((), 1.0e10, dtype=matrices.dtype)
+
+    # min-plus relaxation on a grid padded with infinite costs
+    padded = np.full((batch_size, x_max + 2, y_max + 2), np.inf, dtype=matrices.dtype)
+    grid_costs = padded[:, 1:-1, 1:-1]
+    grid_costs[:] = unreached
+    grid_costs[:, 0, 0] = matrices[:, 0, 0]
+    converged = np.zeros(batch_size, dtype=bool)
+    with np.errstate(invalid="ignore", over="ignore"):
+        for _ in range(num_vertices):
+            best_neighbour = np.full_like(matrices, np.inf)
+            for dx, dy in offsets:
+                np.minimum(best_neighbour, padded[:, 1 + dx : x_max + 1 + dx, 1 + dy : y_max + 1 + dy], out=best_neighbour)
+            relaxed = np.minimum(grid_costs, best_neighbour + matrices)
+            relaxed[:, 0, 0] = matrices[:, 0, 0]
+            converged = (relaxed == grid_costs).all(axis=(1, 2))
+            grid_costs[:] = relaxed
+            if converged.all():
+                break
+
+        weights = matrices.reshape(batch_size, num_vertices)
+        vertex_costs = grid_costs.reshape(batch_size, num_vertices)
+        # the extra column is the padding vertex of the neighbour index
+        costs = np.concatenate([vertex_costs, np.full((batch_size, 1), np.inf, dtype=matrices.dtype)], axis=1)
+        neighbour_costs = costs[:, neighbours]  # [B, V, K]
+        # cost of reaching each vertex through each of its neighbours
+        through_neighbour = neighbour_costs + weights[:, :, None]
+        vertex_index = np.arange(num_vertices)[:, None]
+        popped_before = is_neighbour & (
+            (neighbour_costs < vertex_costs[:, :, None])
+            | ((neighbour_costs == vertex_costs[:, :, None]) & (neighbours < vertex_index))
+        )
+        # the neighbours through which the cost is attained and whose entries come before the vertex
+        attained = popped_before & (through_neighbour == vertex_costs[:, :, None])
+        attained[:, source] = False
+        # every vertex must receive its final heap entry from a vertex popped before it
+        exact = (
+            converged
+            & (weights >= 0).all(axis=1)
+            & (vertex_costs < unreached).all(axis=1)
+            & attained[:, 1:].any(axis=2).all(axis=1)
+        )
+
+    # transitions: the first popped of these neighbours
+    first_cost = np.where(attained, neighbour_costs, np.inf).min(axis=2, keepdims=True)
+    transitions = np.where(attained & (neighbour_costs == first_cost), neighbours, num_vertices).min(axis=2)
+
+    def stale_costs(rows, vertices):
+        """
+        Costs of the stale heap entries of the given vertices [N, K] (inf elsewhere): an entry is pushed
+        every time a neighbour popped before the vertex improves its cost, all but the last one are stale.
+        """
+        rows = rows[:, None]
+        pushed_from = neighbours[vertices]  # [N, K, K]
+        pusher_costs = costs[rows[:, :, None], pushed_from]
+        pushes = np.where(popped_before[rows, vertices], through_neighbour[rows, vertices], np.inf)
+        popped_earlier = (pusher_costs[..., None, :] < pusher_costs[..., :, None]) | (
+            (pusher_costs[..., None, :] == pusher_costs[..., :, None]) & (pushed_from[..., None, :] < pushed_from[..., :, None])
+        )
+        best_before = np.minimum(np.where(popped_earlier, pushes[..., None, :], np.inf).min(axis=-1), unreached)
+        is_stale = (pushes < best_before) & (pushes > costs[rows, vertices][..., None])
+        return np.where(is_stale, pushes, np.inf)
+
+    # dijkstra adds one to num_path for every further pop of a neighbour through which the cost is attained,
+    # stale entries included, before the vertex itself is popped
+    on_path = np.zeros((batch_size, num_vertices), dtype=matrices.dtype)
+    on_path[:, sink] = 1
+    num_path = np.ones(batch_size)
+    current = np.full(batch_size, sink)
+    rows = np.flatnonzero(exact)
+    current = current[rows]
+    while len(rows) > 0:
+        previous = neighbours[current]  # [N, K]
+        vertex_attained = attained[rows, current]
+        # the padding vertex is never attained, any vertex can stand in for it
+        stale = stale_costs(rows, np.minimum(previous, sink))  # [N, K, K]
+        cost = vertex_costs[rows, current][:, None, None]
+        stale_before = (stale < cost) | ((stale == cost) & (previous < current[:, None])[..., None])
+        num_path[rows] += (vertex_attained.sum(axis=1) - 1) + (stale_before & vertex_attained[..., None]).sum(axis=(1, 2))
+        current = transitions[rows, current]
+        on_path[rows, current] = 1.0
+        rows, current = rows[current != source], current[current != source]
+    shortest_path = on_path.reshape(batch_size, x_max, y_max)
+    is_unique = num_path == 1
+
+    for ii in np.flatnonzero(~exact):
+        output = dijkstra(matrices[ii], neighbourhood_fn, request_transitions)
+        shortest_path[ii], is_unique[ii] = output.shortest_path, output.is_unique
+        if request_transitions:
+            transitions[ii] = num_vertices
+            for (x, y), (u, v) in output.transitions.items():
+                transitions[ii, x * y_max + y] = u * y_max + v
+
+    if request_transitions:
+        return DijkstraOutput(shortest_path=shortest_path, is_unique=is_unique, transitions=transitions)
+    return DijkstraOutput(shortest_path=shortest_path, is_unique=is_unique, transitions=None)
+
+
+@functools.lru_cache(32)
 def get_solver(neighbourhood_fn):
+    ### one solver per neighbourhood_fn, so that its worker processes of the local backend are shared
     def solver(matrix):
+        """
+        matrix: a single grid [x_max, y_max] or a batch of grids [B, x_max, y_max]
+        """
+        if matrix.ndim == 3:
+            return batched_dijkstra(matrix, neighbourhood_fn).shortest_path
         return dijkstra(matrix, neighbourhood_fn).shortest_path
 
     return solver
 
 
+class certified_solver:
+    """
+    Solver mode for the training instances, which skips the solve of an instance whose last shortest path
+    is still optimal under the new weights.
+    The shortest path tree of the last solve of every instance is kept, keyed by its dataset index.
+    Under new weights w, the costs of the tree paths are summed by pointer jumping, capped at the cost D of the
+    stored path and lowered by a few rounds of min-plus relaxation, which leaves pi >= min(distance, D).
+    A fixed point pi is dual feasible (pi[u] + w[v] - pi[v] >= 0 for every move u -> v), so the stored path
+    is optimal if pi is still D at the sink. If moreover the reduced cost of every other move into the path
+    exceeds the rounding error of the path costs, the stored path is the unique shortest path, the one
+    dijkstra returns. Otherwise, and for the instances without a certificate, the instance is solved and
+    its certificate replaced.
+    max_relaxations: maximum number of relaxation rounds, x_max + y_max if None
+    """
+
+    def __init__(self, neighbourhood_fn="8-grid", max_relaxations=None):
+        self.neighbourhood_fn = neighbourhood_fn
+        self.max_relaxations = max_relaxations
+        self.solver = get_solver(neighbourhood_fn)
+        # index -> (predecessors [x_max * y_max], shortest path [x_max, y_max])
+        self.certificates = {}
+        self.reset_counts()
+
+    def reset_counts(self):
+        self.solves = {"skipped": 0, "solved": 0}
+
+    def summary(self):
+        """
+        Fraction of the solves skipped since the last reset_counts
+        """
+        total = self.solves["skipped"] + self.solves["solved"]
+        return {"solves_skipped": self.solves["skipped"] / total if total > 0 else float("nan")}
+
+    def _certified(self, matrices, index):
+        batch_size, x_max, y_max = matrices.shape
+        num_vertices = x_max * y_max
+        certified = np.zeros(batch_size, dtype=bool)
+        rows = [ii for ii, key in enumerate(index) if key in self.certificates and self.certificates[key][1].shape == (x_max, y_max)]
+        if len(rows) == 0:
+            return certified
+        predecessors = np.stack([self.certificates[index[ii]][0] for ii in rows])
+        on_path = np.stack([self.certificates[index[ii]][1].reshape(num_vertices) for ii in rows])
+        weights = matrices[rows].reshape(len(rows), num_vertices).astype(np.float64)
+        neighbours = cached_neighbour_index(x_max, y_max, self.neighbourhood_fn)  # [V, K]
+        r = np.arange(len(rows))[:, None]
+
+        # costs of the tree paths by pointer jumping towards the source, the padding vertex costs 0
+        # and is its own predecessor
+        potentials = np.concatenate([weights, np.zeros((len(rows), 1))], axis=1)
+        jump = np.concatenate([predecessors, np.full((len(rows), 1), num_vertices)], axis=1)
+        for _ in range(int(np.ceil(np.log2(num_vertices + 1)))):
+            potentials = potentials + potentials[r, jump]
+            jump = jump[r, jump]
+        path_cost = potentials[:, num_vertices - 1 : num_vertices].copy()
+
+        # min-plus relaxation on a grid padded with infinite costs, as in batched_dijkstra
+        offsets = [(x - 1, y - 1) for x, y in get_neighbourhood_func(self.neighbourhood_fn)(1, 1, x_max=3, y_max=3)]
+        padded = np.full((len(rows), x_max + 2, y_max + 2), np.inf)
+        grid_potentials = padded[:, 1:-1, 1:-1]
+        grid_potentials[:] = np.minimum(potentials[:, :num_vertices], path_cost).reshape(len(rows), x_max, y_max)
+        grid_weights = weights.reshape(len(rows), x_max, y_max)
+        grid_path_cost = path_cost[:, :, None]
+        converged = np.zeros(len(rows), dtype=bool)
+        for _ in range(self.max_relaxations or x_max + y_max):
+            best_neighbour = np.full_like(grid_weights, np.inf)
+            for dx, dy in offsets:
+                np.minimum(best_neighbour, padded[:, 1 + dx : x_max + 1 + dx, 1 + dy : y_max + 1 + dy], out=best_neighbour)
+            relaxed = np.minimum(np.minimum(grid_potentials, best_neighbour + grid_weights), grid_path_cost)
+            relaxed[:, 0, 0] = grid_weights[:, 0, 0]
+            converged = (relaxed == grid_potentials).all(axis=(1, 2))
+            grid_potentials[:] = relaxed
+            if converged.all():
+                break
+        potentials = np.concatenate([grid_potentials.reshape(len(rows), num_vertices), np.full((len(rows), 1), np.inf)], axis=1)
+
+        reduced = potentials[r[:, :, None], neighbours] + weights[:, :, None] - potentials[:, :num_vertices, None]
+        into_path = (neighbours < num_vertices) & on_path[:, :, None] & (neighbours != predecessors[:, :, None])
+        into_path[:, 0] = False
+        # the costs of dijkstra are sums in the precision of the matrices, with one rounding per positive weight
+        # of the path, and a path costing less than 2 D has fewer than 2 D / (smallest positive weight) of them
+        smallest_weight = np.where(weights > 0, weights, np.inf).min(axis=1, keepdims=True)
+        num_terms = np.minimum(num_vertices, np.floor(2 * path_cost / smallest_weight) + 1)
+        tol = (2 * num_terms * np.finfo(matrices.dtype).eps * path_cost)[:, :, None]
+        certified[rows] = (
+            (weights >= 0).all(axis=1)
+            & converged
+            & (potentials[:, num_vertices - 1] == path_cost[:, 0])
+            & np.where(into_path, reduced > tol, True).all(axis=(1, 2))
+        )
+        return certified
+
+    def __call__(self, matrix, index=None):
+        """
+        matrix: a single grid [x_max, y_max] or a batch of grids [B, x_max, y_max]
+        index: list of the dataset indices of the grids; without it every grid is solved
+        """
+        if index is None:
+            return self.solver(matrix)
+        matrices = matrix[None] if matrix.ndim == 2 else matrix
+        certified = self._certified(matrices, index)
+        shortest_path = np.zeros_like(matrices)
+        for ii in np.flatnonzero(certified):
+            shortest_path[ii] = self.certificates[index[ii]][1]
+        unsolved = np.flatnonzero(~certified)
+        if len(unsolved) > 0:
+            output = batched_dijkstra(matrices[unsolved], self.neighbourhood_fn, request_transitions=True)
+            shortest_path[unsolved] = output.shortest_path
+            for jj, ii in enumerate(unsolved):
+                self.certificates[index[ii]] = (output.transitions[jj].astype(np.int32), output.shortest_path[jj].astype(bool))
+        self.solves["skipped"] += int(certified.sum())
+        self.solves["solved"] += len(unsolved)
+        return shortest_path[0] if matrix.ndim == 2 else shortest_path
+
+
+
+
+
+if __name__ == "__main__":
+    # Micro-benchmark of dijkstra against reference_dijkstra, run from the warcraft directory:
+    # python -m comb_modules.dijkstra
+    import time
 
+    rng = np.random.default_rng(0)
+    terrain_costs = np.array([0.8, 1.2, 5.3, 7.7, 9.2], dtype=np.float32)
+    for grid_size in [12, 18, 24, 30]:
+        matrices = rng.choice(terrain_costs, (100, grid_size, grid_size)) * rng.uniform(0.5, 1.5, (100, grid_size, grid_size)).astype(np.float32)
+        timings = {}
+        for name, fn in [("reference", reference_dijkstra), ("dijkstra", dijkstra)]:
+            start = time.perf_counter()
+            outputs = [fn(matrix) for matrix in matrices]
+            timings[name] = (time.perf_counter() - start) / len(matrices), outputs
+        identical = all(
+            (fast.shortest_path == reference.shortest_path).all() and fast.is_unique == reference.is_unique
+            for fast, reference in zip(timings["dijkstra"][1], timings["reference"][1])
+        )
+        print(
+            "{0}x{0}: reference {1:.2f} ms, dijkstra {2:.2f} ms, speedup {3:.1f}x, identical {4}".format(
+                grid_size, 1e3 * timings["reference"][0], 1e3 * timings["dijkstra"][0],
+                timings["reference"][0] / timings["dijkstra"][0], identical
+            )
+        )
@@ -1,6 +1,97 @@
 import torch
 import numpy as np
 import torch.nn.functional as F
+
+def _objective(y, cache):
+    '''
+    y . s for every cost vector of y [batch_size, *shape] and every solution s of the cache [cache_size, *shape],
+    as [batch_size, cache_size]; the cache may be bit-packed (PackedSolutions)
+    '''
+    if hasattr(cache, "objective"):
+        return cache.objective(y)
+    return y.reshape(len(y), -1) @ cache.reshape(len(cache), -1).T.to(y.dtype)
+
+def _column_sums(cache, square=False, dtype=None):
+    '''
+    Sum of the solutions of the cache, or of their squares, as [*shape] of dtype, the one of the cache if None
+    '''
+    if hasattr(cache, "column_sums"):
+        ### the entries of bit-packed solutions are 0/1, so they are their own squares
+        return cache.column_sums(dtype or torch.float32)
+    if square:
+        ### by blocks of solutions, not to copy the whole cache
+        sums = sum(block.square().sum(dim=0) for block in cache.split(4096))
+    else:
+        sums = cache.sum(dim=0)
+    return sums if dtype is None else sums.to(dtype)
+
+def _ranked_pairs(scores, mode="B"):
+    '''
+    The pairs of solutions of the cache which the pairwise losses compare, for every instance, ranked by
+    scores [batch_size, cache_size], the lower the better. As with np.unique(scores[ii], return_index=True),
+    the solutions of equal scores count once, by the first of them, and the distinct scores are in increasing order.
+    mode "B": the best one against every other one, "W": every one against the worst one,
+        "S": every one against the next one
+    Returns the indices of the better and of the worse solution of the pairs, and the mask of the pairs,
+    all [batch_size, cache_size]
+    '''
+    values, order = torch.sort(scores, dim=1, stable=True)
+    first = torch.ones_like(values, dtype=torch.bool)
+    first[:, 1:] = values[:, 1:] != values[:, :-1]
+    ### the first solution of every distinct score, in increasing order of the scores
+    rank = first.cumsum(dim=1) - 1
+    distinct = torch.zeros_like(order)
+    distinct[torch.nonzero(first, as_tuple=True)[0], rank[first]] = order[first]
+    n_distinct = first.sum(dim=1, keepdim=True)
+    following = torch.cat([distinct[:, 1:], distinct[:, :1]], dim=1)
+    if mode == "B":
+        big, small = distinct[:, :1].expand_as(distinct), following
+    elif mode == "W":
+        big, small = distinct, distinct.gather(1, n_distinct - 1).expand_as(distinct)
+    elif mode == "S":
+        big, small = distinct, following
+    else:
+        raise Exception("Invalid mode {}".format(mode))
+    mask = torch.arange(scores.shape[1], device=scores.device).unsqueeze(0) < n_distinct - 1
+    return big, small, mask
+
+def _solution_blocks(cache):
+    '''
+    The solutions of the cache by blocks, as (index of the first one, [k, *shape]); a bit-packed cache
+    (PackedSolutions) is unpacked one block at a time
+    '''
+    if hasattr(cache, "blocks"):
+        return cache.blocks()
+    return [(0, cache)]
+
+def _columnwise_max(diff, target, cache, mm):
+    '''
+    Mean over the instances of the max over the solutions s of the cache and the columns w of
+    mm * sum_h (target - s)[h,w] diff[h,w], the MAP losses of the [img,img] shortest paths, which sum over
+    the rows only. The columns are taken one at a time, and the solutions of a bit-packed cache one block at
+    a time, so that it takes O(batch_size cache_size) memory, and the gradient is spread evenly among the ties,
+    as the max of all the entries of a tensor.
+    '''
+    width = diff.shape[-1]
+    def values(block, w):
+        ### [batch_size, k] values of column w for the solutions of block
+        return mm*( (target[:, :, w]*diff[:, :, w]).sum(dim=1, keepdim=True) - diff[:, :, w] @ block[:, :, w].T.to(diff.dtype) )
+    with torch.no_grad():
+        best = torch.stack([values(block, w).max(dim=1)[0] for _, block in _solution_blocks(cache)
+            for w in range(width)]).max(dim=0)[0]
+        ties = [(b, s + start, w) for start, block in _solution_blocks(cache) for w in range(width)
+            for b, s in [torch.nonzero(values(block, w) == best.unsqueeze(1), as_tuple=True)]]
+    ### the differentiable values at the ties, averaged per instance
+    batch = torch.cat([b for b, s, w in ties])
+    rows = torch.cat([s for b, s, w in ties])
+    cols = torch.cat([torch.full_like(b, w) for b, s, w in ties])
+    ### only the tied solutions of a bit-packed cache are unpacked
+    tied_solutions = cache.unpack(rows.cpu().numpy()) if hasattr(cache, "unpack") else cache[rows]
+    tied_solutions = tied_solutions.to(diff)[torch.arange(len(rows), device=diff.device), :, cols]
+    tied = mm*( (target[batch, :, cols] - tied_solutions)*diff[batch, :, cols] ).sum(dim=1)
+    counts = torch.bincount(batch, minlength=len(diff)).to(diff.dtype)
+    return ( torch.zeros(len(diff), dtype=diff.dtype, device=diff.device).index_add(0, batch, tied) / counts ).mean()
+
 class HammingLoss(torch.nn.Module):
     def forward(self, suggested, target, true_weights):
         errors = suggested * (1.0 - target) + (1.0 - suggested) * target
@@ -18,11 +109,10 @@ class NCE(torch.nn.Module):
         self.mm  = 1 if minimize else -1
     def forward(self, pred_weights, true_weights, target, cache):
 
-        loss = 0
         mm = self.mm
-        for ii in range(len( pred_weights )):
-            loss += ( ( mm* ( target[ii] - cache )*pred_weights[ii]  ).sum(dim=(1)) ).mean() 
-        loss /= len(pred_weights)
+        ### mean over the cache of (sol_true - s) . y_hat, taken with the mean solution of the cache;
+        ### the per-instance losses summed over the rows and averaged over the columns, hence the division
+        loss = ( mm* ( target - _column_sums(cache, dtype=pred_weights.dtype)/len(cache) )*pred_weights  ).sum(dim=(1,2)).mean() / pred_weights.shape[-1]
         return loss
 
 class NCE_c(torch.nn.Module):
@@ -31,11 +121,8 @@ class NCE_c(torch.nn.Module):
         self.mm  = 1 if minimize else -1
     def forward(self, pred_weights, true_weights, target, cache):
 
-        loss = 0
         mm = self.mm
-        for ii in range(len( pred_weights )):
-            loss += ( ( mm* ( target[ii] - cache )* (pred_weights[ii] - true_weights[ii])  ).sum(dim=(1)) ).mean() 
-        loss /= len(pred_weights)
+        loss = ( mm* ( target - _column_sums(cache, dtype=pred_weights.dtype)/len(cache) )* (pred_weights - true_weights)  ).sum(dim=(1,2)).mean() / pred_weights.shape[-1]
         return loss
 
 
@@ -45,12 +132,8 @@ class MAP(torch.nn.Module):
         self.mm  = 1 if minimize else -1
     def forward(self, pred_weights, true_weights, target, cache):
 
-        loss = 0
         mm = self.mm
-
-        for ii in range(len( pred_weights)):
-            loss += (( mm* ( target[ii] - cache )*pred_weights[ii]  ).sum(dim=(1)) ).max() 
-        loss /= len(pred_weights)
+        loss = _columnwise_max(pred_weights, target, cache, mm)
         return loss
 
 
@@ -60,12 +143,8 @@ class MAP_c(torch.nn.Module):
         self.mm  = 1 if minimize else -1
     def forward(self, pred_weights, true_weights, target, cache):
 
-        loss = 0
         mm = self.mm
-
-        for ii in range(len( pred_weights )):
-            loss += (( mm* ( target[ii] - cache )* (pred_weights[ii] - true_weights[ii])   ).sum(dim=(1)) ).max() 
-        loss /= len(pred_weights)
+        loss = _columnwise_max(pred_weights - true_weights, target, cache, mm)
         return loss
 
 
@@ -75,13 +154,8 @@ class MAP_c_actual(torch.nn.Module):
         self.mm  = 1 if minimize else -1
     def forward(self, pred_weights, true_weights, target, cache):
 
-        loss = 0
         mm = self.mm
-
-        for ii in range(len( pred_weights)):
-
-            loss += (( mm* ( target[ii] - cache )* (pred_weights[ii] - true_weights[ii])   ).sum(dim=(1)) ).max() 
-        loss /= len(pred_weights)
+        loss = _columnwise_max(pred_weights - true_weights, target, cache, mm)
         return loss
 
 ###################################### Ranking Loss  Functions  #########################################
@@ -93,10 +167,9 @@ class PointwiseLoss(torch.nn.Module):
         target: true shortest path [batch_size, img,img]
         cache: cache is torch array [cache_size, img,img]
         '''
-        loss = 0
-        for ii in range(len(pred_weights)):
-            loss += ((cache*pred_weights[ii])-(cache*true_weights[ii])).square().mean()
-        loss /= len(pred_weights)
+        ### mean over the cache and the entries of (s*y_hat - s*y_true)^2 = s^2 (y_hat - y_true)^2
+        diff = (pred_weights - true_weights).square()
+        loss = ( diff*_column_sums(cache, square=True, dtype=diff.dtype) ).sum(dim=(1,2)).mean() / (len(cache)*diff[0].numel())
 
         return loss
 
@@ -114,22 +187,10 @@ class PairwiseLoss(torch.nn.Module):
         cache: cache is torch array [cache_size, img,img]
         '''
         relu = torch.nn.ReLU()
-        loss = 0
-        for ii in range(len(pred_weights)):
-            _,indices= np.unique((self.mm*true_weights[ii]*cache).sum(dim= (1,2)).detach().numpy(),return_index=True)
-
-            if self.mode == 'B':
-                big_ind = [indices[0] for p in range(len(indices)-1)] #good one
-                small_ind = [indices[p+1] for p in range(len(indices)-1)] #bad one
-            if self.mode == 'W':
-                big_ind = [indices[p] for p in range(len(indices)-1)] #good one
-                small_ind = [indices[-1] for p in range(len(indices)-1)] #bad one
-            if self.mode == 'S':
-                big_ind = [indices[p] for p in range(len(indices)-1)] #good one
-                small_ind = [indices[p+1] for p in range(len(indices)-1)] #bad one
-            
-            loss += relu(  self.tau+ ( cache[big_ind]*pred_weights[ii] -cache[small_ind]*pred_weights[ii]   ).sum(dim=(1,2)) ).mean()
-        loss /= len(pred_weights)
+        big, small, mask = _ranked_pairs(self.mm*_objective(true_weights, cache).detach(), self.mode)
+        obj_hat = _objective(pred_weights, cache)
+        loss = relu( self.tau + obj_hat.gather(1, big) - obj_hat.gather(1, small) )
+        loss = ( (loss*mask).sum(dim=1) / mask.sum(dim=1) ).mean()
         return loss
 
 class PairwisediffLoss(torch.nn.Module):
@@ -144,23 +205,12 @@ class PairwisediffLoss(torch.nn.Module):
         target: true shortest path [batch_size, img,img]
         cache: cache is torch array [cache_size, img,img]
         '''
-        relu = torch.nn.ReLU()
-        loss = 0
-        for ii in range(len(pred_weights)):
-            _,indices= np.unique((self.mm*true_weights[ii]*cache).sum(dim= (1,2)).detach().numpy(),return_index=True)
-
-            if self.mode == 'B':
-                big_ind = [indices[0] for p in range(len(indices)-1)] #good one
-                small_ind = [indices[p+1] for p in range(len(indices)-1)] #bad one
-            if self.mode == 'W':
-                big_ind = [indices[p] for p in range(len(indices)-1)] #good one
-                small_ind = [indices[-1] for p in range(len(indices)-1)] #bad one
-            if self.mode == 'S':
-                big_ind = [indices[p] for p in range(len(indices)-1)] #good one
-                small_ind = [indices[p+1] for p in range(len(indices)-1)] #bad one
-            
-            loss += ( ( cache[big_ind]*pred_weights[ii] -cache[small_ind]*pred_weights[ii]).sum(dim=(1,2)) - ( cache[big_ind]*true_weights[ii] -cache[small_ind]*true_weights[ii]).sum(dim=(1,2)) ).square().mean()
-        loss /= len(pred_weights)
+        ### the pairs ranked by the true objectives, then the objectives of the solutions of the pairs
+        big, small, mask = _ranked_pairs(self.mm*_objective(true_weights, cache).detach(), self.mode)
+        obj_hat, obj_true = _objective(pred_weights, cache), _objective(true_weights, cache)
+        diff = ( obj_hat.gather(1, big) - obj_hat.gather(1, small) ) - ( obj_true.gather(1, big) - obj_true.gather(1, small) )
+        ### mean over the pairs of every instance; nan as the mean of no pair, if all the solutions are tied
+        loss = ( (diff.square()*mask).sum(dim=1) / mask.sum(dim=1) ).mean()
         return loss
 
 
@@ -172,11 +222,8 @@ class ListwiseLoss(torch.nn.Module):
 
     def forward(self, pred_weights, true_weights, target, cache):
 
-        loss = 0
         mm, tau  = self.mm, self.tau
-
-        for ii in range(len(pred_weights)):
-            loss += - ( F.log_softmax((-mm*pred_weights[ii]*cache/tau).sum(dim=(1,2)),dim=0) * F.softmax((-mm*true_weights[ii]*cache/tau).sum(dim=(1,2)),dim=0)).mean()
-        loss /= len(pred_weights)
+        ### softmax over the cache of the objectives [batch_size, cache_size]
+        loss = - ( F.log_softmax(-mm*_objective(pred_weights, cache)/tau,dim=1) * F.softmax(-mm*_objective(true_weights, cache)/tau,dim=1)).mean(dim=1).mean()
 
         return loss
\ No newline at end of file
@@ -61,3 +61,32 @@ def cached_vertex_grid_to_edges_grid_coords(grid_dim: int):
 def cached_vertex_grid_to_edges(grid_dim: int):
     x, y, xn, yn = cached_vertex_grid_to_edges_grid_coords(grid_dim)
     return np.vstack([vertex_index((x, y), grid_dim), vertex_index((xn, yn), grid_dim)]).T
+
+
+@functools.lru_cache(32)
+def cached_neighbour_index(x_max: int, y_max: int, neighbourhood_fn: str):
+    """
+    Flat vertex indices of the neighbours of every vertex of a x_max * y_max grid, in the order of the neighbourhood function.
+    The rows are padded with x_max * y_max (one past the last vertex) for vertices with fewer neighbours.
+    """
+    neighbours_func = get_neighbourhood_func(neighbourhood_fn)
+    num_vertices = x_max * y_max
+    neighbours = [
+        [x_new * y_max + y_new for x_new, y_new in neighbours_func(x, y, x_max=x_max, y_max=y_max)]
+        for x, y in itertools.product(range(x_max), range(y_max))
+    ]
+    max_degree = max(len(n) for n in neighbours)
+    neighbour_index = np.full((num_vertices, max_degree), num_vertices, dtype=np.int64)
+    for v, n in enumerate(neighbours):
+        neighbour_index[v, : len(n)] = n
+    neighbour_index.flags.writeable = False
+    return neighbour_index
+
+
+@functools.lru_cache(32)
+def cached_neighbour_lists(x_max: int, y_max: int, neighbourhood_fn: str):
+    """
+    Same as cached_neighbour_index, as a tuple of tuples without padding, for the single instance dijkstra.
+    """
+    neighbour_index = cached_neighbour_index(x_max, y_max, neighbourhood_fn)
+    return tuple(tuple(n[n < x_max * y_max].tolist()) for n in neighbour_index)
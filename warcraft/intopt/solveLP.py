@@ -1,8 +1,10 @@
 import numpy as np
 import scipy as sp
 import scipy.sparse as sps
+import scipy.sparse.linalg
 from scipy.linalg import LinAlgError
 from warnings import warn
+import torch
 from scipy.optimize._remove_redundancy import (
     _remove_redundancy_svd, _remove_redundancy_pivot_sparse,
     _remove_redundancy_pivot_dense, _remove_redundancy_id
@@ -482,7 +484,8 @@ def _sym_solve(Dinv, A, r1, r2, solve):
 
 def solveLP(c,A,b,thr, tol=1e-6, 
             maxiter=1000, alpha0=.99995, beta=0.1, sparse=False, lstsq=False,
-                sym_pos=True, cholesky=None, pc=True, ip=False, permc_spec='MMD_AT_PLUS_A'):
+                sym_pos=True, cholesky=None, pc=True, ip=False, permc_spec='MMD_AT_PLUS_A',
+                return_factor=False, damping=0.):
     '''
     c : 1D numpy array
         The coefficients of the linear objective function to be minimized.
@@ -494,6 +497,11 @@ def solveLP(c,A,b,thr, tol=1e-6,
         The equality constraint matrix. 
     b : 1D numpy array, optional
         The equality constraint vector. .
+    return_factor : bool
+        If True, additionally return the Cholesky factor (as given by
+        scipy.linalg.cho_factor) of A X Z^{-1} A.T + damping I at the final iterate,
+        or None if the factorization fails.
+    damping : Tikhonov damping added to the factorized matrix
     '''
     iteration = 0
     c0 = 0
@@ -620,6 +628,378 @@ def solveLP(c,A,b,thr, tol=1e-6,
             message = _get_message(status)
             break
 
-    
+    if return_factor:
+        return x, y, z, tau, kappa, mu, _get_final_factor(A, x, z, damping)
     # [4] Statement after Theorem 8.2
     return x, y, z, tau, kappa, mu
+
+
+def _get_final_factor(A, x, z, damping):
+    """
+    Cholesky factor of the damped matrix of [4] Equation 8.31 at the iterate
+    (x, z), to be reused when differentiating the solution.
+    """
+    Dinv = x / z
+    M = A.dot(Dinv.reshape(-1, 1) * A.T)
+    np.fill_diagonal(M, M.diagonal() + damping)
+    try:
+        return sp.linalg.cho_factor(M)
+    except LinAlgError:
+        return None
+
+
+############################ Batched version of the above #########################
+"""
+The functions below advance a batch of LPs sharing the same (A, b) and
+differing only in c. Every instance follows exactly the iterates solveLP
+would produce for it; instances which have met the stopping criteria are
+masked out and no longer updated.
+"""
+
+def _matvec(A, v):
+    """
+    A @ v[i] for every row of the 2D array v, A being dense or sparse
+    """
+    return (A @ v.T).T
+
+
+def _rmatvec(A, v):
+    """
+    A.T @ v[i] for every row of the 2D array v, A being dense or sparse
+    """
+    return (A.T @ v.T).T
+
+
+def _normal_matrices(A, Dinv, damping=0.):
+    """
+    Assemble M = A D A^T (+ damping I) of [4] Equation 8.31 for every instance.
+    A : 2D array (m, n), Dinv : 2D array (batch_size, n)
+    Returns a 3D array (batch_size, m, m)
+    The scaled copies of A are formed in chunks to bound the memory footprint.
+    """
+    batch_size = len(Dinv)
+    m, n = A.shape
+    M = np.empty((batch_size, m, m))
+    chunk = max(1, (1 << 24) // max(1, m * n))
+    for s in range(0, batch_size, chunk):
+        np.matmul(A * Dinv[s:s + chunk, None, :], A.T, out=M[s:s + chunk])
+    if damping:
+        M[:, np.arange(m), np.arange(m)] += damping
+    return M
+
+
+def _get_batched_solver(M):
+    """
+    Batched counterpart of _get_solver: factorize all normal matrices with one
+    batched Cholesky decomposition and return a handle solving M r = rhs,
+    rhs being a 3D array (batch_size, m, k).
+    As in _get_delta, instances whose Cholesky factorization fails (or gives a
+    non finite solution) are solved by LU and, if that fails too, by least squares.
+    """
+    M_t = torch.from_numpy(M)
+    L, info = torch.linalg.cholesky_ex(M_t)
+    failed = (info > 0).numpy()
+    if np.any(failed):
+        warn(
+            "Solving system with option 'cholesky':True "
+            "failed. It is normal for this to happen "
+            "occasionally, especially as the solution is "
+            "approached. However, if you see this frequently, "
+            "consider setting option 'cholesky' to False.")
+
+    def solve(r):
+        r_t = torch.from_numpy(np.ascontiguousarray(r))
+        sol = torch.cholesky_solve(r_t, L)
+        bad = failed | ~torch.isfinite(sol).all(dim=2).all(dim=1).numpy()
+        if np.any(bad):
+            sol_lu, info_lu = torch.linalg.solve_ex(M_t[bad], r_t[bad])
+            sol[bad] = sol_lu
+            bad_lu = np.flatnonzero(bad)[((info_lu > 0) |
+                ~torch.isfinite(sol_lu).all(dim=2).all(dim=1)).numpy()]
+            if len(bad_lu) > 0:
+                sol[bad_lu] = torch.linalg.lstsq(M_t[bad_lu], r_t[bad_lu], driver='gelsd').solution
+        return sol.numpy()
+    return solve
+
+
+class sparse_normal_equations:
+    """
+    The matrices M = A D A^T (+ damping I) of [4] Equation 8.31 for a sparse A.
+    The sparsity pattern of M does not depend on D, so a fill-reducing ordering
+    and the linear map from D to the entries of M are computed once and
+    reused for every iteration and every instance. The instances of a batch
+    are factorized together as one block diagonal matrix.
+    """
+    def __init__(self, A, permc_spec='MMD_AT_PLUS_A'):
+        A = sps.csr_matrix(A, dtype=float)
+        m, n = A.shape
+        # ordering from the pattern of M, made diagonally dominant so that no pivoting is needed
+        pattern = abs(A) @ abs(A).T
+        pattern = (pattern + sps.diags(np.asarray(pattern.sum(1)).ravel() + 1)).tocsc()
+        lu = sps.linalg.splu(pattern, permc_spec=permc_spec, diag_pivot_thresh=0.,
+                             options=dict(SymmetricMode=True))
+        perm = np.argsort(lu.perm_c)
+
+        # entry (i, j) of the permuted M is sum_k A[i, k] A[j, k] D[k], in csc order
+        A = A[perm]
+        pattern = (abs(A) @ abs(A).T).tocsc()
+        pattern.sort_indices()
+        rows = pattern.indices
+        cols = np.repeat(np.arange(m), np.diff(pattern.indptr))
+        self.K = A[rows].multiply(A[cols]).tocsr()
+        self.indices, self.indptr = pattern.indices, pattern.indptr
+        self.diagonal = np.flatnonzero(rows == cols)
+        self.perm, self.m = perm, m
+
+    def matrices(self, Dinv, damping=0.):
+        """
+        The block diagonal (permuted) normal matrix of all instances, Dinv : 2D array (batch_size, n)
+        """
+        batch_size, m, nnz = len(Dinv), self.m, len(self.indices)
+        data = np.asarray(self.K @ Dinv.T).T
+        if damping:
+            data[:, self.diagonal] += damping
+        offsets = np.arange(batch_size)[:, None]
+        indices = (self.indices[None, :] + m * offsets).ravel()
+        indptr = np.append((self.indptr[None, :-1] + nnz * offsets).ravel(), batch_size * nnz)
+        return sps.csc_matrix((data.ravel(), indices, indptr), shape=(batch_size * m, batch_size * m))
+
+    def factorize(self, Dinv, damping=0.):
+        """
+        Returns a handle solving M r = rhs for every instance, rhs being a 3D array (batch_size, m, k).
+        If the joint factorization fails, each instance is factorized on its own with
+        pivoting and, failing that, solved by least squares.
+        """
+        batch_size, m, perm = len(Dinv), self.m, self.perm
+        M = self.matrices(Dinv, damping)
+        try:
+            lu = sps.linalg.splu(M, permc_spec='NATURAL', diag_pivot_thresh=0.,
+                                 options=dict(SymmetricMode=True))
+            solvers = None
+        except RuntimeError:
+            warn(
+                "Solving system with option 'cholesky':True "
+                "failed. It is normal for this to happen "
+                "occasionally, especially as the solution is "
+                "approached. However, if you see this frequently, "
+                "consider setting option 'cholesky' to False.")
+            solvers = [_get_sparse_solver(M[i*m:(i+1)*m, i*m:(i+1)*m]) for i in range(batch_size)]
+
+        def solve(r):
+            k = r.shape[2]
+            r = r[:, perm, :]
+            if solvers is None:
+                sol = lu.solve(np.ascontiguousarray(r.reshape(batch_size * m, k))).reshape(batch_size, m, k)
+            else:
+                sol = np.stack([solvers[i](r[i]) for i in range(batch_size)])
+            for i in np.flatnonzero(~np.isfinite(sol).all(axis=(1, 2))):
+                M_i = M[i*m:(i+1)*m, i*m:(i+1)*m]
+                sol[i] = np.stack([sps.linalg.lsqr(M_i, r[i, :, j])[0] for j in range(k)], axis=1)
+            out = np.empty_like(sol)
+            out[:, perm, :] = sol
+            return out
+        return solve
+
+
+def _get_sparse_solver(M):
+    """
+    LU factorization of a single sparse normal matrix with pivoting, falling back to least squares
+    """
+    try:
+        return sps.linalg.splu(sps.csc_matrix(M)).solve
+    except RuntimeError:
+        return lambda r: np.stack([sps.linalg.lsqr(M, r[:, j])[0] for j in range(r.shape[1])], axis=1)
+
+
+def _get_normal_solver(A, Dinv, damping=0., normal_equations=None):
+    """
+    Factorize the normal matrices of all instances, dense or sparse, and return the solve handle
+    """
+    if normal_equations is not None:
+        return normal_equations.factorize(Dinv, damping)
+    return _get_batched_solver(_normal_matrices(A, Dinv, damping))
+
+
+def _get_step_batched(x, d_x, z, d_z, tau, d_tau, kappa, d_kappa, alpha0):
+    """
+    Batched implementation of _get_step, [4] equation 8.21
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        alpha_x = alpha0 * np.where(d_x < 0, x / -d_x, np.inf).min(axis=1)
+        alpha_z = alpha0 * np.where(d_z < 0, z / -d_z, np.inf).min(axis=1)
+        alpha_tau = np.where(d_tau < 0, alpha0 * tau / -d_tau, 1)
+        alpha_kappa = np.where(d_kappa < 0, alpha0 * kappa / -d_kappa, 1)
+    return np.minimum.reduce([np.ones_like(tau), alpha_x, alpha_tau, alpha_z, alpha_kappa])
+
+
+def _get_delta_batched(A, b, c, x, y, z, tau, kappa, normal_equations=None):
+    """
+    Batched implementation of _get_delta with the options used by solveLP
+    (predictor-corrector, no initial point improvement).
+    Each instance is a row of c, x, y, z and an entry of tau, kappa.
+    normal_equations : sparse_normal_equations of A, if A is sparse
+    """
+    n_x = x.shape[1]
+
+    # [4] Equation 8.8
+    r_P = b * tau[:, None] - _matvec(A, x)
+    r_D = c * tau[:, None] - _rmatvec(A, y) - z
+    r_G = (c * x).sum(1) - y.dot(b) + kappa
+    mu = ((x * z).sum(1) + tau * kappa) / (n_x + 1)
+
+    #  Assemble M from [4] Equation 8.31 and factorize
+    Dinv = x / z
+    solve = _get_normal_solver(A, Dinv, 0., normal_equations)
+
+    # [4] Equation 8.28, this does not change between predictor and corrector
+    q = solve((b + _matvec(A, Dinv * c))[:, :, None])[:, :, 0]
+    p = Dinv * (_rmatvec(A, q) - c)
+
+    gamma = np.zeros_like(tau)
+    d_x, d_z, d_tau, d_kappa = 0, 0, 0, 0
+    for i in range(2):
+        # Reference [4] Eq. 8.6
+        rhatp = (1 - gamma)[:, None] * r_P
+        rhatd = (1 - gamma)[:, None] * r_D
+        rhatg = (1 - gamma) * r_G
+
+        # Reference [4] Eq. 8.7 and for the corrector Eq. 8.13
+        rhatxs = (gamma * mu)[:, None] - x * z - d_x * d_z
+        rhattk = gamma * mu - tau * kappa - d_tau * d_kappa
+
+        # [4] Equation 8.29
+        r1 = rhatd - (1 / x) * rhatxs
+        v = solve((rhatp + _matvec(A, Dinv * r1))[:, :, None])[:, :, 0]
+        u = Dinv * (_rmatvec(A, v) - r1)
+
+        # [4] Results after 8.29
+        d_tau = ((rhatg + 1 / tau * rhattk - (-(c * u).sum(1) + v.dot(b))) /
+                 (1 / tau * kappa + (-(c * p).sum(1) + q.dot(b))))
+        d_x = u + p * d_tau[:, None]
+        d_y = v + q * d_tau[:, None]
+
+        # [4] Relations between  after 8.25 and 8.26
+        d_z = (1 / x) * (rhatxs - z * d_x)
+        d_kappa = 1 / tau * (rhattk - kappa * d_tau)
+
+        # [4] 8.12 and "Let alpha be the maximal possible step..." before 8.23
+        alpha = _get_step_batched(x, d_x, z, d_z, tau, d_tau, kappa, d_kappa, 1)
+        beta1 = 0.1  # [4] pg. 220 (Table 8.1)
+        gamma = (1 - alpha)**2 * np.minimum(beta1, (1 - alpha))
+
+    return d_x, d_y, d_z, d_tau, d_kappa
+
+
+def _indicators_batched(A, b, c, x, y, z, tau, kappa):
+    """
+    Batched implementation of _indicators, [4] Section 4.5
+    """
+    n_x = x.shape[1]
+    norm = lambda a: np.linalg.norm(a, axis=-1)
+
+    # residuals for termination are relative to the blind start
+    r_p0 = norm(b - np.asarray(A.sum(1)).ravel())
+    r_d0 = norm(c - 1)
+    r_g0 = np.abs(1 + c.sum(1))
+    mu_0 = 1.
+
+    by = y.dot(b)
+    rho_A = np.abs((c * x).sum(1) - by) / (tau + np.abs(by))
+    rho_p = norm(b * tau[:, None] - _matvec(A, x)) / max(1, r_p0)
+    rho_d = norm(c * tau[:, None] - _rmatvec(A, y) - z) / np.maximum(1, r_d0)
+    rho_g = np.abs(kappa + (c * x).sum(1) - by) / np.maximum(1, r_g0)
+    rho_mu = ((x * z).sum(1) + tau * kappa) / (n_x + 1) / mu_0
+    return rho_p, rho_d, rho_A, rho_g, rho_mu
+
+
+def _get_warm_start(x, y, z, tau, kappa, mu, blend=0.1):
+    """
+    Starting point built from previous iterates (x, y, z, tau, kappa) of the
+    same instances. The iterates are normalized to tau = 1, moved by the
+    fraction blend towards the blind start of [4] 4.4 and centred: in every
+    complementary pair the smaller member is raised so that the product is at
+    least mu, which brings the point back into the interior while keeping the
+    larger members, i.e. the previous solution, nearly unchanged.
+    mu : 1D array or scalar
+    """
+    mu = np.broadcast_to(mu, tau.shape)
+    x, y, z, kappa = x / tau[:, None], y / tau[:, None], z / tau[:, None], kappa / tau
+    x, y, z = (1 - blend) * x + blend, (1 - blend) * y, (1 - blend) * z + blend
+    kappa = (1 - blend) * kappa + blend
+    x_small = x < z
+    x = np.where(x_small, np.maximum(x, mu[:, None] / z), x)
+    z = np.where(x_small, z, np.maximum(z, mu[:, None] / x))
+    kappa = np.maximum(kappa, mu)
+    return x, y, z, np.ones_like(tau), kappa
+
+
+def solveLP_batched(c, A, b, thr, tol=1e-6, maxiter=1000, alpha0=.99995,
+        return_solver=False, damping=0., normal_equations=None, start=None):
+    '''
+    Solve a batch of LPs  min c[i] @ x  s.t. A @ x == b, x >= 0
+    c : 2D numpy array (batch_size, n)
+    A : 2D numpy array or scipy sparse matrix (m, n)
+    b : 1D numpy array (m,)
+    normal_equations : sparse_normal_equations of A, to reuse its ordering across calls.
+        Created here if A is sparse and it is not given.
+    start : optional starting point (x, y, z, tau, kappa), e.g. from _get_warm_start;
+        the default is the blind start of every instance.
+    Returns x, y, z, tau, kappa, mu and the number of iterations, each with the batch as leading dimension.
+    If return_solver is True, additionally return the handle of _get_batched_solver
+    for A X Z^{-1} A.T + damping I at the final iterates.
+    '''
+    batch_size, n_x = c.shape
+    m = A.shape[0]
+
+    if start is None:
+        # default initial point
+        x, z = np.ones((batch_size, n_x)), np.ones((batch_size, n_x))
+        y = np.zeros((batch_size, m))
+        tau, kappa = np.ones(batch_size), np.ones(batch_size)
+    else:
+        x, y, z, tau, kappa = (np.array(v, dtype=float) for v in start)
+    mu = ((x * z).sum(1) + tau * kappa) / (n_x + 1)
+    iterations = np.zeros(batch_size, dtype=int)
+    if sps.issparse(A) and normal_equations is None:
+        normal_equations = sparse_normal_equations(A)
+
+    # [4] 4.5
+    rho_p, rho_d, rho_A, rho_g, rho_mu = _indicators_batched(
+        A, b, c, x, y, z, tau, kappa)
+    active = (rho_p > tol) | (rho_d > tol) | (rho_A > tol)
+
+    while np.any(active):
+        idx = np.flatnonzero(active)
+        iterations[idx] += 1
+        c_, x_, y_, z_, tau_, kappa_ = c[idx], x[idx], y[idx], z[idx], tau[idx], kappa[idx]
+
+        # Solve [4] 8.6 and 8.7/8.13
+        d_x, d_y, d_z, d_tau, d_kappa = _get_delta_batched(
+            A, b, c_, x_, y_, z_, tau_, kappa_, normal_equations)
+        # [4] Section 4.3
+        alpha = _get_step_batched(x_, d_x, z_, d_z, tau_,
+                                  d_tau, kappa_, d_kappa, alpha0)
+        # [4] Equation 8.9
+        x_ = x_ + alpha[:, None] * d_x
+        y_ = y_ + alpha[:, None] * d_y
+        z_ = z_ + alpha[:, None] * d_z
+        tau_ = tau_ + alpha * d_tau
+        kappa_ = kappa_ + alpha * d_kappa
+        x[idx], y[idx], z[idx], tau[idx], kappa[idx] = x_, y_, z_, tau_, kappa_
+
+        # [4] 4.5
+        rho_p, rho_d, rho_A, rho_g, rho_mu = _indicators_batched(
+            A, b, c_, x_, y_, z_, tau_, kappa_)
+        mu[idx] = ((x_ * z_).sum(1) + tau_ * kappa_) / (n_x + 1)
+        go = ((rho_p > tol) | (rho_d > tol) | (rho_A > tol)) & (mu[idx] > thr)
+
+        # [4] 4.5, infeasible or unbounded instances are stopped as well
+        inf1 = ((rho_p < tol) & (rho_d < tol) & (rho_g < tol) &
+                (tau_ < tol * np.maximum(1, kappa_)))
+        inf2 = (rho_mu < tol) & (tau_ < tol * np.minimum(1, kappa_))
+        active[idx] = go & ~(inf1 | inf2) & (iterations[idx] < maxiter)
+
+    if return_solver:
+        return x, y, z, tau, kappa, mu, iterations, _get_normal_solver(A, x / z, damping, normal_equations)
+    # [4] Statement after Theorem 8.2
+    return x, y, z, tau, kappa, mu, iterations
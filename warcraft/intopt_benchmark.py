@@ -0,0 +1,46 @@
+'''
+Memory and time of the dense and the sparse mode of IntoptDifflayer, one forward and backward pass over a batch
+of random weight maps of the warcraft shortest path:
+    python intopt_benchmark.py --img_size 12 --batch_size 8
+Each mode runs in its own process; the peak resident memory includes building the layer.
+The dense mode removes the redundant rows the sparse mode removes, so both solve the same standard form.
+Nothing is written to disk, the standard form is not cached.
+'''
+import argparse
+import multiprocessing
+import resource
+import time
+import warnings
+import torch
+from Trainer.diff_layer import IntoptDifflayer
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--img_size", type=int, help="size of the weight maps", default= 12, required=False)
+parser.add_argument("--batch_size", type=int, help="batch size", default= 8, required=False)
+parser.add_argument("--thr", type=float, help="threshold parameter", default= 1e-6)
+parser.add_argument("--damping", type=float, help="damping parameter", default= 1e-3)
+
+def run(args, sparse, queue):
+    torch.manual_seed(0)
+    start = time.time()
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        layer = IntoptDifflayer((args.img_size, args.img_size), thr=args.thr, damping=args.damping, sparse=sparse, rr_method="pivot_sparse")
+        weights = torch.rand(args.batch_size, args.img_size, args.img_size, requires_grad=True)
+        solve_start = time.time()
+        layer(weights).sum().backward()
+    end = time.time()
+    queue.put((solve_start - start, end - solve_start,
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    print("grid {}x{}, batch size {}".format(args.img_size, args.img_size, args.batch_size))
+    for sparse in [False, True]:
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run, args=(args, sparse, queue))
+        process.start()
+        setup_time, solve_time, peak = queue.get()
+        process.join()
+        print("{:6s} setup {:7.2f}s  forward+backward {:7.2f}s  peak rss {:8.0f} MB".format(
+            "sparse" if sparse else "dense", setup_time, solve_time, peak))